@@ -1,14 +1,144 @@
 from PIL import Image, ImageDraw, ImageFont
+import cv2
 import json
+import numpy as np
+import os
+
+from layout import Layout
+
+def blend_tile(canvas, tile, x, y):
+    """
+    アルファ乗算済みのタイルを画像バッファ (NumPy 配列) の (x, y) にその場で合成する
+
+    画像の端からはみ出す部分は切り捨てる。
+
+    Args:
+        canvas: 合成先の画像バッファ (uint8, 高さx幅x3 または 高さx幅x4)
+        tile:   layout.premultiply_mark() で作成したタイル
+        x, y:   タイル左上の位置
+    """
+    premultiplied, alpha = tile
+    tile_height, tile_width = alpha.shape[:2]
+    height, width = canvas.shape[:2]
+
+    # 画像の範囲内に収まる部分だけを求める
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + tile_width, width), min(y + tile_height, height)
+    if x0 >= x1 or y0 >= y1:
+        return
+    tile_rows = slice(y0 - y, y1 - y)
+    tile_cols = slice(x0 - x, x1 - x)
+    a = alpha[tile_rows, tile_cols]
+    region = canvas[y0:y1, x0:x1]
+
+    # out = src (アルファ乗算済み) + dst * (1 - a)
+    rgb = region[..., :3]
+    rgb[...] = premultiplied[tile_rows, tile_cols] + rgb * (1.0 - a) + 0.5
+    if canvas.shape[2] == 4: # 透明度も "over" 合成
+        region[..., 3:4] = a * 255.0 + region[..., 3:4] * (1.0 - a) + 0.5
+
+
+def decode_to_array(image_path, output_mode="RGBA"):
+    """
+    画像ファイルを書き込み可能な NumPy 配列 (RGB / RGBA) に直接デコードする
+
+    OpenCV でデコードした配列をそのまま使うため、PIL Image を経由する場合より
+    画像 1 枚分のコピーが少ない。(日本語を含むパスでも読めるよう imdecode を使う)
+
+    Returns:
+        numpy.ndarray: uint8 の配列 (OpenCV でデコードできない形式の場合は None)
+    """
+    flags = (cv2.IMREAD_UNCHANGED if output_mode == "RGBA" else cv2.IMREAD_COLOR) | cv2.IMREAD_IGNORE_ORIENTATION
+    canvas = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), flags)
+    if canvas is None or canvas.dtype != np.uint8:
+        return None # GIF や 16bit 画像などは PIL で読み込む
+
+    if canvas.ndim == 2: # グレースケール
+        return cv2.cvtColor(canvas, cv2.COLOR_GRAY2RGBA if output_mode == "RGBA" else cv2.COLOR_GRAY2RGB)
+    if output_mode == "RGBA":
+        if canvas.shape[2] == 4:
+            return cv2.cvtColor(canvas, cv2.COLOR_BGRA2RGBA, dst=canvas) # その場で並べ替え
+        return cv2.cvtColor(canvas, cv2.COLOR_BGR2RGBA)
+    return cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB, dst=canvas) # その場で並べ替え
+
+
+def composite_marks(base_image, layout, results, output_mode="RGBA", transform=None):
+    """
+    画像に〇✕マークを NumPy で合成する関数
+
+    元画像を 1 枚分の NumPy 配列として用意し、マークの範囲だけをその場で書き換える。
+    (全面の alpha_composite や合成用の透明画像は作らない)
+
+    Args:
+        base_image:  元画像 (ファイルパス、PIL Image、または decode_to_array() で作成した配列)
+        layout:      layout.Layout
+        results:     問題番号と正誤結果の辞書
+        output_mode: "RGBA" または "RGB" (透明度が不要な場合は "RGB" の方が速く、保存も小さい)
+        transform:   正解位置をシート上の位置に変換する関数 (registration.Registration.transform_point など)
+    Returns:
+        Image: マークが合成されたPIL Imageオブジェクト
+    """
+    canvas = None
+    if isinstance(base_image, np.ndarray):
+        canvas = base_image
+    elif not isinstance(base_image, Image.Image):
+        canvas = decode_to_array(base_image, output_mode)
+        if canvas is None:
+            base_image = Image.open(base_image)
+    if canvas is None: # PIL Image から書き込み可能なコピーを作る
+        if base_image.mode != output_mode:
+            base_image = base_image.convert(output_mode)
+        canvas = np.array(base_image)
+        del base_image # 変換後の画像はここで不要になる
+
+    for tile, (x, y) in layout.tile_placements(results, transform):
+        blend_tile(canvas, tile, x, y)
+
+    height, width = canvas.shape[:2]
+    return Image.frombuffer(output_mode, (width, height), canvas, "raw", output_mode, 0, 1) # 配列をコピーせずに画像化
+
+
+def add_marks_with_layout(image_path, layout, results, output_mode="RGBA", transform=None):
+    """
+    読み込み済みの Layout を使って、正誤結果に応じて画像に〇または✕マークを合成する関数
+
+    位置情報JSONとマーク画像は Layout 作成時に 1 回だけ読み込まれるため、
+    複数のシートを続けて処理する場合はこちらを使う。
+
+    Args:
+        image_path:  元の計算問題画像のファイルパス (または PIL Image オブジェクト)
+        layout:      layout.Layout (位置情報とマーク画像)
+        results:     問題番号と正誤結果の辞書 (例: {"1": True, "2": False, ...})
+        output_mode: 出力画像のモード ("RGBA" または "RGB")
+        transform:   正解位置をシート上の位置に変換する関数 (位置合わせでずれ・傾きを補正する場合)
+    Returns:
+        Image: マークが合成されたPIL Imageオブジェクト (合成失敗時は None)
+    """
+    try:
+        # 画像を読み込み、事前計算済みの貼り付け位置に〇または✕を合成
+        if not isinstance(image_path, Image.Image) and not os.path.exists(image_path):
+            raise FileNotFoundError(image_path)
+        return composite_marks(image_path, layout, results, output_mode, transform)
+
+    except FileNotFoundError as e:
+        print(f"ファイルが見つかりません: {e}")
+        return None
+    except Exception as e:
+        print(f"予期せぬエラーが発生しました: {e}")
+        return None
+
 
 def add_marks_from_json(image_path, json_path, results, correct_mark_path="circle_red.png", incorrect_mark_path="cross_red.png"):
     """
     JSONファイルに定義された位置情報に基づいて、
     正誤結果（results）に応じて画像に〇または✕マークを合成する関数
 
+    1 枚だけ処理する場合向け。複数枚を処理する場合は Layout.load() で
+    読み込んだ Layout を add_marks_with_layout() に渡す方が速い。
+
     Args:
         image_path: 	元の計算問題画像のファイルパス
-        json_path: 	 位置情報が記述されたJSONファイルのファイルパス
+        json_path: 	 位置情報が記述されたJSONファイルのファイルパス (読み込み済みの Layout も可)
         results: 		問題番号と正誤結果の辞書 (例: {1: True, 2: False, 3: True, ...})
                         True: 正解, False: 不正解
         correct_mark_path: 正解マーク画像 (〇) のファイルパス (PNG推奨)
@@ -16,43 +146,12 @@ def add_marks_from_json(image_path, json_path, results, correct_mark_path="circl
     Returns:
         Image: マークが合成されたPIL Imageオブジェクト (合成失敗時は None)
     """
-    try:
-        # 1. JSONファイルの読み込み
-        with open(json_path, 'r', encoding='utf-8') as f:
-            position_data = json.load(f)
-
-        # 2. 画像とマーク画像の読み込み
-        base_image = Image.open(image_path).convert("RGBA") # 元画像をRGBAで読み込み (透明度対応)
-        mark_image_correct = Image.open(correct_mark_path).convert("RGBA") # 〇画像
-        mark_image_incorrect = Image.open(incorrect_mark_path).convert("RGBA") # ✕画像
-
-        # デバッグ用: 画像のモードとサイズを確認
-        print(f"base_image mode: {base_image.mode}, size: {base_image.size}")
-        print(f"mark_image_correct mode: {mark_image_correct.mode}, size: {mark_image_correct.size}")
-        print(f"mark_image_incorrect mode: {mark_image_incorrect.mode}, size: {mark_image_incorrect.size}")
-
-        # 3. 合成用透明RGBA画像を作成し、元画像をペースト
-        合成画像 = Image.new("RGBA", base_image.size, (0, 0, 0, 0)) # 透明RGBA画像
-        合成画像 = Image.alpha_composite(合成画像, base_image) # 元画像を合成
-
-        # 4. JSONの位置情報に基づいて、〇または✕を合成
-        for problem_info in position_data["問題位置情報"]:
-            problem_number = problem_info["問題番号"]
-            correct_position = problem_info["正解位置"] # 正解位置のみ使用 (〇と✕で同じ位置)
-
-            # 問題番号を文字列に変換してから results を参照するように修正
-            problem_number_str = str(problem_number)
-            if problem_number_str in results:
-                is_correct = results[problem_number_str] # 正誤結果を取得
-                mark_to_use = mark_image_correct if is_correct else mark_image_incorrect # 使用するマーク画像を選択
-                position = (correct_position["x"] - mark_to_use.width // 2,
-                            correct_position["y"] - mark_to_use.height // 2) # 中心を位置合わせ
-
-                合成画像.paste(mark_to_use, position, mask=mark_to_use) # アルファマスク合成 (paste のみを使用)
-
-
-        return 合成画像 # 合成後のPIL Imageオブジェクトを返す
+    if isinstance(json_path, Layout):
+        return add_marks_with_layout(image_path, json_path, results)
 
+    try:
+        # JSONファイルとマーク画像の読み込み
+        layout = Layout.load(json_path, correct_mark_path, incorrect_mark_path)
     except FileNotFoundError as e:
         print(f"ファイルが見つかりません: {e}")
         return None
@@ -63,6 +162,8 @@ def add_marks_from_json(image_path, json_path, results, correct_mark_path="circl
         print(f"予期せぬエラーが発生しました: {e}")
         return None
 
+    return add_marks_with_layout(image_path, layout, results)
+
 
 # --- 実行例 ---
 if __name__ == "__main__":
@@ -0,0 +1,339 @@
+import json
+import statistics
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+METHODS = ("auto", "boxes", "equals") # 検出方法 (auto は解答欄の枠と「=」のうち多く見つかった方を使う)
+ORDERS = ("rows", "columns") # 問題番号の付け方 (rows: 上の行から左→右, columns: 左の列から上→下)
+DEFAULT_MAX_SIDE = 2000 # 長辺がこれより大きい画像は縮小して検出する (1 ページ 1 秒未満に収めるため)
+INK_THRESHOLD = 160 # これより暗い画素だけを文字・枠線とみなす (薄いグリッド線を無視する)
+
+
+def load_gray(image):
+    """
+    画像ファイルのパスまたは PIL Image をグレースケールの配列にする (透明部分は白とみなす)
+
+    Returns:
+        numpy.ndarray: グレースケール画像 (uint8, 高さx幅)
+    """
+    if isinstance(image, str):
+        image = Image.open(image)
+    if "A" in image.getbands() or "transparency" in image.info:
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image.convert("RGBA"))
+    return np.asarray(image.convert("L"))
+
+
+def binarize(gray):
+    """
+    文字・枠線を白, 背景を黒にした 2値画像を返す (大津の閾値, ただし INK_THRESHOLD より明るい画素は背景)
+
+    グリッド線付きの画像ではグリッド線が文字の上に描かれて文字が 1 画素幅で切れるため、小さな切れ目をつなぐ。
+    """
+    threshold, _ = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    _, binary = cv2.threshold(gray, min(threshold, INK_THRESHOLD), 255, cv2.THRESH_BINARY_INV)
+    return cv2.morphologyEx(binary, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8)) # グリッド線で切れた文字をつなぐ
+
+
+def find_components(binary):
+    """
+    2値画像の連結成分 (小さなノイズを除く) を返す
+
+    Returns:
+        list: (x1, y1, x2, y2) のリスト
+    """
+    count, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    return [(int(x), int(y), int(x + w), int(y + h)) for x, y, w, h, area in stats[1:count] if area >= 4]
+
+
+def _text_height(components):
+    """文字の高さの目安 (連結成分の高さの中央値, 横線などの低い成分は除く)"""
+    heights = [y2 - y1 for x1, y1, x2, y2 in components if (y2 - y1) * 2.5 >= x2 - x1]
+    return statistics.median(heights) if heights else 12
+
+
+def _union(boxes):
+    """矩形のリストを囲む矩形"""
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+def _contains(outer, inner):
+    """outer が inner の中心を含むか"""
+    cx = (inner[0] + inner[2]) / 2
+    cy = (inner[1] + inner[3]) / 2
+    return outer[0] <= cx <= outer[2] and outer[1] <= cy <= outer[3]
+
+
+def detect_answer_boxes(binary, components=None):
+    """
+    罫線で囲まれた解答欄 (四角い枠) を検出する
+
+    縦横の長い線だけを取り出し (モルフォロジーのオープニング)、線で囲まれた穴のうち
+    ほぼ長方形で、文字より大きくページの 1/5 より小さいものを解答欄とみなす。
+    他の枠を含む枠 (表の外枠など) は除く。
+
+    Returns:
+        list: 解答欄 (x1, y1, x2, y2) のリスト
+    """
+    height, width = binary.shape
+    components = find_components(binary) if components is None else components
+    min_side = max(12, 1.2 * _text_height(components))
+    horizontal = cv2.morphologyEx(binary, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (max(8, width // 40), 1)))
+    vertical = cv2.morphologyEx(binary, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(8, height // 40))))
+    lines = cv2.dilate(cv2.bitwise_or(horizontal, vertical), np.ones((3, 3), np.uint8)) # 角の小さな切れ目をつなぐ
+
+    contours, hierarchy = cv2.findContours(lines, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for contour, info in zip(contours, hierarchy[0] if hierarchy is not None else []):
+        if info[3] == -1:
+            continue # 線の外側の輪郭 (穴 = 枠の内側だけを見る)
+        x, y, w, h = cv2.boundingRect(contour)
+        if w < min_side or h < min_side or w * h > width * height / 5:
+            continue
+        if cv2.contourArea(contour) < 0.85 * w * h:
+            continue # 長方形でない穴
+        boxes.append((x, y, x + w, y + h))
+    return [box for box in boxes if not any(other is not box and _contains(box, other) for other in boxes)]
+
+
+def find_equals_signs(components):
+    """
+    連結成分から「=」(同じ幅の横棒が上下に 2 本並んだもの) を探す
+
+    Returns:
+        list: 「=」(x1, y1, x2, y2) のリスト
+    """
+    bars = sorted((c for c in components if c[2] - c[0] >= 4 and c[2] - c[0] >= 2.5 * (c[3] - c[1])), key=lambda c: c[1])
+    used = set()
+    signs = []
+    for i, upper in enumerate(bars):
+        if i in used:
+            continue
+        upper_width = upper[2] - upper[0]
+        for j in range(i + 1, len(bars)):
+            lower = bars[j]
+            gap = lower[1] - upper[3]
+            if gap > upper_width:
+                break # これより下の横棒は離れすぎ (y でソート済み)
+            lower_width = lower[2] - lower[0]
+            if j in used or gap < 1:
+                continue
+            if abs(upper[0] - lower[0]) <= 0.25 * upper_width and abs(upper_width - lower_width) <= 0.3 * max(upper_width, lower_width):
+                signs.append(_union([upper, lower]))
+                used.update((i, j))
+                break
+    return signs
+
+
+def _same_line(components, anchor, line_height):
+    """anchor と同じ行 (縦方向の中心が近い) にある連結成分"""
+    center_y = (anchor[1] + anchor[3]) / 2
+    return [c for c in components if abs((c[1] + c[3]) / 2 - center_y) <= 0.75 * line_height]
+
+
+def _extend_left(line_components, anchor, line_height, obstacles):
+    """
+    anchor から左へ、間隔が文字 2 個分以内で続く連結成分 (問題文) をたどり、問題文を含む矩形を返す
+    (anchor と問題文の間は空いていることが多いため、最初の間隔だけは文字 6 個分まで許す)
+
+    obstacles (他の問題の解答欄など) に当たったらそこで止める。
+    """
+    extent = list(anchor)
+    for component in sorted((c for c in line_components if c[2] <= anchor[0]), key=lambda c: -c[2]):
+        if extent[0] - component[2] > (6 if extent[0] == anchor[0] else 2) * line_height:
+            break
+        if any(_contains(obstacle, component) or _contains(component, obstacle) for obstacle in obstacles):
+            break
+        extent[0] = min(extent[0], component[0])
+        extent[1] = min(extent[1], component[1])
+        extent[3] = max(extent[3], component[3])
+    return tuple(extent)
+
+
+def _pad(box, padding, width, height):
+    """矩形を padding だけ広げる (画像の範囲内に収める)"""
+    return (max(0, int(box[0] - padding)), max(0, int(box[1] - padding)),
+            min(width, int(box[2] + padding)), min(height, int(box[3] + padding)))
+
+
+def propose_from_boxes(binary, components):
+    """
+    解答欄の枠から候補を作る (正解位置 = 枠の中心, 問題領域 = 枠と左側の問題文)
+
+    Returns:
+        list: (正解位置 (x, y), 問題領域 (x1, y1, x2, y2)) のリスト
+    """
+    height, width = binary.shape
+    boxes = detect_answer_boxes(binary, components)
+    # 枠線そのものと枠の中の文字 (記入済みの答え) は問題文として扱わない
+    text_components = [c for c in components
+                       if not any(_contains(c, box) or _contains(box, c) for box in boxes)]
+    proposals = []
+    for box in boxes:
+        line_height = box[3] - box[1]
+        line_components = _same_line(text_components, box, line_height)
+        region = _extend_left(line_components, box, _text_height(line_components) if line_components else line_height,
+                              [other for other in boxes if other is not box])
+        center = ((box[0] + box[2]) // 2, (box[1] + box[3]) // 2)
+        proposals.append((center, _pad(region, 4, width, height)))
+    return proposals
+
+
+def propose_from_equals(binary, components):
+    """
+    「=」の位置から候補を作る (正解位置 = 「=」の右の答え, 問題領域 = 問題文から答えまで)
+
+    「=」の右に文字があれば (記入例のあるシート) その中心を、なければ (空欄のシート)
+    「=」の右の文字 1.5 個分の位置を正解位置とする。
+
+    Returns:
+        list: (正解位置 (x, y), 問題領域 (x1, y1, x2, y2)) のリスト
+    """
+    height, width = binary.shape
+    signs = find_equals_signs(components)
+    sign_parts = [c for c in components if any(_contains(sign, c) for sign in signs)]
+    text_components = [c for c in components if c not in sign_parts]
+    proposals = []
+    answers = []
+    for sign in signs:
+        sign_width = sign[2] - sign[0]
+        nearby = _same_line(text_components, sign, 2 * sign_width)
+        line_height = _text_height(nearby) if nearby else 1.5 * sign_width
+        line_components = _same_line(text_components, sign, line_height)
+
+        answer = []
+        for component in sorted((c for c in line_components if c[0] >= sign[2]), key=lambda c: c[0]):
+            previous_end = answer[-1][2] if answer else sign[2]
+            if component[0] - previous_end > (3 if not answer else 1) * line_height:
+                break
+            answer.append(component)
+        center_y = (sign[1] + sign[3]) / 2
+        if answer:
+            answer_box = _union(answer)
+        else: # 空欄: 「=」の右に文字 2 個分の欄があるとみなす
+            answer_box = (sign[2] + 0.5 * line_height, center_y - line_height / 2,
+                          sign[2] + 2.5 * line_height, center_y + line_height / 2)
+        answers.append(answer_box)
+        proposals.append((sign, answer_box, line_components, line_height))
+
+    results = []
+    for sign, answer_box, line_components, line_height in proposals:
+        others = [other for other in answers if other is not answer_box]
+        question = _extend_left(line_components, sign, line_height, others)
+        region = _union([question, answer_box])
+        center = (int((answer_box[0] + answer_box[2]) / 2), int((answer_box[1] + answer_box[3]) / 2))
+        results.append((center, _pad(region, 0.25 * line_height, width, height)))
+    return results
+
+
+def order_proposals(proposals, order="rows"):
+    """
+    候補を問題番号の順に並べる
+
+    rows は上の行から順に各行を左→右、columns は左の列から順に各列を上→下。
+    正解位置の縦 (columns では横) の差が問題領域の高さ (幅) の半分以内なら同じ行 (列) とみなす。
+    """
+    axis = 1 if order == "rows" else 0 # 行・列を分ける軸
+    if not proposals:
+        return []
+    tolerance = statistics.median(region[axis + 2] - region[axis] for _, region in proposals) / 2
+    remaining = sorted(proposals, key=lambda p: p[0][axis])
+    ordered = []
+    while remaining:
+        first = remaining[0][0][axis]
+        line = [p for p in remaining if p[0][axis] - first <= tolerance]
+        remaining = [p for p in remaining if p[0][axis] - first > tolerance]
+        ordered.extend(sorted(line, key=lambda p: p[0][1 - axis]))
+    return ordered
+
+
+def detect_layout(image, method="auto", order="rows", max_side=DEFAULT_MAX_SIDE):
+    """
+    テンプレート画像から解答位置を検出し、位置情報JSONの形の候補を作る
+
+    Args:
+        image:    画像ファイルのパスまたは PIL Image (記入前のシート, またはグリッド線付きのシート)
+        method:   検出方法 (METHODS)
+        order:    問題番号の付け方 (ORDERS)
+        max_side: 長辺がこれより大きい画像は縮小して検出する (座標は元画像の大きさに戻す)
+
+    Returns:
+        tuple: (位置情報の辞書 ({"問題位置情報": [...]}, 各問題に「問題領域」付き), 使った検出方法)
+    """
+    gray = load_gray(image)
+    scale = 1.0
+    if max(gray.shape) > max_side:
+        scale = max_side / max(gray.shape)
+        gray = cv2.resize(gray, (round(gray.shape[1] * scale), round(gray.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+    binary = binarize(gray)
+    components = find_components(binary)
+
+    candidates = {}
+    if method in ("auto", "boxes"):
+        candidates["boxes"] = propose_from_boxes(binary, components)
+    if method in ("auto", "equals"):
+        candidates["equals"] = propose_from_equals(binary, components)
+    used_method = max(candidates, key=lambda name: len(candidates[name])) # 同数なら枠を優先 (先に追加した方)
+
+    problems = []
+    for number, (center, region) in enumerate(order_proposals(candidates[used_method], order), start=1):
+        problems.append({
+            "問題番号": number,
+            "正解位置": {"x": round(center[0] / scale), "y": round(center[1] / scale)},
+            "問題領域": {"x1": round(region[0] / scale), "y1": round(region[1] / scale),
+                         "x2": round(region[2] / scale), "y2": round(region[3] / scale)},
+        })
+    return {"問題位置情報": problems}, used_method
+
+
+def draw_preview(image, position_data):
+    """
+    検出結果を画像に描いて確認用の画像を作る (問題領域は青枠, 正解位置は赤丸と問題番号)
+
+    Returns:
+        PIL.Image: 確認用の画像 (RGB)
+    """
+    canvas = cv2.cvtColor(load_gray(image), cv2.COLOR_GRAY2BGR)
+    for problem_info in position_data["問題位置情報"]:
+        region = problem_info.get("問題領域")
+        if region:
+            cv2.rectangle(canvas, (region["x1"], region["y1"]), (region["x2"], region["y2"]), (255, 0, 0), 1)
+        x, y = problem_info["正解位置"]["x"], problem_info["正解位置"]["y"]
+        cv2.circle(canvas, (x, y), 6, (0, 0, 255), 2)
+        cv2.putText(canvas, str(problem_info["問題番号"]), (x + 8, y - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1, cv2.LINE_AA)
+    return Image.fromarray(cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB))
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="テンプレート画像から位置情報JSONの候補を自動で作る")
+    parser.add_argument("template", help="テンプレート画像 (記入前のシート, またはグリッド線付きのシート)")
+    parser.add_argument("-o", "--output", default="problem_positions_auto.json", help="位置情報JSONの保存先")
+    parser.add_argument("--method", choices=METHODS, default="auto", help="検出方法 (boxes: 解答欄の枠, equals: 「=」の右)")
+    parser.add_argument("--order", choices=ORDERS, default="rows", help="問題番号の付け方 (rows: 行ごと, columns: 列ごと)")
+    parser.add_argument("--preview", help="検出結果を描いた確認用の画像の保存先")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        detected, detected_by = detect_layout(args.template, args.method, args.order)
+    except (FileNotFoundError, OSError) as e:
+        print(f"画像を読み込めませんでした: {e}", file=sys.stderr)
+        sys.exit(1)
+    elapsed = time.perf_counter() - start
+    problem_count = len(detected["問題位置情報"])
+    print(f"{problem_count} 問を検出しました (検出方法: {detected_by}, {elapsed * 1000:.0f} ms)")
+    if not problem_count:
+        sys.exit(1)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(detected, f, indent=4, ensure_ascii=False)
+    print(f"位置情報を {args.output} に保存しました (position_config_tool.py で読み込んで確認・修正してください)")
+    if args.preview:
+        draw_preview(args.template, detected).save(args.preview)
+        print(f"確認用の画像を {args.preview} に保存しました")
@@ -0,0 +1,90 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+from PIL import Image
+
+from add_marks_to_image import add_marks_with_layout
+from layout import Layout
+
+SHEET_SIZES = [(1000, 1400), (4000, 5600)] # 計測するシートのサイズ (幅, 高さ)
+
+
+def legacy_add_marks(image_path, layout, results):
+    """変更前の合成処理 (透明画像に元画像を alpha_composite してから paste) の再現"""
+    base_image = Image.open(image_path).convert("RGBA")
+    合成画像 = Image.new("RGBA", base_image.size, (0, 0, 0, 0))
+    合成画像 = Image.alpha_composite(合成画像, base_image)
+    for mark_to_use, position in layout.mark_placements(results):
+        合成画像.paste(mark_to_use, position, mask=mark_to_use)
+    return 合成画像
+
+
+IMPLEMENTATIONS = {
+    "legacy (PIL alpha_composite + paste)": lambda path, layout, results: legacy_add_marks(path, layout, results),
+    "numpy (RGBA)": lambda path, layout, results: add_marks_with_layout(path, layout, results, "RGBA"),
+    "numpy (RGB)": lambda path, layout, results: add_marks_with_layout(path, layout, results, "RGB"),
+}
+
+
+def make_synthetic_sheet(sample_path, size, problem_count, work_dir):
+    """サンプル画像を指定サイズに拡大したシートと、問題を格子状に並べた Layout を作る"""
+    sheet_path = os.path.join(work_dir, f"sheet_{size[0]}x{size[1]}.png")
+    with Image.open(sample_path) as sample:
+        sample.convert("RGB").resize(size, Image.BILINEAR).save(sheet_path)
+
+    columns = 4
+    rows = (problem_count + columns - 1) // columns
+    problems = []
+    for i in range(problem_count):
+        x = int((i % columns + 0.75) * size[0] / columns)
+        y = int((i // columns + 0.5) * size[1] / rows)
+        problems.append({"問題番号": i + 1, "正解位置": {"x": x, "y": y}})
+    results = {str(i + 1): i % 3 != 0 for i in range(problem_count)}
+    return sheet_path, {"問題位置情報": problems}, results
+
+
+def _measure(queue, name, sheet_path, position_data, results, correct_mark_path, incorrect_mark_path, repeat):
+    """子プロセスで 1 つの実装を計測する (最大常駐メモリを実装ごとに分けて測るため)"""
+    layout = Layout(position_data, Image.open(correct_mark_path).convert("RGBA"),
+                    Image.open(incorrect_mark_path).convert("RGBA"))
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        marked_image = IMPLEMENTATIONS[name](sheet_path, layout, results)
+        elapsed.append(time.perf_counter() - start)
+        del marked_image
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((min(elapsed), sum(elapsed) / len(elapsed), (peak_kb - baseline_kb) / 1024))
+
+
+def run_benchmark(sample_path, correct_mark_path, incorrect_mark_path, problem_count, repeat):
+    context = multiprocessing.get_context("spawn") # 親プロセスのメモリ使用量の影響を受けないようにする
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in SHEET_SIZES:
+            sheet_path, position_data, results = make_synthetic_sheet(sample_path, size, problem_count, work_dir)
+            print(f"--- {size[0]}x{size[1]} ({problem_count} 問, {repeat} 回) ---")
+            for name in IMPLEMENTATIONS:
+                queue = context.Queue()
+                process = context.Process(target=_measure, args=(queue, name, sheet_path, position_data, results,
+                                                                 correct_mark_path, incorrect_mark_path, repeat))
+                process.start()
+                best, average, peak_mb = queue.get()
+                process.join()
+                print(f"  {name:<38} 最小 {best * 1000:8.1f} ms  平均 {average * 1000:8.1f} ms  "
+                      f"ピークメモリ増加 {peak_mb:8.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="〇×マーク合成処理のベンチマーク (処理時間とピークメモリ)")
+    parser.add_argument("--sample", default="keisan_problem.png", help="シートの元にするサンプル画像")
+    parser.add_argument("--correct-mark", default="circle_red.png", help="正解マーク画像 (〇)")
+    parser.add_argument("--incorrect-mark", default="cross_red.png", help="不正解マーク画像 (✕)")
+    parser.add_argument("--problems", type=int, default=40, help="1 シートあたりの問題数")
+    parser.add_argument("--repeat", type=int, default=5, help="計測回数")
+    args = parser.parse_args()
+
+    run_benchmark(args.sample, args.correct_mark, args.incorrect_mark, args.problems, args.repeat)
@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import cv2
+import numpy as np
+
+import fake_gemini
+import get_gemini_results_json
+from layout import Layout
+from local_grader import HybridGrader, LocalGrader, load_answer_key
+
+_ANSWER_FONTS = [cv2.FONT_HERSHEY_SCRIPT_SIMPLEX, cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX]
+
+
+def make_synthetic_sheets(work_dir, sheet_count, problem_count, wrong_rate, messy_rate, seed):
+    """
+    たし算ドリルの疑似的な解答シートを作る (答えは手書き風のフォントで位置・太さ・傾きをばらつかせる)
+
+    messy_rate の割合の答えには線のかすれや落書きを加え、ローカルでは読み取りにくくする。
+
+    Returns:
+        tuple: (シート画像パスのリスト, 位置情報JSONのパス, 正解キーのパス, シートごとの正しい正誤結果のリスト)
+    """
+    rng = random.Random(seed)
+    row_height = 70
+    width, height = 420, 40 + row_height * problem_count
+    problems = [(rng.randint(1, 49), rng.randint(1, 49)) for _ in range(problem_count)]
+    positions = [{"問題番号": i + 1, "正解位置": {"x": 320, "y": 40 + i * row_height + 10}} for i in range(problem_count)]
+    answer_key = {str(i + 1): str(a + b) for i, (a, b) in enumerate(problems)}
+
+    json_path = os.path.join(work_dir, "positions.json")
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump({"問題位置情報": positions}, f, ensure_ascii=False)
+    answer_key_path = os.path.join(work_dir, "answer_key.json")
+    with open(answer_key_path, 'w', encoding='utf-8') as f:
+        json.dump(answer_key, f)
+
+    sheet_paths = []
+    truths = []
+    for sheet in range(sheet_count):
+        canvas = np.full((height, width), 255, dtype=np.uint8)
+        truth = {}
+        for i, (a, b) in enumerate(problems):
+            y = 40 + i * row_height + 24
+            cv2.putText(canvas, f"({i + 1}) {a} + {b} =", (16, y), cv2.FONT_HERSHEY_SIMPLEX, 0.9, 0, 2, cv2.LINE_AA)
+            answer = a + b
+            if rng.random() < wrong_rate:
+                answer += rng.choice([-10, -1, 1, 10])
+            truth[str(i + 1)] = answer == a + b
+
+            answer_image = np.full((70, 120), 255, dtype=np.uint8)
+            cv2.putText(answer_image, str(answer), (18 + rng.randint(-4, 4), 48 + rng.randint(-3, 3)),
+                        rng.choice(_ANSWER_FONTS), rng.uniform(1.0, 1.3), 0, rng.randint(2, 3), cv2.LINE_AA)
+            rotation = cv2.getRotationMatrix2D((60, 35), rng.uniform(-8, 8), 1.0)
+            answer_image = cv2.warpAffine(answer_image, rotation, (120, 70), borderValue=255)
+            if rng.random() < messy_rate: # 書き直しの跡のような線を重ねる
+                for _ in range(3):
+                    cv2.line(answer_image, (rng.randint(15, 105), rng.randint(15, 55)),
+                             (rng.randint(15, 105), rng.randint(15, 55)), 0, rng.randint(2, 4))
+            canvas[y - 48:y + 22, 260:380] = np.minimum(canvas[y - 48:y + 22, 260:380], answer_image)
+        sheet_path = os.path.join(work_dir, f"sheet_{sheet:03d}.png")
+        cv2.imwrite(sheet_path, canvas)
+        sheet_paths.append(sheet_path)
+        truths.append(truth)
+    return sheet_paths, json_path, answer_key_path, truths
+
+
+def make_fake_api_grader(truth_by_path, latency):
+    """正しい正誤結果を latency 秒後に返す疑似 Gemini API (fake_gemini.FakeGenerativeModel を使用)"""
+    def api_grader(image_path):
+        model = fake_gemini.FakeGenerativeModel(json.dumps(truth_by_path[image_path]), latency=latency, jitter=0.0)
+        return get_gemini_results_json.parse_problem_results(model.generate_content([]).text)
+    return api_grader
+
+
+def run_benchmark(sheet_count, problem_count, wrong_rate, messy_rate, latency, min_confidence, seed):
+    with tempfile.TemporaryDirectory() as work_dir:
+        sheet_paths, json_path, answer_key_path, truths = make_synthetic_sheets(
+            work_dir, sheet_count, problem_count, wrong_rate, messy_rate, seed)
+        truth_by_path = dict(zip(sheet_paths, truths))
+        api_grader = make_fake_api_grader(truth_by_path, latency)
+
+        start = time.perf_counter()
+        local_grader = LocalGrader(Layout.load(json_path), load_answer_key(answer_key_path), min_confidence=min_confidence)
+        setup_seconds = time.perf_counter() - start # 認識器の学習 (起動時に 1 回だけ)
+
+        hybrid = HybridGrader(local_grader, api_grader)
+        elapsed = []
+        local_elapsed = []
+        correct = 0
+        total = 0
+        local_correct = 0
+        for sheet_path in sheet_paths:
+            start = time.perf_counter()
+            local_grader.grade(sheet_path)
+            local_elapsed.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            problem_results = hybrid(sheet_path)
+            elapsed.append(time.perf_counter() - start)
+
+            local_results, _ = local_grader.grade(sheet_path)
+            truth = truth_by_path[sheet_path]
+            local_correct += sum(1 for number, is_correct in local_results.items() if truth[number] == is_correct)
+            correct += sum(1 for number, is_correct in problem_results.items() if truth[number] == is_correct)
+            total += len(truth)
+
+        stats = hybrid.stats
+        print(f"--- {sheet_count} 枚 x {problem_count} 問 (誤答 {wrong_rate:.0%}, 読みにくい答え {messy_rate:.0%}, "
+              f"API 応答 {latency * 1000:.0f} ms, 確信度の下限 {min_confidence}) ---")
+        print(f"  認識器の準備:           {setup_seconds * 1000:8.1f} ms (起動時に 1 回)")
+        print(f"  ローカル読み取り:       平均 {np.mean(local_elapsed) * 1000:8.1f} ms / 枚")
+        print(f"  API のみ (従来):        平均 {latency * 1000:8.1f} ms / 枚 (API 呼び出し {sheet_count} 回)")
+        print(f"  ローカル + API:         平均 {np.mean(elapsed) * 1000:8.1f} ms / 枚 (API 呼び出し {stats['api_sheets']} 回)")
+        print(f"  省略できた API 呼び出し: {hybrid.api_calls_avoided():.0%} "
+              f"(ローカルで判定した問題 {stats['local_problems']} / {stats['local_problems'] + stats['api_problems']})")
+        print(f"  ローカル判定の正確さ:   {local_correct / max(1, stats['local_problems']):.1%}  "
+              f"最終結果の正確さ: {correct / total:.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ローカル採点 (OCR) で省略できる API 呼び出しの割合と 1 枚あたりの処理時間を計測する")
+    parser.add_argument("--sheets", type=int, default=50, help="シート数")
+    parser.add_argument("--problems", type=int, default=10, help="1 シートあたりの問題数")
+    parser.add_argument("--wrong-rate", type=float, default=0.2, help="誤答の割合")
+    parser.add_argument("--messy-rate", type=float, default=0.03, help="読み取りにくい答えの割合")
+    parser.add_argument("--latency", type=float, default=2.0, help="疑似 API の応答時間 (秒)")
+    parser.add_argument("--min-confidence", type=float, default=0.8, help="ローカルで正誤を決める確信度の下限")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+    args = parser.parse_args()
+
+    run_benchmark(args.sheets, args.problems, args.wrong_rate, args.messy_rate, args.latency, args.min_confidence, args.seed)
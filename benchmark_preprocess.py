@@ -0,0 +1,72 @@
+import argparse
+import io
+import os
+import time
+from PIL import Image
+
+from preprocess_image import preprocess_for_upload
+
+
+def encoded_size(image, format_name="PNG"):
+    """画像をエンコードした時のバイト数を返す"""
+    buffer = io.BytesIO()
+    image.save(buffer, format=format_name)
+    return buffer.tell()
+
+
+def measure_api_latency(upload_image):
+    """Gemini API に 1 回リクエストを送り、応答までの時間 (秒) を返す (GEMINI_API_KEY が必要)"""
+    import get_gemini_results_json # --api 指定時のみ使う (Gemini SDK は get_model() の初回に読み込まれる)
+
+    model = get_gemini_results_json.get_model()
+    start = time.perf_counter()
+    response = model.generate_content([get_gemini_results_json.PROMPT_TEXT, upload_image])
+    response.resolve()
+    return time.perf_counter() - start
+
+
+def run_benchmark(image_path, scan_long_edge, max_long_edge, binarize, repeat, with_api):
+    """
+    前処理あり・なしで API に送るデータ量と処理時間を比較する
+
+    scan_long_edge を指定した場合は、サンプル画像をその長辺まで拡大して
+    スマートフォンで撮影した高解像度スキャンを模擬する。
+    """
+    original = Image.open(image_path)
+    original.load()
+    if scan_long_edge and max(original.size) < scan_long_edge:
+        ratio = scan_long_edge / max(original.size)
+        original = original.resize((round(original.width * ratio), round(original.height * ratio)), Image.LANCZOS)
+
+    original_bytes = encoded_size(original)
+
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = preprocess_for_upload(original, max_long_edge=max_long_edge, binarize=binarize)
+        elapsed.append(time.perf_counter() - start)
+
+    print(f"入力画像: {image_path} -> {original.size[0]}x{original.size[1]}")
+    print(f"  前処理なし: {original_bytes:>10,} バイト (PNG)")
+    print(f"  前処理あり: {len(result.payload):>10,} バイト ({result.mime_type}, {result.image.size[0]}x{result.image.size[1]})"
+          f"  削減率 {1 - len(result.payload) / original_bytes:.1%}")
+    print(f"  前処理時間: 平均 {sum(elapsed) / len(elapsed) * 1000:.1f} ms (最小 {min(elapsed) * 1000:.1f} ms, {repeat} 回)")
+
+    if with_api:
+        print(f"  API 応答時間 (前処理なし): {measure_api_latency(original):.2f} 秒")
+        print(f"  API 応答時間 (前処理あり): {measure_api_latency(result.as_blob()):.2f} 秒")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="API 送信前の画像前処理のベンチマーク")
+    parser.add_argument("image", nargs="?", default="keisan_problem.png", help="計算問題画像のファイルパス")
+    parser.add_argument("--scan-long-edge", type=int, default=4000, help="高解像度スキャンを模擬する長辺サイズ (0 で拡大しない)")
+    parser.add_argument("--max-long-edge", type=int, default=1600, help="前処理後の長辺の最大サイズ")
+    parser.add_argument("--binarize", action="store_true", help="二値化して PNG で送る")
+    parser.add_argument("--repeat", type=int, default=5, help="前処理の計測回数")
+    parser.add_argument("--api", action="store_true", help="Gemini API の応答時間も計測する (API キーと通信が必要)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.image):
+        parser.error(f"画像ファイルが見つかりません: {args.image}")
+    run_benchmark(args.image, args.scan_long_edge, args.max_long_edge, args.binarize, args.repeat, args.api)
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# 計測用の子プロセスで実行するコード (毎回新しいプロセスで、モジュールが読み込まれていない状態から計測する)
+PROBE_CODE = """
+import json, time
+start = time.perf_counter()
+import main
+result = {"import": time.perf_counter() - start}
+if {open_window}:
+    try:
+        app = main.MainApplication()
+        app.update() # ウィンドウを表示する (描画イベントを処理)
+        result["window"] = time.perf_counter() - start
+        app.destroy()
+    except Exception as e: # ディスプレイがない環境など (tkinter.TclError)
+        result["error"] = str(e)
+print(json.dumps(result), flush=True)
+"""
+
+
+def measure_once(open_window=True):
+    """
+    新しいプロセスで main.py を読み込み、ウィンドウが表示されるまでの時間を 1 回計測する
+
+    Returns:
+        dict: {"import": import main の時間, "window": import からウィンドウ表示までの時間,
+               "process": プロセス起動からウィンドウ表示までの時間 (インタープリタの起動を含む), ("error")} (秒)
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-c", PROBE_CODE.replace("{open_window}", str(open_window))],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline() # ウィンドウを表示した直後に出力される
+    elapsed = time.perf_counter() - start
+    process.wait()
+    if not line:
+        raise RuntimeError("計測用のプロセスが異常終了しました")
+    result = json.loads(line)
+    result["process"] = elapsed
+    return result
+
+
+def slowest_imports(top=10):
+    """
+    python -X importtime で main.py が直接読み込むモジュールごとの読み込み時間を調べる
+
+    Returns:
+        list: (モジュール名, 読み込み時間 (秒)) を遅い順に top 個
+    """
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    direct_imports = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue # 見出し行
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2 # 子モジュールは親より先に、字下げして出力される
+        if depth == 0:
+            if name.strip() == "main":
+                break
+            direct_imports = [] # main より前にトップレベルで読み込まれたもの (site など)
+        elif depth == 1:
+            direct_imports.append((name.strip(), int(cumulative) / 1_000_000))
+    return sorted(direct_imports, key=lambda item: item[1], reverse=True)[:top]
+
+
+def run_benchmark(repeat, open_window, top):
+    """起動時間を repeat 回計測し、中央値と遅いモジュールを表示する"""
+    results = [measure_once(open_window) for _ in range(repeat)]
+    errors = [result["error"] for result in results if "error" in result]
+
+    print(f"main.py の起動時間 ({repeat} 回の中央値)")
+    print(f"  import main:               {statistics.median(r['import'] for r in results) * 1000:8.1f} ms")
+    if open_window and not errors:
+        print(f"  ウィンドウ表示まで:        {statistics.median(r['window'] for r in results) * 1000:8.1f} ms")
+        print(f"  プロセス起動から表示まで:  {statistics.median(r['process'] for r in results) * 1000:8.1f} ms")
+    elif errors:
+        print(f"  ウィンドウを表示できないため、import の時間だけを計測しました: {errors[0]}")
+
+    print(f"main.py が読み込むモジュール (遅い順に {top} 個)")
+    for module_name, seconds in slowest_imports(top):
+        print(f"  {module_name:<28} {seconds * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GUI (main.py) の起動時間のベンチマーク (import 時間とウィンドウ表示までの時間)")
+    parser.add_argument("--repeat", type=int, default=5, help="計測回数 (毎回新しいプロセスで計測)")
+    parser.add_argument("--no-window", action="store_true", help="ウィンドウを作らず import の時間だけを計測する")
+    parser.add_argument("--top", type=int, default=10, help="表示する遅いモジュールの数")
+    args = parser.parse_args()
+    run_benchmark(args.repeat, not args.no_window, args.top)
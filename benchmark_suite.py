@@ -0,0 +1,349 @@
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import warnings
+import numpy as np
+from PIL import Image
+
+DEFAULT_SCALES = [1, 4, 8] # サンプル画像 (keisan_problem.png) に対する拡大率 (279x198 → 2232x1584)
+RESULTS_DIR = "benchmark_results" # 計測結果 (JSON) の保存先
+HIGHER_IS_BETTER = {"sheets_per_minute"} # 大きいほど良い指標 (それ以外は小さいほど良い)
+
+# 応答の解析で計測する回答テキストの例 (モデルがよく返す形をそろえる)
+PARSE_SAMPLES = {
+    "plain": json.dumps({str(i): i % 3 != 0 for i in range(1, 41)}),
+    "indented": json.dumps({str(i): i % 3 != 0 for i in range(1, 41)}, indent=4),
+    "nested_batch": json.dumps({str(s): {str(i): i % 3 != 0 for i in range(1, 41)} for s in range(8)}),
+    "chatty": "採点結果です。\n```json\n" + json.dumps({f"問題{i}": "正解" if i % 3 else "×" for i in range(1, 41)},
+                                           ensure_ascii=False) + "\n```",
+}
+
+
+def make_class(sample_path, positions_path, sheet_count, scale, work_dir, seed=0):
+    """
+    サンプルのシートと位置情報JSONから、1 クラス分 (sheet_count 枚) の疑似的な解答シートを作る
+
+    サンプル画像を scale 倍に拡大し、シートごとに位置を数ピクセルずらしてスキャンのノイズを加える。
+    位置情報JSONの座標も同じ倍率で拡大する。
+
+    Returns:
+        tuple: (シート画像パスのリスト, 拡大した位置情報JSONのパス)
+    """
+    rng = random.Random(seed)
+    noise_rng = np.random.default_rng(seed)
+    class_dir = os.path.join(work_dir, f"class_x{scale}")
+    os.makedirs(class_dir, exist_ok=True)
+
+    with open(positions_path, 'r', encoding='utf-8') as f:
+        position_data = json.load(f)
+    position_data.pop("テンプレート画像", None) # 拡大したシートには合わないため位置合わせの基準は持ち込まない
+    for problem in position_data["問題位置情報"]:
+        problem["正解位置"] = {"x": problem["正解位置"]["x"] * scale, "y": problem["正解位置"]["y"] * scale}
+    layout_path = os.path.join(class_dir, "positions.json")
+    with open(layout_path, 'w', encoding='utf-8') as f:
+        json.dump(position_data, f, ensure_ascii=False)
+
+    with Image.open(sample_path) as sample:
+        base = np.asarray(sample.convert("L").resize((sample.width * scale, sample.height * scale), Image.BILINEAR))
+    sheet_paths = []
+    for i in range(sheet_count):
+        shift_x, shift_y = rng.randint(-2, 2) * scale, rng.randint(-2, 2) * scale
+        sheet = np.roll(base, (shift_y, shift_x), axis=(0, 1)).astype(np.int16)
+        sheet += noise_rng.integers(-12, 13, size=sheet.shape, dtype=np.int16) # スキャンのノイズ
+        sheet_path = os.path.join(class_dir, f"sheet_{i:03d}.png")
+        Image.fromarray(np.clip(sheet, 0, 255).astype(np.uint8)).convert("RGB").save(sheet_path, compress_level=1)
+        sheet_paths.append(sheet_path)
+    return sheet_paths, layout_path
+
+
+@contextlib.contextmanager
+def _quiet():
+    """計測中の print (応答の JSON 表示など) を捨てる"""
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def scenario_pipeline(sheet_paths, layout_path, options):
+    """API (疑似) → 合成 → 書き出しの全体を GradingPipeline で実行し、スループットと段ごとの時間を計測"""
+    import fake_gemini
+    import grading_client
+    import grading_pipeline
+    import image_writer
+    import tracing
+    from add_marks_to_image import add_marks_with_layout
+    from layout import Layout
+
+    sheet_layout = Layout.load(layout_path, options["correct_mark"], options["incorrect_mark"])
+    model = fake_gemini.FakeGenerativeModel(latency=options["latency"], jitter=options["jitter"],
+                                            rate_limit_rate=options["rate_limit_rate"],
+                                            error_rate=options["error_rate"], seed=options["seed"])
+    client = grading_client.AsyncGradingClient(model=model, requests_per_minute=None, tokens_per_minute=None,
+                                               max_in_flight=options["api_workers"], base_delay=0.05, max_delay=0.5)
+    tracer = tracing.set_tracer(tracing.Tracer())
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_writer = image_writer.OutputWriter(options["output_format"])
+        image_folder = os.path.dirname(sheet_paths[0])
+        jobs = grading_pipeline.build_jobs(image_folder, output_dir, [os.path.basename(p) for p in sheet_paths],
+                                           output_extension=output_writer.extension)
+        pipeline = grading_pipeline.GradingPipeline(
+            client.as_sync_grader(),
+            lambda image_path, problem_results: add_marks_with_layout(
+                image_path, sheet_layout, problem_results, output_mode=output_writer.output_mode),
+            api_workers=options["api_workers"],
+            cpu_workers=options["cpu_workers"],
+            writer=output_writer,
+        )
+        start = time.perf_counter()
+        with _quiet():
+            pipeline.start(jobs)
+            pipeline.wait()
+            output_writer.close()
+        elapsed = time.perf_counter() - start
+        client.close()
+
+    events = pipeline.poll_events(max_events=len(jobs) * 10)
+    saved = sum(1 for event in events if event["event"] == "saved")
+    stages = tracer.summary()["stages"]
+    metrics = {
+        "sheets_per_minute": saved / elapsed * 60 if elapsed > 0 else 0.0,
+        "elapsed_seconds": elapsed,
+        "failed_sheets": len(jobs) - saved,
+        "retries": client.stats["retries"],
+    }
+    for name in ("api", "composite", "encode", "sheet"):
+        if name in stages:
+            metrics[f"{name}_p50_ms"] = stages[name]["p50"] * 1000
+            metrics[f"{name}_p95_ms"] = stages[name]["p95"] * 1000
+    return metrics
+
+
+def scenario_composite(sheet_paths, layout_path, options):
+    """〇×マーク合成 (読み込み + 合成) だけを繰り返し計測"""
+    from add_marks_to_image import add_marks_with_layout
+    from layout import Layout
+
+    sheet_layout = Layout.load(layout_path, options["correct_mark"], options["incorrect_mark"])
+    results = {problem_number: i % 3 != 0 for i, problem_number in enumerate(sheet_layout.problem_numbers)}
+    elapsed = []
+    for sheet_path in sheet_paths:
+        start = time.perf_counter()
+        add_marks_with_layout(sheet_path, sheet_layout, results, output_mode="RGB")
+        elapsed.append(time.perf_counter() - start)
+    return {"mean_ms": float(np.mean(elapsed)) * 1000, "min_ms": min(elapsed) * 1000}
+
+
+def scenario_parse(sheet_paths, layout_path, options):
+    """Gemini の回答テキストの解析 (get_gemini_results_json.parse_problem_results) を計測"""
+    import get_gemini_results_json
+
+    repeat = options["parse_repeat"]
+    metrics = {}
+    for name, response_text in PARSE_SAMPLES.items():
+        with _quiet():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                get_gemini_results_json.parse_problem_results(response_text)
+            elapsed = time.perf_counter() - start
+        metrics[f"{name}_us"] = elapsed / repeat * 1_000_000
+    return metrics
+
+
+SCENARIOS = {
+    "pipeline": scenario_pipeline,
+    "composite": scenario_composite,
+    "parse": scenario_parse,
+}
+
+
+def peak_rss_mb():
+    """
+    このプロセスの最大常駐メモリ (MB)
+
+    resource モジュールがない Windows では測れないため None を返す。
+    ru_maxrss の単位は Linux などでは KB、macOS ではバイト。
+    """
+    try:
+        import resource # Unix のみ
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+
+def _run_scenario(result_queue, name, sheet_paths, layout_path, options):
+    """
+    子プロセスで 1 つのシナリオを実行する (最大常駐メモリをシナリオごとに分けて測るため)
+
+    例外が起きた場合も親プロセスが待ち続けないよう、{"error": トレースバック} を送る。
+    """
+    warnings.simplefilter("ignore", FutureWarning) # google.generativeai の非推奨警告を子プロセスごとに出さない
+    try:
+        baseline_mb = peak_rss_mb()
+        metrics = SCENARIOS[name](sheet_paths, layout_path, options)
+        if baseline_mb is not None: # 測れない環境では指標に含めない
+            metrics["peak_rss_increase_mb"] = peak_rss_mb() - baseline_mb
+    except Exception:
+        result_queue.put({"error": traceback.format_exc()})
+        return
+    result_queue.put({"metrics": metrics})
+
+
+def _wait_for_scenario(result_queue, process, poll_seconds=1.0):
+    """子プロセスの結果を待つ (結果を送らずに終了した場合は、終了コードをエラーとして返す)"""
+    while True:
+        try:
+            return result_queue.get(timeout=poll_seconds)
+        except queue.Empty:
+            if not process.is_alive(): # 強制終了などで結果が届かない
+                try:
+                    return result_queue.get(timeout=poll_seconds) # 終了直前に送った結果が残っていれば使う
+                except queue.Empty:
+                    return {"error": f"子プロセスが結果を返さずに終了しました (終了コード {process.exitcode})"}
+
+
+def git_revision():
+    """現在のコミット (取得できなければ None)"""
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(options, scenario_names, scales):
+    """
+    シナリオ × 解像度ごとに計測し、保存・比較できる形の計測結果を返す
+
+    Returns:
+        dict: {"revision", "created_at", "python", "platform", "options", "results": [{"scenario", "scale", "size", "metrics"}]}
+              失敗したシナリオの結果は metrics が空で、"error" にエラー内容を持つ
+    """
+    context = multiprocessing.get_context("spawn") # 親プロセスのメモリ使用量の影響を受けないようにする
+    report = {
+        "revision": git_revision(),
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": options,
+        "results": [],
+    }
+    if peak_rss_mb() is None:
+        print("この環境では最大常駐メモリを測れないため、peak_rss_increase_mb は計測しません")
+    with tempfile.TemporaryDirectory() as work_dir:
+        for scale in scales:
+            sheet_paths, layout_path = make_class(options["sample"], options["positions"], options["sheets"],
+                                                  scale, work_dir, options["seed"])
+            with Image.open(sheet_paths[0]) as first_sheet:
+                size = first_sheet.size
+            print(f"--- {size[0]}x{size[1]} (x{scale}, {len(sheet_paths)} 枚) ---")
+            for name in scenario_names:
+                result_queue = context.Queue()
+                process = context.Process(target=_run_scenario,
+                                          args=(result_queue, name, sheet_paths, layout_path, options))
+                process.start()
+                outcome = _wait_for_scenario(result_queue, process)
+                process.join()
+                result = {"scenario": name, "scale": scale, "size": list(size), "metrics": outcome.get("metrics", {})}
+                if "error" in outcome:
+                    result["error"] = outcome["error"]
+                    print(f"  {name:<10} 失敗しました:\n{outcome['error']}", file=sys.stderr)
+                else:
+                    print(f"  {name:<10} " + "  ".join(f"{key} {value:.1f}" for key, value in result["metrics"].items()))
+                report["results"].append(result)
+    return report
+
+
+def compare_reports(baseline, current, threshold):
+    """
+    2 つの計測結果を比較し、threshold (割合) を超えて悪化した指標を表示する
+
+    Returns:
+        int: 悪化した指標の数
+    """
+    baseline_metrics = {(r["scenario"], r["scale"]): r["metrics"] for r in baseline["results"]}
+    print(f"--- 比較: {baseline.get('revision')} ({baseline.get('created_at')}) → "
+          f"{current.get('revision')} ({current.get('created_at')}) ---")
+    regressions = 0
+    for result in current["results"]:
+        previous = baseline_metrics.get((result["scenario"], result["scale"]))
+        if previous is None:
+            continue
+        for key, value in result["metrics"].items():
+            old_value = previous.get(key)
+            if not old_value or key == "peak_rss_increase_mb" and abs(value - old_value) < 5: # 数 MB の差は誤差
+                continue
+            change = (value - old_value) / abs(old_value)
+            worse = -change if key in HIGHER_IS_BETTER else change
+            flag = ""
+            if worse > threshold:
+                flag = "  << 悪化"
+                regressions += 1
+            elif worse < -threshold:
+                flag = "  (改善)"
+            print(f"  {result['scenario']:<10} x{result['scale']:<3} {key:<22} {old_value:10.1f} → {value:10.1f} "
+                  f"({change:+.0%}){flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="疑似 Gemini API を使った採点処理全体のベンチマーク (API 利用枠・ネットワーク不要)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"実行するシナリオ (カンマ区切り: {', '.join(SCENARIOS)})")
+    parser.add_argument("--scales", default=",".join(map(str, DEFAULT_SCALES)), help="サンプル画像に対する拡大率 (カンマ区切り)")
+    parser.add_argument("--sheets", type=int, default=30, help="1 クラスあたりのシート数")
+    parser.add_argument("--sample", default="keisan_problem.png", help="シートの元にするサンプル画像")
+    parser.add_argument("--positions", default="problem_positions.json", help="サンプル画像の位置情報JSON")
+    parser.add_argument("--correct-mark", default="circle_red.png", help="正解マーク画像 (〇)")
+    parser.add_argument("--incorrect-mark", default="cross_red.png", help="不正解マーク画像 (✕)")
+    parser.add_argument("--latency", type=float, default=0.5, help="疑似 API の応答時間 (秒)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="疑似 API の応答時間のばらつき (秒)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="疑似 API が 429 を返す確率")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="疑似 API が 503 を返す確率")
+    parser.add_argument("--api-workers", type=int, default=8, help="同時に実行する API 呼び出しの数")
+    parser.add_argument("--cpu-workers", type=int, default=2, help="マーク合成を行うワーカーの数")
+    parser.add_argument("--output-format", default="png", help="採点済み画像の形式 (image_writer.OUTPUT_FORMATS)")
+    parser.add_argument("--parse-repeat", type=int, default=2000, help="応答の解析を繰り返す回数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード")
+    parser.add_argument("--output", help=f"計測結果の保存先 (省略時は {RESULTS_DIR}/<日時>.json)")
+    parser.add_argument("--compare", help="比較する過去の計測結果 (JSON)。悪化した指標があれば終了コード 1")
+    parser.add_argument("--threshold", type=float, default=0.10, help="悪化とみなす変化の割合")
+    args = parser.parse_args()
+
+    scenario_names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in scenario_names if name not in SCENARIOS]
+    if unknown:
+        print(f"不明なシナリオです: {', '.join(unknown)}", file=sys.stderr)
+        sys.exit(2)
+    suite_options = {key: getattr(args, key) for key in (
+        "sheets", "sample", "positions", "correct_mark", "incorrect_mark", "latency", "jitter", "rate_limit_rate",
+        "error_rate", "api_workers", "cpu_workers", "output_format", "parse_repeat", "seed")}
+    suite_report = run_suite(suite_options, scenario_names, [int(scale) for scale in args.scales.split(",")])
+
+    output_path = args.output or os.path.join(RESULTS_DIR, datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(suite_report, f, ensure_ascii=False, indent=2)
+    print(f"計測結果を保存しました: {output_path}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline_report = json.load(f)
+        regression_count = compare_reports(baseline_report, suite_report, args.threshold)
+        if regression_count:
+            print(f"{regression_count} 個の指標が {args.threshold:.0%} 以上悪化しました")
+            sys.exit(1)
+    failed_results = [result for result in suite_report["results"] if "error" in result]
+    if failed_results:
+        print(f"{len(failed_results)} 個のシナリオが失敗しました: "
+              + ", ".join(f"{result['scenario']} x{result['scale']}" for result in failed_results), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import random
+import threading
+import time
+
+
+class FakeAPIError(Exception):
+    """疑似的な API エラー (code 属性に HTTP ステータスを持つ)"""
+
+    def __init__(self, code, message):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeResponse:
+    """generate_content の戻り値の代わり (text と resolve() のみ実装)"""
+
+    def __init__(self, text):
+        self.text = text
+
+    def resolve(self):
+        pass
+
+
+class FakeStreamResponse:
+    """
+    stream=True で呼んだ場合の戻り値の代わり (回答を数回に分けて返す)
+
+    同期版は for 文、非同期版は async for 文で FakeResponse (text のみ) を順に取り出せる。
+    text は全てのチャンクを受け取った後の回答全体。
+    """
+
+    def __init__(self, text, delays):
+        chunk_count = len(delays)
+        size = max(1, -(-len(text) // chunk_count))
+        self._chunks = [text[i * size:(i + 1) * size] for i in range(chunk_count)]
+        self._delays = delays
+        self.text = text
+
+    def resolve(self):
+        pass
+
+    def __iter__(self):
+        for chunk, delay in zip(self._chunks, self._delays):
+            time.sleep(delay)
+            yield FakeResponse(chunk)
+
+    async def __aiter__(self):
+        for chunk, delay in zip(self._chunks, self._delays):
+            await asyncio.sleep(delay)
+            yield FakeResponse(chunk)
+
+
+class FakeGenerativeModel:
+    """
+    Gemini API を呼ばずに、決まった JSON を返す GenerativeModel の代わり
+
+    応答までの待ち時間・ばらつき・エラー (429 / 503) の発生率を指定でき、
+    API 利用枠を使わずに採点処理の動作確認や性能計測ができる。
+
+    Args:
+        response_text: 返す回答テキスト (省略時は 3 問分の正誤結果)
+        latency:       応答までの平均待ち時間 (秒)
+        jitter:        待ち時間のばらつき (秒, ±jitter の一様分布)
+        rate_limit_rate: 429 (Too Many Requests) を返す確率
+        error_rate:    503 (Service Unavailable) を返す確率
+        chatty_rate:   回答を前置きとコードブロックで囲んで返す確率 (指示に従わない回答の再現)
+        seed:          乱数シード (再現性が必要な場合に指定)
+        stream_chunks: stream=True で呼ばれた場合に回答を分ける数 (待ち時間の半分は最初のチャンクまで)
+    """
+
+    def __init__(self, response_text=None, latency=0.5, jitter=0.1, rate_limit_rate=0.0, error_rate=0.0, seed=None,
+                 chatty_rate=0.0, stream_chunks=4):
+        self.response_text = response_text or json.dumps({"1": True, "2": False, "3": True})
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.chatty_rate = chatty_rate
+        self.stream_chunks = max(1, stream_chunks)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.request_count = 0 # 受け付けたリクエスト数 (エラーを含む)
+        self.max_in_flight = 0 # 同時に処理していたリクエスト数の最大値
+        self._in_flight = 0
+
+    def _next_delay_and_error(self):
+        with self._lock:
+            self.request_count += 1
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            roll = self._random.random()
+        if roll < self.rate_limit_rate:
+            return delay, FakeAPIError(429, "Resource has been exhausted (fake)")
+        if roll < self.rate_limit_rate + self.error_rate:
+            return delay, FakeAPIError(503, "Service Unavailable (fake)")
+        return delay, None
+
+    def _response(self, delay, stream):
+        """回答を作る (stream=True なら待ち時間の後半をチャンクの間に分ける)"""
+        with self._lock:
+            chatty = self._random.random() < self.chatty_rate
+        text = self.response_text
+        if chatty:
+            text = f"採点結果は以下の通りです。\n```json\n{text}\n```\n他に確認したいことがあればお知らせください。"
+        if stream:
+            return FakeStreamResponse(text, [delay / 2 / self.stream_chunks] * self.stream_chunks)
+        return FakeResponse(text)
+
+    def _enter(self):
+        with self._lock:
+            self._in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self._in_flight)
+
+    def _leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        """同期版 (genai.GenerativeModel.generate_content と同じ呼び出し方)"""
+        delay, error = self._next_delay_and_error()
+        self._enter()
+        try:
+            time.sleep(delay / 2 if stream and error is None else delay)
+        finally:
+            self._leave()
+        if error is not None:
+            raise error
+        return self._response(delay, stream)
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        """非同期版 (genai.GenerativeModel.generate_content_async と同じ呼び出し方)"""
+        delay, error = self._next_delay_and_error()
+        self._enter()
+        try:
+            await asyncio.sleep(delay / 2 if stream and error is None else delay)
+        finally:
+            self._leave()
+        if error is not None:
+            raise error
+        return self._response(delay, stream)
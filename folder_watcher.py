@@ -0,0 +1,141 @@
+import os
+import time
+
+from grading_pipeline import IMAGE_EXTENSIONS
+
+DEFAULT_POLL_INTERVAL = 1.0 # フォルダを調べる間隔 (秒)
+DEFAULT_SETTLE_SECONDS = 2.0 # サイズと更新時刻がこの秒数変わらなければ書き込み完了とみなす
+# 形式ごとのファイル末尾の目印 (書き込みが途中で止まったファイルを見分けるため)
+_END_MARKERS = {".png": b"IEND\xaeB`\x82", ".jpg": b"\xff\xd9", ".jpeg": b"\xff\xd9"}
+
+
+def looks_complete(path):
+    """
+    画像ファイルが最後まで書き込まれているかを末尾の目印で簡易的に確かめる (PNG / JPEG のみ, 他の形式は常に True)
+    """
+    marker = _END_MARKERS.get(os.path.splitext(path)[1].lower())
+    if marker is None:
+        return True
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 64)) # JPEG は末尾に余分なバイトが付くことがあるため少し広めに見る
+            return marker in f.read()
+    except OSError:
+        return False
+
+
+class FolderWatcher:
+    """
+    フォルダに届いた新しい画像・書き換えられた画像を見つける (ポーリング + stat のキャッシュ)
+
+    poll() のたびに os.scandir でフォルダを調べ、前回のサイズ・更新時刻と比べて変化したファイルだけを候補にする。
+    スキャナーが書き込み中のファイルを読まないよう、サイズと更新時刻が settle_seconds の間
+    変わらなかった時点で「届いた」として返す (デバウンス)。PNG / JPEG は末尾の目印も確かめ、
+    書き込みが途中で止まったファイルは書き直されるまで待つ。
+    inotify が使えないネットワーク共有フォルダでも動くよう、ファイルシステムの通知は使わない。
+
+    Args:
+        folder_path:     監視する画像フォルダ
+        recursive:       サブフォルダも監視するか
+        exclude_dirs:    監視しないフォルダのパスのリスト (出力フォルダなど)
+        settle_seconds:  書き込み完了とみなすまでの静止時間 (秒)
+    """
+
+    def __init__(self, folder_path, recursive=True, exclude_dirs=(), settle_seconds=DEFAULT_SETTLE_SECONDS):
+        self.folder_path = folder_path
+        self.recursive = recursive
+        self.excluded = {os.path.abspath(d) for d in exclude_dirs}
+        self.settle_seconds = settle_seconds
+        self._known = {} # 相対パス -> 処理対象として返した時の (サイズ, 更新時刻)
+        self._pending = {} # 相対パス -> (サイズ, 更新時刻, その状態を最初に見た時刻)
+
+    def prime(self, image_files):
+        """
+        すでに処理対象にしたファイル (相対パスのリスト) を登録する (変更されない限り poll() で返さない)
+        """
+        for image_file in image_files:
+            try:
+                stat = os.stat(os.path.join(self.folder_path, image_file))
+            except OSError:
+                continue
+            self._known[image_file] = (stat.st_size, stat.st_mtime_ns)
+
+    def _scan(self):
+        """フォルダ内の画像ファイルの {相対パス: (サイズ, 更新時刻)} を返す"""
+        found = {}
+        directories = [self.folder_path]
+        while directories:
+            directory = directories.pop()
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue # 監視中に消えたフォルダなど
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.recursive and os.path.abspath(entry.path) not in self.excluded:
+                            directories.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        stat = entry.stat()
+                        found[os.path.relpath(entry.path, self.folder_path)] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    continue # 調べている間に消えたファイル
+        return found
+
+    def poll(self, now=None):
+        """
+        フォルダを調べ、書き込みが終わった新しい画像・書き換えられた画像を返す
+
+        Returns:
+            list: 画像フォルダからの相対パスのリスト (ソート済み)
+        """
+        now = time.monotonic() if now is None else now
+        current = self._scan()
+        ready = []
+        for image_file, signature in current.items():
+            if self._known.get(image_file) == signature:
+                continue # 処理済みで変化なし
+            if signature[0] == 0:
+                self._pending.pop(image_file, None) # 作成直後の空ファイル
+                continue
+            pending = self._pending.get(image_file)
+            if pending is None or pending[:2] != signature:
+                self._pending[image_file] = (signature[0], signature[1], now) # 書き込み中 (静止するまで待つ)
+                continue
+            if now - pending[2] >= self.settle_seconds:
+                if not looks_complete(os.path.join(self.folder_path, image_file)):
+                    continue # 静止しているが途中までしか書かれていない (書き直されるまで待つ)
+                ready.append(image_file)
+                self._known[image_file] = signature
+                del self._pending[image_file]
+        for image_file in list(self._pending):
+            if image_file not in current: # 書き込み途中で消えた
+                del self._pending[image_file]
+        for image_file in list(self._known):
+            if image_file not in current: # 削除された (同じ名前で再び届けば処理する)
+                del self._known[image_file]
+        return sorted(ready)
+
+    @property
+    def waiting_count(self):
+        """書き込み完了を待っているファイルの数"""
+        return len(self._pending)
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("使い方: python folder_watcher.py 画像フォルダ")
+        sys.exit(1)
+    watcher = FolderWatcher(sys.argv[1])
+    print(f"{sys.argv[1]} を監視します (Ctrl+C で終了)")
+    try:
+        while True:
+            for arrived in watcher.poll():
+                print(f"届きました: {arrived}")
+            time.sleep(DEFAULT_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        pass
@@ -1,70 +1,446 @@
-import google.generativeai as genai
+import io
 import json
 from PIL import Image
 import os
+import threading
 
-# Gemini API の API キーを設定
-api_key = os.environ.get("GEMINI_API_KEY")
-genai.configure(api_key=api_key)
+import response_parser
+from preprocess_image import preprocess_for_upload
+from region_mosaic import build_mosaic, mosaic_label
+from result_cache import make_cache_key
 
-def get_problem_results_from_gemini_json(image_path):
+MODEL_NAME = 'gemini-2.0-flash-exp' # 使用する Gemini モデル
+
+_model = None # get_model() で作成した GenerativeModel (全リクエストで使い回す)
+_model_lock = threading.Lock()
+
+# プロンプト (JSON 形式での回答を指示)
+PROMPT_TEXT = """
+        この画像は計算問題です。各問題の正誤判定を行い、
+        問題番号をキー、正誤結果 (正解の場合は true, 不正解の場合は false) を値とする JSON 形式の文字列で出力してください。
+        JSON 形式の文字列 *のみ* を出力し、それ以外のテキスト、特にコードブロックなどは絶対に出力しないでください。
+        """ # ユーザープロンプト
+
+# 複数シートをまとめて送る場合のプロンプト (シート番号ごとに結果を返すよう指示)
+BATCH_PROMPT_TEXT = """
+        これから {sheet_count} 枚の画像を送ります。それぞれ別の生徒の計算問題で、各画像の直前に「シート番号: N」と示します。
+        シートごとに各問題の正誤判定を行い、シート番号 (文字列) をキー、
+        そのシートの「問題番号をキー、正誤結果 (正解の場合は true, 不正解の場合は false) を値とする JSON オブジェクト」を値とする
+        JSON 形式の文字列で出力してください。例: {{"0": {{"1": true, "2": false}}, "1": {{"1": true, "2": true}}}}
+        JSON 形式の文字列 *のみ* を出力し、それ以外のテキスト、特にコードブロックなどは絶対に出力しないでください。
+        """ # ユーザープロンプト (複数シート用)
+
+# 問題ごとに切り出した領域を並べた画像 (region_mosaic.build_mosaic) を送る場合のプロンプト
+REGION_PROMPT_TEXT = """
+        この画像は計算問題の解答用紙から、問題ごとの領域を切り出して並べたものです。
+        各領域の上に黒地に白文字で [問題番号] のラベルがあり、含まれるラベルは {labels} です。
+        各領域の問題の正誤判定を行い、ラベルの問題番号 (括弧を除いた文字列) をキー、
+        正誤結果 (正解の場合は true, 不正解の場合は false) を値とする JSON 形式の文字列で出力してください。
+        ラベルにない問題番号は出力しないでください。
+        JSON 形式の文字列 *のみ* を出力し、それ以外のテキスト、特にコードブロックなどは絶対に出力しないでください。
+        """ # ユーザープロンプト (問題領域モード)
+
+# API に送る前の画像の前処理 (preprocess_image.preprocess_for_upload の引数, None で元画像をそのまま送る)
+DEFAULT_PREPROCESS_OPTIONS = {"max_long_edge": 1600, "grayscale": True, "binarize": False, "jpeg_quality": 85}
+
+DEFAULT_BATCH_SIZE = 8 # 1 リクエストにまとめるシート数の既定値
+DEFAULT_MAX_BATCH_BYTES = 15 * 1024 * 1024 # 1 リクエストに含める画像の合計サイズ上限 (バイト)
+
+def get_model():
+    """
+    Gemini API のモデル (GenerativeModel) を返す
+
+    google.generativeai の読み込みと API キーの設定は import 時ではなく最初の呼び出し時に 1 回だけ行い、
+    作成したモデルは以後のリクエストで使い回す。(SDK の読み込みに時間がかかるため、
+    キャッシュやローカル採点だけで済む場合や GUI の起動時には読み込まない)
+
+    Returns:
+        GenerativeModel (set_model() で差し替えた場合はそのモデル)
+    """
+    global _model
+    with _model_lock: # 複数のワーカーから同時に呼ばれても 1 回だけ作成する
+        if _model is None:
+            import google.generativeai as genai # 読み込みに時間がかかるため、最初に使うときに読み込む
+            genai.configure(api_key=os.environ.get("GEMINI_API_KEY")) # Gemini API の API キーを設定
+            _model = genai.GenerativeModel(MODEL_NAME)
+        return _model
+
+
+def set_model(model):
+    """get_model() が返すモデルを差し替える (fake_gemini.FakeGenerativeModel での動作確認用, None で元に戻す)"""
+    global _model
+    with _model_lock:
+        _model = model
+
+
+def _cache_prompt_identity(prompt_text, preprocess_options):
+    """キャッシュキー用に、プロンプトと前処理の設定をまとめた文字列を作る (前処理が変われば別キー)"""
+    return prompt_text + json.dumps(preprocess_options, sort_keys=True)
+
+
+def _load_upload_image(image_bytes, preprocess_options):
+    """API に送る画像を用意する (前処理ありならエンコード済みデータ、なしなら PIL Image)"""
+    image = Image.open(io.BytesIO(image_bytes)) # 画像を PIL Image オブジェクトとして読み込み
+    if preprocess_options is None:
+        return image
+    return preprocess_for_upload(image, **preprocess_options).as_blob()
+
+
+def cache_key_for(image_bytes, preprocess_options=DEFAULT_PREPROCESS_OPTIONS):
+    """1 枚ずつ採点する場合のキャッシュキー (画像・モデル・プロンプト・前処理設定から作成)"""
+    return make_cache_key(image_bytes, MODEL_NAME, _cache_prompt_identity(PROMPT_TEXT, preprocess_options))
+
+
+def build_contents(image_bytes, preprocess_options=DEFAULT_PREPROCESS_OPTIONS):
+    """1 枚分のリクエスト内容 (プロンプトと画像) を作成"""
+    image = _load_upload_image(image_bytes, preprocess_options) # 縮小・圧縮した画像 (前処理なしの場合は元画像)
+    return [PROMPT_TEXT, image]
+
+
+def batch_cache_key_for(image_bytes, preprocess_options=DEFAULT_PREPROCESS_OPTIONS):
+    """複数シートをまとめて採点する場合のキャッシュキー (1 枚ずつとはプロンプトが違うため別のキー)"""
+    return make_cache_key(image_bytes, MODEL_NAME, _cache_prompt_identity(BATCH_PROMPT_TEXT, preprocess_options))
+
+
+def build_batch_contents(images_bytes, preprocess_options=DEFAULT_PREPROCESS_OPTIONS):
+    """
+    複数シートを 1 回で送るリクエスト内容 (プロンプト, "シート番号: 0", 画像, "シート番号: 1", 画像, ...) を作成
+
+    Returns:
+        tuple: (リクエスト内容, 送信する画像のリスト)
+    """
+    contents = [BATCH_PROMPT_TEXT.format(sheet_count=len(images_bytes))]
+    upload_images = []
+    for index, image_bytes in enumerate(images_bytes):
+        upload_images.append(_load_upload_image(image_bytes, preprocess_options))
+        contents += [f"シート番号: {index}", upload_images[-1]]
+    return contents, upload_images
+
+
+def parse_batch_results(response_text, sheet_count):
+    """
+    複数シートの回答をシート番号ごとに分解する
+
+    Returns:
+        dict: シート番号 (int) をキー、正誤結果の辞書を値とする辞書
+              (形式が正しいシートのみ含む。応答全体が不正な場合は None)
+    """
+    batch_response_json = response_parser.parse_batch_response(response_text)
+    if batch_response_json is None:
+        print("API response format error (batch): no verdicts found.")
+        return None
+
+    batch_results = {}
+    for sheet_key, sheet_results in batch_response_json.items():
+        try:
+            index = int(sheet_key)
+        except (TypeError, ValueError):
+            continue # シート番号として解釈できないキーは無視
+        if 0 <= index < sheet_count and isinstance(sheet_results, dict):
+            batch_results[index] = sheet_results
+    return batch_results
+
+
+def build_region_request(image_bytes, layout, problem_numbers=None, preprocess_options=DEFAULT_PREPROCESS_OPTIONS):
+    """
+    問題ごとの領域を並べたモザイク画像で、1 枚分のリクエスト内容を作成
+
+    Args:
+        image_bytes:     シート画像のファイル内容
+        layout:          layout.Layout (問題番号と問題領域)
+        problem_numbers: 採点する問題番号のリスト (None で全問題)
+        preprocess_options: 送信前の前処理の設定 (None で前処理なし)
+    Returns:
+        tuple: (キャッシュキー, リクエスト内容, 含めた問題番号のリスト)。含める問題がない場合は (None, None, [])
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        mosaic, labels = build_mosaic(image, layout, problem_numbers)
+        image_size = image.size
+    if mosaic is None:
+        return None, None, []
+    prompt_text = REGION_PROMPT_TEXT.format(labels=", ".join(mosaic_label(label) for label in labels))
+    regions = [layout.problem_region(layout.index_by_problem[label], image_size) for label in labels]
+    cache_key = make_cache_key(image_bytes, MODEL_NAME,
+                               _cache_prompt_identity(prompt_text, preprocess_options) + json.dumps(regions))
+    if preprocess_options is None:
+        upload_image = mosaic
+    else:
+        upload_image = preprocess_for_upload(mosaic, **preprocess_options).as_blob()
+    return cache_key, [prompt_text, upload_image], labels
+
+
+def select_region_results(problem_results, labels):
+    """
+    問題領域モードの回答から、送った問題番号の結果だけを取り出す (キーは位置情報JSONの問題番号に揃える)
+
+    Returns:
+        response_parser.ProblemResults: 問題番号をキー、正誤結果を値とする辞書 (送った問題の結果が 1 つもない場合は None)
+    """
+    if problem_results is None:
+        return None
+    normalized = {response_parser.normalize_problem_key(key): value for key, value in problem_results.items()}
+    selected = {label: normalized[label] for label in labels if isinstance(normalized.get(label), bool)}
+    missing = [label for label in labels if label not in selected]
+    if missing:
+        print(f"回答に含まれていない問題番号: {', '.join(missing)}")
+    if not selected:
+        return None
+    confidence = {response_parser.normalize_problem_key(key): value
+                  for key, value in response_parser.confidence_of(problem_results).items()}
+    return response_parser.ProblemResults(selected, {label: confidence[label] for label in selected if label in confidence})
+
+
+def parse_problem_results(gemini_response_json_string):
+    """
+    Gemini API の回答テキストを正誤結果の辞書にパースする関数
+
+    コードブロックや前置きの付いた回答、"問題1" や "正解" / "○" のような表記ゆれも
+    response_parser で読み取る (読めなかった回答は response_parser.parse_stats() で件数を確認できる)。
+
+    Args:
+        gemini_response_json_string: 回答テキスト (JSON 形式と期待)
+    Returns:
+        response_parser.ProblemResults: 問題番号をキー、正誤結果 (True/False) を値とする辞書。
+              回答に確信度が含まれていれば .confidence に問題番号 -> 確信度 (0.0-1.0) を持つ
+              (正誤結果を 1 つも読み取れない場合は None)
+    """
+    return results_from_parsed_response(response_parser.parse_response(gemini_response_json_string),
+                                        gemini_response_json_string)
+
+
+def results_from_parsed_response(parsed, gemini_response_json_string):
+    """
+    response_parser で解析済みの回答 (parse_response / StreamingVerdictParser.finish の戻り値) から正誤結果を取り出す
+
+    Args:
+        parsed:                      解析結果 (読み取れなかった場合は None)
+        gemini_response_json_string: 回答テキスト (エラー表示用)
+    Returns:
+        response_parser.ProblemResults: 確信度付きの正誤結果 (読み取れない場合は None)
+    """
+    if not gemini_response_json_string: # 回答テキストが空の場合 (API エラーの可能性)
+        print("Gemini API response text is empty.") # エラーメッセージ
+        return None
+
+    if parsed is None: # 正誤結果として読める部分がない
+        print("API response format error: no verdicts found.") # エラーメッセージ
+        print("Response text:", gemini_response_json_string) # レスポンス全体を表示 (デバッグ用)
+        return None # エラー時は None を返す
+    if parsed["dropped"]:
+        print(f"解釈できなかった回答: {', '.join(parsed['dropped'])}")
+    problem_results_json = response_parser.ProblemResults(parsed["results"], parsed["confidence"])
+
+    print("Gemini API response (JSON):") # デバッグ用出力
+    print(json.dumps(problem_results_json, indent=4, ensure_ascii=False)) # JSON を整形して表示
+    return problem_results_json # パースした辞書 (problem_results_json) を返す
+
+
+def get_problem_results_from_gemini_json(image_path, cache=None, refresh_cache=False,
+                                         preprocess_options=DEFAULT_PREPROCESS_OPTIONS):
     """
     Gemini API を使って画像内の計算問題を解析し、
     正誤結果を JSON 形式で取得する関数
 
     Args:
         image_path: 計算問題画像のファイルパス
+        cache:      result_cache.ResultCache (None の場合はキャッシュを使わない)
+        refresh_cache: True の場合はキャッシュを読まずに API を呼び出し、結果でキャッシュを上書きする
+        preprocess_options: 送信前の前処理の設定 (preprocess_image.preprocess_for_upload の引数, None で前処理なし)
     Returns:
         dict: 問題番号をキー、正誤結果 (True/False) を値とする辞書
               API リクエスト失敗時などは None を返す
     """
     try:
-        model = genai.GenerativeModel('gemini-2.0-flash-exp') # gemini-2.0-flash-exp モデルを使用
+        with open(image_path, 'rb') as f:
+            image_bytes = f.read() # キャッシュキー計算と API 送信の両方に使う
 
-        image = Image.open(image_path) # 画像を PIL Image オブジェクトとして読み込み
+        # --- キャッシュ確認 (画像・モデル・プロンプトが同じなら API を呼ばない) ---
+        cache_key = None
+        if cache is not None:
+            cache_key = cache_key_for(image_bytes, preprocess_options)
+            if not refresh_cache:
+                cached_results = cache.get(cache_key)
+                if cached_results is not None:
+                    print(f"Cache hit: {image_path}")
+                    return cached_results
 
-        # プロンプト (JSON 形式での回答を指示)
-        prompt_text = """
-        この画像は計算問題です。各問題の正誤判定を行い、
-        問題番号をキー、正誤結果 (正解の場合は true, 不正解の場合は false) を値とする JSON 形式の文字列で出力してください。
-        JSON 形式の文字列 *のみ* を出力し、それ以外のテキスト、特にコードブロックなどは絶対に出力しないでください。
-        """ # ユーザープロンプト
+        model = get_model() # gemini-2.0-flash-exp モデルを使用
 
-        response = model.generate_content([prompt_text, image]) # テキストと画像を Gemini API に送信
+        response = model.generate_content(build_contents(image_bytes, preprocess_options)) # テキストと画像を Gemini API に送信
         response.resolve() # レスポンスを resolve (エラーハンドリングのため)
 
-        if response.text: # 回答テキストが存在する場合
-            gemini_response_json_string = response.text # 回答テキスト (JSON 形式と期待)
-
-            try:
-                problem_results_json = json.loads(gemini_response_json_string) # JSON 文字列を Python 辞書にパース
-                # problem_results = problem_results_json.get("problem_results") # "problem_results" キーの値を取得  <-  削除またはコメントアウト
-
-                # if isinstance(problem_results, dict): # 辞書形式であることを確認 <- 修正
-                if isinstance(problem_results_json, dict): # problem_results_json自体が辞書形式であることを確認
-                    print("Gemini API response (JSON):") # デバッグ用出力
-                    print(json.dumps(problem_results_json, indent=4, ensure_ascii=False)) # JSON を整形して表示
-                    # return problem_results # パースした辞書を返す <- 修正
-                    return problem_results_json # パースした辞書 (problem_results_json) を返す
-                else:
-                    print("API response format error: 'problem_results' key not found or not a dictionary.") # エラーメッセージ
-                    print("Response text:", gemini_response_json_string) # レスポンス全体を表示 (デバッグ用)
-                    return None # エラー時は None を返す
-
-            except json.JSONDecodeError as e: # JSON パースエラー
-                print(f"JSON Decode Error: {e}") # JSON パースエラーメッセージ
-                print("Response text:", gemini_response_json_string) # レスポンス全体を表示 (デバッグ用)
-                return None # エラー時は None を返す
-
-        else: # 回答テキストが空の場合 (API エラーの可能性)
-            print("Gemini API response text is empty.") # エラーメッセージ
-            print("Raw response:", response) # レスポンス全体を表示 (デバッグ用)
-            return None # エラー時は None を返す
+        problem_results = parse_problem_results(response.text)
+        if problem_results is not None and cache is not None:
+            cache.put(cache_key, problem_results, MODEL_NAME) # 成功した結果のみキャッシュ
+        return problem_results
 
     except Exception as e: # 予期せぬエラー
         print(f"Gemini API request error: {e}") # エラーメッセージ
         return None # エラー時は None を返す
-    
+
+
+def get_problem_results_by_region(image_path, layout, problem_numbers=None, cache=None, refresh_cache=False,
+                                  preprocess_options=DEFAULT_PREPROCESS_OPTIONS):
+    """
+    問題ごとの領域を切り出して並べた画像で正誤結果を取得する関数 (問題領域モード)
+
+    ページ全体を送る get_problem_results_from_gemini_json より画像が小さく、
+    結果のキーは必ず位置情報JSONの問題番号になる。problem_numbers で一部の問題だけを採点し直せる。
+
+    Args:
+        image_path:      計算問題画像のファイルパス
+        layout:          layout.Layout
+        problem_numbers: 採点する問題番号のリスト (None で全問題)
+        cache:           result_cache.ResultCache (None の場合はキャッシュを使わない)
+        refresh_cache:   True の場合はキャッシュを読まずに API を呼び出す
+        preprocess_options: 送信前の前処理の設定 (None で前処理なし)
+    Returns:
+        dict: 問題番号をキー、正誤結果 (True/False) を値とする辞書 (失敗時は None)
+    """
+    try:
+        with open(image_path, 'rb') as f:
+            image_bytes = f.read()
+        cache_key, contents, labels = build_region_request(image_bytes, layout, problem_numbers, preprocess_options)
+        if contents is None:
+            print(f"採点する問題がありません: {image_path}")
+            return None
+
+        if cache is not None and not refresh_cache:
+            cached_results = cache.get(cache_key)
+            if cached_results is not None:
+                print(f"Cache hit: {image_path}")
+                return cached_results
+
+        model = get_model()
+        response = model.generate_content(contents)
+        response.resolve()
+
+        problem_results = select_region_results(parse_problem_results(response.text), labels)
+        if problem_results is not None and cache is not None:
+            cache.put(cache_key, problem_results, MODEL_NAME)
+        return problem_results
+
+    except Exception as e: # 予期せぬエラー
+        print(f"Gemini API request error: {e}")
+        return None
+
+
+def split_into_batches(image_paths, batch_size=DEFAULT_BATCH_SIZE, max_batch_bytes=DEFAULT_MAX_BATCH_BYTES):
+    """
+    画像パスのリストを、枚数上限とファイルサイズ合計の上限を守るバッチに分割する関数
+
+    1 枚で上限を超える画像は単独のバッチになる。
+
+    Args:
+        image_paths:     画像ファイルパスのリスト
+        batch_size:      1 バッチの最大枚数
+        max_batch_bytes: 1 バッチの画像ファイルサイズ合計の上限 (バイト)
+    Returns:
+        list: 画像パスのリストのリスト
+    """
+    batches = []
+    current_batch = []
+    current_bytes = 0
+    for image_path in image_paths:
+        image_bytes = os.path.getsize(image_path)
+        if current_batch and (len(current_batch) >= batch_size or current_bytes + image_bytes > max_batch_bytes):
+            batches.append(current_batch)
+            current_batch = []
+            current_bytes = 0
+        current_batch.append(image_path)
+        current_bytes += image_bytes
+    if current_batch:
+        batches.append(current_batch)
+    return batches
+
+
+def get_problem_results_batch_from_gemini_json(image_paths, batch_size=DEFAULT_BATCH_SIZE,
+                                               max_batch_bytes=DEFAULT_MAX_BATCH_BYTES,
+                                               cache=None, refresh_cache=False,
+                                               preprocess_options=DEFAULT_PREPROCESS_OPTIONS):
+    """
+    複数の画像を 1 回の Gemini API リクエストにまとめて正誤結果を取得する関数
+
+    応答はシート番号ごとに分解して画像ごとの辞書に戻す。
+    レート制限・再試行は行わない (GUI・grade_cli は grading_client.AsyncGradingClient.grade_batch を使う)。
+    応答全体が不正な場合はそのバッチの全画像を、特定のシートの結果だけが欠けている・不正な場合は
+    そのシートだけを get_problem_results_from_gemini_json で 1 枚ずつ取得し直す。
+
+    Args:
+        image_paths:     計算問題画像のファイルパスのリスト
+        batch_size:      1 リクエストにまとめる最大枚数
+        max_batch_bytes: 1 リクエストに含める画像ファイルサイズ合計の上限 (バイト)
+        cache:           result_cache.ResultCache (None の場合はキャッシュを使わない)
+        refresh_cache:   True の場合はキャッシュを読まずに API を呼び出す
+        preprocess_options: 送信前の前処理の設定 (None で前処理なし)
+    Returns:
+        dict: 画像パスをキー、正誤結果の辞書 (取得失敗時は None) を値とする辞書
+    """
+    all_results = {}
+    pending_paths = []
+    cache_keys = {}
+
+    # --- キャッシュ済みの画像はリクエストに含めない ---
+    for image_path in image_paths:
+        if cache is not None:
+            try:
+                with open(image_path, 'rb') as f:
+                    cache_keys[image_path] = batch_cache_key_for(f.read(), preprocess_options)
+            except OSError as e:
+                print(f"画像ファイルの読み込みに失敗しました: {e}")
+                all_results[image_path] = None
+                continue
+            if not refresh_cache:
+                cached_results = cache.get(cache_keys[image_path])
+                if cached_results is not None:
+                    print(f"Cache hit: {image_path}")
+                    all_results[image_path] = cached_results
+                    continue
+        pending_paths.append(image_path)
+
+    for batch in split_into_batches(pending_paths, batch_size, max_batch_bytes):
+        if len(batch) == 1: # 1 枚だけなら通常の 1 枚ずつの呼び出し
+            all_results[batch[0]] = get_problem_results_from_gemini_json(
+                batch[0], cache=cache, refresh_cache=refresh_cache, preprocess_options=preprocess_options)
+            continue
+
+        batch_results = _request_batch(batch, preprocess_options)
+        for index, image_path in enumerate(batch):
+            sheet_results = batch_results.get(index) if batch_results is not None else None
+            if sheet_results is None: # このシートだけ 1 枚ずつの呼び出しにフォールバック
+                print(f"Batch fallback: {image_path}")
+                sheet_results = get_problem_results_from_gemini_json(
+                    image_path, cache=cache, refresh_cache=refresh_cache, preprocess_options=preprocess_options)
+            elif cache is not None:
+                cache.put(cache_keys[image_path], sheet_results, MODEL_NAME)
+            all_results[image_path] = sheet_results
+
+    return all_results
+
+
+def _request_batch(batch, preprocess_options=DEFAULT_PREPROCESS_OPTIONS):
+    """
+    1 バッチ分の画像を 1 回のリクエストで送信し、応答をシート番号ごとに分解する
+
+    Returns:
+        dict: シート番号 (int) をキー、正誤結果の辞書を値とする辞書
+              (形式が正しいシートのみ含む。応答全体が不正な場合は None)
+    """
+    try:
+        model = get_model()
+        images_bytes = []
+        for image_path in batch:
+            with open(image_path, 'rb') as f:
+                images_bytes.append(f.read())
+        contents, _ = build_batch_contents(images_bytes, preprocess_options)
+
+        response = model.generate_content(contents) # 全シートを 1 回で送信
+        response.resolve()
+    except Exception as e: # 予期せぬエラー
+        print(f"Gemini API request error (batch): {e}")
+        return None
+    return parse_batch_results(response.text, len(batch))
+
 
 # --- 実行例 ---
 if __name__ == "__main__":
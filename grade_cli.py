@@ -0,0 +1,464 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import add_marks_to_image
+import folder_watcher
+import get_gemini_results_json
+import grade_report
+import grading_client
+import grading_pipeline
+import image_writer
+import job_journal
+import layout
+import local_grader
+import page_source
+import preprocess_image
+import registration
+import response_parser
+import result_cache
+import sheet_dedup
+import tracing
+
+RESULTS_FILE_NAME = "grading_results" # 結果ファイル名 (拡張子は形式に合わせて付ける)
+
+
+class ResultsWriter:
+    """
+    シートごとの採点結果を、処理が終わった順に結果ファイルへ書き出すクラス
+
+    jsonl: 1 行 1 シート ({"sheet", "status", "results", "confidence", "elapsed", ...})
+    csv:   1 行 1 問 (sheet, problem, correct, confidence, status, elapsed, output_path, message)
+    confidence は Gemini の回答に含まれていた問題ごとの確信度 (含まれていない問題は空欄)
+    """
+
+    CSV_FIELDS = ["sheet", "problem", "correct", "confidence", "status", "elapsed", "output_path", "message"]
+
+    def __init__(self, output_folder_path, results_format="jsonl"):
+        self.results_format = results_format
+        self.path = os.path.join(output_folder_path, f"{RESULTS_FILE_NAME}.{results_format}")
+        self._file = open(self.path, 'w', encoding='utf-8', newline='')
+        self._csv_writer = None
+        if results_format == "csv":
+            self._csv_writer = csv.DictWriter(self._file, fieldnames=self.CSV_FIELDS)
+            self._csv_writer.writeheader()
+
+    def write(self, record):
+        """1 シート分の結果を書き出す"""
+        if self._csv_writer is None:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            common = {"sheet": record["sheet"], "status": record["status"], "elapsed": record["elapsed"],
+                      "output_path": record.get("output_path", ""), "message": record.get("message", "")}
+            problem_results = record.get("results") or {}
+            confidence = record.get("confidence") or {}
+            if not problem_results: # 失敗したシートも 1 行は残す
+                self._csv_writer.writerow(dict(common, problem="", correct="", confidence=""))
+            for problem_number, is_correct in problem_results.items():
+                self._csv_writer.writerow(dict(common, problem=problem_number, correct=bool(is_correct),
+                                               confidence=confidence.get(problem_number, "")))
+        self._file.flush() # 途中で止まっても書き出し済みの結果は残す
+
+    def close(self):
+        self._file.close()
+
+
+def event_to_record(event):
+    """パイプラインの完了イベントを結果ファイルの 1 レコードに変換"""
+    record = {
+        "sheet": event["sheet_id"],
+        "image_path": event["image_path"],
+        "status": event["event"],
+        "elapsed": round(event.get("elapsed", 0.0), 3),
+    }
+    if event["event"] == "saved":
+        record["output_path"] = event["output_path"]
+        record["results"] = event.get("problem_results")
+        record["confidence"] = event.get("confidence") or {}
+        record["bytes_written"] = event.get("bytes_written")
+        record["encode_seconds"] = round(event.get("encode_seconds", 0.0), 3)
+        if "alignment" in event:
+            record["alignment"] = event["alignment"]
+    if "message" in event:
+        record["message"] = event["message"]
+    return record
+
+
+def skipped_record(job):
+    """前回完了済みで飛ばしたシートの結果ファイルのレコード (前回の正誤結果と確信度を含める)"""
+    return {"sheet": job.sheet_id, "image_path": job.image_path, "status": "skipped", "elapsed": 0.0,
+            "output_path": job.output_path, "results": job.problem_results,
+            "confidence": response_parser.confidence_of(job.problem_results)}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="画像フォルダ (サブフォルダを含む) をまとめて採点する")
+    parser.add_argument("input_dir", help="採点する画像のフォルダ (サブフォルダも再帰的に探す)")
+    parser.add_argument("--layout", required=True, help="位置情報JSONファイル (position_config_tool.py で作成)")
+    parser.add_argument("--output-dir", default="marked_images", help="採点済み画像と結果ファイルの出力フォルダ")
+    parser.add_argument("--correct-mark", default="circle_red.png", help="正解マーク画像 (〇)")
+    parser.add_argument("--incorrect-mark", default="cross_red.png", help="不正解マーク画像 (✕)")
+    parser.add_argument("--api-workers", type=int, default=4, help="同時に実行する API 呼び出しの数")
+    parser.add_argument("--cpu-workers", type=int, default=2, help="マーク合成・保存を行うワーカーの数")
+    parser.add_argument("--batch-size", type=int, default=1, help="1 回の API リクエストにまとめるシート数")
+    parser.add_argument("--rpm", type=int, default=60, help="1 分あたりのリクエスト数の上限")
+    parser.add_argument("--tpm", type=int, default=1_000_000, help="1 分あたりの入力トークン数の上限")
+    parser.add_argument("--max-retries", type=int, default=5, help="一時的なエラーの再試行回数")
+    parser.add_argument("--region-mode", action="store_true",
+                        help="ページ全体ではなく、問題ごとの領域 (位置情報JSONの「問題領域」) を並べた画像を送る")
+    parser.add_argument("--crop-to-layout", action="store_true",
+                        help="ページ全体ではなく、全問題の範囲 (問題文を含む) だけを切り抜いて送る (位置情報JSONの「問題領域」を使用)")
+    parser.add_argument("--regrade-problems",
+                        help="指定した問題番号だけを採点し直す (例: 2,5。問題領域モードで実行し、他の問題は前回の結果を使う)")
+    parser.add_argument("--answer-key", help="正解キーJSON ({\"問題番号\": \"答え\"})。指定すると読み取れた問題は API を使わずに採点する")
+    parser.add_argument("--local-min-confidence", type=float, default=local_grader.DEFAULT_MIN_CONFIDENCE,
+                        help="ローカル採点で正誤を決める確信度の下限 (これ未満の問題は API で採点)")
+    parser.add_argument("--digit-samples", help="ローカル採点の認識器に追加する手書き数字のフォルダ (<数字>/*.png)")
+    parser.add_argument("--cache-dir", default=".markai_cache", help="正誤結果キャッシュのフォルダ")
+    parser.add_argument("--no-cache", action="store_true", help="キャッシュを使わない")
+    parser.add_argument("--refresh-cache", action="store_true", help="キャッシュを読まずに再採点し、キャッシュを更新する")
+    parser.add_argument("--output-format", choices=list(image_writer.OUTPUT_FORMATS), default="png",
+                        help="採点済み画像の形式 (png: RGBA PNG, png-rgb: 透明度なし PNG, jpeg, webp)")
+    parser.add_argument("--png-compress-level", type=int, default=6, help="PNG の圧縮レベル (0-9, 小さいほど速い)")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG / WebP の品質 (1-100)")
+    parser.add_argument("--writer-threads", type=int, default=2, help="画像の書き出しを行うスレッド数")
+    parser.add_argument("--results-format", choices=["jsonl", "csv"], default="jsonl", help="結果ファイルの形式")
+    parser.add_argument("--no-recursive", action="store_true", help="サブフォルダを探さない")
+    parser.add_argument("--dpi", type=int, default=page_source.DEFAULT_DPI,
+                        help="複数ページの PDF / TIFF のページを画像にする解像度 (0 で元の画像のまま)")
+    parser.add_argument("--pages-ahead", type=int, default=page_source.DEFAULT_MAX_AHEAD,
+                        help="PDF / TIFF のページを採点に先立って画像にしておく枚数の上限 (メモリ・一時ファイルの上限)")
+    parser.add_argument("--assemble", action="store_true",
+                        help="PDF / TIFF ごとに採点済みのページを同じ形式の 1 ファイル (marked_<元のファイル名>) にまとめる")
+    parser.add_argument("--resume", action="store_true",
+                        help="前回の実行記録 (ジャーナル) を使い、完了済みのシートを飛ばして失敗・未処理のシートだけ採点する")
+    parser.add_argument("--report", action="store_true",
+                        help=f"採点後に採点済み画像と集計表をまとめた PDF ({grade_report.REPORT_FILE_NAME}) を出力フォルダに作成する")
+    parser.add_argument("--no-contact-sheet", action="store_true", help="PDF レポートにサムネイルの一覧ページを入れない")
+    parser.add_argument("--watch", action="store_true",
+                        help="採点後もフォルダを監視し、新しく届いた・書き換えられた画像だけを続けて採点する (Ctrl+C で終了)")
+    parser.add_argument("--watch-interval", type=float, default=folder_watcher.DEFAULT_POLL_INTERVAL,
+                        help="フォルダを調べる間隔 (秒)")
+    parser.add_argument("--settle-seconds", type=float, default=folder_watcher.DEFAULT_SETTLE_SECONDS,
+                        help="サイズと更新時刻がこの秒数変わらなければ書き込み完了とみなす (スキャン途中のファイルを読まないため)")
+    parser.add_argument("--align", action="store_true",
+                        help="シートをテンプレート画像に位置合わせし、スキャンのずれ・傾き・拡大率の違いを補正してマークを付ける")
+    parser.add_argument("--template",
+                        help="位置合わせの基準にするテンプレート画像 (省略時は位置情報JSONの「テンプレート画像」)")
+    parser.add_argument("--align-method", choices=registration.METHODS, default="affine",
+                        help="推定する変換 (affine: ずれ・回転・拡大縮小, homography: 斜めから撮影した画像にも対応)")
+    parser.add_argument("--dedup", action="store_true",
+                        help="重複したシート (二重送り・再スキャン) を見つけ、1 枚目の正誤結果を使って API 呼び出しを省く "
+                             f"(まとめた組を {sheet_dedup.REPORT_FILE_NAME} に保存)")
+    parser.add_argument("--dedup-threshold", type=int, default=sheet_dedup.DEFAULT_THRESHOLD,
+                        help="重複の候補とする知覚ハッシュの距離 (0-64, 大きいほど見た目の違うシートも候補にする)")
+    parser.add_argument("--dedup-no-verify", action="store_true",
+                        help="候補を画素で照合せず、ハッシュの距離だけで重複とみなす (速いが、答えが 1 つだけ違うシートもまとめる恐れがある)")
+    parser.add_argument("--stream", action="store_true",
+                        help="回答をストリーミングで受信する (最初の問題の結果までの時間を --trace の api 段に記録)")
+    parser.add_argument("--trace",
+                        help="処理段ごとの計測データの保存先 (.jsonl なら JSONL, それ以外は chrome://tracing / Perfetto 用の JSON)。"
+                             "指定すると終了時に段ごとの p50/p95 も表示する")
+    return parser
+
+
+def run(args):
+    """
+    コマンドライン引数に従って採点を実行する
+
+    Returns:
+        int: 終了コード (全シート成功で 0, 失敗したシートがあれば 1, 実行できなければ 2)
+    """
+    if not os.path.isdir(args.input_dir):
+        print(f"画像フォルダが見つかりません: {args.input_dir}", file=sys.stderr)
+        return 2
+    try:
+        sheet_layout = layout.Layout.load(args.layout, args.correct_mark, args.incorrect_mark)
+    except Exception as e:
+        print(f"位置情報JSONまたはマーク画像の読み込みに失敗しました: {e}", file=sys.stderr)
+        return 2
+
+    answer_key = None
+    if args.answer_key:
+        try:
+            answer_key = local_grader.load_answer_key(args.answer_key)
+        except Exception as e:
+            print(f"正解キーの読み込みに失敗しました: {e}", file=sys.stderr)
+            return 2
+
+    image_files = grading_pipeline.find_image_files(args.input_dir, recursive=not args.no_recursive,
+                                                    exclude_dirs=[args.output_dir])
+    multipage_files = page_source.find_multipage_files(args.input_dir, recursive=not args.no_recursive,
+                                                       exclude_dirs=[args.output_dir])
+    if not image_files and not multipage_files and not args.watch:
+        print(f"画像ファイルが見つかりません: {args.input_dir}", file=sys.stderr)
+        return 2
+
+    regrade_problems = None
+    if args.regrade_problems:
+        regrade_problems = [number.strip() for number in args.regrade_problems.split(",") if number.strip()]
+        unknown = [number for number in regrade_problems if number not in sheet_layout.index_by_problem]
+        if unknown:
+            print(f"位置情報JSONにない問題番号です: {', '.join(unknown)}", file=sys.stderr)
+            return 2
+    region_mode = args.region_mode or regrade_problems is not None
+    if region_mode and args.batch_size > 1:
+        print("問題領域モードでは複数シートをまとめて送りません (--batch-size は無視します)", file=sys.stderr)
+        args.batch_size = 1
+
+    preprocess_options = get_gemini_results_json.DEFAULT_PREPROCESS_OPTIONS
+    if args.crop_to_layout:
+        crop_options = None
+        if region_mode:
+            print("問題領域モードでは問題ごとに切り出して送るため、--crop-to-layout は無視します", file=sys.stderr)
+        else:
+            crop_options = preprocess_image.layout_crop_options(
+                sheet_layout, os.path.join(args.input_dir, image_files[0]) if image_files else None)
+            if crop_options is None:
+                print("問題の範囲を決められないため、ページ全体を送ります (テンプレート画像もシート画像もありません)",
+                      file=sys.stderr)
+        if crop_options is not None:
+            preprocess_options = dict(preprocess_options, **crop_options)
+            print(f"問題の範囲だけを送ります: {crop_options['crop_box']} (基準の画像サイズ {crop_options['crop_reference_size']})")
+
+    registrar = None
+    if args.align:
+        template_path = args.template or sheet_layout.template_path
+        if not template_path:
+            print("位置合わせにはテンプレート画像が必要です (--template で指定するか、位置情報設定ツールで画像を開いて JSON を保存し直してください)",
+                  file=sys.stderr)
+            return 2
+        try:
+            registrar = registration.SheetRegistrar(template_path, method=args.align_method)
+        except ValueError as e:
+            print(f"位置合わせの準備に失敗しました: {e}", file=sys.stderr)
+            return 2
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    cache = None if args.no_cache else result_cache.ResultCache(args.cache_dir)
+    client = grading_client.AsyncGradingClient(
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        max_in_flight=args.api_workers,
+        max_retries=args.max_retries,
+        cache=cache,
+        refresh_cache=args.refresh_cache,
+        preprocess_options=preprocess_options,
+        layout=sheet_layout if region_mode else None,
+        stream=args.stream,
+    )
+    output_writer = image_writer.OutputWriter(args.output_format, compress_level=args.png_compress_level,
+                                              quality=args.quality, max_workers=args.writer_threads)
+
+    journal = job_journal.JobJournal(args.output_dir, sheet_layout.fingerprint)
+    jobs, skipped_jobs = journal.plan(grading_pipeline.build_jobs(args.input_dir, args.output_dir, image_files,
+                                                                 output_extension=output_writer.extension),
+                                      resume=args.resume and regrade_problems is None)
+
+    batch_grader = None
+    if args.batch_size > 1: # まとめたリクエストも 1 枚ずつと同じレート制限・再試行・サーキットブレーカーを通す
+        batch_grader = client.as_sync_batch_grader(batch_size=args.batch_size)
+
+    grader = client.as_sync_grader()
+    previous_results = {}
+    if regrade_problems is not None: # 指定した問題以外は前回の正誤結果を使う
+        previous_results = journal.previous_results(jobs)
+        grader = grading_client.make_partial_regrader(grader, regrade_problems, previous_results)
+    hybrid_grader = None
+    if answer_key is not None: # 読み取れた問題はローカルで採点し、残りだけを API に送る
+        hybrid_grader = local_grader.HybridGrader(
+            local_grader.LocalGrader(sheet_layout, answer_key,
+                                     recognizer=local_grader.KnnDigitRecognizer(args.digit_samples),
+                                     min_confidence=args.local_min_confidence),
+            grader,
+            batch_api_grader=batch_grader,
+        )
+        grader = hybrid_grader
+        if batch_grader is not None:
+            batch_grader = hybrid_grader.grade_batch
+    deduplicator = None
+    if args.dedup: # 重複したシートは 1 枚目の正誤結果を使う (過去の実行の索引はキャッシュフォルダに保存)
+        deduplicator = sheet_dedup.SheetDeduplicator(
+            sheet_layout.fingerprint,
+            index_path=None if args.no_cache or args.refresh_cache else os.path.join(args.cache_dir, sheet_dedup.INDEX_FILE_NAME),
+            threshold=args.dedup_threshold,
+            verify=not args.dedup_no_verify,
+        )
+        grader = deduplicator.wrap(grader)
+        if batch_grader is not None:
+            batch_grader = deduplicator.wrap_batch(batch_grader)
+
+    pipeline = grading_pipeline.GradingPipeline(
+        grader,
+        lambda image_path, problem_results, transform=None: add_marks_to_image.add_marks_with_layout(
+            image_path, sheet_layout, problem_results, output_mode=output_writer.output_mode, transform=transform),
+        api_workers=args.api_workers,
+        cpu_workers=args.cpu_workers,
+        batch_grader=batch_grader,
+        batch_size=args.batch_size,
+        writer=output_writer,
+        registrar=registrar,
+        input_hasher=job_journal.hash_file, # 再開用の入力ハッシュは API 段で求める
+    )
+
+    results_writer = ResultsWriter(args.output_dir, args.results_format)
+    for job in skipped_jobs: # 前回完了済みのシートも結果ファイルには含める
+        results_writer.write(skipped_record(job))
+    counts = {"saved": 0, "failed": 0, "cancelled": 0}
+    problem_counts = {"correct": 0, "total": 0} # 採点した問題の累計 (監視中の集計表示用)
+    low_confidence_sheets = [] # 位置合わせの確信度が低かったシート (要確認)
+    total_jobs = len(jobs)
+    if skipped_jobs:
+        print(f"前回完了済みの {len(skipped_jobs)} 枚を飛ばします")
+    print(f"{len(jobs)} 枚の採点を開始します: {args.input_dir}")
+    spooler = None
+    if multipage_files: # PDF / TIFF はページを 1 枚ずつ画像にして、採点が進むのに合わせて投入する
+        spooler = page_source.PageSpooler(args.input_dir, args.output_dir, multipage_files, dpi=args.dpi or None,
+                                          output_extension=output_writer.extension, max_ahead=args.pages_ahead)
+        print(f"複数ページのファイル {len(multipage_files)} 個のページを順に採点します: {', '.join(multipage_files[:5])}"
+              f"{' ...' if len(multipage_files) > 5 else ''}")
+    tracer = tracing.set_tracer(tracing.Tracer()) if args.trace else None
+    watcher = None
+    if args.watch:
+        watcher = folder_watcher.FolderWatcher(args.input_dir, recursive=not args.no_recursive,
+                                               exclude_dirs=[args.output_dir], settle_seconds=args.settle_seconds)
+        watcher.prime(image_files) # 起動時にあった画像は、書き換えられない限り再採点しない
+        print("フォルダを監視します。新しいシートが届くと採点します (Ctrl+C で監視を終了)")
+    started_at = time.perf_counter()
+    if deduplicator is not None:
+        deduplicator.track(jobs)
+    pipeline.start(jobs, keep_open=watcher is not None or spooler is not None)
+    if spooler is not None:
+        spooler.start()
+    next_poll_at = time.monotonic()
+
+    finished = False
+    try:
+        while not finished:
+            try:
+                pipeline.wait(timeout=0.5)
+                if spooler is not None and not spooler.exhausted: # 画像にできたページを投入
+                    page_jobs, page_errors = spooler.take()
+                    for sheet_id, message in page_errors:
+                        counts["failed"] += 1
+                        results_writer.write({"sheet": sheet_id, "image_path": None, "status": "failed",
+                                              "elapsed": 0.0, "message": message})
+                        print(f"{sheet_id} : {message}", file=sys.stderr)
+                    if page_jobs:
+                        page_jobs, page_skipped = journal.plan(page_jobs, resume=args.resume and regrade_problems is None)
+                        if regrade_problems is not None:
+                            previous_results.update(journal.previous_results(page_jobs))
+                        for job in page_skipped:
+                            results_writer.write(skipped_record(job))
+                            spooler.release(job.sheet_id)
+                        if page_skipped:
+                            print(f"前回完了済みのページ {len(page_skipped)} 枚を飛ばします")
+                        if page_jobs:
+                            total_jobs += len(page_jobs)
+                            if deduplicator is not None: # 一時ファイルではなく元の PDF / TIFF のページで照合する
+                                deduplicator.track(page_jobs)
+                            pipeline.submit(page_jobs)
+                    if spooler.exhausted and watcher is None: # 全ページを投入した
+                        pipeline.close()
+                if watcher is not None and time.monotonic() >= next_poll_at:
+                    next_poll_at = time.monotonic() + args.watch_interval
+                    arrived_files = watcher.poll()
+                    if arrived_files: # 届いたシートだけを採点 (同じ内容で採点済みのものは飛ばす)
+                        arrived_jobs, arrived_skipped = journal.plan(
+                            grading_pipeline.build_jobs(args.input_dir, args.output_dir, arrived_files,
+                                                        output_extension=output_writer.extension))
+                        for job in arrived_skipped:
+                            print(f"採点済みと同じ内容のため飛ばします: {job.sheet_id}")
+                        if arrived_jobs:
+                            total_jobs += len(arrived_jobs)
+                            print(f"{len(arrived_jobs)} 枚が届きました: {', '.join(job.sheet_id for job in arrived_jobs)}")
+                            if deduplicator is not None:
+                                deduplicator.track(arrived_jobs)
+                            pipeline.submit(arrived_jobs)
+            except KeyboardInterrupt:
+                if watcher is not None: # 1 回目は監視だけを終了し、届いたシートは最後まで採点する
+                    watcher = None
+                    if spooler is None or spooler.exhausted: # PDF / TIFF のページが残っていれば投入し終えてから締め切る
+                        pipeline.close()
+                    print("監視を終了します (採点中のシートは最後まで処理します。もう一度 Ctrl+C で中断)", file=sys.stderr)
+                else: # Ctrl+C で残りのシートをキャンセル (書き出し済みの結果は残る)
+                    pipeline.cancel_all()
+                    if spooler is not None: # 残りのページは読まない
+                        spooler.stop()
+                    print("中断します (API 呼び出し中のシートは応答後に破棄します)", file=sys.stderr)
+            for event in pipeline.poll_events(max_events=1000):
+                journal.record(event)
+                if event["event"] == "finished":
+                    finished = True
+                elif event["event"] in counts:
+                    counts[event["event"]] += 1
+                    if spooler is not None: # ページの一時ファイルを消し、次のページを読めるようにする
+                        spooler.release(event["sheet_id"])
+                    results_writer.write(event_to_record(event))
+                    done = sum(counts.values())
+                    status = event.get("message", event["event"])
+                    if event["event"] == "saved":
+                        problem_results = event.get("problem_results") or {}
+                        correct_count = sum(1 for is_correct in problem_results.values() if is_correct)
+                        problem_counts["correct"] += correct_count
+                        problem_counts["total"] += len(problem_results)
+                        status = (f"完了 {correct_count}/{len(problem_results)} 問正解, "
+                                  f"{event['bytes_written'] / 1024:.0f} KB (エンコード {event['encode_seconds'] * 1000:.0f} ms)")
+                        if event.get("alignment", {}).get("low_confidence"):
+                            low_confidence_sheets.append(event["sheet_id"])
+                            status += f" [{event['message']}]"
+                    print(f"[{done}/{total_jobs}] {event['sheet_id']} : {status} ({event.get('elapsed', 0.0):.1f} 秒)")
+                    if args.watch and problem_counts["total"]:
+                        print(f"  累計: 成功 {counts['saved']} 枚, 失敗 {counts['failed']} 枚, "
+                              f"正答率 {problem_counts['correct'] / problem_counts['total']:.0%} "
+                              f"({problem_counts['correct']}/{problem_counts['total']} 問)")
+    finally:
+        if spooler is not None:
+            spooler.stop()
+        output_writer.close()
+        results_writer.close()
+        journal.close()
+        client.close()
+
+    elapsed = time.perf_counter() - started_at
+    print(f"成功 {counts['saved']} 枚, 失敗 {counts['failed']} 枚, キャンセル {counts['cancelled']} 枚 "
+          f"({elapsed:.1f} 秒, API リクエスト {client.stats['requests']} 件, キャッシュヒット {client.stats['cache_hits']} 件)")
+    if hybrid_grader is not None:
+        local_stats = hybrid_grader.stats
+        print(f"ローカル採点 {local_stats['local_problems']} 問, API で採点 {local_stats['api_problems']} 問 "
+              f"(API を省略したシート {hybrid_grader.api_calls_avoided():.0%})")
+    parse_stats = response_parser.parse_stats()
+    if parse_stats["responses"]:
+        print(f"回答の解析: 正常 {parse_stats['clean']} 件, 修復 {parse_stats['recovered']} 件, 失敗 {parse_stats['failed']} 件 "
+              f"(解釈できなかった項目 {parse_stats['dropped_entries']} 件)")
+        for sample in parse_stats["failed_samples"][-3:]:
+            print(f"  読み取れなかった回答: {sample[:200]!r}", file=sys.stderr)
+    if registrar is not None:
+        print(f"位置合わせ: 確信度が低く補正しなかったシート {len(low_confidence_sheets)} 枚"
+              + (f" (要確認: {', '.join(low_confidence_sheets[:20])}{' ...' if len(low_confidence_sheets) > 20 else ''})"
+                 if low_confidence_sheets else ""))
+    if deduplicator is not None:
+        print(deduplicator.format_summary())
+        deduplicator.write_report(os.path.join(args.output_dir, sheet_dedup.REPORT_FILE_NAME))
+    if spooler is not None and args.assemble:
+        for container_path, page_count, missing_count in spooler.assemble():
+            print(f"ページをまとめたファイル: {container_path} ({page_count} ページ"
+                  + (f", 保存できなかった {missing_count} ページは含めていません)" if missing_count else ")"))
+    print(f"結果ファイル: {results_writer.path}")
+    if tracer is not None:
+        print(tracer.format_summary())
+        tracer.export(args.trace)
+        print(f"計測データ: {args.trace}")
+    if args.report:
+        report_path = os.path.join(args.output_dir, grade_report.REPORT_FILE_NAME)
+        page_count = grade_report.build_report(grade_report.load_results(results_writer.path), report_path,
+                                               contact_sheet=not args.no_contact_sheet)
+        print(f"PDF レポート: {report_path} ({page_count} ページ)")
+    return 0 if counts["failed"] == 0 and counts["cancelled"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(run(build_parser().parse_args()))
@@ -0,0 +1,246 @@
+import argparse
+import os
+import socket
+import sys
+import time
+
+import grading_pipeline
+import image_writer
+import work_queue
+
+DEFAULT_QUEUE_PATH = "grading_queue.db" # 待ち行列ファイルの既定のパス
+
+
+def run_enqueue(args):
+    """コーディネーター: 位置情報JSONとマーク画像、フォルダ内のシートを待ち行列に登録する"""
+    import layout
+
+    if not os.path.isdir(args.input_dir):
+        print(f"画像フォルダが見つかりません: {args.input_dir}", file=sys.stderr)
+        return 2
+    try:
+        sheet_layout = layout.Layout.load(args.layout, args.correct_mark, args.incorrect_mark)
+    except Exception as e:
+        print(f"位置情報JSONまたはマーク画像の読み込みに失敗しました: {e}", file=sys.stderr)
+        return 2
+    image_files = grading_pipeline.find_image_files(args.input_dir, recursive=not args.no_recursive,
+                                                    exclude_dirs=[args.output_dir])
+    if not image_files:
+        print(f"画像ファイルが見つかりません: {args.input_dir}", file=sys.stderr)
+        return 2
+
+    queue = work_queue.WorkQueue(args.queue, wal=not args.no_wal)
+    queue.set_setting("output_format", args.output_format) # ワーカーはこの形式で書き出す
+    queue.set_setting("lease_seconds", args.lease_seconds)
+    queue.set_setting("max_attempts", args.max_attempts)
+    queue.set_budget(work_queue.REQUEST_BUDGET, args.rpm or None) # 全ワーカーで共有する上限
+    layout_id = queue.add_layout(sheet_layout, args.layout, args.correct_mark, args.incorrect_mark)
+    jobs = grading_pipeline.build_jobs(args.input_dir, args.output_dir, image_files,
+                                       output_extension=image_writer.OUTPUT_FORMATS[args.output_format][1])
+    added = queue.enqueue(jobs, layout_id, requeue_done=args.requeue_done)
+    print(f"{added} 枚を待ち行列に追加しました ({len(jobs) - added} 枚は登録済み): {args.queue}")
+    print(f"ワーカーの起動: python grade_queue.py work --queue {args.queue}")
+    return 0
+
+
+def run_worker(args):
+    """
+    ワーカー: 待ち行列からシートを取り出して採点し (Gemini API → 〇×マーク合成 → 保存)、結果を書き戻す
+
+    取り出したシートは grading_pipeline.GradingPipeline に投入し、API 呼び出しの前に
+    待ち行列の共有レート制限から枠を取る (キャッシュにある結果は枠を使わない)。
+    """
+    import add_marks_to_image
+    import get_gemini_results_json
+    import result_cache
+
+    queue = work_queue.WorkQueue(args.queue, wal=not args.no_wal)
+    worker_id = args.worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    output_writer = image_writer.OutputWriter(queue.get_setting("output_format", "png"),
+                                              compress_level=args.png_compress_level, quality=args.quality,
+                                              max_workers=args.writer_threads)
+    cache = None if args.no_cache else result_cache.ResultCache(args.cache_dir)
+    limiter = work_queue.SharedRateLimiter(queue)
+    lease_seconds = queue.get_setting("lease_seconds", work_queue.DEFAULT_LEASE_SECONDS)
+    in_flight = {} # 画像パス -> 処理中の QueuedJob
+    layouts = {} # レイアウトID -> layout.Layout
+
+    def grade(image_path):
+        if cache is not None and not args.refresh_cache: # キャッシュにあれば API の枠を使わない
+            with open(image_path, 'rb') as f:
+                cached_results = cache.get(get_gemini_results_json.cache_key_for(f.read()))
+            if cached_results is not None:
+                return cached_results
+        limiter.acquire()
+        return get_gemini_results_json.get_problem_results_from_gemini_json(image_path, cache=cache,
+                                                                            refresh_cache=args.refresh_cache)
+
+    def composite(image_path, problem_results):
+        return add_marks_to_image.add_marks_with_layout(image_path, layouts[in_flight[image_path].layout_id],
+                                                        problem_results, output_mode=output_writer.output_mode)
+
+    pipeline = grading_pipeline.GradingPipeline(grade, composite, api_workers=args.api_workers,
+                                                cpu_workers=args.cpu_workers, writer=output_writer)
+    prefetch = args.prefetch or args.api_workers * 2 # 手元に取り出しておくシート数 (多すぎると他のワーカーの分が減る)
+    counts = {"saved": 0, "retry": 0, "failed": 0}
+    heartbeat_at = time.monotonic() + lease_seconds / 3
+    print(f"ワーカー {worker_id} を開始します: {args.queue}")
+    started_at = time.perf_counter()
+    pipeline.start([], keep_open=True)
+    try:
+        while True:
+            if len(in_flight) < prefetch:
+                jobs = queue.claim(worker_id, prefetch - len(in_flight))
+                for job in jobs:
+                    if job.layout_id not in layouts:
+                        layouts[job.layout_id] = queue.load_layout(job.layout_id)
+                    in_flight[job.image_path] = job
+                if jobs:
+                    pipeline.submit(jobs)
+                elif not in_flight:
+                    remaining = queue.counts()
+                    if not args.wait and remaining["queued"] == 0 and remaining["leased"] == 0:
+                        break # 全シート完了 (他のワーカーの処理中のシートが期限切れで戻る可能性がある間は待つ)
+                    time.sleep(args.poll_interval)
+                    continue
+
+            pipeline.wait(timeout=0.5)
+            for event in pipeline.poll_events(max_events=1000):
+                if event["event"] not in ("saved", "failed", "cancelled"):
+                    continue
+                job = in_flight.pop(event["image_path"])
+                elapsed = event.get("elapsed", 0.0)
+                if event["event"] == "saved":
+                    if queue.complete(job.job_id, worker_id, event["problem_results"], elapsed):
+                        counts["saved"] += 1
+                        status = f"完了 {sum(1 for v in event['problem_results'].values() if v)}/{len(event['problem_results'])} 問正解"
+                    else:
+                        status = "完了 (他のワーカーが処理済みのため結果は書き戻しません)"
+                else:
+                    state = queue.fail(job.job_id, worker_id, event.get("message", event["event"]), elapsed)
+                    counts["retry" if state == "queued" else "failed"] += 1
+                    status = f"{event.get('message', event['event'])} ({'あとで再試行' if state == 'queued' else '失敗'}, {job.attempts} 回目)"
+                print(f"{job.sheet_id} : {status} ({elapsed:.1f} 秒)")
+
+            if time.monotonic() >= heartbeat_at: # 処理中のシートのリースを延長
+                heartbeat_at = time.monotonic() + lease_seconds / 3
+                queue.extend_leases(worker_id, [job.job_id for job in in_flight.values()])
+    except KeyboardInterrupt:
+        pipeline.cancel_all()
+        print(f"中断します (処理中の {queue.release(worker_id)} 枚は待ち行列に戻しました)", file=sys.stderr)
+    finally:
+        pipeline.close()
+        output_writer.close()
+
+    print(f"ワーカー {worker_id}: 完了 {counts['saved']} 枚, 再試行待ち {counts['retry']} 枚, 失敗 {counts['failed']} 枚 "
+          f"({time.perf_counter() - started_at:.1f} 秒, レート制限の待ち {limiter.waited:.1f} 秒)")
+    return 0 if counts["failed"] == 0 else 1
+
+
+def run_status(args):
+    """待ち行列の状態を表示する (期限切れのリースはここでも待ち行列に戻す)"""
+    if not os.path.exists(args.queue):
+        print(f"待ち行列が見つかりません: {args.queue}", file=sys.stderr)
+        return 2
+    queue = work_queue.WorkQueue(args.queue, wal=not args.no_wal)
+    requeued = queue.requeue_expired()
+    counts = queue.counts()
+    total = sum(counts[state] for state in work_queue.JOB_STATES)
+    print(f"全 {total} 枚: 待ち {counts['queued']} 枚, 処理中 {counts['leased']} 枚 (ワーカー {counts['workers']} 台), "
+          f"完了 {counts['done']} 枚, 失敗 {counts['failed']} 枚")
+    if requeued:
+        print(f"リースの期限が切れた {requeued} 枚を待ち行列に戻しました")
+    return 0
+
+
+def run_collect(args):
+    """完了・失敗したシートの結果を、grade_cli.py と同じ形式の結果ファイル (と PDF レポート) にまとめる"""
+    import grade_cli
+    import grade_report
+
+    if not os.path.exists(args.queue):
+        print(f"待ち行列が見つかりません: {args.queue}", file=sys.stderr)
+        return 2
+    queue = work_queue.WorkQueue(args.queue, wal=not args.no_wal)
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_writer = grade_cli.ResultsWriter(args.output_dir, args.results_format)
+    written = 0
+    try:
+        for job in queue.finished_jobs():
+            record = {"sheet": job["sheet"], "image_path": job["image_path"],
+                      "status": "saved" if job["state"] == "done" else "failed",
+                      "elapsed": round(job["elapsed"], 3), "attempts": job["attempts"]}
+            if job["state"] == "done":
+                record["output_path"] = job["output_path"]
+                record["results"] = job["results"]
+            if job["message"]:
+                record["message"] = job["message"]
+            results_writer.write(record)
+            written += 1
+    finally:
+        results_writer.close()
+    print(f"{written} 枚の結果を書き出しました: {results_writer.path}")
+    counts = queue.counts()
+    if counts["queued"] or counts["leased"]:
+        print(f"未完了のシートが {counts['queued'] + counts['leased']} 枚あります (結果ファイルには含みません)")
+    if args.report:
+        report_path = os.path.join(args.output_dir, grade_report.REPORT_FILE_NAME)
+        page_count = grade_report.build_report(grade_report.load_results(results_writer.path), report_path)
+        print(f"PDF レポート: {report_path} ({page_count} ページ)")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="待ち行列 (SQLite ファイル) を使い、複数のワーカープロセス・マシンで採点を分担する")
+    parser.add_argument("--queue", default=DEFAULT_QUEUE_PATH, help="待ち行列ファイル (全ワーカーから同じパスで読めること)")
+    parser.add_argument("--no-wal", action="store_true",
+                        help="WAL モードを使わない (複数のマシンから共有フォルダの待ち行列を使う場合に指定)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    enqueue = commands.add_parser("enqueue", help="シートを待ち行列に登録する (コーディネーター)")
+    enqueue.add_argument("input_dir", help="採点する画像のフォルダ (サブフォルダも再帰的に探す)")
+    enqueue.add_argument("--layout", required=True, help="位置情報JSONファイル")
+    enqueue.add_argument("--output-dir", default="marked_images", help="採点済み画像の出力フォルダ")
+    enqueue.add_argument("--correct-mark", default="circle_red.png", help="正解マーク画像 (〇)")
+    enqueue.add_argument("--incorrect-mark", default="cross_red.png", help="不正解マーク画像 (✕)")
+    enqueue.add_argument("--output-format", choices=list(image_writer.OUTPUT_FORMATS), default="png",
+                         help="採点済み画像の形式 (全ワーカー共通)")
+    enqueue.add_argument("--rpm", type=int, default=60, help="全ワーカー合計の 1 分あたりのリクエスト数の上限 (0 で制限なし)")
+    enqueue.add_argument("--lease-seconds", type=float, default=work_queue.DEFAULT_LEASE_SECONDS,
+                         help="リースの期限 (秒)。ワーカーが止まると、この時間の後にシートが待ち行列に戻る")
+    enqueue.add_argument("--max-attempts", type=int, default=work_queue.DEFAULT_MAX_ATTEMPTS,
+                         help="1 枚あたりの最大試行回数")
+    enqueue.add_argument("--requeue-done", action="store_true", help="完了済みのシートも採点し直す")
+    enqueue.add_argument("--no-recursive", action="store_true", help="サブフォルダを探さない")
+    enqueue.set_defaults(handler=run_enqueue)
+
+    work = commands.add_parser("work", help="待ち行列のシートを採点する (ワーカー, 何台でも起動できる)")
+    work.add_argument("--worker-id", help="ワーカーの名前 (省略時は ホスト名:プロセスID)")
+    work.add_argument("--api-workers", type=int, default=4, help="同時に実行する API 呼び出しの数")
+    work.add_argument("--cpu-workers", type=int, default=2, help="マーク合成・保存を行うワーカーの数")
+    work.add_argument("--prefetch", type=int, help="一度に取り出しておくシート数 (省略時は --api-workers の 2 倍)")
+    work.add_argument("--cache-dir", default=".markai_cache", help="正誤結果キャッシュのフォルダ")
+    work.add_argument("--no-cache", action="store_true", help="キャッシュを使わない")
+    work.add_argument("--refresh-cache", action="store_true", help="キャッシュを読まずに再採点し、キャッシュを更新する")
+    work.add_argument("--png-compress-level", type=int, default=6, help="PNG の圧縮レベル (0-9, 小さいほど速い)")
+    work.add_argument("--quality", type=int, default=90, help="JPEG / WebP の品質 (1-100)")
+    work.add_argument("--writer-threads", type=int, default=2, help="画像の書き出しを行うスレッド数")
+    work.add_argument("--wait", action="store_true", help="待ち行列が空になっても終了せず、新しいシートを待つ (Ctrl+C で終了)")
+    work.add_argument("--poll-interval", type=float, default=2.0, help="待ち行列が空の間に調べ直す間隔 (秒)")
+    work.set_defaults(handler=run_worker)
+
+    status = commands.add_parser("status", help="待ち行列の状態を表示する")
+    status.set_defaults(handler=run_status)
+
+    collect = commands.add_parser("collect", help="採点結果を結果ファイルにまとめる")
+    collect.add_argument("--output-dir", default="marked_images", help="結果ファイルの出力フォルダ")
+    collect.add_argument("--results-format", choices=["jsonl", "csv"], default="jsonl", help="結果ファイルの形式")
+    collect.add_argument("--report", action="store_true", help="採点済み画像と集計表をまとめた PDF レポートも作成する")
+    collect.set_defaults(handler=run_collect)
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    sys.exit(args.handler(args))
@@ -0,0 +1,367 @@
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import zlib
+from PIL import Image, ImageDraw, ImageFont
+
+import job_journal
+
+REPORT_FILE_NAME = "grade_report.pdf" # 既定のレポートファイル名
+SUMMARY_PAGE_SIZE = (1240, 1754) # 集計表・一覧ページの大きさ (A4, 150dpi 相当のピクセル数)
+SUMMARY_ROWS_PER_PAGE = 40 # 集計表 1 ページあたりの行数
+THUMBNAIL_SIZE = (180, 250) # 一覧ページのサムネイルの最大サイズ
+THUMBNAIL_COLUMNS = 6 # 一覧ページの列数
+
+# 日本語を表示できるフォントの候補 (見つからない場合は PIL の既定フォント)
+FONT_CANDIDATES = [
+    "NotoSansCJK-Regular.ttc", "NotoSansJP-Regular.ttf",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+    "C:/Windows/Fonts/meiryo.ttc", "C:/Windows/Fonts/msgothic.ttc", "C:/Windows/Fonts/YuGothM.ttc",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc", "/Library/Fonts/Arial Unicode.ttf",
+]
+
+
+def load_font(size, font_path=None):
+    """集計表の描画に使うフォントを読み込む"""
+    for candidate in ([font_path] if font_path else []) + FONT_CANDIDATES:
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+
+class StreamingPdfWriter:
+    """
+    JPEG 画像を 1 ページずつ PDF に書き込むクラス
+
+    各ページはエンコードした時点でファイルに書き出すため、ページ数が増えてもメモリ使用量は増えない。
+    ページの並び順は close() で決めるので、後から作った集計表ページを先頭に置ける。
+    """
+
+    def __init__(self, pdf_path):
+        self.pdf_path = pdf_path
+        self._file = open(pdf_path, 'wb')
+        self._offsets = {} # オブジェクト番号 -> ファイル内の位置
+        self._next_object = 3 # 1: カタログ, 2: ページツリー
+        self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _begin_object(self, number=None):
+        if number is None:
+            number = self._next_object
+            self._next_object += 1
+        self._offsets[number] = self._file.tell()
+        self._file.write(f"{number} 0 obj\n".encode("ascii"))
+        return number
+
+    def _write_object(self, body, number=None):
+        number = self._begin_object(number)
+        self._file.write(body + b"\nendobj\n")
+        return number
+
+    def _write_stream(self, dictionary, data):
+        number = self._begin_object()
+        self._file.write(f"<< {dictionary} /Length {len(data)} >>\nstream\n".encode("ascii"))
+        self._file.write(data)
+        self._file.write(b"\nendstream\nendobj\n")
+        return number
+
+    def add_image_page(self, image, dpi=150, quality=85):
+        """
+        画像を 1 ページとして追加する
+
+        Args:
+            image:   PIL Image (RGBA の場合は白背景に合成)
+            dpi:     ページの大きさを決める解像度
+            quality: JPEG の品質
+        Returns:
+            int: ページのオブジェクト番号 (close() の並び順の指定に使う)
+        """
+        if image.mode == "RGBA":
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+        color_space = "/DeviceGray" if image.mode == "L" else "/DeviceRGB"
+        width, height = image.size
+        image_object = self._write_stream(
+            f"/Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace {color_space} "
+            f"/BitsPerComponent 8 /Filter /DCTDecode", buffer.getvalue())
+
+        page_width = width * 72.0 / dpi
+        page_height = height * 72.0 / dpi
+        content = zlib.compress(f"q {page_width:.2f} 0 0 {page_height:.2f} 0 0 cm /Im0 Do Q".encode("ascii"))
+        content_object = self._write_stream("/Filter /FlateDecode", content)
+        return self._write_object(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width:.2f} {page_height:.2f}] "
+            f"/Resources << /XObject << /Im0 {image_object} 0 R >> >> /Contents {content_object} 0 R >>".encode("ascii"))
+
+    def close(self, page_order):
+        """
+        ページツリー・相互参照表を書き込んで PDF を完成させる
+
+        Args:
+            page_order: add_image_page() が返したページ番号を表示順に並べたリスト
+        """
+        kids = " ".join(f"{page} 0 R" for page in page_order)
+        self._write_object(f"<< /Type /Pages /Kids [{kids}] /Count {len(page_order)} >>".encode("ascii"), 2)
+        self._write_object(b"<< /Type /Catalog /Pages 2 0 R >>", 1)
+
+        xref_offset = self._file.tell()
+        object_count = self._next_object
+        self._file.write(f"xref\n0 {object_count}\n0000000000 65535 f \n".encode("ascii"))
+        for number in range(1, object_count):
+            self._file.write(f"{self._offsets[number]:010d} 00000 n \n".encode("ascii"))
+        self._file.write(f"trailer\n<< /Size {object_count} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("ascii"))
+        self._file.close()
+
+
+def load_results(path):
+    """
+    保存済みの採点結果を読み込む (再採点せずにレポートを作り直すため)
+
+    Args:
+        path: grade_cli.py の結果ファイル (grading_results.jsonl / .csv)、ジャーナル (grading_journal.jsonl)、
+              またはそれらを含む出力フォルダ
+    Returns:
+        list: シートごとの辞書 ({"sheet", "status", "output_path", "results"}) のリスト。
+              output_path は結果ファイルのフォルダを基準に探した採点済み画像のパス
+    """
+    if os.path.isdir(path):
+        for file_name in ("grading_results.jsonl", "grading_results.csv", job_journal.JOURNAL_FILE_NAME):
+            candidate = os.path.join(path, file_name)
+            if os.path.exists(candidate):
+                path = candidate
+                break
+        else:
+            raise FileNotFoundError(f"結果ファイルが見つかりません: {path}")
+
+    records = {}
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f): # 1 行 1 問をシートごとにまとめる
+                record = records.setdefault(row["sheet"], {"sheet": row["sheet"], "status": row["status"],
+                                                           "output_path": row["output_path"], "results": {}})
+                if row["problem"]:
+                    record["results"][row["problem"]] = row["correct"] == "True"
+        elif os.path.basename(path) == job_journal.JOURNAL_FILE_NAME:
+            for line in f: # GUI で採点した場合は結果ファイルがないため、ジャーナルの最新の状態を使う
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                previous = records.get(entry["sheet"], {})
+                if previous.get("input_hash") != entry.get("input_hash"):
+                    previous = {} # 入力画像が変わったシートは前回の結果を引き継がない
+                records[entry["sheet"]] = {
+                    "sheet": entry["sheet"],
+                    "status": entry["stage"],
+                    "output_path": entry.get("output_path", previous.get("output_path")),
+                    "results": entry.get("results", previous.get("results")),
+                    "input_hash": entry.get("input_hash"),
+                }
+        else:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    records[record["sheet"]] = record # 同じシートは後の行を優先
+    results_dir = os.path.dirname(os.path.abspath(path))
+    for record in records.values():
+        if record.get("output_path"):
+            record["output_path"] = resolve_output_path(record["output_path"], results_dir)
+    return sorted(records.values(), key=lambda record: record["sheet"])
+
+
+def resolve_output_path(output_path, results_dir):
+    """
+    結果ファイルに記録された採点済み画像のパスを、実行時のカレントフォルダに依らず解決する
+
+    相対パスは採点したときのカレントフォルダ基準 (例: marked_images/sub/marked_a.png) で記録されているため、
+    結果ファイルのフォルダ (= 出力フォルダ) を基準にして、先頭のフォルダを順に外しながら探す。
+    見つからない場合は記録されたパスをそのまま返す。
+    """
+    if os.path.isabs(output_path):
+        return output_path
+    parts = os.path.normpath(output_path).split(os.sep)
+    for start in range(len(parts)):
+        candidate = os.path.join(results_dir, *parts[start:])
+        if os.path.exists(candidate):
+            return candidate
+    if os.path.exists(output_path): # 結果ファイルだけを別の場所に移した場合など
+        return os.path.abspath(output_path)
+    return output_path
+
+
+def _problem_sort_key(problem_number):
+    return (0, int(problem_number)) if str(problem_number).isdigit() else (1, str(problem_number))
+
+
+def render_summary_pages(records, font_path=None):
+    """
+    シートごとの正答数と問題ごとの正答率の集計表をページ画像として作る
+
+    Returns:
+        list: PIL Image (1 枚 = 1 ページ) のリスト
+    """
+    font = load_font(22, font_path)
+    title_font = load_font(34, font_path)
+    width, height = SUMMARY_PAGE_SIZE
+    columns = [60, 110, 760, 960, 1100] # No., シート, 正解数, 正答率, 状態 の x 座標
+
+    problem_totals = {}
+    rows = []
+    for number, record in enumerate(records, start=1):
+        problem_results = record.get("results") or {}
+        correct = sum(1 for is_correct in problem_results.values() if is_correct)
+        total = len(problem_results)
+        for problem_number, is_correct in problem_results.items():
+            counts = problem_totals.setdefault(str(problem_number), [0, 0])
+            counts[0] += 1 if is_correct else 0
+            counts[1] += 1
+        rate = f"{correct / total:.0%}" if total else "-"
+        rows.append((str(number), record["sheet"], f"{correct} / {total}", rate, record.get("status", "")))
+
+    problem_lines = [f"問題{problem_number}: {counts[0]}/{counts[1]} ({counts[0] / counts[1]:.0%})"
+                     for problem_number, counts in sorted(problem_totals.items(), key=lambda item: _problem_sort_key(item[0]))]
+
+    pages = []
+    for page_start in range(0, max(1, len(rows)), SUMMARY_ROWS_PER_PAGE):
+        page = Image.new("RGB", (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw(page)
+        draw.text((60, 50), f"採点結果一覧 ({len(records)} 枚)", fill=(0, 0, 0), font=title_font)
+        y = 120
+        for x, header in zip(columns, ["No.", "シート", "正解数", "正答率", "状態"]):
+            draw.text((x, y), header, fill=(0, 0, 0), font=font)
+        draw.line((50, y + 32, width - 50, y + 32), fill=(0, 0, 0), width=2)
+        y += 44
+        for row in rows[page_start:page_start + SUMMARY_ROWS_PER_PAGE]:
+            for x, value in zip(columns, row):
+                draw.text((x, y), value if len(value) <= 48 else "…" + value[-47:], fill=(0, 0, 0), font=font)
+            y += 34
+        pages.append(page)
+
+    # 問題ごとの正答率 (最後のページに入りきらなければページを追加)
+    line_height = 32
+    page = pages[-1]
+    y = 164 + min(len(rows) - (len(pages) - 1) * SUMMARY_ROWS_PER_PAGE, SUMMARY_ROWS_PER_PAGE) * 34 + 40
+    for i, line in enumerate(["問題ごとの正答率"] + problem_lines):
+        if y + line_height > height - 50:
+            page = Image.new("RGB", (width, height), (255, 255, 255))
+            pages.append(page)
+            y = 60
+        ImageDraw.Draw(page).text((60, y), line, fill=(0, 0, 0), font=title_font if i == 0 else font)
+        y += line_height + (16 if i == 0 else 0)
+    return pages
+
+
+def render_contact_sheet_pages(thumbnails, font_path=None):
+    """
+    サムネイル (JPEG バイト列, シート名) から一覧ページを作る
+
+    Returns:
+        list: PIL Image のリスト
+    """
+    font = load_font(16, font_path)
+    width, height = SUMMARY_PAGE_SIZE
+    cell_width = (width - 80) // THUMBNAIL_COLUMNS
+    cell_height = THUMBNAIL_SIZE[1] + 40
+    rows_per_page = (height - 80) // cell_height
+    per_page = rows_per_page * THUMBNAIL_COLUMNS
+
+    pages = []
+    for page_start in range(0, len(thumbnails), per_page):
+        page = Image.new("RGB", (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw(page)
+        for i, (jpeg_bytes, label) in enumerate(thumbnails[page_start:page_start + per_page]):
+            x = 40 + (i % THUMBNAIL_COLUMNS) * cell_width
+            y = 40 + (i // THUMBNAIL_COLUMNS) * cell_height
+            with Image.open(io.BytesIO(jpeg_bytes)) as thumbnail:
+                page.paste(thumbnail, (x + (cell_width - thumbnail.width) // 2, y))
+            draw.text((x + 4, y + THUMBNAIL_SIZE[1] + 8), f"{page_start + i + 1}. {os.path.basename(label)}"[:24],
+                      fill=(0, 0, 0), font=font)
+        pages.append(page)
+    return pages
+
+
+def build_report(records, pdf_path, dpi=150, quality=85, contact_sheet=True, font_path=None, on_missing=None):
+    """
+    採点済み画像を 1 つの PDF にまとめる (先頭に集計表、必要なら一覧ページ)
+
+    採点済み画像は 1 枚ずつ読み込み・エンコード・書き込みを行うため、
+    シート数が多くてもメモリ使用量はほぼ一定。(一覧ページ用に小さな JPEG サムネイルだけを保持する)
+
+    Args:
+        records:       シートごとの辞書 ({"sheet", "output_path", "results", "status"}) のリスト
+        pdf_path:      出力する PDF のファイルパス
+        dpi:           採点済み画像のページの解像度
+        quality:       ページ画像の JPEG 品質
+        contact_sheet: サムネイルの一覧ページを入れるか
+        font_path:     集計表に使うフォントのファイルパス (省略時は自動で探す)
+        on_missing:    採点済み画像が見つからなかったシートごとに on_missing(シートID, 画像パス) を呼ぶ
+                       (省略時は標準エラー出力に表示)
+    Returns:
+        int: PDF のページ数
+    """
+    writer = StreamingPdfWriter(pdf_path)
+    sheet_pages = []
+    thumbnails = []
+    try:
+        for record in records:
+            output_path = record.get("output_path")
+            if not output_path:
+                continue # 失敗したシートは集計表にのみ載せる
+            if not os.path.exists(output_path): # 移動・削除された画像は集計表にのみ載せて知らせる
+                if on_missing is None:
+                    print(f"採点済み画像が見つかりません: {record['sheet']} ({output_path})", file=sys.stderr)
+                else:
+                    on_missing(record["sheet"], output_path)
+                continue
+            with Image.open(output_path) as marked_image:
+                sheet_pages.append(writer.add_image_page(marked_image, dpi=dpi, quality=quality))
+                if contact_sheet:
+                    thumbnail = marked_image.convert("RGB")
+                    thumbnail.thumbnail(THUMBNAIL_SIZE)
+                    buffer = io.BytesIO()
+                    thumbnail.save(buffer, format="JPEG", quality=70)
+                    thumbnails.append((buffer.getvalue(), record["sheet"]))
+
+        front_pages = [writer.add_image_page(page, dpi=150, quality=90) for page in render_summary_pages(records, font_path)]
+        if contact_sheet:
+            front_pages += [writer.add_image_page(page, dpi=150, quality=85)
+                            for page in render_contact_sheet_pages(thumbnails, font_path)]
+    except Exception:
+        writer.close([])
+        raise
+    page_order = front_pages + sheet_pages
+    writer.close(page_order)
+    return len(page_order)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="採点結果 (結果ファイルと採点済み画像) から PDF レポートを作成する")
+    parser.add_argument("results", help="結果ファイル (grading_results.jsonl / .csv)、ジャーナル、または採点済み画像の出力フォルダ")
+    parser.add_argument("-o", "--output", help=f"出力する PDF (省略時は結果ファイルと同じフォルダの {REPORT_FILE_NAME})")
+    parser.add_argument("--dpi", type=int, default=150, help="採点済み画像のページの解像度")
+    parser.add_argument("--quality", type=int, default=85, help="ページ画像の JPEG 品質")
+    parser.add_argument("--no-contact-sheet", action="store_true", help="サムネイルの一覧ページを入れない")
+    parser.add_argument("--font", help="集計表に使うフォントのファイルパス")
+    args = parser.parse_args()
+
+    try:
+        sheet_records = load_results(args.results)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"結果ファイルの読み込みに失敗しました: {e}", file=sys.stderr)
+        sys.exit(1)
+    results_dir = args.results if os.path.isdir(args.results) else os.path.dirname(args.results)
+    report_path = args.output or os.path.join(results_dir, REPORT_FILE_NAME)
+    page_count = build_report(sheet_records, report_path, dpi=args.dpi, quality=args.quality,
+                              contact_sheet=not args.no_contact_sheet, font_path=args.font)
+    print(f"{len(sheet_records)} 枚分のレポート ({page_count} ページ) を {report_path} に保存しました。")
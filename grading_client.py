@@ -0,0 +1,571 @@
+import asyncio
+import io
+import math
+import random
+import threading
+import time
+from collections import deque
+from PIL import Image
+
+import get_gemini_results_json
+import response_parser
+from tracing import get_tracer
+
+# リトライ対象とする HTTP ステータス (レート制限・一時的なサーバーエラー)
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# リトライ対象とする例外クラス名 (google.api_core.exceptions を import せずに判定するため名前で比較)
+RETRYABLE_ERROR_NAMES = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+                         "InternalServerError", "GatewayTimeout", "BadGateway"}
+
+
+def is_retryable_error(error):
+    """一時的なエラー (時間をおけば成功する可能性があるもの) かどうかを判定"""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    code = getattr(error, "code", None)
+    if callable(code): # grpc のエラーは code() がメソッド
+        code = None
+    if isinstance(code, int) and code in RETRYABLE_STATUS_CODES:
+        return True
+    return type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+
+def estimate_request_tokens(image_size, prompt_text=get_gemini_results_json.PROMPT_TEXT):
+    """
+    1 リクエストの入力トークン数を見積もる (トークン/分の制限用)
+
+    Gemini は画像を 768x768 のタイルごとに約 258 トークンとして数えるため、それに合わせて見積もる。
+    """
+    width, height = image_size
+    tiles = max(1, math.ceil(width / 768)) * max(1, math.ceil(height / 768))
+    return tiles * 258 + len(prompt_text)
+
+
+class TokenBucket:
+    """
+    トークンバケット方式のレート制限 (1 分あたりの上限を一定速度で補充)
+
+    Args:
+        per_minute: 1 分あたりの上限 (None で制限なし)
+        burst:      一度に使える最大量 (省略時は per_minute)
+    """
+
+    def __init__(self, per_minute, burst=None):
+        self.per_minute = per_minute
+        self.capacity = burst or per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.per_minute / 60.0)
+        self.updated_at = now
+
+    async def acquire(self, amount=1):
+        """amount 分の枠が空くまで待ってから消費する"""
+        if self.per_minute is None:
+            return
+        amount = min(amount, self.capacity) # 上限を超える要求は満タンになるまで待てば通す
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) * 60.0 / self.per_minute)
+
+    def debit(self, amount):
+        """実際の使用量が見積もりを超えた分を後から差し引く"""
+        if self.per_minute is None:
+            return
+        self._refill()
+        self.tokens -= amount
+
+
+class CircuitBreaker:
+    """
+    直近のリクエストのエラー率が高くなったら、全体の処理を一時停止するサーキットブレーカー
+
+    停止 (open) 中は cooldown 秒待ってから 1 件だけ試し (half-open)、
+    成功すれば再開 (closed)、失敗すればもう一度停止する。
+
+    Args:
+        window:          エラー率を計算する直近のリクエスト数
+        error_threshold: 停止するエラー率 (0.0-1.0)
+        min_requests:    エラー率を判定する最小リクエスト数
+        cooldown:        停止してから再試行するまでの秒数
+    """
+
+    def __init__(self, window=20, error_threshold=0.5, min_requests=5, cooldown=30.0):
+        self.window = window
+        self.error_threshold = error_threshold
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened_at = None
+        self.trip_count = 0 # 停止した回数
+        self._outcomes = deque(maxlen=window) # True: 成功, False: 失敗
+        self._probe_in_flight = False
+
+    async def wait_until_ready(self):
+        """リクエストを送ってよい状態になるまで待つ"""
+        while True:
+            if self.state == "closed":
+                return
+            if self.state == "open":
+                remaining = self.opened_at + self.cooldown - time.monotonic()
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+                    continue
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True # 試しの 1 件だけ通す
+                return
+            await asyncio.sleep(0.1)
+
+    def record(self, success):
+        """リクエストの結果を記録し、必要なら状態を切り替える"""
+        if self.state == "half_open" and self._probe_in_flight:
+            self._probe_in_flight = False
+            if success:
+                self.state = "closed"
+                self._outcomes.clear()
+            else:
+                self._open()
+            return
+
+        self._outcomes.append(success)
+        failures = self._outcomes.count(False)
+        if (self.state == "closed" and len(self._outcomes) >= self.min_requests
+                and failures / len(self._outcomes) >= self.error_threshold):
+            self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.trip_count += 1
+        print(f"サーキットブレーカー作動: エラー率が高いため {self.cooldown:.0f} 秒間リクエストを停止します")
+
+
+class AsyncGradingClient:
+    """
+    レート制限・リトライ・サーキットブレーカー付きの非同期採点クライアント
+
+    リクエスト数/分とトークン数/分の 2 つのトークンバケットで送信速度を抑え、
+    同時実行数を max_in_flight に制限する。一時的なエラー (429 や 503 など) は
+    指数バックオフ + ジッターで max_retries 回まで再試行する。
+
+    GUI からは as_sync_grader() / as_sync_batch_grader() で得た関数を grading_pipeline.GradingPipeline の
+    grader / batch_grader に渡し、ヘッドレス実行では asyncio.run(client.grade_many(paths)) のように使う。
+    複数シートをまとめたリクエスト (grade_batch) も同じ制限・再試行・サーキットブレーカーを通る。
+
+    Args:
+        model:               GenerativeModel (省略時は get_gemini_results_json.get_model() の共有モデル。
+                             動作確認には fake_gemini.FakeGenerativeModel を渡す)
+        requests_per_minute: 1 分あたりのリクエスト数の上限 (None で制限なし)
+        tokens_per_minute:   1 分あたりの入力トークン数の上限 (None で制限なし)
+        max_in_flight:       同時に送信中にできるリクエスト数
+        max_retries:         一時的なエラーの再試行回数
+        base_delay:          バックオフの初期待ち時間 (秒)
+        max_delay:           バックオフの最大待ち時間 (秒)
+        circuit_breaker:     CircuitBreaker (省略時は既定値で作成)
+        cache:               result_cache.ResultCache (None の場合はキャッシュを使わない)
+        refresh_cache:       True の場合はキャッシュを読まずに API を呼び出す
+        preprocess_options:  送信前の前処理の設定 (None で前処理なし)
+        layout:              layout.Layout を指定すると問題領域モードになり、ページ全体ではなく
+                             問題ごとに切り出した領域を並べた画像を送る (一部の問題だけの再採点も可能)
+        stream:              True の場合はストリーミングで回答を受け取り、問題ごとの結果が届いた時点で
+                             on_verdict を呼ぶ (最初の結果までの時間は計測 (tracing) の api 段に記録)
+        on_verdict:          (画像パス, 問題番号, 正誤結果) を受け取る関数 (stream=True の場合のみ。
+                             イベントループのスレッドから呼ばれる)
+    """
+
+    def __init__(self, model=None, requests_per_minute=60, tokens_per_minute=1_000_000, max_in_flight=4,
+                 max_retries=5, base_delay=1.0, max_delay=30.0, circuit_breaker=None, cache=None,
+                 refresh_cache=False, preprocess_options=get_gemini_results_json.DEFAULT_PREPROCESS_OPTIONS,
+                 layout=None, stream=False, on_verdict=None):
+        self.model = model
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.cache = cache
+        self.refresh_cache = refresh_cache
+        self.preprocess_options = preprocess_options
+        self.layout = layout
+        self.stream = stream
+        self.on_verdict = on_verdict
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "parse_failures": 0, "cache_hits": 0}
+        self._semaphore = None # イベントループ上で作成する
+        self._loop = None
+        self._loop_thread = None
+
+    def _get_model(self):
+        if self.model is None:
+            self.model = get_gemini_results_json.get_model() # 全クライアントで 1 つのモデルを共有
+        return self.model
+
+    def _backoff_delay(self, attempt):
+        """attempt 回目の再試行までの待ち時間 (指数バックオフ + フルジッター)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def grade(self, image_path, problem_numbers=None):
+        """
+        1 枚分の正誤結果を取得する
+
+        Args:
+            image_path:      計算問題画像のファイルパス
+            problem_numbers: 採点する問題番号のリスト (問題領域モードのみ有効, None で全問題)
+        Returns:
+            dict: 問題番号をキー、正誤結果 (True/False) を値とする辞書 (再試行しても失敗した場合は None)
+        """
+        tracer = get_tracer()
+        try:
+            with tracer.span("load", sheet=image_path) as span_fields:
+                image_bytes = await asyncio.to_thread(_read_file, image_path) # ディスクの読み込みでイベントループを止めない
+                span_fields["bytes"] = len(image_bytes)
+        except OSError as e:
+            print(f"画像ファイルの読み込みに失敗しました: {e}")
+            return None
+
+        labels = None
+        if self.layout is not None: # 問題領域モード (モザイク画像の作成はスレッドで行い、イベントループを止めない)
+            with tracer.span("preprocess", sheet=image_path) as span_fields:
+                cache_key, contents, labels = await asyncio.to_thread(
+                    get_gemini_results_json.build_region_request, image_bytes, self.layout, problem_numbers,
+                    self.preprocess_options)
+                if contents is not None:
+                    span_fields["bytes"] = _content_bytes(contents[1])
+            if contents is None:
+                print(f"採点する問題がありません: {image_path}")
+                return None
+        else:
+            cache_key = get_gemini_results_json.cache_key_for(image_bytes, self.preprocess_options)
+            contents = None
+
+        if self.cache is not None and not self.refresh_cache:
+            cached_results = await asyncio.to_thread(self.cache.get, cache_key) # キャッシュはディスク上のファイル
+            if cached_results is not None:
+                self.stats["cache_hits"] += 1
+                return cached_results
+
+        if contents is None: # 画像の縮小・圧縮はスレッドで行い、他のシートの送受信を止めない
+            with tracer.span("preprocess", sheet=image_path) as span_fields:
+                contents = await asyncio.to_thread(get_gemini_results_json.build_contents, image_bytes,
+                                                   self.preprocess_options)
+                span_fields["bytes"] = _content_bytes(contents[1])
+        estimated_tokens = estimate_request_tokens(_content_image_size(contents[1]))
+
+        response_text, parsed = await self._request(contents, estimated_tokens, image_path,
+                                                    _content_bytes(contents[1]), stream=self.stream)
+        if response_text is None:
+            return None
+        with tracer.span("parse", sheet=image_path) as span_fields:
+            if self.stream: # 受信しながら解析済み (回答全体を解析し直さない)
+                problem_results = get_gemini_results_json.results_from_parsed_response(parsed, response_text)
+            else:
+                problem_results = get_gemini_results_json.parse_problem_results(response_text)
+            if labels is not None: # 送った問題番号の結果だけを使う
+                problem_results = get_gemini_results_json.select_region_results(problem_results, labels)
+            span_fields["ok"] = problem_results is not None
+        if problem_results is None: # 応答は受け取ったが正誤結果を読み取れなかった
+            self.stats["failures"] += 1
+            self.stats["parse_failures"] += 1
+        elif self.cache is not None:
+            await asyncio.to_thread(self.cache.put, cache_key, problem_results, get_gemini_results_json.MODEL_NAME)
+        return problem_results
+
+    async def _request(self, contents, estimated_tokens, sheet, content_bytes, stream=False, **span_extra):
+        """
+        リクエストを 1 件送信し、回答テキストを返す
+
+        サーキットブレーカー・2 つのトークンバケット・同時実行数の上限を通してから送信し、
+        一時的なエラーは指数バックオフで max_retries 回まで再試行する (1 枚ずつ・まとめて送る場合で共通)。
+
+        Args:
+            contents:         リクエスト内容
+            estimated_tokens: 入力トークン数の見積もり
+            sheet:            計測 (tracing) に記録する画像パス
+            content_bytes:    送信する画像のバイト数 (計測用)
+            stream:           True の場合はストリーミングで受信し、on_verdict を呼ぶ (1 枚ずつの場合のみ)
+            span_extra:       計測の api 段に追加で記録する値
+        Returns:
+            tuple: (回答テキスト, ストリーミング受信時は StreamingVerdictParser.finish() の解析結果・それ以外は None)。
+                   再試行しても失敗した場合は (None, None)
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        tracer = get_tracer()
+        for attempt in range(self.max_retries + 1):
+            await self.circuit_breaker.wait_until_ready()
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(estimated_tokens)
+            async with self._semaphore:
+                self.stats["requests"] += 1
+                try:
+                    with tracer.span("api", sheet=sheet, attempt=attempt, estimated_tokens=estimated_tokens,
+                                     bytes=content_bytes, **span_extra) as span_fields:
+                        if stream:
+                            response, response_text, parsed = await self._receive_stream(contents, sheet, span_fields)
+                        else:
+                            response = await self._get_model().generate_content_async(contents)
+                            response_text, parsed = response.text, None
+                        span_fields["tokens"] = _usage_tokens(response) or estimated_tokens
+                except Exception as e:
+                    retryable = is_retryable_error(e)
+                    self.circuit_breaker.record(False)
+                    if not retryable or attempt == self.max_retries:
+                        print(f"Gemini API request error: {e}")
+                        self.stats["failures"] += 1
+                        return None, None
+                    error = e
+                else:
+                    self.circuit_breaker.record(True)
+                    self._debit_actual_tokens(response, estimated_tokens)
+                    return response_text, parsed
+
+            delay = self._backoff_delay(attempt)
+            self.stats["retries"] += 1
+            print(f"再試行 {attempt + 1}/{self.max_retries} ({delay:.1f} 秒後): {error}")
+            await asyncio.sleep(delay)
+        return None, None
+
+    async def grade_batch(self, image_paths, batch_size=get_gemini_results_json.DEFAULT_BATCH_SIZE,
+                          max_batch_bytes=get_gemini_results_json.DEFAULT_MAX_BATCH_BYTES):
+        """
+        複数シートを 1 回のリクエストにまとめて正誤結果を取得する (batch_size 枚ごと、バッチ同士は並行)
+
+        キャッシュ済みのシートは送らない。応答全体が不正な場合はそのバッチの全シートを、
+        一部のシートの結果だけが欠けている場合はそのシートだけを grade() で 1 枚ずつ取得し直す。
+
+        Args:
+            image_paths:     画像パスのリスト
+            batch_size:      1 リクエストにまとめる最大枚数
+            max_batch_bytes: 1 リクエストに含める画像ファイルサイズ合計の上限 (バイト)
+        Returns:
+            dict: 画像パス -> 正誤結果の辞書 (取得失敗時は None)
+        """
+        all_results = {}
+        pending = {} # 画像パス -> (画像データ, キャッシュキー)
+        for image_path in image_paths:
+            try:
+                image_bytes = await asyncio.to_thread(_read_file, image_path)
+            except OSError as e:
+                print(f"画像ファイルの読み込みに失敗しました: {e}")
+                all_results[image_path] = None
+                continue
+            cache_key = get_gemini_results_json.batch_cache_key_for(image_bytes, self.preprocess_options)
+            if self.cache is not None and not self.refresh_cache:
+                cached_results = await asyncio.to_thread(self.cache.get, cache_key)
+                if cached_results is not None:
+                    self.stats["cache_hits"] += 1
+                    all_results[image_path] = cached_results
+                    continue
+            pending[image_path] = (image_bytes, cache_key)
+
+        batches = get_gemini_results_json.split_into_batches(list(pending), batch_size, max_batch_bytes)
+        for batch_results in await asyncio.gather(*(self._grade_one_batch(batch, pending) for batch in batches)):
+            all_results.update(batch_results)
+        return all_results
+
+    async def _grade_one_batch(self, batch, pending):
+        """grade_batch の 1 リクエスト分 (1 枚だけなら grade() と同じ 1 枚ずつのリクエスト)"""
+        if len(batch) == 1:
+            return {batch[0]: await self.grade(batch[0])}
+
+        tracer = get_tracer()
+        with tracer.span("preprocess", sheet=batch[0], batch_size=len(batch)) as span_fields:
+            contents, upload_images = await asyncio.to_thread( # 画像の縮小・圧縮でイベントループを止めない
+                get_gemini_results_json.build_batch_contents, [pending[path][0] for path in batch],
+                self.preprocess_options)
+            content_bytes = sum(_content_bytes(image) for image in upload_images)
+            span_fields["bytes"] = content_bytes
+        estimated_tokens = sum(estimate_request_tokens(_content_image_size(image), prompt_text="")
+                               for image in upload_images) + len(contents[0])
+
+        response_text, _ = await self._request(contents, estimated_tokens, batch[0], content_bytes,
+                                               batch_size=len(batch))
+        batch_results = None
+        if response_text is not None:
+            with tracer.span("parse", sheet=batch[0], batch_size=len(batch)) as span_fields:
+                batch_results = get_gemini_results_json.parse_batch_results(response_text, len(batch))
+                span_fields["ok"] = batch_results is not None
+
+        results = {}
+        fallback_paths = []
+        for index, image_path in enumerate(batch):
+            sheet_results = batch_results.get(index) if batch_results is not None else None
+            if sheet_results is None: # このシートだけ 1 枚ずつのリクエストで取得し直す
+                fallback_paths.append(image_path)
+                continue
+            if self.cache is not None:
+                await asyncio.to_thread(self.cache.put, pending[image_path][1], sheet_results,
+                                        get_gemini_results_json.MODEL_NAME)
+            results[image_path] = sheet_results
+        if fallback_paths:
+            print(f"Batch fallback: {', '.join(fallback_paths)}")
+            for image_path, sheet_results in zip(fallback_paths,
+                                                 await asyncio.gather(*(self.grade(path) for path in fallback_paths))):
+                results[image_path] = sheet_results
+        return results
+
+    async def _receive_stream(self, contents, image_path, span_fields):
+        """
+        ストリーミングで回答を受け取り、問題ごとの結果が確定するたびに on_verdict を呼ぶ
+
+        Returns:
+            tuple: (応答オブジェクト, 回答テキスト全体, StreamingVerdictParser.finish() の解析結果)
+        """
+        started_at = time.perf_counter()
+        response = await self._get_model().generate_content_async(contents, stream=True)
+        stream_parser = response_parser.StreamingVerdictParser()
+        async for chunk in response:
+            for problem_number, verdict in stream_parser.feed(chunk.text):
+                if "first_verdict_seconds" not in span_fields:
+                    span_fields["first_verdict_seconds"] = time.perf_counter() - started_at
+                if self.on_verdict is not None:
+                    self.on_verdict(image_path, problem_number, verdict)
+        return response, stream_parser.text, stream_parser.finish()
+
+    def _debit_actual_tokens(self, response, estimated_tokens):
+        """応答に使用トークン数が含まれていれば、見積もりとの差をトークンバケットに反映"""
+        prompt_tokens = _usage_tokens(response)
+        if prompt_tokens is not None and prompt_tokens > estimated_tokens:
+            self.token_bucket.debit(prompt_tokens - estimated_tokens)
+
+    async def grade_many(self, image_paths):
+        """複数枚を並行して採点し、{画像パス: 正誤結果} を返す"""
+        results = await asyncio.gather(*(self.grade(image_path) for image_path in image_paths))
+        return dict(zip(image_paths, results))
+
+    # --- スレッドからの利用 (GUI・grading_pipeline 用) ---
+
+    def _ensure_loop(self):
+        """専用スレッドでイベントループを起動する (起動済みなら何もしない)"""
+        if self._loop is not None:
+            return self._loop
+        ready = threading.Event()
+
+        def run_loop():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            ready.set()
+            self._loop.run_forever()
+
+        self._loop_thread = threading.Thread(target=run_loop, name="grading-client-loop", daemon=True)
+        self._loop_thread.start()
+        ready.wait()
+        return self._loop
+
+    def as_sync_grader(self):
+        """
+        任意のスレッドから呼べる同期版の採点関数を返す
+
+        全ての呼び出しは同じイベントループ上で実行されるため、
+        呼び出し元のスレッド数に関係なくレート制限と同時実行数の上限が共有される。
+        """
+        loop = self._ensure_loop()
+
+        def grade_sync(image_path, problem_numbers=None):
+            return asyncio.run_coroutine_threadsafe(self.grade(image_path, problem_numbers), loop).result()
+
+        return grade_sync
+
+    def as_sync_batch_grader(self, batch_size=get_gemini_results_json.DEFAULT_BATCH_SIZE,
+                             max_batch_bytes=get_gemini_results_json.DEFAULT_MAX_BATCH_BYTES):
+        """
+        任意のスレッドから呼べる同期版の grade_batch を返す (grading_pipeline.GradingPipeline の batch_grader 用)
+
+        as_sync_grader() と同じイベントループで実行し、レート制限・同時実行数の上限・統計を共有する。
+        """
+        loop = self._ensure_loop()
+
+        def grade_batch_sync(image_paths):
+            return asyncio.run_coroutine_threadsafe(
+                self.grade_batch(image_paths, batch_size=batch_size, max_batch_bytes=max_batch_bytes), loop).result()
+
+        return grade_batch_sync
+
+    def close(self):
+        """専用スレッドのイベントループを停止"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join(timeout=5)
+            self._loop = None
+
+
+def make_partial_regrader(grader, problem_numbers, previous_results_by_path):
+    """
+    指定した問題だけを採点し直し、他の問題は前回の正誤結果を使う採点関数を作る (問題領域モード用)
+
+    Args:
+        grader:          grade_sync(image_path, problem_numbers) の形で呼べる採点関数 (as_sync_grader の戻り値)
+        problem_numbers: 採点し直す問題番号のリスト
+        previous_results_by_path: 画像パス -> 前回の正誤結果 (job_journal.JobJournal.previous_results)
+    Returns:
+        function: 画像パス -> 正誤結果の辞書 (前回の結果がないシートは全問題を採点)
+    """
+    def regrade(image_path):
+        previous_results = previous_results_by_path.get(image_path)
+        if not previous_results:
+            return grader(image_path)
+        problem_results = grader(image_path, problem_numbers)
+        if problem_results is None:
+            return None
+        merged_results = response_parser.ProblemResults(previous_results, response_parser.confidence_of(previous_results))
+        merged_results.merge(problem_results) # 採点し直した問題は確信度も置き換える
+        return merged_results
+
+    return regrade
+
+
+def _usage_tokens(response):
+    """応答に含まれる入力トークン数 (含まれていなければ None)"""
+    usage = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(usage, "prompt_token_count", None)
+    return prompt_tokens if isinstance(prompt_tokens, int) else None
+
+
+def _read_file(path):
+    """ファイル全体をバイト列で読み込む (asyncio.to_thread でイベントループの外から呼ぶ)"""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _content_bytes(upload_image):
+    """送信する画像のエンコード済みのバイト数 (PIL Image のまま送る場合は 0)"""
+    if isinstance(upload_image, dict):
+        return len(upload_image["data"])
+    return 0
+
+
+def _content_image_size(upload_image):
+    """送信する画像 (PIL Image またはエンコード済みデータ) のサイズを返す"""
+    if isinstance(upload_image, dict):
+        return Image.open(io.BytesIO(upload_image["data"])).size
+    return upload_image.size
+
+
+# --- 実行例 (疑似 API で 429 を発生させて動作を確認) ---
+if __name__ == "__main__":
+    from fake_gemini import FakeGenerativeModel
+
+    fake_model = FakeGenerativeModel(latency=0.2, jitter=0.05, rate_limit_rate=0.2, seed=0)
+    client = AsyncGradingClient(model=fake_model, requests_per_minute=600, max_in_flight=4,
+                                base_delay=0.1, max_delay=1.0,
+                                circuit_breaker=CircuitBreaker(error_threshold=0.8, cooldown=1.0))
+    image_paths = ["keisan_problem.png"] * 20
+
+    async def grade_all():
+        return await asyncio.gather(*(client.grade(image_path) for image_path in image_paths))
+
+    start = time.perf_counter()
+    results = asyncio.run(grade_all())
+    elapsed = time.perf_counter() - start
+
+    succeeded = sum(1 for r in results if r is not None)
+    print(f"{succeeded}/{len(image_paths)} 枚成功, {elapsed:.2f} 秒, 統計: {client.stats}, "
+          f"最大同時実行数: {fake_model.max_in_flight}")
@@ -0,0 +1,423 @@
+import os
+import queue
+import threading
+import time
+
+import response_parser
+from tracing import get_tracer
+
+# 採点対象とする画像ファイルの拡張子
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+
+class SheetJob:
+    """採点対象 1 枚分の情報 (パイプライン内部で受け渡す)"""
+
+    def __init__(self, sheet_id, image_path, output_path):
+        self.sheet_id = sheet_id # シートID (通常は画像ファイル名)
+        self.image_path = image_path # 入力画像のファイルパス
+        self.output_path = output_path # 採点済み画像の出力ファイルパス
+        self.source_path = image_path # 元の入力ファイル (複数ページのファイルのページは PDF / TIFF のパス)
+        self.page_number = None # 複数ページのファイルのページ番号 (1 から。image_path は採点後に消える一時ファイル)
+        self.problem_results = None # Gemini API から取得した正誤結果 (事前に設定すると API 呼び出しを省略)
+        self.input_hash = None # 入力画像のハッシュ (job_journal が計算済み、または API 段で input_hasher が求める)
+        self.started_at = None # 処理開始時刻 (time.perf_counter)
+        self.alignment = None # 位置合わせの結果の要約 (registration.Registration.summary, 位置合わせしない場合は None)
+
+
+class GradingPipeline:
+    """
+    採点処理を「API 呼び出し」と「マーク合成・保存」の 2 段に分け、
+    それぞれを別のワーカースレッド群で並行実行するパイプライン
+
+    段と段の間は上限付きキューでつなぎ、API 側が先行しすぎないようにする。
+    処理結果はイベント (辞書) として結果キューに積まれ、
+    GUI からは poll_events() を after() で定期的に呼び出して受け取る。
+    "graded" と "saved" イベントの confidence は問題ごとの確信度 (正誤結果が
+    response_parser.ProblemResults で、回答に確信度が含まれていた問題のみ)。
+
+    Args:
+        grader:      画像パスを受け取り正誤結果の辞書 (失敗時 None) を返す関数
+                     (通常は get_gemini_results_json.get_problem_results_from_gemini_json)
+        compositor:  (画像パス, 正誤結果) を受け取りマーク合成済み画像 (失敗時 None) を返す関数
+                     (registrar を指定した場合は、キーワード引数 transform で正解位置の変換関数も受け取る)
+        saver:       (画像, 出力パス) を受け取り画像を保存する関数 (省略時は image.save)
+        api_workers: 同時に実行する API 呼び出しの数
+        cpu_workers: マーク合成・保存を行うワーカーの数
+        queue_size:  段と段の間のキューの上限 (0 以下で上限なし)
+        batch_grader: 画像パスのリストを受け取り {画像パス: 正誤結果} を返す関数 (省略時はまとめない)
+                      (通常は grading_client.AsyncGradingClient.as_sync_batch_grader() の戻り値)
+        batch_size:  batch_grader に 1 回で渡す最大枚数
+        writer:      image_writer.OutputWriter (指定した場合は saver の代わりにバックグラウンドで書き出し、
+                     "saved" イベントに書き出しバイト数とエンコード時間を含める)
+        registrar:   registration.SheetRegistrar (指定した場合は合成前にシートをテンプレートに位置合わせし、
+                     "saved" イベントに位置合わせの結果 (alignment) を含める)
+        input_hasher: 画像パスを受け取り入力画像のハッシュを返す関数 (通常は job_journal.hash_file)。
+                      指定した場合は API 段で求め、以降のイベントの input_hash に含める (GUI スレッドで計算しない)
+    """
+
+    def __init__(self, grader, compositor, saver=None, api_workers=4, cpu_workers=2, queue_size=8,
+                 batch_grader=None, batch_size=1, writer=None, registrar=None, input_hasher=None):
+        self.grader = grader
+        self.input_hasher = input_hasher
+        self.batch_grader = batch_grader
+        self.batch_size = max(1, int(batch_size))
+        self.writer = writer
+        self.registrar = registrar
+        self.compositor = compositor
+        self.saver = saver or (lambda image, output_path: image.save(output_path))
+        self.api_workers = max(1, int(api_workers))
+        self.cpu_workers = max(1, int(cpu_workers))
+
+        job_queue_size = max(queue_size, self.batch_size * self.api_workers) if queue_size > 0 else 0 # バッチを組めるだけの余裕を持たせる
+        self._job_queue = queue.Queue(maxsize=job_queue_size) # 投入待ち → API 段
+        self._composite_queue = queue.Queue(maxsize=max(0, queue_size)) # API 段 → 合成段
+        self._event_queue = queue.Queue() # 結果イベント (GUI 側が取り出す)
+        self._inbox = queue.Queue() # 投入されたジョブ (上限なし。投入側をブロックしない)
+        self._keep_open = False # True の間は全シートが終わっても終了しない (フォルダ監視用)
+
+        self._cancelled_ids = set() # キャンセル済みのシートID
+        self._cancel_all = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pending = 0 # 未完了のシート数
+        self._finished = threading.Event()
+        self._finish_sent = False
+        self.started_at = None
+
+    # --- 公開API ---
+
+    def start(self, jobs, keep_open=False):
+        """
+        ジョブ (SheetJob のリスト) を投入してパイプラインを開始する
+
+        呼び出し元のスレッド (GUI スレッド) はブロックしない。
+        keep_open=True の場合は全シートが終わっても終了せず、submit() で後からジョブを追加できる
+        (フォルダ監視で新しいシートが届くたびに投入する場合)。close() を呼ぶと残りを処理して終了する。
+        """
+        jobs = list(jobs)
+        self._keep_open = keep_open
+        self._pending = len(jobs)
+        self.started_at = time.perf_counter()
+        if not jobs and not keep_open:
+            self._finished.set()
+            self._event_queue.put({"event": "finished", "elapsed": 0.0})
+            return
+
+        for job in jobs:
+            self._inbox.put(job)
+        feeder = threading.Thread(target=self._feed, name="grading-feeder", daemon=True)
+        self._threads.append(feeder)
+        for i in range(self.api_workers):
+            self._threads.append(threading.Thread(target=self._api_worker, name=f"grading-api-{i}", daemon=True))
+        for i in range(self.cpu_workers):
+            self._threads.append(threading.Thread(target=self._cpu_worker, name=f"grading-cpu-{i}", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, jobs):
+        """
+        実行中のパイプラインにジョブを追加する (start(keep_open=True) で開始した場合のみ)
+
+        Raises:
+            RuntimeError: keep_open=False で開始した、または close() 済みの場合
+        """
+        jobs = list(jobs)
+        with self._lock:
+            if not self._keep_open:
+                raise RuntimeError("ジョブを追加できるのは keep_open=True で開始したパイプラインのみです")
+            self._pending += len(jobs)
+        for job in jobs:
+            self._inbox.put(job)
+
+    def close(self):
+        """ジョブの追加を締め切る (投入済みのジョブが全て終わると "finished" イベントを出して終了)"""
+        with self._lock:
+            self._keep_open = False
+            done = self._pending <= 0
+        if done:
+            self._finish()
+
+    def cancel(self, sheet_id):
+        """指定したシートの処理をキャンセル (API 呼び出し中の場合は結果を破棄する)"""
+        with self._lock:
+            self._cancelled_ids.add(sheet_id)
+
+    def cancel_all(self):
+        """未完了の全シートの処理をキャンセル"""
+        self._cancel_all.set()
+
+    def is_cancelled(self, sheet_id):
+        """指定したシートがキャンセルされているか"""
+        if self._cancel_all.is_set():
+            return True
+        with self._lock:
+            return sheet_id in self._cancelled_ids
+
+    def poll_events(self, max_events=100):
+        """溜まっているイベントをブロックせずに取り出す (GUI の after() から呼ぶ)"""
+        events = []
+        while len(events) < max_events:
+            try:
+                events.append(self._event_queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def wait(self, timeout=None):
+        """全シートの処理が終わるまで待つ (ヘッドレス実行用)"""
+        return self._finished.wait(timeout)
+
+    @property
+    def finished(self):
+        return self._finished.is_set()
+
+    # --- 内部処理 ---
+
+    def _emit(self, event, job, **fields):
+        """イベントを結果キューに積む"""
+        payload = {"event": event, "sheet_id": job.sheet_id, "image_path": job.image_path,
+                   "output_path": job.output_path}
+        if job.input_hash is not None:
+            payload["input_hash"] = job.input_hash
+        payload.update(fields)
+        self._event_queue.put(payload)
+
+    def _complete(self, job, event, **fields):
+        """シート 1 枚分の処理を終了扱いにする (成功・失敗・キャンセル共通)"""
+        finished_at = time.perf_counter()
+        elapsed = finished_at - job.started_at if job.started_at else 0.0
+        if event == "saved" and job.started_at: # シート全体 (API 待ちから保存まで) の所要時間
+            get_tracer().record("sheet", job.started_at, finished_at, sheet=job.image_path)
+        if event == "saved":
+            fields["confidence"] = response_parser.confidence_of(job.problem_results) # 問題ごとの確信度 (回答に含まれていた場合)
+        if event == "saved" and job.alignment is not None:
+            fields["alignment"] = job.alignment
+            if job.alignment["low_confidence"]: # マークの位置がずれている可能性がある (要確認)
+                fields["message"] = f"位置合わせの確信度が低いため補正していません (要確認): {job.alignment.get('reason', '')}"
+        self._emit(event, job, elapsed=elapsed, **fields)
+        with self._lock:
+            self._pending -= 1
+            done = self._pending <= 0 and not self._keep_open
+        if done:
+            self._finish()
+
+    def _finish(self):
+        """全シートの処理が終わったことを通知する (1 回だけ)"""
+        with self._lock:
+            if self._finish_sent:
+                return
+            self._finish_sent = True
+        self._event_queue.put({"event": "finished", "elapsed": time.perf_counter() - self.started_at})
+        self._finished.set()
+
+    def _next_job(self, source_queue):
+        """キューから次のジョブを取り出す (全シート完了後は None を返してワーカーを終了させる)"""
+        while not self._finished.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _feed(self):
+        """
+        投入されたジョブを API 段のキューに順に渡す (キューが一杯なら空くまで待つ)
+
+        正誤結果が設定済みのジョブ (再開時に前回の結果を再利用する場合など) は API 段を飛ばして合成段へ渡す。
+        """
+        while True:
+            job = self._next_job(self._inbox)
+            if job is None:
+                return
+            if job.problem_results is not None:
+                job.started_at = time.perf_counter()
+                self._emit("graded", job, problem_results=job.problem_results,
+                           confidence=response_parser.confidence_of(job.problem_results), reused=True)
+                self._composite_queue.put(job)
+            else:
+                self._job_queue.put(job)
+
+    def _api_worker(self):
+        """API 段: 正誤結果を取得して合成段へ渡す (batch_size > 1 なら複数シートをまとめて取得)"""
+        while True:
+            job = self._next_job(self._job_queue)
+            if job is None:
+                return
+            batch = [job]
+            while self.batch_grader is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._job_queue.get_nowait()) # すでに待っているジョブだけをまとめる
+                except queue.Empty:
+                    break
+
+            active_jobs = []
+            for batch_job in batch:
+                batch_job.started_at = time.perf_counter()
+                if self.is_cancelled(batch_job.sheet_id):
+                    self._complete(batch_job, "cancelled")
+                    continue
+                if self.input_hasher is not None and batch_job.input_hash is None:
+                    try:
+                        batch_job.input_hash = self.input_hasher(batch_job.image_path) # 一時ファイルが消える前に求める
+                    except OSError:
+                        pass # 読めない画像は採点の失敗として扱う
+                self._emit("started", batch_job)
+                active_jobs.append(batch_job)
+            if not active_jobs:
+                continue
+
+            try:
+                if len(active_jobs) > 1:
+                    results_by_path = self.batch_grader([j.image_path for j in active_jobs])
+                else:
+                    results_by_path = {active_jobs[0].image_path: self.grader(active_jobs[0].image_path)}
+            except Exception as e: # 予期せぬエラー
+                for active_job in active_jobs:
+                    self._complete(active_job, "failed", stage="api", message=f"予期せぬエラー: {e}", error=e)
+                continue
+
+            for active_job in active_jobs:
+                self._handle_graded(active_job, results_by_path.get(active_job.image_path))
+
+    def _handle_graded(self, job, problem_results):
+        """API 段の結果を受けて、失敗・キャンセル扱いにするか合成段へ渡す"""
+        if problem_results is None:
+            self._complete(job, "failed", stage="api", message="Gemini API エラーまたは正誤結果取得失敗")
+            return
+        if self.is_cancelled(job.sheet_id):
+            self._complete(job, "cancelled")
+            return
+
+        job.problem_results = problem_results
+        self._emit("graded", job, problem_results=problem_results,
+                   confidence=response_parser.confidence_of(problem_results))
+        self._composite_queue.put(job)
+
+    def _cpu_worker(self):
+        """合成段: 〇×マークを合成して保存する"""
+        while True:
+            job = self._next_job(self._composite_queue)
+            if job is None:
+                return
+            if self.is_cancelled(job.sheet_id):
+                self._complete(job, "cancelled")
+                continue
+
+            try:
+                transform = None
+                if self.registrar is not None: # テンプレートとのずれ・傾きを求め、マークの位置を補正する
+                    with get_tracer().span("register", sheet=job.image_path) as span_fields:
+                        registration = self.registrar.register(job.image_path)
+                        span_fields["inliers"] = registration.inliers
+                    job.alignment = registration.summary()
+                    if registration.matrix is not None:
+                        transform = registration.transform_point
+                with get_tracer().span("composite", sheet=job.image_path):
+                    if transform is None:
+                        marked_image = self.compositor(job.image_path, job.problem_results)
+                    else:
+                        marked_image = self.compositor(job.image_path, job.problem_results, transform=transform)
+                if marked_image is None:
+                    self._complete(job, "failed", stage="composite", message="〇×マーク合成失敗")
+                    continue
+                self._emit("composited", job)
+                if self.writer is not None: # エンコードと書き込みは書き出し用スレッドに任せて次のシートへ
+                    future = self.writer.submit(marked_image, job.output_path)
+                    future.add_done_callback(lambda f, job=job: self._on_written(job, f))
+                    continue
+                with get_tracer().span("write", sheet=job.image_path):
+                    self.saver(marked_image, job.output_path)
+            except Exception as e: # 予期せぬエラー
+                self._complete(job, "failed", stage="composite", message=f"予期せぬエラー: {e}", error=e)
+                continue
+
+            self._complete(job, "saved", problem_results=job.problem_results)
+
+    def _on_written(self, job, future):
+        """書き出し用スレッドでの保存が終わった時の処理"""
+        try:
+            write_stats = future.result()
+        except Exception as e: # 予期せぬエラー
+            self._complete(job, "failed", stage="write", message=f"画像の保存に失敗しました: {e}", error=e)
+            return
+        tracer = get_tracer()
+        encoded_at = write_stats["started_at"] + write_stats["encode_seconds"]
+        tracer.record("encode", write_stats["started_at"], encoded_at, sheet=job.image_path,
+                      bytes=write_stats["bytes_written"])
+        tracer.record("write", encoded_at, encoded_at + write_stats["write_seconds"], sheet=job.image_path,
+                      bytes=write_stats["bytes_written"])
+        self._complete(job, "saved", problem_results=job.problem_results,
+                       bytes_written=write_stats["bytes_written"],
+                       encode_seconds=write_stats["encode_seconds"],
+                       write_seconds=write_stats["write_seconds"])
+
+
+def find_image_files(image_folder_path, recursive=False, exclude_dirs=(), extensions=IMAGE_EXTENSIONS):
+    """
+    フォルダ内の画像ファイルを探す関数
+
+    Args:
+        image_folder_path: 画像フォルダのパス
+        recursive:         サブフォルダも探すか
+        exclude_dirs:      探索しないフォルダのパスのリスト (出力フォルダなど)
+        extensions:        探すファイルの拡張子 (小文字)
+    Returns:
+        list: image_folder_path からの相対パスのリスト (ソート済み)
+    """
+    if not recursive:
+        return sorted(f for f in os.listdir(image_folder_path) if f.lower().endswith(extensions))
+
+    excluded = {os.path.abspath(d) for d in exclude_dirs}
+    image_files = []
+    for dir_path, dir_names, file_names in os.walk(image_folder_path):
+        dir_names[:] = sorted(d for d in dir_names if os.path.abspath(os.path.join(dir_path, d)) not in excluded)
+        for file_name in file_names:
+            if file_name.lower().endswith(extensions):
+                image_files.append(os.path.relpath(os.path.join(dir_path, file_name), image_folder_path))
+    return sorted(image_files)
+
+
+def build_jobs(image_folder_path, output_folder_path, image_files, output_extension=None):
+    """
+    画像ファイル (image_folder_path からの相対パス) のリストから SheetJob のリストを作成
+
+    サブフォルダ内の画像は、出力フォルダ内の同じ構成のサブフォルダに marked_<ファイル名> で出力する。
+    output_extension を指定した場合は出力ファイルの拡張子をそれに置き換える (例: ".jpg")。
+    """
+    jobs = []
+    for image_file in image_files:
+        output_name = f"marked_{os.path.basename(image_file)}"
+        if output_extension:
+            output_name = os.path.splitext(output_name)[0] + output_extension
+        jobs.append(SheetJob(image_file,
+                             os.path.join(image_folder_path, image_file),
+                             os.path.join(output_folder_path, os.path.dirname(image_file), output_name)))
+    return jobs
+
+
+# --- 実行例 (スタブの採点関数で並行実行の効果を確認) ---
+if __name__ == "__main__":
+    api_latency = 0.5 # 1 枚あたりの API 呼び出し時間 (秒, 疑似)
+    sheet_count = 16
+    api_workers = 8
+
+    def stub_grader(image_path):
+        time.sleep(api_latency) # API 呼び出しの代わりに待つだけ
+        return {"1": True, "2": False, "3": True}
+
+    def stub_compositor(image_path, problem_results):
+        time.sleep(0.01) # マーク合成の代わり
+        return object()
+
+    jobs = [SheetJob(f"sheet_{i:02d}.png", f"sheet_{i:02d}.png", f"marked_sheet_{i:02d}.png") for i in range(sheet_count)]
+    pipeline = GradingPipeline(stub_grader, stub_compositor, saver=lambda image, path: None,
+                               api_workers=api_workers, cpu_workers=2)
+    pipeline.start(jobs)
+    pipeline.wait()
+
+    events = pipeline.poll_events(max_events=10_000)
+    saved = sum(1 for e in events if e["event"] == "saved")
+    elapsed = events[-1]["elapsed"]
+    print(f"{saved}/{sheet_count} 枚を処理: {elapsed:.2f} 秒 "
+          f"(逐次実行なら約 {api_latency * sheet_count:.2f} 秒, 理論値 約 {api_latency * sheet_count / api_workers:.2f} 秒)")
@@ -0,0 +1,165 @@
+import collections
+import logging
+import logging.handlers
+import queue
+
+DEFAULT_LOG_PATH = "markai.log" # 全てのログを書き出すファイル
+DEFAULT_MAX_BYTES = 1_000_000 # ログファイルがこの大きさを超えたら切り替える (バイト)
+DEFAULT_BACKUP_COUNT = 3 # 残しておく古いログファイルの数 (markai.log.1 〜 .3)
+DEFAULT_MAX_LINES = 500 # 画面に表示しておく行数 (表示エリアごと、古い行から消す)
+VIEWS = ("progress", "error") # progress: 進捗状況, error: エラーメッセージ
+FILE_FORMAT = "%(asctime)s %(levelname)-7s %(message)s"
+
+
+class _ViewHandler(logging.Handler):
+    """ログを表示待ちのキューに入れるハンドラ (どのスレッドから呼ばれてもよい。Tk の操作はしない)"""
+
+    def __init__(self, pending):
+        super().__init__()
+        self.pending = pending
+
+    def emit(self, record):
+        self.pending.put((getattr(record, "view", "progress"), record.getMessage()))
+
+
+class GuiLog:
+    """
+    GUI の進捗・エラー表示用のログ
+
+    ワーカースレッドを含むどこからでも log() で書き込め、メッセージはキューに溜まる。
+    GUI スレッドは drain() で溜まった分をまとめて取り出し、append_lines() で 1 回の挿入で表示する
+    (メッセージごとにウィジェットを更新しない)。画面には表示エリアごとに max_lines 行だけを残し、
+    全てのログは (画面の表示レベルに関係なく) ローテーションするファイルに書き出す。
+    """
+
+    def __init__(self, log_path=DEFAULT_LOG_PATH, level=logging.INFO, file_level=logging.DEBUG,
+                 max_lines=DEFAULT_MAX_LINES, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT):
+        """
+        Args:
+            log_path:     ログファイルのパス (None でファイルに書き出さない)
+            level:        画面に表示するレベル (logging.DEBUG で処理段ごとの詳細も表示)
+            file_level:   ログファイルに書き出すレベル
+            max_lines:    表示エリアごとに残す行数
+            max_bytes:    ログファイルを切り替える大きさ (バイト)
+            backup_count: 残しておく古いログファイルの数
+        """
+        self.max_lines = max_lines
+        self.pending = queue.SimpleQueue() # (表示エリア, メッセージ)
+        self.logger = logging.Logger("markai.gui") # ルートロガーには流さない (他のライブラリのログと混ぜない)
+        self.view_handler = _ViewHandler(self.pending)
+        self.view_handler.setLevel(level)
+        self.logger.addHandler(self.view_handler)
+        self.file_handler = None
+        if log_path:
+            self.file_handler = logging.handlers.RotatingFileHandler(
+                log_path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+            self.file_handler.setFormatter(logging.Formatter(FILE_FORMAT))
+            self.file_handler.setLevel(file_level)
+            self.logger.addHandler(self.file_handler)
+        self.logger.setLevel(min(level, file_level))
+        self.dropped = {view: 0 for view in VIEWS} # 画面に表示する前に消えた行数 (ファイルには残っている)
+
+    @property
+    def level(self):
+        """画面に表示するレベル"""
+        return self.view_handler.level
+
+    def set_level(self, level):
+        """画面に表示するレベルを変更する (ファイルに書き出すレベルは変えない)"""
+        self.view_handler.setLevel(level)
+        self.logger.setLevel(min(level, self.file_handler.level if self.file_handler is not None else level))
+
+    def log(self, message, level=logging.INFO, view="progress"):
+        """
+        メッセージを記録する (スレッドセーフ。表示されるのは次の drain() の後)
+
+        Args:
+            message: メッセージ
+            level:   logging のレベル (処理段ごとの経過は DEBUG)
+            view:    表示エリア ("progress" または "error")
+        """
+        self.logger.log(level, message, extra={"view": view})
+
+    def progress(self, message, level=logging.INFO):
+        """進捗状況を記録する"""
+        self.log(message, level, "progress")
+
+    def error(self, message, level=logging.ERROR):
+        """エラーメッセージを記録する"""
+        self.log(message, level, "error")
+
+    def drain(self):
+        """
+        溜まったメッセージを全て取り出す (GUI スレッドから定期的に呼ぶ)
+
+        Returns:
+            dict: 表示エリア -> 表示する行のリスト (1 回に max_lines 行まで。超えた分は古い順に捨てる)
+        """
+        lines = {view: collections.deque(maxlen=self.max_lines) for view in VIEWS}
+        received = {view: 0 for view in VIEWS}
+        while True:
+            try:
+                view, message = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            lines[view].append(message)
+            received[view] += 1
+        for view in VIEWS:
+            self.dropped[view] += received[view] - len(lines[view])
+        return {view: list(view_lines) for view, view_lines in lines.items() if view_lines}
+
+    def close(self):
+        """ログファイルを閉じる"""
+        if self.file_handler is not None:
+            self.logger.removeHandler(self.file_handler)
+            self.file_handler.close()
+            self.file_handler = None
+
+
+def append_lines(text_widget, lines, max_lines=DEFAULT_MAX_LINES):
+    """
+    Text ウィジェットに複数行をまとめて追記し、古い行を消して max_lines 行に保つ
+
+    Args:
+        text_widget: 表示エリア (編集不可の状態で渡し、編集不可に戻す)
+        lines:       追記する行のリスト
+        max_lines:   残す行数
+    """
+    if not lines:
+        return
+    text_widget.config(state="normal") # 編集可能にする
+    text_widget.insert("end", "\n".join(lines) + "\n") # まとめて 1 回で追記
+    line_count = int(text_widget.index("end-1c").split(".")[0]) - 1 # 最後の改行の後の空行を除いた行数
+    if line_count > max_lines:
+        text_widget.delete("1.0", f"{line_count - max_lines + 1}.0") # 古い行を消す
+    text_widget.see("end") # 一番下にスクロール
+    text_widget.config(state="disabled") # 編集不可に戻す
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    import threading
+    import time
+
+    gui_log = GuiLog("gui_log_example.log", max_lines=5)
+
+    def worker(worker_id):
+        for i in range(1000):
+            gui_log.progress(f"worker {worker_id}: シート {i} の採点処理を開始...", logging.DEBUG) # 画面には表示しない
+            gui_log.progress(f"worker {worker_id}: シート {i} 採点完了")
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(worker_id,)) for worker_id in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    gui_log.error("エラーの例")
+    batch = gui_log.drain()
+    print(f"8000 件を記録 ({(time.perf_counter() - start) * 1000:.1f} ms)")
+    for view, view_lines in batch.items():
+        print(f"[{view}] 表示 {len(view_lines)} 行 (表示せずに捨てた行 {gui_log.dropped[view]})")
+        for line in view_lines:
+            print(f"  {line}")
+    gui_log.close()
+    print("全てのログは gui_log_example.log に保存されています")
@@ -0,0 +1,103 @@
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# 出力形式 -> (PIL の保存形式, 拡張子, 画像モード)
+OUTPUT_FORMATS = {
+    "png": ("PNG", ".png", "RGBA"), # 従来通りの RGBA PNG
+    "png-rgb": ("PNG", ".png", "RGB"), # 透明度なしの PNG (小さく速い)
+    "jpeg": ("JPEG", ".jpg", "RGB"),
+    "webp": ("WEBP", ".webp", "RGB"),
+}
+
+
+class OutputWriter:
+    """
+    採点済み画像をエンコードしてファイルに書き出すクラス
+
+    submit() はバックグラウンドのスレッドでエンコードと書き込みを行うため、
+    呼び出し元 (マーク合成のワーカー) はすぐに次のシートの処理に移れる。
+    書き出し待ちの画像が max_pending 枚を超えると submit() は空きができるまで待つ (メモリ使用量の上限)。
+
+    Args:
+        output_format:  出力形式 ("png", "png-rgb", "jpeg", "webp")
+        compress_level: PNG の圧縮レベル (0-9, 小さいほど速く大きい)
+        quality:        JPEG / WebP の品質 (1-100)
+        max_workers:    書き出しを行うスレッド数
+        max_pending:    書き出し待ちにできる最大枚数
+    """
+
+    def __init__(self, output_format="png", compress_level=6, quality=90, max_workers=2, max_pending=8):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"未対応の出力形式です: {output_format} (対応形式: {', '.join(OUTPUT_FORMATS)})")
+        self.output_format = output_format
+        self.pil_format, self.extension, self.output_mode = OUTPUT_FORMATS[output_format]
+        self.compress_level = compress_level
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-writer")
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def output_path_for(self, output_path):
+        """出力ファイルパスの拡張子を出力形式に合わせる"""
+        return os.path.splitext(output_path)[0] + self.extension
+
+    def encode(self, image):
+        """
+        画像を出力形式でエンコードする
+
+        Returns:
+            bytes: エンコード済みデータ
+        """
+        if image.mode != self.output_mode:
+            image = image.convert(self.output_mode)
+        buffer = io.BytesIO()
+        if self.pil_format == "PNG":
+            image.save(buffer, format="PNG", compress_level=self.compress_level)
+        else:
+            image.save(buffer, format=self.pil_format, quality=self.quality)
+        return buffer.getvalue()
+
+    def write(self, image, output_path):
+        """
+        画像をエンコードしてファイルに書き出す (呼び出し元のスレッドで実行)
+
+        Returns:
+            dict: {"output_path", "bytes_written", "started_at", "encode_seconds", "write_seconds"}
+                  (started_at は time.perf_counter の値。計測 (tracing) で各段の開始時刻に使う)
+        """
+        start = time.perf_counter()
+        data = self.encode(image)
+        encoded_at = time.perf_counter()
+
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        with open(output_path, 'wb') as f:
+            f.write(data)
+        return {
+            "output_path": output_path,
+            "bytes_written": len(data),
+            "started_at": start,
+            "encode_seconds": encoded_at - start,
+            "write_seconds": time.perf_counter() - encoded_at,
+        }
+
+    def submit(self, image, output_path):
+        """
+        画像の書き出しをバックグラウンドで開始する
+
+        Returns:
+            concurrent.futures.Future: 結果は write() と同じ辞書
+        """
+        self._pending.acquire() # 書き出し待ちが多すぎる場合はここで待つ
+        try:
+            future = self._executor.submit(self.write, image, output_path)
+        except Exception:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+    def close(self):
+        """書き出し待ちの画像を全て書き出してからスレッドを終了"""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import time
+
+import response_parser
+
+JOURNAL_FILE_NAME = "grading_journal.jsonl" # 出力フォルダ内のジャーナルファイル名
+
+# パイプラインのイベント → ジャーナルに記録する段階
+_RECORDED_STAGES = {"graded", "composited", "saved", "failed", "cancelled"}
+
+
+def hash_file(path):
+    """ファイル内容の SHA-256 (16進文字列)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _entry_results(entry):
+    """ジャーナルの 1 行から正誤結果を取り出す (記録されていれば確信度も添える)"""
+    if entry.get("results") is None:
+        return None
+    return response_parser.ProblemResults(entry["results"], entry.get("confidence"))
+
+
+class JobJournal:
+    """
+    採点の進み具合をシートごとに追記していくジャーナル (JSONL, 追記のみ)
+
+    1 行 = 1 イベント ({"sheet", "input_hash", "layout_hash", "stage", "results", "confidence", "time", ...})。
+    同じシートの行は後のものが優先される。途中でアプリが終了しても、
+    次回 plan() で完了済みのシートを飛ばし、失敗・未処理のシートだけをやり直せる。
+
+    Args:
+        output_folder_path: 出力フォルダ (ジャーナルファイルはこの中に作成)
+        layout_hash:        使用するレイアウトのハッシュ (layout.Layout.fingerprint)
+    """
+
+    def __init__(self, output_folder_path, layout_hash):
+        self.path = os.path.join(output_folder_path, JOURNAL_FILE_NAME)
+        self.layout_hash = layout_hash
+        self.input_hashes = {} # シートID -> 入力画像のハッシュ
+        os.makedirs(output_folder_path, exist_ok=True)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def load(self):
+        """
+        ジャーナルを読み込み、シートごとの最新の状態を返す
+
+        Returns:
+            dict: シートID -> 最新のエントリ。正誤結果を取得済みなら "results" を持つ
+        """
+        latest = {}
+        if not os.path.exists(self.path):
+            return latest
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # 書き込み途中で終了した最終行などは無視
+                sheet_id = entry.get("sheet")
+                previous = latest.get(sheet_id)
+                if previous is not None and previous.get("input_hash") == entry.get("input_hash") and "results" not in entry:
+                    entry["results"] = previous.get("results") # 後段のエントリにも取得済みの正誤結果を引き継ぐ
+                latest[sheet_id] = entry
+        return latest
+
+    def plan(self, jobs, resume=True):
+        """
+        前回の記録をもとに、実行が必要なジョブを選ぶ
+
+        - 入力画像もレイアウトも変わっておらず保存済み (かつ出力ファイルが存在) → 飛ばす
+        - 入力画像が同じで正誤結果を取得済み → 前回の正誤結果を使い、合成・保存だけやり直す
+        - 入力画像が変わった・失敗した・記録がない → 最初からやり直す
+
+        Args:
+            jobs:   grading_pipeline.SheetJob のリスト
+            resume: False の場合は記録を無視して全ジョブを実行する
+                    (入力ハッシュは計算せず、パイプラインの API 段で求めたものをイベントから受け取る)
+        Returns:
+            tuple: (実行するジョブのリスト, 飛ばしたジョブのリスト)
+        """
+        if not resume:
+            return list(jobs), []
+        latest = self.load()
+        jobs_to_run = []
+        skipped_jobs = []
+        for job in jobs:
+            input_hash = hash_file(job.image_path)
+            self.input_hashes[job.sheet_id] = input_hash
+            job.input_hash = input_hash # パイプラインで求め直さない
+            entry = latest.get(job.sheet_id)
+            if entry is None or entry.get("input_hash") != input_hash:
+                jobs_to_run.append(job)
+                continue
+            if (entry.get("stage") == "saved" and entry.get("layout_hash") == self.layout_hash
+                    and os.path.exists(job.output_path)):
+                job.problem_results = _entry_results(entry)
+                skipped_jobs.append(job)
+                continue
+            if entry.get("results") is not None:
+                job.problem_results = _entry_results(entry) # 正誤結果は再利用 (API 呼び出しを省略)
+            jobs_to_run.append(job)
+        return jobs_to_run, skipped_jobs
+
+    def previous_results(self, jobs):
+        """
+        前回取得した正誤結果を返す (入力画像が変わったシートは含めない)
+
+        一部の問題だけを採点し直す場合に、残りの問題の結果として使う。
+
+        Returns:
+            dict: 画像パス -> 前回の正誤結果の辞書
+        """
+        latest = self.load()
+        results_by_path = {}
+        for job in jobs:
+            entry = latest.get(job.sheet_id)
+            if entry is None or not entry.get("results"):
+                continue
+            input_hash = self.input_hashes.get(job.sheet_id) or hash_file(job.image_path)
+            if entry.get("input_hash") == input_hash:
+                results_by_path[job.image_path] = _entry_results(entry)
+        return results_by_path
+
+    def record(self, event):
+        """
+        パイプラインのイベントを 1 行追記する (記録対象外のイベントは無視)
+
+        入力ハッシュはここでは計算しない (GUI スレッドから呼ばれるため)。イベントの input_hash
+        (GradingPipeline の input_hasher が求めたもの) か、plan() で求めたものを使う。
+        """
+        stage = event.get("event")
+        if stage not in _RECORDED_STAGES:
+            return
+        sheet_id = event["sheet_id"]
+        if event.get("input_hash") is not None:
+            self.input_hashes[sheet_id] = event["input_hash"]
+        entry = {
+            "sheet": sheet_id,
+            "input_hash": self.input_hashes.get(sheet_id),
+            "layout_hash": self.layout_hash,
+            "stage": stage,
+            "time": time.time(),
+        }
+        if stage in ("graded", "saved") and event.get("problem_results") is not None:
+            entry["results"] = event["problem_results"]
+            if event.get("confidence"):
+                entry["confidence"] = event["confidence"]
+        if stage == "saved":
+            entry["output_path"] = event["output_path"] # レポート作成時に採点済み画像を探すため
+        if "message" in event:
+            entry["message"] = event["message"]
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+from array import array
+import numpy as np
+
+import mark_assets
+
+
+def premultiply_mark(mark_image):
+    """
+    マーク画像 (RGBA) を合成用のタイルに変換する
+
+    Returns:
+        tuple: (アルファ乗算済みの RGB (float32, 高さx幅x3), アルファ (float32, 高さx幅x1, 0.0-1.0))
+    """
+    rgba = np.asarray(mark_image.convert("RGBA"), dtype=np.float32)
+    alpha = rgba[..., 3:4] / 255.0
+    return (rgba[..., :3] * alpha, alpha)
+
+
+class Layout:
+    """
+    位置情報JSONとマーク画像を 1 回だけ読み込んで保持するクラス
+
+    採点中は全シートで同じ Layout を使い回すことで、シートごとの JSON 読み込み・
+    マーク画像の読み込みと RGBA 変換・問題リストの線形探索を省く。
+
+    問題番号 → 配列の添字 の辞書と、マークごとの貼り付け位置 (左上座標) の配列を
+    事前に計算しておくため、1 枚あたりの処理は貼り付けだけになる。
+
+    各問題は任意で「問題領域」({"x1", "y1", "x2", "y2"}, 問題文と解答を含む矩形) を持てる。
+    問題ごとに切り出して採点する場合に使い、ない場合は隣の問題との中間までを領域とみなす (problem_region)。
+
+    位置情報JSONの「テンプレート画像」(位置情報を作った画像のパス) は、スキャンのずれ・傾きを補正する
+    位置合わせ (registration.SheetRegistrar) の基準に使う。
+
+    Args:
+        position_data:  位置情報JSONを読み込んだ辞書 ({"問題位置情報": [...]})
+        correct_mark:   正解マーク画像 (PIL Image, RGBA)
+        incorrect_mark: 不正解マーク画像 (PIL Image, RGBA)
+        fingerprint:    位置情報とマーク画像から計算したハッシュ (レイアウトが変わったかの判定用)
+    """
+
+    def __init__(self, position_data, correct_mark, incorrect_mark, fingerprint=None):
+        self.position_data = position_data
+        self.correct_mark = correct_mark
+        self.incorrect_mark = incorrect_mark
+        self.fingerprint = fingerprint
+        self.template_path = position_data.get("テンプレート画像") # 位置合わせの基準画像 (なければ None)
+
+        problems = position_data["問題位置情報"]
+        self.problem_numbers = [str(problem_info["問題番号"]) for problem_info in problems]
+        self.index_by_problem = {number: i for i, number in enumerate(self.problem_numbers)}
+
+        # 正解位置 (マークの中心) とマークごとの貼り付け位置 (左上) を配列で保持
+        self.center_x = array('i', (problem_info["正解位置"]["x"] for problem_info in problems))
+        self.center_y = array('i', (problem_info["正解位置"]["y"] for problem_info in problems))
+        self.correct_x = array('i', (x - correct_mark.width // 2 for x in self.center_x))
+        self.correct_y = array('i', (y - correct_mark.height // 2 for y in self.center_y))
+        self.incorrect_x = array('i', (x - incorrect_mark.width // 2 for x in self.center_x))
+        self.incorrect_y = array('i', (y - incorrect_mark.height // 2 for y in self.center_y))
+
+        # 問題領域 (左上 x, 左上 y, 右下 x, 右下 y)。JSON で指定されていない問題は None
+        self.regions = []
+        for problem_info in problems:
+            region = problem_info.get("問題領域")
+            self.regions.append(None if region is None else
+                                (region["x1"], region["y1"], region["x2"], region["y2"]))
+
+        # NumPy での合成用に、アルファ乗算済みのタイルも用意しておく
+        self.correct_tile = premultiply_mark(correct_mark)
+        self.incorrect_tile = premultiply_mark(incorrect_mark)
+
+    @classmethod
+    def load(cls, json_path, correct_mark_path="circle_red.png", incorrect_mark_path="cross_red.png"):
+        """
+        位置情報JSONファイルとマーク画像ファイルから Layout を作成する
+
+        Args:
+            json_path:           位置情報JSONファイルのファイルパス
+            correct_mark_path:   正解マーク画像 (〇) のファイルパス
+            incorrect_mark_path: 不正解マーク画像 (✕) のファイルパス
+        Returns:
+            Layout
+        Raises:
+            FileNotFoundError, json.JSONDecodeError: ファイルが読み込めない場合
+        """
+        with open(json_path, 'r', encoding='utf-8') as f:
+            position_data = json.load(f)
+        correct_mark = mark_assets.load_mark(correct_mark_path) # 同じファイルは 2 回目以降デコードしない
+        incorrect_mark = mark_assets.load_mark(incorrect_mark_path)
+
+        fingerprint = hashlib.sha256()
+        for path in (json_path, correct_mark_path, incorrect_mark_path):
+            with open(path, 'rb') as f:
+                fingerprint.update(hashlib.sha256(f.read()).digest())
+        sheet_layout = cls(position_data, correct_mark, incorrect_mark, fingerprint.hexdigest())
+        if sheet_layout.template_path and not os.path.isabs(sheet_layout.template_path): # JSON からの相対パス
+            sheet_layout.template_path = os.path.join(os.path.dirname(os.path.abspath(json_path)), sheet_layout.template_path)
+        return sheet_layout
+
+    def __len__(self):
+        return len(self.problem_numbers)
+
+    def problem_region(self, index, image_size):
+        """
+        問題の領域 (切り出す矩形) を返す
+
+        位置情報JSONに「問題領域」がない場合は、正解位置から推定する:
+        縦は上下の問題との中間まで、横は同じ行の左右の問題との中間まで (いなければ画像の端まで)。
+
+        Args:
+            index:      問題の添字 (problem_numbers の順)
+            image_size: シート画像の大きさ (幅, 高さ)
+        Returns:
+            tuple: (左上 x, 左上 y, 右下 x, 右下 y) (画像の範囲内に収める)
+        """
+        width, height = image_size
+        region = self.regions[index]
+        if region is None:
+            center_x, center_y = self.center_x[index], self.center_y[index]
+            row_gaps = [abs(y - center_y) for y in self.center_y if abs(y - center_y) >= 20] # 20px 未満のずれは同じ行
+            row_tolerance = min(row_gaps) / 2 if row_gaps else height # これより y が近い問題は同じ行とみなす
+            above = [y for y in self.center_y if center_y - y > row_tolerance]
+            below = [y for y in self.center_y if y - center_y > row_tolerance]
+            same_row = [x for i, x in enumerate(self.center_x)
+                        if i != index and abs(self.center_y[i] - center_y) <= row_tolerance]
+            left = [x for x in same_row if x < center_x]
+            right = [x for x in same_row if x > center_x]
+            region = (
+                (max(left) + center_x) // 2 if left else 0,
+                (max(above) + center_y) // 2 if above else 0,
+                (min(right) + center_x) // 2 if right else width,
+                (min(below) + center_y) // 2 if below else height,
+            )
+        x1, y1, x2, y2 = region
+        return (max(0, min(x1, x2)), max(0, min(y1, y2)), min(width, max(x1, x2)), min(height, max(y1, y2)))
+
+    def mark_placements(self, results, transform=None):
+        """
+        正誤結果から、貼り付けるマークと貼り付け位置の一覧を作る
+
+        Args:
+            results:   問題番号と正誤結果の辞書 (例: {"1": True, "2": False})
+            transform: 正解位置をシート上の位置に変換する関数 ((x, y) -> (x, y), 位置合わせで補正する場合)
+        Returns:
+            list: (マーク画像, (x, y)) のリスト (位置情報JSONにない問題番号は無視)
+        """
+        return self._placements(results, self.correct_mark, self.incorrect_mark, transform)
+
+    def tile_placements(self, results, transform=None):
+        """mark_placements と同じだが、マーク画像の代わりにアルファ乗算済みのタイルを返す"""
+        return self._placements(results, self.correct_tile, self.incorrect_tile, transform)
+
+    def _placements(self, results, correct, incorrect, transform=None):
+        placements = []
+        for problem_number, is_correct in results.items():
+            index = self.index_by_problem.get(str(problem_number))
+            if index is None:
+                continue
+            if transform is not None: # 位置合わせした正解位置を中心に貼り付ける
+                x, y = transform(self.center_x[index], self.center_y[index])
+                mark = self.correct_mark if is_correct else self.incorrect_mark
+                placements.append((correct if is_correct else incorrect,
+                                   (round(x) - mark.width // 2, round(y) - mark.height // 2)))
+            elif is_correct:
+                placements.append((correct, (self.correct_x[index], self.correct_y[index])))
+            else:
+                placements.append((incorrect, (self.incorrect_x[index], self.incorrect_y[index])))
+        return placements
@@ -0,0 +1,383 @@
+import json
+import os
+import threading
+import cv2
+import numpy as np
+
+import response_parser
+from tracing import get_tracer
+
+DEFAULT_REGION_SIZE = (100, 56) # 正解位置を中心に切り出す解答領域の大きさ (幅, 高さ)
+DEFAULT_MIN_CONFIDENCE = 0.8 # これ未満の問題は Gemini API で採点する
+DIGIT_SIZE = 20 # 数字 1 文字を正規化する大きさ (ピクセル)
+
+# 学習用の数字を描画する OpenCV の Hershey フォント (手書きに近い SCRIPT 系を含む)
+_TRAINING_FONTS = [
+    cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_COMPLEX,
+    cv2.FONT_HERSHEY_TRIPLEX, cv2.FONT_HERSHEY_PLAIN, cv2.FONT_HERSHEY_SCRIPT_SIMPLEX,
+    cv2.FONT_HERSHEY_SCRIPT_COMPLEX,
+]
+HOG_BINS = 16 # 勾配方向ヒストグラムのビン数
+
+
+def load_answer_key(answer_key_path):
+    """
+    正解キー (レイアウトごとの問題番号 → 正しい答え) を読み込む
+
+    ファイル形式: {"1": "10", "2": "10", ...} (答えは数字の文字列または整数)
+
+    Returns:
+        dict: 問題番号 (文字列) -> 正しい答え (空白を除いた文字列)
+    """
+    with open(answer_key_path, 'r', encoding='utf-8') as f:
+        answer_key = json.load(f)
+    return {str(problem_number): str(answer).replace(" ", "") for problem_number, answer in answer_key.items()}
+
+
+def digit_features(digit_image):
+    """
+    2値化済みの数字画像 (白文字・黒背景) を傾き補正・正規化して特徴量 (HOG) にする
+
+    Returns:
+        numpy.ndarray: float32 の特徴ベクトル
+    """
+    ys, xs = np.nonzero(digit_image)
+    if len(xs) == 0:
+        return np.zeros(4 * HOG_BINS, dtype=np.float32)
+    digit_image = digit_image[ys.min():ys.max() + 1, xs.min():xs.max() + 1]
+
+    # 縦横比を保ったまま中央に配置 (細い「1」が潰れないように)
+    height, width = digit_image.shape
+    scale = (DIGIT_SIZE - 4) / max(height, width)
+    resized = cv2.resize(digit_image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                         interpolation=cv2.INTER_AREA)
+    canvas = np.zeros((DIGIT_SIZE, DIGIT_SIZE), dtype=np.uint8)
+    top = (DIGIT_SIZE - resized.shape[0]) // 2
+    left = (DIGIT_SIZE - resized.shape[1]) // 2
+    canvas[top:top + resized.shape[0], left:left + resized.shape[1]] = resized
+
+    moments = cv2.moments(canvas)
+    if abs(moments["mu02"]) > 1e-2: # 傾き補正 (手書きの斜体を起こす)
+        skew = moments["mu11"] / moments["mu02"]
+        matrix = np.float32([[1, skew, -0.5 * DIGIT_SIZE * skew], [0, 1, 0]])
+        canvas = cv2.warpAffine(canvas, matrix, (DIGIT_SIZE, DIGIT_SIZE),
+                                flags=cv2.WARP_INVERSE_MAP | cv2.INTER_LINEAR)
+
+    # 4 分割した各領域の勾配方向ヒストグラム (HOG) を特徴量にする
+    gx = cv2.Sobel(canvas, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(canvas, cv2.CV_32F, 0, 1)
+    magnitude, angle = cv2.cartToPolar(gx, gy)
+    bins = np.minimum((angle * HOG_BINS / (2 * np.pi)).astype(np.int32), HOG_BINS - 1)
+    half = DIGIT_SIZE // 2
+    histograms = [np.bincount(bins[y:y + half, x:x + half].ravel(), magnitude[y:y + half, x:x + half].ravel(), HOG_BINS)
+                  for y in (0, half) for x in (0, half)]
+    feature = np.hstack(histograms).astype(np.float32)
+    feature = np.sqrt(feature / (feature.sum() + 1e-7)) # Hellinger 正規化 (線の太さの違いに強くする)
+    return feature
+
+
+def render_training_digits():
+    """
+    Hershey フォントで描画した数字 (太さ・傾き・大きさを変えたもの) を学習用データとして作る
+
+    Returns:
+        tuple: (特徴量の配列, ラベルの配列)
+    """
+    features = []
+    labels = []
+    for digit in range(10):
+        for font in _TRAINING_FONTS:
+            for thickness in (1, 2, 3, 4):
+                for angle in (-12, -6, 0, 6, 12):
+                    canvas = np.zeros((64, 64), dtype=np.uint8)
+                    cv2.putText(canvas, str(digit), (14, 50), font, 1.6, 255, thickness, cv2.LINE_AA)
+                    rotation = cv2.getRotationMatrix2D((32, 32), angle, 1.0)
+                    canvas = cv2.warpAffine(canvas, rotation, (64, 64))
+                    _, canvas = cv2.threshold(canvas, 100, 255, cv2.THRESH_BINARY)
+                    features.append(digit_features(canvas))
+                    labels.append(digit)
+    return np.array(features, dtype=np.float32), np.array(labels, dtype=np.int32)
+
+
+class KnnDigitRecognizer:
+    """
+    k近傍法で数字 1 文字を読み取る軽量な認識器 (学習データは数千件程度なので NumPy で全件と比較する)
+
+    学習データは Hershey フォントで描画した数字に、sample_dir の手書きサンプル
+    (sample_dir/<数字>/*.png, 白背景に黒文字) を加えたもの。
+    確信度は k 個の近傍のうち結果と同じ数字だった割合に、最も近い学習データとの距離による係数
+    (accept_distance 以下で 1.0, reject_distance 以上で 0.0) を掛けたもの。
+    落書きや書き直しのように、どの数字にも似ていない文字の確信度は低くなる。
+
+    Args:
+        sample_dir:      追加の手書きサンプルのフォルダ (省略可)
+        k:               参照する近傍の数
+        accept_distance: 確信度を下げない最近傍との距離 (特徴量は長さ 1 のベクトルなので二乗距離は 0.0-4.0)
+        reject_distance: 確信度が 0 になる最近傍との距離
+    """
+
+    def __init__(self, sample_dir=None, k=5, accept_distance=0.15, reject_distance=0.25):
+        self.k = k
+        self.accept_distance = accept_distance
+        self.reject_distance = reject_distance
+        features, labels = render_training_digits()
+        if sample_dir:
+            sample_features, sample_labels = self._load_samples(sample_dir)
+            if len(sample_labels):
+                features = np.vstack([features, sample_features])
+                labels = np.concatenate([labels, sample_labels])
+        self._features = features
+        self._squared_norms = (features ** 2).sum(axis=1)
+        self._labels = labels.astype(np.int32)
+
+    @staticmethod
+    def _load_samples(sample_dir):
+        features = []
+        labels = []
+        for digit in range(10):
+            digit_dir = os.path.join(sample_dir, str(digit))
+            if not os.path.isdir(digit_dir):
+                continue
+            for file_name in sorted(os.listdir(digit_dir)):
+                sample = cv2.imread(os.path.join(digit_dir, file_name), cv2.IMREAD_GRAYSCALE)
+                if sample is None:
+                    continue
+                _, binary = cv2.threshold(sample, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+                features.append(digit_features(binary))
+                labels.append(digit)
+        return np.array(features, dtype=np.float32).reshape(len(features), -1), np.array(labels, dtype=np.int32)
+
+    def recognize_digits(self, digit_images):
+        """
+        数字画像のリストを読み取る
+
+        Returns:
+            list: (数字, 確信度 0.0-1.0) のリスト
+        """
+        if not digit_images:
+            return []
+        features = np.array([digit_features(digit_image) for digit_image in digit_images], dtype=np.float32)
+        distances = ((features ** 2).sum(axis=1)[:, None] + self._squared_norms[None, :]
+                     - 2.0 * features @ self._features.T) # 二乗距離
+        nearest = np.argpartition(distances, self.k, axis=1)[:, :self.k]
+        recognized = []
+        for neighbour_labels, neighbour_distances in zip(self._labels[nearest], np.take_along_axis(distances, nearest, axis=1)):
+            votes = np.bincount(neighbour_labels, minlength=10)
+            digit = int(votes.argmax())
+            similarity = (self.reject_distance - neighbour_distances.min()) / (self.reject_distance - self.accept_distance)
+            recognized.append((digit, float(votes[digit]) / self.k * min(1.0, max(0.0, similarity))))
+        return recognized
+
+
+def segment_digits(binary_region, min_height_ratio=0.3):
+    """
+    解答領域 (2値化済み, 白文字・黒背景) から数字を左から順に切り出す
+
+    領域の端に接している部品 (隣の「=」や問題文のはみ出し) と小さなノイズは除く。
+    x 方向に重なる部品 (手書きで途切れた「4」「5」など) は 1 文字にまとめる。
+
+    Returns:
+        list: 数字 1 文字ずつの 2値画像のリスト
+    """
+    height, width = binary_region.shape
+    count, _, stats, _ = cv2.connectedComponentsWithStats(binary_region, connectivity=8)
+    boxes = []
+    for x, y, w, h, area in stats[1:count]:
+        if x == 0 or y == 0 or x + w >= width or y + h >= height:
+            continue
+        if area < 8 or h < height * min_height_ratio * 0.5:
+            continue
+        boxes.append([x, y, x + w, y + h])
+    if not boxes:
+        return []
+
+    tallest = max(box[3] - box[1] for box in boxes)
+    boxes = [box for box in boxes if box[3] - box[1] >= tallest * min_height_ratio] # 「=」などの低い部品を除く
+    boxes.sort()
+    merged = [boxes[0]]
+    for box in boxes[1:]:
+        last = merged[-1]
+        overlap = min(last[2], box[2]) - max(last[0], box[0])
+        if overlap > 0.5 * min(last[2] - last[0], box[2] - box[0]):
+            merged[-1] = [min(last[0], box[0]), min(last[1], box[1]), max(last[2], box[2]), max(last[3], box[3])]
+        else:
+            merged.append(box)
+    return [binary_region[y0:y1, x0:x1] for x0, y0, x1, y1 in merged]
+
+
+class LocalGrader:
+    """
+    解答領域の数字を CPU で読み取り、正解キーと照合する採点器 (Gemini API を使わない高速経路)
+
+    読み取りの確信度が min_confidence 以上の問題だけ正誤を決め、残りは「不確か」として返す。
+
+    Args:
+        layout:         layout.Layout (問題番号と正解位置)
+        answer_key:     問題番号 -> 正しい答え の辞書 (load_answer_key)
+        recognizer:     recognize_digits(digit_images) -> [(数字, 確信度)] を持つ認識器 (省略時は KnnDigitRecognizer)
+        min_confidence: 正誤を決める確信度の下限
+        region_size:    正解位置を中心に切り出す解答領域の大きさ (幅, 高さ)
+    """
+
+    def __init__(self, layout, answer_key, recognizer=None, min_confidence=DEFAULT_MIN_CONFIDENCE,
+                 region_size=DEFAULT_REGION_SIZE):
+        self.layout = layout
+        self.answer_key = answer_key
+        self.recognizer = recognizer or KnnDigitRecognizer()
+        self.min_confidence = min_confidence
+        self.region_size = region_size
+
+    def read_answers(self, image_path):
+        """
+        シートの各解答領域の数字を読み取る
+
+        Returns:
+            dict: 問題番号 -> (読み取った答え, 確信度)。画像が読めない場合は None
+        """
+        gray = cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            return None
+        region_width, region_height = self.region_size
+        answers = {}
+        for i, problem_number in enumerate(self.layout.problem_numbers):
+            x0 = max(0, self.layout.center_x[i] - region_width // 2)
+            y0 = max(0, self.layout.center_y[i] - region_height // 2)
+            region = gray[y0:y0 + region_height, x0:x0 + region_width]
+            if region.size == 0:
+                answers[problem_number] = ("", 0.0)
+                continue
+            _, binary = cv2.threshold(region, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+            digits = self.recognizer.recognize_digits(segment_digits(binary))
+            if not digits: # 空欄や読み取れない場合は API に任せる
+                answers[problem_number] = ("", 0.0)
+                continue
+            answers[problem_number] = ("".join(str(digit) for digit, _ in digits),
+                                       min(confidence for _, confidence in digits))
+        return answers
+
+    def grade(self, image_path):
+        """
+        シートを採点する
+
+        Returns:
+            tuple: (確信度が高い問題の正誤結果の辞書, 不確かな問題番号のリスト)。画像が読めない場合は (None, None)
+        """
+        with get_tracer().span("local_ocr", sheet=image_path) as span_fields:
+            answers = self.read_answers(image_path)
+            span_fields["problems"] = len(answers) if answers is not None else 0
+        if answers is None:
+            return None, None
+        problem_results = {}
+        uncertain = []
+        for problem_number, (answer, confidence) in answers.items():
+            expected = self.answer_key.get(problem_number)
+            if expected is None or confidence < self.min_confidence:
+                uncertain.append(problem_number)
+            else:
+                problem_results[problem_number] = answer == expected
+        return problem_results, uncertain
+
+
+class HybridGrader:
+    """
+    ローカル採点で確信が持てない問題だけを Gemini API で採点し、結果をまとめる採点器
+
+    全問題をローカルで採点できたシートは API を呼ばない。呼んだ場合も、確信度の高い問題は
+    ローカルの結果を優先し、不確かな問題だけ API の結果を使う。
+    GradingPipeline の grader (1 枚) / batch_grader (複数枚) としてそのまま使える。
+
+    Args:
+        local_grader:  LocalGrader
+        api_grader:    画像パス -> 正誤結果の辞書 (失敗時は None)
+        batch_api_grader: 画像パスのリスト -> {画像パス: 正誤結果の辞書} (省略時は api_grader を 1 枚ずつ呼ぶ)
+    """
+
+    def __init__(self, local_grader, api_grader, batch_api_grader=None):
+        self.local_grader = local_grader
+        self.api_grader = api_grader
+        self.batch_api_grader = batch_api_grader
+        self._lock = threading.Lock()
+        self.stats = {"sheets": 0, "api_sheets": 0, "local_problems": 0, "api_problems": 0}
+
+    def _merge(self, local_results, uncertain, api_results):
+        """不確かな問題だけ API の結果で上書きする (確信度は API の結果を使った問題のみ)"""
+        if api_results is None:
+            return None
+        problem_results = response_parser.ProblemResults(local_results)
+        api_confidence = response_parser.confidence_of(api_results)
+        problem_results.merge(response_parser.ProblemResults(
+            {problem_number: api_results[problem_number] for problem_number in uncertain if problem_number in api_results},
+            api_confidence))
+        return problem_results
+
+    def _count(self, local_results, uncertain, used_api):
+        with self._lock:
+            self.stats["sheets"] += 1
+            self.stats["api_sheets"] += 1 if used_api else 0
+            self.stats["local_problems"] += len(local_results)
+            self.stats["api_problems"] += len(uncertain)
+
+    def __call__(self, image_path):
+        """1 枚を採点する (GradingPipeline の grader)"""
+        local_results, uncertain = self.local_grader.grade(image_path)
+        if local_results is None: # ローカルで読めない画像は全問題を API に任せる
+            self._count({}, self.local_grader.layout.problem_numbers, True)
+            return self.api_grader(image_path)
+        self._count(local_results, uncertain, bool(uncertain))
+        if not uncertain:
+            return local_results
+        return self._merge(local_results, uncertain, self.api_grader(image_path))
+
+    def grade_batch(self, image_paths):
+        """
+        複数枚を採点する (GradingPipeline の batch_grader)。API が必要なシートだけをまとめて送る
+
+        Returns:
+            dict: 画像パス -> 正誤結果の辞書 (取得失敗時は None)
+        """
+        results_by_path = {}
+        pending = {}
+        for image_path in image_paths:
+            local_results, uncertain = self.local_grader.grade(image_path)
+            if local_results is None: # ローカルで読めない画像は全問題を API に任せる
+                self._count({}, self.local_grader.layout.problem_numbers, True)
+            else:
+                self._count(local_results, uncertain, bool(uncertain))
+                if not uncertain:
+                    results_by_path[image_path] = local_results
+                    continue
+            pending[image_path] = (local_results, uncertain)
+        if not pending:
+            return results_by_path
+
+        if self.batch_api_grader is not None:
+            api_results_by_path = self.batch_api_grader(list(pending))
+        else:
+            api_results_by_path = {image_path: self.api_grader(image_path) for image_path in pending}
+        for image_path, (local_results, uncertain) in pending.items():
+            api_results = api_results_by_path.get(image_path)
+            results_by_path[image_path] = (api_results if local_results is None
+                                           else self._merge(local_results, uncertain, api_results))
+        return results_by_path
+
+    def api_calls_avoided(self):
+        """API を呼ばずに採点できたシートの割合 (0.0-1.0)"""
+        with self._lock:
+            if self.stats["sheets"] == 0:
+                return 0.0
+            return 1.0 - self.stats["api_sheets"] / self.stats["sheets"]
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    import sys
+    import layout as layout_module
+
+    if len(sys.argv) < 4:
+        print("使い方: python local_grader.py 画像ファイル 位置情報JSON 正解キーJSON")
+        sys.exit(1)
+    sheet_layout = layout_module.Layout.load(sys.argv[2])
+    grader = LocalGrader(sheet_layout, load_answer_key(sys.argv[3]))
+    for problem_number, (answer, confidence) in (grader.read_answers(sys.argv[1]) or {}).items():
+        print(f"問題{problem_number}: 読み取り '{answer}' (確信度 {confidence:.2f}), 正解 '{grader.answer_key.get(problem_number)}'")
+    print(grader.grade(sys.argv[1]))
@@ -1,13 +1,29 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox, Text, Scrollbar, BOTH, VERTICAL, Y, Menu
+from tkinter import filedialog, messagebox, Text, Scrollbar, Listbox, Spinbox, BOTH, VERTICAL, Y, Menu
+import importlib
+import logging
 import os
-from PIL import Image, ImageTk, ImageDraw  # ImageDraw をインポート
-
-# --- 4つの機能をモジュールとしてインポート ---
-import create_grid_image
-import position_config_tool # position_config_tool.py はGUIツールなので、ここでは直接機能は使用しないが、インポートしておく
-import add_marks_to_image
+import queue
+import threading
+import time
+
+# --- 機能をモジュールとしてインポート ---
+# OpenCV・NumPy を使うモジュール (add_marks_to_image, layout, local_grader, registration) は
+# ウィンドウの表示を遅らせないよう、採点開始時に読み込む (PRELOAD_MODULES)。Gemini SDK は最初の API 呼び出し時に読み込まれる
+import folder_watcher
 import get_gemini_results_json
+import grade_report
+import grading_client
+import grading_pipeline
+import gui_log
+import image_writer
+import job_journal
+import mark_assets
+import response_parser
+import result_cache
+import tracing
+
+PRELOAD_MODULES = ("add_marks_to_image", "layout", "local_grader", "page_source", "preprocess_image", "registration", "sheet_dedup") # ウィンドウ表示後に裏で読み込んでおくモジュール
 
 class MainApplication(tk.Tk):
     def __init__(self):
@@ -22,11 +38,109 @@ class MainApplication(tk.Tk):
         self.progress_text = None # 進捗状況表示エリア (Textウィジェット)
         self.error_text = None # エラーメッセージ表示エリア (Textウィジェット)
 
+        # --- ログ (どのスレッドからも記録でき、画面にはまとめて表示。全てのログはファイルに保存) ---
+        self.log_path = gui_log.DEFAULT_LOG_PATH # ローテーションするログファイル
+        self.log_interval_ms = 100 # 溜まったログを画面に表示する間隔 (ミリ秒)
+        self.log_max_lines = gui_log.DEFAULT_MAX_LINES # 表示エリアごとに残す行数 (古い行から消す)
+        self.verbose_log = False # True で処理段ごとの経過 (DEBUG) も画面に表示
+        try:
+            self.gui_log = gui_log.GuiLog(self.log_path, max_lines=self.log_max_lines)
+        except OSError as e: # ログファイルを作れない場合は画面にだけ表示する
+            print(f"ログファイル {self.log_path} を開けませんでした: {e}")
+            self.gui_log = gui_log.GuiLog(None, max_lines=self.log_max_lines)
+
         # --- マーク画像ファイルのパス (デフォルト) ---
         self.correct_mark_path = "circle_red.png" # 〇マーク (赤)
         self.incorrect_mark_path = "cross_red.png" # ✕マーク (赤)
 
+        # --- 並行処理の設定 ---
+        self.api_workers = 4 # 同時に実行する Gemini API 呼び出しの数 (GUI から変更可)
+        self.cpu_workers = 2 # マーク合成・保存を行うワーカーの数
+        self.batch_size = 1 # 1 回の API リクエストにまとめるシート数 (1 でまとめない, GUI から変更可)
+        self.poll_interval_ms = 100 # 採点結果を GUI に反映する間隔 (ミリ秒)
+        self.pipeline = None # 実行中の採点パイプライン (grading_pipeline.GradingPipeline)
+        self.sheet_index = {} # シートID -> シート一覧 (Listbox) の行番号
+
+        # --- API 呼び出しの制限 (レート制限・リトライ) ---
+        self.requests_per_minute = 60 # 1 分あたりのリクエスト数の上限
+        self.tokens_per_minute = 1_000_000 # 1 分あたりの入力トークン数の上限
+        self.max_retries = 5 # 一時的なエラー (429 など) の再試行回数
+        self.grading_client = None # grading_client.AsyncGradingClient (採点開始ごとに作成)
+        self.sync_grader = None # grading_client から取得した同期版の採点関数
+        self.sync_batch_grader = None # grading_client から取得した同期版の複数シート採点関数
+        self.layout = None # 位置情報とマーク画像 (layout.Layout, 採点開始時に 1 回だけ読み込む)
+        self.resume = False # 前回の実行記録 (ジャーナル) から再開するか
+        self.journal = None # job_journal.JobJournal (出力フォルダに採点の進み具合を記録)
+        self.output_format = "png" # 採点済み画像の形式 (image_writer.OUTPUT_FORMATS のいずれか)
+        self.output_writer = None # image_writer.OutputWriter (バックグラウンドで画像を書き出す)
+        self.report_thread = None # PDF レポートを作成中のスレッド
+        self.plan_thread = None # 前回の実行記録と照合中のスレッド (採点開始時)
+        self.report_result = None # PDF レポート作成の結果 (ページ数 または 例外)
+
+        # --- ローカル採点 (正解キーがある場合、読み取れた問題は API を使わずに採点) ---
+        self.answer_key_path = "" # 正解キーJSONファイルパス (空ならローカル採点を使わない)
+        self.local_min_confidence = None # これ未満の問題は API で採点 (None で local_grader.DEFAULT_MIN_CONFIDENCE)
+        self.digit_recognizer = None # local_grader.KnnDigitRecognizer (初回の採点開始時に 1 回だけ作成)
+        self.hybrid_grader = None # local_grader.HybridGrader (正解キー使用時のみ)
+
+        # --- 問題領域モード (問題ごとに切り出した領域を並べた画像を送る) ---
+        self.region_mode = False
+        self.crop_to_layout = False # ページ全体ではなく、全問題の範囲 (問題文を含む) だけを切り抜いて送るか
+        self.regrade_problems = None # 採点し直す問題番号のリスト (None で全問題)
+        self.previous_results = {} # 画像パス -> 前回の正誤結果 (再採点時に、指定した問題以外に使う)
+
+        # --- 位置合わせ (シートをテンプレート画像に合わせ、スキャンのずれ・傾きを補正してマークを付ける) ---
+        self.align_sheets = False
+        self.registrar = None # registration.SheetRegistrar (テンプレートが変わらない限り特徴点を使い回す)
+        self.registrar_template = None # registrar を作ったテンプレート画像のパス
+
+        # --- 重複シート (二重送り・再スキャン) は 1 枚目の正誤結果を使い、API 呼び出しを省く ---
+        self.dedup_sheets = False
+        self.deduplicator = None # sheet_dedup.SheetDeduplicator (有効時のみ)
+
+        # --- 複数ページの PDF / TIFF (ページを 1 枚ずつ画像にして採点。シートIDは "ファイル#ページ番号") ---
+        self.page_dpi = 200 # ページを画像にする解像度 (page_source.DEFAULT_DPI)
+        self.pages_ahead = 8 # 採点に先立って画像にしておくページ数の上限 (page_source.DEFAULT_MAX_AHEAD)
+        self.assemble_pages = False # 採点済みのページを元と同じ形式の 1 ファイルにまとめ直すか
+        self.page_spooler = None # page_source.PageSpooler (PDF / TIFF がある場合のみ)
+
+        # --- ストリーミング受信 (回答の生成中に届いた問題から受信数を表示) ---
+        self.stream_responses = True
+        self.received_verdicts = queue.SimpleQueue() # イベントループのスレッドから受信した画像パスを渡す
+        self.verdict_counts = {} # 画像パス -> 受信済みの問題数
+        self.sheet_id_by_path = {} # 画像パス -> シートID
+
+        # --- フォルダ監視 (スキャナーから届いたシートだけを続けて採点) ---
+        self.watch_folder = False
+        self.folder_watcher = None # folder_watcher.FolderWatcher (監視中のみ)
+        self.watch_interval_ms = int(folder_watcher.DEFAULT_POLL_INTERVAL * 1000) # フォルダを調べる間隔 (ミリ秒)
+
+        # --- 正誤結果キャッシュの設定 ---
+        self.cache_dir = ".markai_cache" # キャッシュ保存フォルダ
+        self.result_cache = result_cache.ResultCache(self.cache_dir)
+        self.use_cache = True # 採点開始時に GUI のチェックボックスから読み込む
+        self.refresh_cache = False
+        self.cache_hits_at_start = 0
+
+        # --- 処理段ごとの計測 (tracing) ---
+        self.tracer = tracing.set_tracer(tracing.Tracer()) # 採点開始ごとにリセット
+        self.trace_summary_text = None # 計測結果の表示エリア (Textウィジェット)
+        self.trace_refresh_ms = 1000 # 計測結果の表示を更新する間隔 (ミリ秒)
+        self.trace_refreshed_at = 0.0
+
         self.create_widgets() # GUI 部品を作成・配置
+        self.after(200, self.preload_modules) # ウィンドウが表示されてから、採点に使うモジュールを裏で読み込む
+        self.after(self.log_interval_ms, self.drain_log)
+
+    def preload_modules(self):
+        """採点に使う重いモジュール (OpenCV・NumPy) を別スレッドで読み込んでおく (最初の採点開始を待たせないため)"""
+        def load():
+            for module_name in PRELOAD_MODULES:
+                try:
+                    importlib.import_module(module_name)
+                except Exception as e: # 読み込めない場合は採点開始時にエラーを表示する
+                    print(f"モジュール {module_name} の事前読み込みに失敗しました: {e}")
+        threading.Thread(target=load, daemon=True).start()
 
     def create_widgets(self):
         """GUI 部品を作成・配置"""
@@ -39,7 +153,7 @@ class MainApplication(tk.Tk):
         input_frame.pack(pady=10)
 
         output_frame = tk.Frame(self) # 出力設定用フレーム
-        output_frame.pack(pady=5)
+        output_frame.pack(pady=5, padx=10, fill=tk.X)
 
         process_frame = tk.Frame(self) # 処理実行用フレーム
         process_frame.pack(pady=10)
@@ -52,15 +166,71 @@ class MainApplication(tk.Tk):
         tk.Button(input_frame, text="画像フォルダ選択", command=self.select_image_folder).pack(side=tk.LEFT, padx=5)
         # 2. 位置情報JSONファイル読込
         tk.Button(input_frame, text="位置情報JSON読込", command=self.load_position_json).pack(side=tk.LEFT, padx=5)
+        # 正解キー読込 (任意, 読み込むとローカル採点を使用)
+        tk.Button(input_frame, text="正解キー読込 (任意)", command=self.load_answer_key).pack(side=tk.LEFT, padx=5)
 
         # --- 出力設定 ---
         # 3. 出力フォルダ設定 (必要に応じて)
         # Label(output_frame, text="出力フォルダ:").pack(side=tk.LEFT, padx=5) # 必要であれば出力フォルダ設定を追加
         # tk.Entry(output_frame, width=40).pack(side=tk.LEFT, padx=5) # 必要であれば出力フォルダ設定を追加
+        # 設定が 1 行に収まらないよう、用途ごとの枠に分けて縦に並べる
+        api_frame = tk.LabelFrame(output_frame, text="API 呼び出し") # 送り方・キャッシュ
+        api_frame.pack(fill=tk.X, pady=2)
+        upload_frame = tk.LabelFrame(output_frame, text="送る内容") # シートのどこをどう送るか
+        upload_frame.pack(fill=tk.X, pady=2)
+        sheet_frame = tk.LabelFrame(output_frame, text="シートの補正・照合") # 位置合わせ・重複シート
+        sheet_frame.pack(fill=tk.X, pady=2)
+        files_frame = tk.LabelFrame(output_frame, text="入力・出力") # 出力形式・再開・監視
+        files_frame.pack(fill=tk.X, pady=2)
+
+        tk.Label(api_frame, text="同時API呼び出し数:").pack(side=tk.LEFT, padx=5)
+        self.api_workers_var = tk.IntVar(value=self.api_workers)
+        Spinbox(api_frame, from_=1, to=32, width=4, textvariable=self.api_workers_var).pack(side=tk.LEFT, padx=5)
+        tk.Label(api_frame, text="まとめて送る枚数:").pack(side=tk.LEFT, padx=5)
+        self.batch_size_var = tk.IntVar(value=self.batch_size)
+        Spinbox(api_frame, from_=1, to=16, width=4, textvariable=self.batch_size_var).pack(side=tk.LEFT, padx=5)
+        self.stream_var = tk.BooleanVar(value=self.stream_responses)
+        tk.Checkbutton(api_frame, text="ストリーミングで受信", variable=self.stream_var).pack(side=tk.LEFT, padx=5)
+        self.use_cache_var = tk.BooleanVar(value=self.use_cache)
+        tk.Checkbutton(api_frame, text="キャッシュを使用", variable=self.use_cache_var).pack(side=tk.LEFT, padx=5)
+        self.refresh_cache_var = tk.BooleanVar(value=self.refresh_cache)
+        tk.Checkbutton(api_frame, text="キャッシュを更新 (再採点)", variable=self.refresh_cache_var).pack(side=tk.LEFT, padx=5)
+
+        self.region_mode_var = tk.BooleanVar(value=self.region_mode)
+        tk.Checkbutton(upload_frame, text="問題ごとに切り出して送る", variable=self.region_mode_var).pack(side=tk.LEFT, padx=5)
+        self.crop_to_layout_var = tk.BooleanVar(value=self.crop_to_layout)
+        tk.Checkbutton(upload_frame, text="問題の範囲だけ送る", variable=self.crop_to_layout_var).pack(side=tk.LEFT, padx=5)
+        tk.Label(upload_frame, text="再採点する問題 (例: 2,5):").pack(side=tk.LEFT, padx=5)
+        self.regrade_problems_entry = tk.Entry(upload_frame, width=8) # 空欄なら全問題を採点
+        self.regrade_problems_entry.pack(side=tk.LEFT, padx=5)
+
+        self.align_var = tk.BooleanVar(value=self.align_sheets)
+        tk.Checkbutton(sheet_frame, text="位置合わせ (ずれ・傾きを補正)", variable=self.align_var).pack(side=tk.LEFT, padx=5)
+        self.dedup_var = tk.BooleanVar(value=self.dedup_sheets)
+        tk.Checkbutton(sheet_frame, text="重複シートをまとめる", variable=self.dedup_var).pack(side=tk.LEFT, padx=5)
+
+        tk.Label(files_frame, text="出力形式:").pack(side=tk.LEFT, padx=5)
+        self.output_format_var = tk.StringVar(value=self.output_format)
+        tk.OptionMenu(files_frame, self.output_format_var, *image_writer.OUTPUT_FORMATS).pack(side=tk.LEFT, padx=5)
+        self.assemble_var = tk.BooleanVar(value=self.assemble_pages)
+        tk.Checkbutton(files_frame, text="PDF / TIFF にまとめ直す", variable=self.assemble_var).pack(side=tk.LEFT, padx=5)
+        self.resume_var = tk.BooleanVar(value=self.resume)
+        tk.Checkbutton(files_frame, text="前回の続きから再開", variable=self.resume_var).pack(side=tk.LEFT, padx=5)
+        self.watch_var = tk.BooleanVar(value=self.watch_folder)
+        tk.Checkbutton(files_frame, text="フォルダを監視 (届いたシートを自動採点)", variable=self.watch_var).pack(side=tk.LEFT, padx=5)
 
         # --- 処理実行ボタン ---
         # 4. 採点開始ボタン
         tk.Button(process_frame, text="採点開始", font=("Helvetica", 12, "bold"), command=self.start_grading).pack(side=tk.LEFT, padx=10)
+        # 5. キャンセルボタン (選択したシートのみ / 全シート)
+        tk.Button(process_frame, text="選択シートをキャンセル", command=self.cancel_selected_sheets).pack(side=tk.LEFT, padx=5)
+        tk.Button(process_frame, text="全てキャンセル", command=self.cancel_grading).pack(side=tk.LEFT, padx=5)
+        tk.Button(process_frame, text="監視を終了", command=self.stop_watching).pack(side=tk.LEFT, padx=5)
+
+        # --- シート一覧 (各シートの処理状態を表示) ---
+        tk.Label(status_frame, text="シート一覧:").pack(anchor=tk.NW)
+        self.sheet_listbox = Listbox(status_frame, height=8, selectmode=tk.EXTENDED)
+        self.sheet_listbox.pack(fill=tk.X)
 
         # --- 進捗状況表示エリア ---
         tk.Label(status_frame, text="進捗状況:").pack(anchor=tk.NW) # 左上に配置
@@ -70,6 +240,12 @@ class MainApplication(tk.Tk):
         progress_scrollbar.pack(side=tk.RIGHT, fill=Y)
         self.progress_text.pack(side=tk.LEFT, fill=BOTH, expand=True)
 
+        # --- 処理段ごとの計測結果 (スループット, p50/p95) ---
+        tk.Label(status_frame, text="処理時間 (段ごと):").pack(anchor=tk.NW)
+        self.trace_summary_text = Text(status_frame, height=6, wrap=tk.NONE, font=("Courier", 9))
+        self.trace_summary_text.config(state=tk.DISABLED)
+        self.trace_summary_text.pack(fill=tk.X)
+
         # --- エラーメッセージ表示エリア ---
         tk.Label(status_frame, text="エラーメッセージ:").pack(anchor=tk.NW) # 左上に配置, 進捗状況の下に配置したい場合は row=1 などで指定
         self.error_text = Text(status_frame, height=5, wrap=tk.WORD)
@@ -84,6 +260,11 @@ class MainApplication(tk.Tk):
         menubar = Menu(self)
         file_menu = Menu(menubar, tearoff=0)
         file_menu.add_command(label="設定", command=self.open_settings_dialog) # 設定画面 (未実装)
+        file_menu.add_command(label="PDFレポートを作成", command=self.export_report)
+        file_menu.add_command(label="計測データを保存", command=self.export_trace)
+        file_menu.add_command(label="キャッシュを削除", command=self.clear_result_cache)
+        self.verbose_log_var = tk.BooleanVar(value=self.verbose_log)
+        file_menu.add_checkbutton(label="詳細ログを表示", variable=self.verbose_log_var, command=self.apply_log_level)
         file_menu.add_separator()
         file_menu.add_command(label="終了", command=self.quit)
         menubar.add_cascade(label="ファイル", menu=file_menu)
@@ -106,6 +287,17 @@ class MainApplication(tk.Tk):
             self.progress_log(f"位置情報JSONファイルを読み込みました: {self.position_json_path}")
 
 
+    def load_answer_key(self):
+        """正解キーJSONファイルを選択 (キャンセルした場合はローカル採点を使わない)"""
+        self.answer_key_path = filedialog.askopenfilename(
+            defaultextension=".json", filetypes=[("JSON files", "*.json")]
+        )
+        if self.answer_key_path:
+            self.progress_log(f"正解キーを読み込みました (読み取れた問題は API を使わずに採点): {self.answer_key_path}")
+        else:
+            self.progress_log("正解キーを解除しました (全ての問題を API で採点)")
+
+
     def start_grading(self):
         """採点処理を開始 (コアロジック)"""
         if not self.image_folder_path:
@@ -115,57 +307,541 @@ class MainApplication(tk.Tk):
             messagebox.showerror("エラー", "位置情報JSONファイルを読み込んでください")
             return
 
-        image_files = [f for f in os.listdir(self.image_folder_path) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp'))]
-        if not image_files:
+        import page_source # 起動を速くするため、ここで読み込む (Pillow を使うため)
+
+        self.watch_folder = self.watch_var.get()
+        image_files = grading_pipeline.find_image_files(self.image_folder_path)
+        multipage_files = page_source.find_multipage_files(self.image_folder_path) # 複数ページの PDF / TIFF
+        if not image_files and not multipage_files and not self.watch_folder:
             messagebox.showerror("エラー", "画像フォルダに画像ファイルが見つかりません")
             return
 
+        if (self.pipeline is not None and not self.pipeline.finished) or \
+                (self.plan_thread is not None and self.plan_thread.is_alive()):
+            messagebox.showerror("エラー", "採点処理を実行中です")
+            return
+
+        import layout # 起動を速くするため、ここで読み込む (preload_modules で読み込み済みならすぐ終わる)
+        import local_grader
+        import registration
+
+        # --- 位置情報JSONとマーク画像を読み込み (全シートで共有) ---
+        try:
+            for generated_path in mark_assets.ensure_default_marks(self.correct_mark_path, self.incorrect_mark_path):
+                self.progress_log(f"マーク画像 {generated_path} を生成しました。") # 初回の採点時などに表示
+            self.layout = layout.Layout.load(self.position_json_path, self.correct_mark_path, self.incorrect_mark_path)
+        except Exception as e:
+            messagebox.showerror("エラー", f"位置情報JSONまたはマーク画像の読み込みに失敗しました: {e}")
+            return
+
+        # --- 再採点する問題 (指定時は問題領域モードで、その問題だけを送る) ---
+        regrade_text = self.regrade_problems_entry.get().strip()
+        self.regrade_problems = [number.strip() for number in regrade_text.split(",") if number.strip()] or None
+        if self.regrade_problems is not None:
+            unknown = [number for number in self.regrade_problems if number not in self.layout.index_by_problem]
+            if unknown:
+                messagebox.showerror("エラー", f"位置情報JSONにない問題番号です: {', '.join(unknown)}")
+                return
+        self.region_mode = self.region_mode_var.get() or self.regrade_problems is not None
+        answer_key = None
+        if self.answer_key_path:
+            try:
+                answer_key = local_grader.load_answer_key(self.answer_key_path)
+            except Exception as e:
+                messagebox.showerror("エラー", f"正解キーの読み込みに失敗しました: {e}")
+                return
+
+        # --- 位置合わせの準備 (テンプレート画像の特徴点は 1 回だけ求める) ---
+        self.align_sheets = self.align_var.get()
+        if self.align_sheets:
+            template_path = self.layout.template_path
+            if not template_path or not os.path.exists(template_path):
+                template_path = filedialog.askopenfilename(
+                    title="位置合わせの基準にするテンプレート画像 (位置情報JSONを作った画像)",
+                    filetypes=[("Image files", "*.png;*.jpg;*.jpeg;*.gif;*.bmp")])
+                if not template_path:
+                    return
+            if self.registrar is None or self.registrar_template != template_path:
+                try:
+                    self.registrar = registration.SheetRegistrar(template_path)
+                except ValueError as e:
+                    messagebox.showerror("エラー", f"位置合わせの準備に失敗しました: {e}")
+                    return
+                self.registrar_template = template_path
+
         self.progress_log("採点処理を開始します...")
         self.error_clear() # エラー表示エリアをクリア
 
         os.makedirs(self.output_folder_path, exist_ok=True) # 出力フォルダを作成 (存在していてもOK)
 
-        for image_file in image_files:
-            image_path = os.path.join(self.image_folder_path, image_file)
-            output_image_path = os.path.join(self.output_folder_path, f"marked_{image_file}") # 出力ファイルパス
-
-            self.progress_log(f"{image_file} の採点処理を開始...")
-
+        # --- 採点済み画像の書き出し設定 ---
+        self.output_format = self.output_format_var.get()
+        self.output_writer = image_writer.OutputWriter(self.output_format)
+
+        # --- 前回の実行記録を確認 (再開時は完了済みのシートを飛ばす) ---
+        self.resume = self.resume_var.get()
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = job_journal.JobJournal(self.output_folder_path, self.layout.fingerprint)
+        all_jobs = grading_pipeline.build_jobs(self.image_folder_path, self.output_folder_path, image_files,
+                                               output_extension=self.output_writer.extension)
+        resume = self.resume and self.regrade_problems is None # 再採点する場合は全シートを処理
+        if resume:
+            self.progress_log(f"前回の実行記録を確認中... ({len(all_jobs)} 枚)")
+
+        def plan():
             try:
-                # --- 1. Gemini API連携で正誤結果を取得 ---
-                self.progress_log("  Gemini API 連携...")
-                problem_results = get_gemini_results_json.get_problem_results_from_gemini_json(image_path)
-                if problem_results is None:
-                    error_message = f"  Gemini API エラーまたは正誤結果取得失敗: {image_file}"
-                    self.error_log(error_message) # エラーメッセージをエラー表示エリアへ
-                    continue # 次の画像へ
-
-                # --- 2. 〇×マーク合成 ---
-                self.progress_log("  〇×マーク合成...")
-                marked_image = add_marks_to_image.add_marks_from_json(
-                    image_path,
-                    self.position_json_path,
-                    problem_results,
-                    correct_mark_path=self.correct_mark_path, # マーク画像ファイルパスを渡す
-                    incorrect_mark_path=self.incorrect_mark_path # マーク画像ファイルパスを渡す
-                )
-                if marked_image is None:
-                    error_message = f"  〇×マーク合成失敗: {image_file}"
-                    self.error_log(error_message) # エラーメッセージをエラー表示エリアへ
-                    continue # 次の画像へ
-
-                # --- 3. 採点済み画像を保存 ---
-                marked_image.save(output_image_path)
-                self.progress_log(f"{image_file} : 採点完了。{output_image_path} に保存")
-
-            except Exception as e: # 予期せぬエラー
-                error_message = f"{image_file} : 予期せぬエラー: {e}"
+                jobs, skipped_jobs = self.journal.plan(all_jobs, resume=resume)
+                previous_results = {}
+                if self.regrade_problems is not None: # 指定した問題以外は前回の正誤結果を使う
+                    previous_results = self.journal.previous_results(jobs) # PDF / TIFF のページは画像にした時に追加
+                self.plan_result = (jobs, skipped_jobs, previous_results)
+            except Exception as e:
+                self.plan_result = e
+
+        self.plan_result = None
+        self.plan_thread = threading.Thread(target=plan, daemon=True) # 入力画像のハッシュ計算で GUI を止めない
+        self.plan_thread.start()
+        self.after(self.poll_interval_ms, lambda: self.poll_plan(image_files, multipage_files, answer_key))
+
+
+    def poll_plan(self, image_files, multipage_files, answer_key):
+        """前回の実行記録との照合 (入力画像のハッシュ計算) の完了を待つ (after() で定期実行)"""
+        if self.plan_thread.is_alive():
+            self.after(self.poll_interval_ms, lambda: self.poll_plan(image_files, multipage_files, answer_key))
+            return
+        if isinstance(self.plan_result, Exception):
+            self.error_log(f"前回の実行記録を確認できませんでした: {self.plan_result}")
+            return
+        self.run_pipeline(*self.plan_result, image_files, multipage_files, answer_key)
+
+
+    def run_pipeline(self, jobs, skipped_jobs, previous_results, image_files, multipage_files, answer_key):
+        """実行するジョブが決まった後、採点クライアントとパイプラインを作って採点を始める"""
+        import local_grader # いずれも start_grading の時点で読み込み済み
+        import page_source
+        import preprocess_image
+        import sheet_dedup
+
+        if skipped_jobs:
+            self.progress_log(f"前回完了済みの {len(skipped_jobs)} 枚を飛ばします")
+
+        # --- シート一覧を初期化 ---
+        self.sheet_listbox.delete(0, tk.END)
+        self.sheet_index = {}
+        for job in skipped_jobs:
+            self.sheet_index[job.sheet_id] = self.sheet_listbox.size()
+            self.sheet_listbox.insert(tk.END, f"{job.sheet_id} : 完了 (前回)")
+        for job in jobs:
+            self.sheet_index[job.sheet_id] = self.sheet_listbox.size()
+            self.sheet_listbox.insert(tk.END, f"{job.sheet_id} : 待機中")
+
+        # --- 採点パイプラインを開始 (API 呼び出しと合成・保存はバックグラウンドで並行実行) ---
+        try:
+            self.api_workers = max(1, int(self.api_workers_var.get()))
+            self.batch_size = max(1, int(self.batch_size_var.get()))
+        except (tk.TclError, ValueError):
+            pass # 不正な入力の場合は前回の値を使う
+        self.use_cache = self.use_cache_var.get() # ワーカースレッドから Tk 変数を読まないよう、ここで値を取り出す
+        self.refresh_cache = self.refresh_cache_var.get()
+        self.stream_responses = self.stream_var.get()
+        self.cache_hits_at_start = self.result_cache.hits
+
+        # --- 送る範囲 (問題の範囲だけを切り抜くと画像が小さくなる。問題領域モードでは問題ごとに切り出すため使わない) ---
+        self.crop_to_layout = self.crop_to_layout_var.get() and not self.region_mode
+        preprocess_options = get_gemini_results_json.DEFAULT_PREPROCESS_OPTIONS
+        if self.crop_to_layout:
+            crop_options = preprocess_image.layout_crop_options(
+                self.layout, os.path.join(self.image_folder_path, image_files[0]) if image_files else None)
+            if crop_options is None:
+                self.error_log("問題の範囲を決められないため、ページ全体を送ります (テンプレート画像もシート画像もありません)")
+            else:
+                preprocess_options = dict(preprocess_options, **crop_options)
+                self.progress_log(f"問題の範囲だけを送ります: {crop_options['crop_box']}")
+        if self.grading_client is not None:
+            self.grading_client.close()
+        self.grading_client = grading_client.AsyncGradingClient(
+            requests_per_minute=self.requests_per_minute,
+            tokens_per_minute=self.tokens_per_minute,
+            max_in_flight=self.api_workers,
+            max_retries=self.max_retries,
+            cache=self.result_cache if self.use_cache else None,
+            refresh_cache=self.refresh_cache,
+            preprocess_options=preprocess_options,
+            layout=self.layout if self.region_mode else None,
+            stream=self.stream_responses,
+            on_verdict=self.on_verdict,
+        )
+        self.sync_grader = self.grading_client.as_sync_grader() # 全 API ワーカーでレート制限を共有
+        self.sync_batch_grader = self.grading_client.as_sync_batch_grader(batch_size=self.batch_size)
+        self.previous_results = previous_results
+        if self.regrade_problems is not None:
+            self.sync_grader = grading_client.make_partial_regrader(
+                self.sync_grader, self.regrade_problems, self.previous_results)
+            self.progress_log(f"問題 {', '.join(self.regrade_problems)} を採点し直します")
+        self.hybrid_grader = None
+        if answer_key is not None:
+            if self.digit_recognizer is None:
+                self.digit_recognizer = local_grader.KnnDigitRecognizer()
+            self.hybrid_grader = local_grader.HybridGrader(
+                local_grader.LocalGrader(self.layout, answer_key, recognizer=self.digit_recognizer,
+                                         min_confidence=local_grader.DEFAULT_MIN_CONFIDENCE
+                                         if self.local_min_confidence is None else self.local_min_confidence),
+                self.sync_grader,
+                batch_api_grader=self.request_batch_results,
+            )
+            self.sync_grader = self.hybrid_grader
+        self.dedup_sheets = self.dedup_var.get()
+        self.deduplicator = None
+        if self.dedup_sheets: # 過去の実行で採点したシートの索引はキャッシュフォルダに保存
+            self.deduplicator = sheet_dedup.SheetDeduplicator(
+                self.layout.fingerprint,
+                index_path=os.path.join(self.cache_dir, sheet_dedup.INDEX_FILE_NAME)
+                if self.use_cache and not self.refresh_cache else None)
+            self.sync_grader = self.deduplicator.wrap(self.sync_grader)
+        self.tracer.clear()
+        response_parser.reset_parse_stats()
+        self.verdict_counts = {}
+        self.sheet_id_by_path = {job.image_path: job.sheet_id for job in jobs}
+        self.pipeline = grading_pipeline.GradingPipeline(
+            self.grade_sheet,
+            self.composite_marks,
+            api_workers=self.api_workers,
+            cpu_workers=self.cpu_workers,
+            batch_grader=self.grade_sheets_batch if self.batch_size > 1 and not self.region_mode else None,
+            batch_size=self.batch_size,
+            writer=self.output_writer,
+            registrar=self.registrar if self.align_sheets else None,
+            input_hasher=job_journal.hash_file, # 再開用の入力ハッシュは API 段で求める
+        )
+        self.folder_watcher = None
+        if self.watch_folder: # 起動時にあった画像は、書き換えられない限り再採点しない
+            self.folder_watcher = folder_watcher.FolderWatcher(self.image_folder_path, recursive=False,
+                                                               exclude_dirs=[self.output_folder_path])
+            self.folder_watcher.prime(image_files)
+            self.progress_log("フォルダを監視します。新しいシートが届くと採点します")
+            self.after(self.watch_interval_ms, self.poll_folder_watch)
+        self.assemble_pages = self.assemble_var.get()
+        self.page_spooler = None
+        if multipage_files: # ページを 1 枚ずつ画像にして、採点が進むのに合わせて投入する
+            self.page_spooler = page_source.PageSpooler(self.image_folder_path, self.output_folder_path, multipage_files,
+                                                        dpi=self.page_dpi, output_extension=self.output_writer.extension,
+                                                        max_ahead=self.pages_ahead)
+            self.progress_log(f"複数ページのファイル {len(multipage_files)} 個のページを順に採点します")
+        if self.deduplicator is not None: # 重複シートの索引と一覧をシートIDで記録する
+            self.deduplicator.track(jobs)
+        self.pipeline.start(jobs, keep_open=self.watch_folder or self.page_spooler is not None)
+        if self.page_spooler is not None:
+            self.page_spooler.start()
+            self.after(self.poll_interval_ms, self.poll_page_spooler)
+        self.after(self.poll_interval_ms, self.poll_grading_events)
+
+
+    def on_verdict(self, image_path, problem_number, is_correct):
+        """ストリーミング受信中に問題 1 つ分の結果が届いた時の処理 (イベントループのスレッドから呼ばれる)"""
+        self.received_verdicts.put(image_path) # Tk の操作は GUI スレッドの poll_grading_events で行う
+
+
+    def grade_sheet(self, image_path):
+        """1 枚分の正誤結果を取得 (パイプラインの API 段から呼ばれる。一時的なエラーは再試行する)"""
+        return self.sync_grader(image_path)
+
+
+    def grade_sheets_batch(self, image_paths):
+        """複数シートの正誤結果を 1 回のリクエストで取得 (パイプラインの API 段から呼ばれる)"""
+        batch_grader = self.request_batch_results
+        if self.hybrid_grader is not None: # ローカルで採点しきれなかったシートだけを API に送る
+            batch_grader = self.hybrid_grader.grade_batch
+        if self.deduplicator is not None: # 重複したシートは送らない
+            return self.deduplicator.grade_batch(image_paths, batch_grader)
+        return batch_grader(image_paths)
+
+
+    def request_batch_results(self, image_paths):
+        """複数シートをまとめて Gemini API で採点 (1 枚ずつの採点とレート制限・再試行・統計を共有)"""
+        return self.sync_batch_grader(image_paths)
+
+
+    def composite_marks(self, image_path, problem_results, transform=None):
+        """1 枚分の〇×マーク合成 (パイプラインの合成段から呼ばれる。位置合わせした場合は transform で位置を補正)"""
+        import add_marks_to_image # OpenCV を使うため起動時には読み込まない (2 回目以降は読み込み済みのモジュールを返すだけ)
+        return add_marks_to_image.add_marks_with_layout(image_path, self.layout, problem_results,
+                                                        output_mode=self.output_writer.output_mode, transform=transform)
+
+
+    def poll_grading_events(self):
+        """採点パイプラインのイベントを取り出して GUI に反映 (after() で定期実行)"""
+        pipeline = self.pipeline
+        if pipeline is None:
+            return
+
+        updated_paths = set()
+        while not self.received_verdicts.empty(): # ストリーミングで届いた問題数を表示 (API 応答の完了前)
+            image_path = self.received_verdicts.get()
+            self.verdict_counts[image_path] = self.verdict_counts.get(image_path, 0) + 1
+            updated_paths.add(image_path)
+        for image_path in updated_paths:
+            self.set_sheet_status(self.sheet_id_by_path.get(image_path), f"Gemini API 受信中 ({self.verdict_counts[image_path]} 問)")
+
+        for event in pipeline.poll_events():
+            self.journal.record(event) # 途中で終了しても再開できるよう記録
+            kind = event["event"]
+            image_file = event.get("sheet_id")
+            if kind in ("saved", "failed", "cancelled") and self.page_spooler is not None:
+                self.page_spooler.release(image_file) # ページの一時ファイルを消し、次のページを読めるようにする
+
+            if kind == "started":
+                self.set_sheet_status(image_file, "Gemini API 連携中")
+                self.progress_log(f"{image_file} の採点処理を開始...", logging.DEBUG) # 処理段ごとの経過は詳細ログのみ
+            elif kind == "graded":
+                self.set_sheet_status(image_file, "〇×マーク合成中")
+                if event.get("reused"):
+                    self.progress_log(f"  {image_file} : 前回の正誤結果を使って〇×マーク合成...", logging.DEBUG)
+                else:
+                    self.progress_log(f"  {image_file} : 〇×マーク合成...", logging.DEBUG)
+            elif kind == "saved":
+                self.set_sheet_status(image_file, "完了")
+                self.progress_log(f"{image_file} : 採点完了。{event['output_path']} に保存 ({event['elapsed']:.1f} 秒, "
+                                  f"{event['bytes_written'] / 1024:.0f} KB, エンコード {event['encode_seconds'] * 1000:.0f} ms)")
+                if event.get("alignment", {}).get("low_confidence"): # マークがずれている可能性がある
+                    self.set_sheet_status(image_file, "完了 (位置合わせ要確認)")
+                    self.error_log(f"  {event['message']}: {image_file}")
+            elif kind == "failed":
+                self.set_sheet_status(image_file, "失敗")
+                error_message = f"  {event['message']}: {image_file}"
                 self.error_log(error_message) # エラーメッセージをエラー表示エリアへ
-                messagebox.showerror("エラー", error_message) # MessageBoxでもエラー表示
-                continue # 次の画像へ
+                if event.get("error") is not None: # 予期せぬエラーは MessageBox でも表示
+                    messagebox.showerror("エラー", f"{image_file} : {event['message']}")
+            elif kind == "cancelled":
+                self.set_sheet_status(image_file, "キャンセル")
+                self.progress_log(f"{image_file} : キャンセルしました")
+            elif kind == "finished":
+                self.output_writer.close() # 書き出し用スレッドを終了
+                self.update_trace_summary()
+                self.progress_log(f"全ての画像の採点処理が完了しました。({event['elapsed']:.1f} 秒)")
+                if self.use_cache:
+                    cache_hits = self.result_cache.hits - self.cache_hits_at_start
+                    self.progress_log(f"キャッシュヒット: {cache_hits} 件 (API 呼び出しを省略)")
+                client_stats = self.grading_client.stats
+                self.progress_log(f"API リクエスト: {client_stats['requests']} 件 (再試行 {client_stats['retries']} 件, "
+                                  f"一時停止 {self.grading_client.circuit_breaker.trip_count} 回)")
+                parse_stats = response_parser.parse_stats()
+                if parse_stats["responses"]:
+                    self.progress_log(f"回答の解析: 正常 {parse_stats['clean']} 件, 修復 {parse_stats['recovered']} 件, "
+                                      f"失敗 {parse_stats['failed']} 件 (解釈できなかった項目 {parse_stats['dropped_entries']} 件)")
+                    if parse_stats["failed"]:
+                        self.error_log(f"正誤結果を読み取れなかった回答 (先頭): {parse_stats['failed_samples'][-1][:200]}")
+                if self.hybrid_grader is not None:
+                    local_stats = self.hybrid_grader.stats
+                    self.progress_log(f"ローカル採点: {local_stats['local_problems']} 問 "
+                                      f"(API で採点 {local_stats['api_problems']} 問, "
+                                      f"API を省略したシート {self.hybrid_grader.api_calls_avoided():.0%})")
+                if self.deduplicator is not None:
+                    import sheet_dedup # 採点開始時に読み込み済み
+                    self.progress_log(self.deduplicator.format_summary())
+                    report_path = os.path.join(self.output_folder_path, sheet_dedup.REPORT_FILE_NAME)
+                    try:
+                        self.deduplicator.write_report(report_path)
+                    except OSError as e:
+                        self.error_log(f"重複シートの記録を保存できませんでした: {e}")
+                if self.page_spooler is not None and self.assemble_pages: # ページ数が多いと時間がかかるため別スレッドで
+                    threading.Thread(target=self.assemble_page_files, args=(self.page_spooler,), daemon=True).start()
+                messagebox.showinfo("完了", "採点処理が完了しました。") # 完了メッセージ
+                return # ポーリング終了
+
+        now = time.monotonic()
+        if now - self.trace_refreshed_at >= self.trace_refresh_ms / 1000: # 集計は重いので間引いて更新
+            self.trace_refreshed_at = now
+            self.update_trace_summary()
+        self.after(self.poll_interval_ms, self.poll_grading_events)
+
+
+    def update_trace_summary(self):
+        """処理段ごとの計測結果 (スループット, p50/p95) の表示を更新"""
+        self.trace_summary_text.config(state=tk.NORMAL)
+        self.trace_summary_text.delete("1.0", tk.END)
+        self.trace_summary_text.insert(tk.END, self.tracer.format_summary())
+        self.trace_summary_text.config(state=tk.DISABLED)
+
+
+    def export_trace(self):
+        """直前の採点の計測データを保存 (.json は chrome://tracing / Perfetto 用, .jsonl は 1 行 1 スパン)"""
+        if not self.tracer.spans():
+            messagebox.showerror("エラー", "計測データがありません。採点後に保存してください")
+            return
+        trace_path = filedialog.asksaveasfilename(title="計測データの保存先", defaultextension=".json",
+                                                  initialdir=self.output_folder_path, initialfile="trace.json",
+                                                  filetypes=[("Chrome トレース", "*.json"), ("JSONL", "*.jsonl")])
+        if not trace_path:
+            return
+        try:
+            self.tracer.export(trace_path)
+        except OSError as e:
+            self.error_log(f"計測データの保存に失敗しました: {e}")
+            return
+        self.progress_log(f"計測データを保存しました: {trace_path}")
+
+
+    def poll_folder_watch(self):
+        """監視中のフォルダに届いたシートを採点パイプラインに追加 (after() で定期実行)"""
+        if self.folder_watcher is None:
+            return
+        arrived_files = self.folder_watcher.poll()
+        if arrived_files:
+            jobs, skipped_jobs = self.journal.plan(
+                grading_pipeline.build_jobs(self.image_folder_path, self.output_folder_path, arrived_files,
+                                            output_extension=self.output_writer.extension))
+            for job in skipped_jobs:
+                self.progress_log(f"{job.sheet_id} : 採点済みと同じ内容のため飛ばします")
+            for job in jobs:
+                self.sheet_id_by_path[job.image_path] = job.sheet_id
+                if job.sheet_id in self.sheet_index: # 書き換えられたシートは同じ行で再採点
+                    self.set_sheet_status(job.sheet_id, "待機中 (更新)")
+                else:
+                    self.sheet_index[job.sheet_id] = self.sheet_listbox.size()
+                    self.sheet_listbox.insert(tk.END, f"{job.sheet_id} : 待機中")
+            if jobs:
+                self.progress_log(f"{len(jobs)} 枚が届きました: {', '.join(job.sheet_id for job in jobs)}")
+                if self.deduplicator is not None:
+                    self.deduplicator.track(jobs)
+                self.pipeline.submit(jobs)
+        self.after(self.watch_interval_ms, self.poll_folder_watch)
+
+
+    def poll_page_spooler(self):
+        """PDF / TIFF のページのうち、画像にできたものを採点パイプラインに追加 (after() で定期実行)"""
+        spooler = self.page_spooler
+        if spooler is None or spooler.exhausted:
+            return
+        jobs, errors = spooler.take()
+        for sheet_id, message in errors:
+            self.error_log(f"  {message}: {sheet_id}")
+        if jobs:
+            jobs, skipped_jobs = self.journal.plan(jobs, resume=self.resume and self.regrade_problems is None)
+            if self.regrade_problems is not None:
+                self.previous_results.update(self.journal.previous_results(jobs))
+            for job in skipped_jobs:
+                self.sheet_index[job.sheet_id] = self.sheet_listbox.size()
+                self.sheet_listbox.insert(tk.END, f"{job.sheet_id} : 完了 (前回)")
+                spooler.release(job.sheet_id)
+            for job in jobs:
+                self.sheet_id_by_path[job.image_path] = job.sheet_id
+                self.sheet_index[job.sheet_id] = self.sheet_listbox.size()
+                self.sheet_listbox.insert(tk.END, f"{job.sheet_id} : 待機中")
+            if jobs:
+                if self.deduplicator is not None: # 一時ファイルではなく元の PDF / TIFF のページで照合する
+                    self.deduplicator.track(jobs)
+                self.pipeline.submit(jobs)
+        if spooler.exhausted: # 全ページを投入した (監視中でなければ、残りを処理して終了)
+            if self.folder_watcher is None:
+                self.pipeline.close()
+            return
+        self.after(self.poll_interval_ms, self.poll_page_spooler)
 
-        self.progress_log("全ての画像の採点処理が完了しました。")
-        messagebox.showinfo("完了", "採点処理が完了しました。") # 完了メッセージ
+
+    def assemble_page_files(self, spooler):
+        """採点済みのページを PDF / TIFF ごとに 1 ファイルにまとめる (別スレッドで実行。ログはスレッドセーフ)"""
+        try:
+            for container_path, page_count, missing_count in spooler.assemble():
+                self.progress_log(f"ページをまとめました: {container_path} ({page_count} ページ"
+                                  + (f", 保存できなかった {missing_count} ページは含めていません)" if missing_count else ")"))
+        except Exception as e:
+            self.error_log(f"ページをまとめられませんでした: {e}")
+
+
+    def stop_watching(self):
+        """フォルダの監視を終了 (届いたシートの採点は最後まで行う)"""
+        if self.folder_watcher is None:
+            return
+        self.folder_watcher = None
+        if self.page_spooler is None or self.page_spooler.exhausted: # PDF / TIFF のページが残っていれば投入し終えてから締め切る
+            self.pipeline.close()
+        self.progress_log("フォルダの監視を終了しました (採点中のシートは最後まで処理します)")
+
+
+    def set_sheet_status(self, image_file, status):
+        """シート一覧の該当行の状態表示を更新"""
+        index = self.sheet_index.get(image_file)
+        if index is None:
+            return
+        self.sheet_listbox.delete(index)
+        self.sheet_listbox.insert(index, f"{image_file} : {status}")
+
+
+    def cancel_selected_sheets(self):
+        """シート一覧で選択したシートの採点をキャンセル"""
+        if self.pipeline is None or self.pipeline.finished:
+            return
+        for index in self.sheet_listbox.curselection():
+            image_file = self.sheet_listbox.get(index).rsplit(" : ", 1)[0]
+            self.pipeline.cancel(image_file)
+            self.progress_log(f"{image_file} : キャンセルを要求しました")
+
+
+    def cancel_grading(self):
+        """実行中の採点処理を全てキャンセル"""
+        if self.pipeline is None or self.pipeline.finished:
+            return
+        self.stop_watching()
+        if self.page_spooler is not None: # 残りのページは読まない
+            self.page_spooler.stop()
+        self.pipeline.cancel_all()
+        self.progress_log("採点処理のキャンセルを要求しました (API 呼び出し中のシートは応答後に破棄します)")
+
+
+    def clear_result_cache(self):
+        """正誤結果キャッシュを全て削除"""
+        if self.pipeline is not None and not self.pipeline.finished:
+            messagebox.showerror("エラー", "採点処理の実行中はキャッシュを削除できません")
+            return
+        self.result_cache.clear()
+        self.progress_log(f"キャッシュを削除しました: {self.cache_dir}")
+
+
+    def export_report(self):
+        """出力フォルダの採点結果から PDF レポートを作成 (再採点はしない)"""
+        if self.pipeline is not None and not self.pipeline.finished:
+            messagebox.showerror("エラー", "採点処理の完了後に作成してください")
+            return
+        if self.report_thread is not None and self.report_thread.is_alive():
+            messagebox.showerror("エラー", "PDFレポートを作成中です")
+            return
+        try:
+            records = grade_report.load_results(self.output_folder_path)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("エラー", f"採点結果の読み込みに失敗しました: {e}")
+            return
+        report_path = filedialog.asksaveasfilename(title="PDFレポートの保存先", defaultextension=".pdf",
+                                                   initialdir=self.output_folder_path,
+                                                   initialfile=grade_report.REPORT_FILE_NAME,
+                                                   filetypes=[("PDF", "*.pdf")])
+        if not report_path:
+            return
+
+        def build():
+            try:
+                self.report_result = grade_report.build_report(
+                    records, report_path,
+                    on_missing=lambda sheet_id, output_path: self.error_log(f"採点済み画像が見つかりません: {sheet_id} ({output_path})"))
+            except Exception as e:
+                self.report_result = e
+
+        self.progress_log(f"PDFレポートを作成中... ({len(records)} 枚)")
+        self.report_result = None
+        self.report_thread = threading.Thread(target=build, daemon=True) # 作成中も GUI を操作できるようにする
+        self.report_thread.start()
+        self.after(self.poll_interval_ms, lambda: self.poll_report(report_path))
+
+
+    def poll_report(self, report_path):
+        """PDF レポートの作成完了を待つ (after() で定期実行)"""
+        if self.report_thread.is_alive():
+            self.after(self.poll_interval_ms, lambda: self.poll_report(report_path))
+            return
+        if isinstance(self.report_result, Exception):
+            self.error_log(f"PDFレポートの作成に失敗しました: {self.report_result}")
+            return
+        self.progress_log(f"PDFレポートを保存しました: {report_path} ({self.report_result} ページ)")
 
 
     def open_settings_dialog(self):
@@ -173,26 +849,38 @@ class MainApplication(tk.Tk):
         messagebox.showinfo("設定", "設定画面はまだ実装されていません。")
 
 
-    def progress_log(self, message):
-        """進捗状況を Text ウィジェットに追記表示 (改行あり)"""
-        self.progress_text.config(state=tk.NORMAL) # 編集可能にする
-        self.progress_text.insert(tk.END, message + "\n") # テキスト追記
-        self.progress_text.see(tk.END) #  一番下にスクロール
-        self.progress_text.config(state=tk.DISABLED) # 編集不可に戻す
-        self.update_idletasks() #  GUI を更新 (即時反映)
+    def progress_log(self, message, level=logging.INFO):
+        """進捗状況を記録 (スレッドセーフ。画面には drain_log でまとめて表示し、ログファイルにも書き出す)"""
+        self.gui_log.progress(message, level)
 
 
-    def error_log(self, message):
-        """エラーメッセージを Text ウィジェットに追記表示 (改行あり)"""
-        self.error_text.config(state=tk.NORMAL) # 編集可能にする
-        self.error_text.insert(tk.END, message + "\n") # エラーメッセージ追記
-        self.error_text.see(tk.END)
-        self.error_text.config(state=tk.DISABLED) # 編集不可に戻す
-        self.update_idletasks()
+    def error_log(self, message, level=logging.ERROR):
+        """エラーメッセージを記録 (スレッドセーフ。画面には drain_log でまとめて表示し、ログファイルにも書き出す)"""
+        self.gui_log.error(message, level)
+
+
+    def drain_log(self):
+        """溜まったログを表示エリアにまとめて追記 (after() で定期実行。表示エリアは log_max_lines 行に保つ)"""
+        self.render_log()
+        self.after(self.log_interval_ms, self.drain_log)
+
+
+    def render_log(self):
+        """溜まったログを表示エリアに追記 (表示エリアごとに 1 回の挿入)"""
+        widgets = {"progress": self.progress_text, "error": self.error_text}
+        for view, lines in self.gui_log.drain().items():
+            gui_log.append_lines(widgets[view], lines, self.log_max_lines)
+
+
+    def apply_log_level(self):
+        """詳細ログ (処理段ごとの経過) を画面に表示するかを切り替える (ログファイルには常に書き出す)"""
+        self.verbose_log = self.verbose_log_var.get()
+        self.gui_log.set_level(logging.DEBUG if self.verbose_log else logging.INFO)
 
 
     def error_clear(self):
         """エラーメッセージ表示エリアをクリア"""
+        self.render_log() # 表示待ちのログを先に表示してから消す (消した後に古いエラーが出ないように)
         self.error_text.config(state=tk.NORMAL) # 編集可能にする
         self.error_text.delete("1.0", tk.END) #  すべて削除
         self.error_text.config(state=tk.DISABLED) # 編集不可に戻す
@@ -200,27 +888,6 @@ class MainApplication(tk.Tk):
 
 
 if __name__ == "__main__":
-    app = MainApplication()
-
-    # --- マーク画像ファイル (〇×) が存在しない場合は、デフォルトの画像を生成して保存 ---
-    if not os.path.exists(app.correct_mark_path):
-        # デフォルトの〇画像生成 (赤丸)
-        mark_size = 60 # マークのサイズ (pixel)
-        mark_image = Image.new("RGBA", (mark_size, mark_size), (0, 0, 0, 0)) # 透明RGBA画像
-        draw = ImageDraw.Draw(mark_image)
-        draw.ellipse((5, 5, mark_size - 5, mark_size - 5), fill=(255, 0, 0, 255), width=5) # 赤丸
-        mark_image.save(app.correct_mark_path) # ファイルに保存
-        print(f"〇マーク画像 {app.correct_mark_path} を生成しました。") #  初回起動時などにメッセージを表示
-
-    if not os.path.exists(app.incorrect_mark_path):
-        # デフォルトの✕画像生成 (赤バツ)
-        mark_size = 60
-        mark_image = Image.new("RGBA", (mark_size, mark_size), (0, 0, 0, 0)) # 透明RGBA画像
-        draw = ImageDraw.Draw(mark_image)
-        draw.line((10, 10, mark_size - 10, mark_size - 10), fill=(255, 0, 0, 255), width=8) # 赤バツ斜め線
-        draw.line((10, mark_size - 10, mark_size - 10, 10), fill=(255, 0, 0, 255), width=8) # 赤バツ斜め線 (もう一本)
-        mark_image.save(app.incorrect_mark_path) # ファイルに保存
-        print(f"✕マーク画像 {app.incorrect_mark_path} を生成しました。") # 初回起動時などにメッセージを表示
-
-
-    app.mainloop()
\ No newline at end of file
+    app = MainApplication() # マーク画像 (〇×) がない場合は、採点開始時に既定の画像を生成する (mark_assets)
+    app.mainloop()
+    app.gui_log.close() # ログファイルを閉じる
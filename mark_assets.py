@@ -0,0 +1,84 @@
+import os
+import threading
+
+from PIL import Image, ImageDraw
+
+MARK_SIZE = 60 # 既定のマーク画像のサイズ (pixel)
+MARK_KINDS = ("correct", "incorrect") # correct: 〇 (正解), incorrect: ✕ (不正解)
+
+_marks = {} # (絶対パス, 更新時刻, サイズ) -> 読み込み済みのマーク画像 (RGBA)
+_marks_lock = threading.Lock()
+
+
+def draw_default_mark(kind, mark_size=MARK_SIZE):
+    """
+    既定のマーク画像 (赤丸 / 赤バツ) を描画する
+
+    Args:
+        kind:      "correct" (〇) または "incorrect" (✕)
+        mark_size: マーク画像の一辺 (pixel)
+    Returns:
+        Image: 透明背景の RGBA 画像
+    """
+    if kind not in MARK_KINDS:
+        raise ValueError(f"不明なマークの種類です: {kind}")
+    mark_image = Image.new("RGBA", (mark_size, mark_size), (0, 0, 0, 0)) # 透明RGBA画像
+    draw = ImageDraw.Draw(mark_image)
+    if kind == "correct":
+        draw.ellipse((5, 5, mark_size - 5, mark_size - 5), fill=(255, 0, 0, 255), width=5) # 赤丸
+    else:
+        draw.line((10, 10, mark_size - 10, mark_size - 10), fill=(255, 0, 0, 255), width=8) # 赤バツ斜め線
+        draw.line((10, mark_size - 10, mark_size - 10, 10), fill=(255, 0, 0, 255), width=8) # 赤バツ斜め線 (もう一本)
+    return mark_image
+
+
+def ensure_default_marks(correct_mark_path="circle_red.png", incorrect_mark_path="cross_red.png"):
+    """
+    マーク画像ファイル (〇×) が存在しない場合は、既定の画像を生成して保存する (初回の採点時など)
+
+    Args:
+        correct_mark_path:   正解マーク画像 (〇) のファイルパス
+        incorrect_mark_path: 不正解マーク画像 (✕) のファイルパス
+    Returns:
+        list: 生成したファイルのパス (すべて存在した場合は空)
+    """
+    generated = []
+    for path, kind in ((correct_mark_path, "correct"), (incorrect_mark_path, "incorrect")):
+        if not os.path.exists(path):
+            draw_default_mark(kind).save(path) # ファイルに保存
+            generated.append(path)
+    return generated
+
+
+def load_mark(path):
+    """
+    マーク画像ファイルを RGBA 画像として読み込む
+
+    読み込んだ画像はパスと更新時刻ごとに保持し、同じファイルは 2 回目以降デコードしない
+    (採点開始のたびに Layout.load() で読み込むため)。ファイルを差し替えると読み込み直す。
+    返す画像は共有されるため、呼び出し側で書き換えないこと。
+
+    Args:
+        path: マーク画像のファイルパス (PNG推奨)
+    Returns:
+        Image: RGBA 画像
+    Raises:
+        FileNotFoundError: ファイルがない場合
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _marks_lock:
+        mark_image = _marks.get(key)
+    if mark_image is None:
+        with Image.open(path) as image:
+            mark_image = image.convert("RGBA")
+        with _marks_lock:
+            _marks[key] = mark_image
+    return mark_image
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    for generated_path in ensure_default_marks():
+        print(f"マーク画像 {generated_path} を生成しました。")
+    print(load_mark("circle_red.png"), load_mark("cross_red.png"))
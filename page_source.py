@@ -0,0 +1,375 @@
+import os
+import queue
+import threading
+
+from PIL import Image, ImageOps, TiffImagePlugin
+
+import grading_pipeline
+
+MULTIPAGE_EXTENSIONS = ('.pdf', '.tif', '.tiff') # 1 ファイルに複数のシートが入った入力 (スキャナーの出力)
+PAGE_SEPARATOR = "#" # シートID の区切り (例: "1組.pdf#12" = 1組.pdf の 12 ページ目)
+DEFAULT_DPI = 200 # ページを画像にする解像度 (PDF はページの大きさから、TIFF は記録された解像度から換算)
+DEFAULT_MAX_AHEAD = 8 # 採点が終わるのを待たずに画像にしておくページ数の上限
+SPOOL_DIR_NAME = ".pages" # 出力フォルダ内の、ページを画像にした一時ファイルを置くフォルダ
+
+
+def is_multipage_file(path):
+    """複数ページの入力ファイル (PDF / TIFF) か"""
+    return path.lower().endswith(MULTIPAGE_EXTENSIONS)
+
+
+def page_sheet_id(source_file, page_number):
+    """ページのシートID ("ファイル#ページ番号", ページ番号は 1 から)"""
+    return f"{source_file}{PAGE_SEPARATOR}{page_number}"
+
+
+def find_multipage_files(image_folder_path, recursive=False, exclude_dirs=()):
+    """フォルダ内の PDF / TIFF ファイルを探す (image_folder_path からの相対パスのリスト, ソート済み)"""
+    return grading_pipeline.find_image_files(image_folder_path, recursive=recursive, exclude_dirs=exclude_dirs,
+                                             extensions=MULTIPAGE_EXTENSIONS)
+
+
+def _open_pdf(pdf_file):
+    """
+    pypdf で PDF を開く (PDF を入力にする場合のみ必要なため、ここで読み込む)
+
+    パスではなく開いたファイルを渡す (パスを渡すと pypdf はファイル全体をメモリに読み込むため)
+    """
+    try:
+        import pypdf
+    except ImportError:
+        raise RuntimeError("PDF を読み込むには pypdf が必要です (pip install pypdf)") from None
+    return pypdf.PdfReader(pdf_file)
+
+
+def count_pages(path):
+    """ファイルのページ数 (ページの画像はデコードしない)"""
+    if path.lower().endswith(".pdf"):
+        with open(path, 'rb') as pdf_file:
+            return len(_open_pdf(pdf_file).pages)
+    with Image.open(path) as image:
+        return getattr(image, "n_frames", 1)
+
+
+def _resize_to_dpi(image, size):
+    """指定した大きさ (pixel) に合わせる (ほぼ同じ大きさなら何もしない)"""
+    width, height = size
+    if width <= 0 or height <= 0 or (abs(width - image.width) <= 1 and abs(height - image.height) <= 1):
+        return image
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def _iter_pdf_pages(path, dpi):
+    """
+    スキャンした PDF の各ページに埋め込まれた画像を取り出す
+
+    PDF を描画するのではなく、ページ内で最も大きい画像 (スキャン画像) を取り出して、
+    ページの大きさと dpi から求めた大きさに合わせる。画像を含まないページは ValueError。
+    """
+    with open(path, 'rb') as pdf_file:
+        reader = _open_pdf(pdf_file)
+        for index in range(len(reader.pages)):
+            try:
+                image = _pdf_page_image(reader.pages[index], dpi)
+            except ValueError as e:
+                yield index + 1, e
+                continue
+            yield index + 1, image
+            image = None
+            reader.resolved_objects.clear() # 読み込んだページの画像データを保持し続けないよう、解析済みオブジェクトを捨てる
+
+
+def _pdf_page_image(page, dpi):
+    """PDF の 1 ページに埋め込まれた最も大きい画像を取り出す (画像を含まないページは ValueError)"""
+    images = list(page.images)
+    if not images:
+        raise ValueError("ページに画像がありません (スキャンした PDF のみ読み込めます)")
+    image = max((image_file.image for image_file in images), key=lambda image: image.width * image.height)
+    images = None
+    rotation = page.rotation % 360
+    if rotation:
+        image = image.rotate(-rotation, expand=True) # /Rotate は時計回り
+    if dpi:
+        page_width, page_height = float(page.mediabox.width), float(page.mediabox.height)
+        if rotation in (90, 270):
+            page_width, page_height = page_height, page_width
+        image = _resize_to_dpi(image, (round(page_width * dpi / 72), round(page_height * dpi / 72)))
+    return image
+
+
+def _iter_tiff_pages(path, dpi):
+    """TIFF の各ページを 1 枚ずつデコードする (記録された解像度があれば dpi に合わせる)"""
+    with Image.open(path) as image:
+        for index in range(getattr(image, "n_frames", 1)):
+            image.seek(index)
+            yield index + 1, _tiff_page_image(image, dpi)
+
+
+def _tiff_page_image(image, dpi):
+    """seek() 済みの TIFF の現在のページをデコードする"""
+    page = ImageOps.exif_transpose(image.copy()) # copy() でこのページだけをデコード
+    source_dpi = image.info.get("dpi")
+    if dpi and source_dpi and source_dpi[0] and source_dpi[1]:
+        page = _resize_to_dpi(page, (round(page.width * dpi / float(source_dpi[0])),
+                                     round(page.height * dpi / float(source_dpi[1]))))
+    return page
+
+
+def iter_pages(path, dpi=DEFAULT_DPI):
+    """
+    複数ページのファイルからページの画像を 1 枚ずつ取り出す
+
+    同時にデコードするのは 1 ページだけなので、ページ数が多くてもメモリ使用量は増えない。
+
+    Args:
+        path: PDF または TIFF ファイルのパス
+        dpi:  ページの解像度 (None で元の画像のまま)
+    Yields:
+        tuple: (ページ番号 (1 から), PIL Image)。読み込めないページは Image の代わりに例外
+    """
+    if path.lower().endswith(".pdf"):
+        return _iter_pdf_pages(path, dpi)
+    return _iter_tiff_pages(path, dpi)
+
+
+def load_page(path, page_number, dpi=DEFAULT_DPI):
+    """
+    複数ページのファイルから 1 ページだけを画像にする (前のページはデコードしない)
+
+    一時ファイルを消した後のページを読み直す場合 (重複シートの照合など) に使う。
+
+    Args:
+        path:        PDF または TIFF ファイルのパス
+        page_number: ページ番号 (1 から)
+        dpi:         ページの解像度 (None で元の画像のまま)
+    Returns:
+        PIL Image
+    Raises:
+        ValueError: ページがない・画像を含まないページの場合
+    """
+    if path.lower().endswith(".pdf"):
+        with open(path, 'rb') as pdf_file:
+            reader = _open_pdf(pdf_file)
+            if not 1 <= page_number <= len(reader.pages):
+                raise ValueError(f"ページ {page_number} はありません ({len(reader.pages)} ページ)")
+            return _pdf_page_image(reader.pages[page_number - 1], dpi)
+    with Image.open(path) as image:
+        page_count = getattr(image, "n_frames", 1)
+        if not 1 <= page_number <= page_count:
+            raise ValueError(f"ページ {page_number} はありません ({page_count} ページ)")
+        image.seek(page_number - 1)
+        return _tiff_page_image(image, dpi)
+
+
+def page_file_name(source_file, page_number, extension):
+    """
+    ページの画像ファイル名 (例: 1組.pdf_p012.png)
+
+    同じフォルダの 1組.pdf と 1組.tif が同じ名前にならないよう、元のファイルの拡張子も残す。
+    """
+    return f"{os.path.basename(source_file)}_p{page_number:03d}{extension}"
+
+
+def page_output_path(output_folder_path, source_file, page_number, extension):
+    """ページの採点済み画像の出力パス (例: marked_1組.pdf_p012.png。元ファイルと同じ構成のサブフォルダに出力)"""
+    return os.path.join(output_folder_path, os.path.dirname(source_file),
+                        "marked_" + page_file_name(source_file, page_number, extension))
+
+
+def assembled_output_path(output_folder_path, source_file):
+    """ページをまとめ直したファイルの出力パス (例: marked_1組.pdf)"""
+    return os.path.join(output_folder_path, os.path.dirname(source_file), f"marked_{os.path.basename(source_file)}")
+
+
+def assemble_pages(page_paths, container_path, dpi=DEFAULT_DPI):
+    """
+    採点済みのページ画像を元と同じ形式 (PDF / TIFF) の 1 ファイルにまとめる
+
+    ページは 1 枚ずつ読み込んで書き込むため、ページ数が多くてもメモリ使用量は増えない。
+
+    Args:
+        page_paths:     ページ画像のパスのリスト (ページ順)
+        container_path: 出力ファイルのパス (拡張子 .pdf / .tif / .tiff で形式を決める)
+        dpi:            ページの解像度 (PDF のページの大きさ, TIFF に記録する解像度)
+    Returns:
+        int: 書き込んだページ数
+    """
+    if container_path.lower().endswith(".pdf"):
+        import grade_report # PDF の書き出し (JPEG で 1 ページずつ書き込む)
+        writer = grade_report.StreamingPdfWriter(container_path)
+        page_order = []
+        for page_path in page_paths:
+            with Image.open(page_path) as page:
+                page_order.append(writer.add_image_page(page, dpi=dpi or 150))
+        writer.close(page_order)
+        return len(page_order)
+
+    with TiffImagePlugin.AppendingTiffWriter(container_path, new=True) as tiff:
+        for page_path in page_paths:
+            with Image.open(page_path) as page:
+                if page.mode not in ("1", "L", "RGB"):
+                    page = page.convert("RGB")
+                options = {"dpi": (dpi, dpi)} if dpi else {}
+                page.save(tiff, format="TIFF", compression="tiff_lzw", **options)
+            tiff.newFrame()
+    return len(page_paths)
+
+
+class PageSpooler:
+    """
+    複数ページのファイルをページごとの画像ファイルにして、採点するシート (SheetJob) として順に渡す
+
+    別スレッドでページを 1 枚ずつデコードし、出力フォルダ内の一時フォルダに PNG で書き出す。
+    採点が終わっていないページが max_ahead 枚に達すると、release() されるまで次のページを読まない
+    (メモリ使用量も一時ファイルの数も、ページ数によらず一定に保つ)。
+    呼び出し側は take() で書き出し済みのページを受け取ってパイプラインに投入し、
+    シートの処理が終わったら release() で一時ファイルを消す。
+
+    Args:
+        image_folder_path:  入力フォルダ
+        output_folder_path: 出力フォルダ (一時ファイルは SPOOL_DIR_NAME のサブフォルダに置く)
+        source_files:       複数ページのファイル (image_folder_path からの相対パス) のリスト
+        dpi:                ページの解像度 (None で元の画像のまま)
+        output_extension:   採点済み画像の拡張子 (None で ".png")
+        max_ahead:          採点待ちにしておくページ数の上限
+    """
+
+    def __init__(self, image_folder_path, output_folder_path, source_files, dpi=DEFAULT_DPI,
+                 output_extension=None, max_ahead=DEFAULT_MAX_AHEAD):
+        self.image_folder_path = image_folder_path
+        self.output_folder_path = output_folder_path
+        self.source_files = list(source_files)
+        self.dpi = dpi
+        self.output_extension = output_extension or ".png"
+        self.spool_dir = os.path.join(output_folder_path, SPOOL_DIR_NAME)
+        self.page_outputs = {source_file: [] for source_file in self.source_files} # ファイル -> ページの出力パス (ページ順)
+        self._ready = queue.Queue() # ("job", SheetJob) / ("error", シートID, メッセージ) / ("done",)
+        self._slots = threading.Semaphore(max(1, int(max_ahead)))
+        self._spooled = {} # シートID -> 一時ファイルのパス (release() 待ち)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.exhausted = False # 全てのページを take() で渡し終えたか
+
+    def start(self):
+        """ページの書き出しを別スレッドで開始する"""
+        self._thread = threading.Thread(target=self._produce, name="page-spooler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """これ以降のページを読まない (キャンセル時)"""
+        self._stop.set()
+
+    def _acquire_slot(self):
+        """採点待ちのページが max_ahead 枚未満になるまで待つ (stop() されたら False)"""
+        while not self._stop.is_set():
+            if self._slots.acquire(timeout=0.1):
+                return True
+        return False
+
+    def _produce(self):
+        """全ファイルのページを順に画像ファイルにする (書き出しスレッド)"""
+        try:
+            for source_file in self.source_files:
+                source_path = os.path.join(self.image_folder_path, source_file)
+                try:
+                    pages = iter_pages(source_path, self.dpi)
+                    for page_number, page in pages:
+                        sheet_id = page_sheet_id(source_file, page_number)
+                        if isinstance(page, Exception):
+                            self._ready.put(("error", sheet_id, f"ページを読み込めませんでした: {page}"))
+                            continue
+                        if not self._acquire_slot():
+                            return
+                        spool_path = os.path.join(self.spool_dir, os.path.dirname(source_file),
+                                                  page_file_name(source_file, page_number, ".png"))
+                        os.makedirs(os.path.dirname(spool_path), exist_ok=True)
+                        page.save(spool_path)
+                        page = None
+                        output_path = page_output_path(self.output_folder_path, source_file, page_number,
+                                                       self.output_extension)
+                        self.page_outputs[source_file].append(output_path)
+                        with self._lock:
+                            self._spooled[sheet_id] = spool_path
+                        job = grading_pipeline.SheetJob(sheet_id, spool_path, output_path)
+                        job.source_path, job.page_number = source_path, page_number # 一時ファイルを消した後も元のページを読めるように
+                        self._ready.put(("job", job))
+                        if self._stop.is_set():
+                            return
+                except Exception as e: # 壊れたファイル・pypdf がない場合など (このファイルの残りのページは飛ばす)
+                    self._ready.put(("error", source_file, f"ファイルを読み込めませんでした: {e}"))
+        finally:
+            self._ready.put(("done",))
+
+    def take(self):
+        """
+        書き出し済みのページを受け取る (待たない)
+
+        Returns:
+            tuple: (SheetJob のリスト, (シートID, エラーメッセージ) のリスト)
+        """
+        jobs, errors = [], []
+        while True:
+            try:
+                item = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            if item[0] == "job":
+                jobs.append(item[1])
+            elif item[0] == "error":
+                errors.append((item[1], item[2]))
+            else:
+                self.exhausted = True
+        return jobs, errors
+
+    def release(self, sheet_id):
+        """ページの処理が終わった (保存・失敗・キャンセル・前回完了済み)。一時ファイルを消し、次のページを読めるようにする"""
+        with self._lock:
+            spool_path = self._spooled.pop(sheet_id, None)
+        if spool_path is None:
+            return # このスプーラーのページではない
+        try:
+            os.remove(spool_path)
+        except OSError:
+            pass
+        self._slots.release()
+
+    def assemble(self, dpi=None):
+        """
+        ファイルごとに、保存できたページを元と同じ形式の 1 ファイル (marked_<元のファイル名>) にまとめる
+
+        Returns:
+            list: (出力パス, まとめたページ数, 含めなかったページ数) のリスト
+        """
+        assembled = []
+        for source_file, output_paths in self.page_outputs.items():
+            page_paths = [path for path in output_paths if os.path.exists(path)]
+            if not page_paths:
+                continue
+            container_path = assembled_output_path(self.output_folder_path, source_file)
+            os.makedirs(os.path.dirname(container_path) or ".", exist_ok=True)
+            page_count = assemble_pages(page_paths, container_path, dpi=dpi or self.dpi)
+            assembled.append((container_path, page_count, len(output_paths) - page_count))
+        return assembled
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    import sys
+    import time
+    import tracemalloc
+
+    if len(sys.argv) < 2:
+        print("使い方: python page_source.py <PDF または TIFF> [dpi]")
+        sys.exit(1)
+    dpi = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_DPI
+    tracemalloc.start()
+    start = time.perf_counter()
+    print(f"{sys.argv[1]}: {count_pages(sys.argv[1])} ページ")
+    for page_number, page in iter_pages(sys.argv[1], dpi):
+        if isinstance(page, Exception):
+            print(f"  {PAGE_SEPARATOR}{page_number}: {page}")
+            continue
+        print(f"  {PAGE_SEPARATOR}{page_number}: {page.size[0]}x{page.size[1]} {page.mode}")
+    current, peak = tracemalloc.get_traced_memory()
+    print(f"{time.perf_counter() - start:.2f} 秒, メモリ使用量のピーク {peak / 1024 / 1024:.1f} MB")
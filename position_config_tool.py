@@ -1,7 +1,11 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, Label, Entry, Button, Canvas, Scrollbar, BOTH, VERTICAL, HORIZONTAL
-from PIL import Image, ImageTk, UnidentifiedImageError
+from PIL import UnidentifiedImageError
 import json
+import os
+
+from auto_layout import detect_layout
+from tiled_image_view import ImagePyramid, TiledImageView, ZOOM_STEP
 
 class PositionConfigTool(tk.Tk):
     def __init__(self):
@@ -10,8 +14,9 @@ class PositionConfigTool(tk.Tk):
         self.geometry("1000x800") # ウィンドウサイズを少し大きく
 
         self.image_path = ""
-        self.grid_image_tk = None
         self.positions = {"問題位置情報": []} # 位置情報を格納する辞書
+        self.drag_start = None # ドラッグ開始位置 (Canvas座標)
+        self.region = None # ドラッグで指定した問題領域 (x1, y1, x2, y2, 元画像の座標)
 
         # --- GUI要素の作成 ---
         # 1. 画像表示エリア
@@ -21,7 +26,7 @@ class PositionConfigTool(tk.Tk):
         self.canvas_scrollbar_y = Scrollbar(self.canvas_frame, orient=VERTICAL)
         self.canvas_scrollbar_x = Scrollbar(self.canvas_frame, orient=HORIZONTAL)
 
-        self.canvas = Canvas(self.canvas_frame, bd=0, xscrollcommand=self.canvas_scrollbar_x.set, yscrollcommand=self.canvas_scrollbar_y.set, relief=tk.SUNKEN) # Scrollbarと連携、凹んだ枠線
+        self.canvas = Canvas(self.canvas_frame, bd=0, relief=tk.SUNKEN) # 凹んだ枠線 (Scrollbarとの連携は TiledImageView が行う)
 
         self.canvas_scrollbar_y.config(command=self.canvas.yview)
         self.canvas_scrollbar_x.config(command=self.canvas.xview)
@@ -30,7 +35,12 @@ class PositionConfigTool(tk.Tk):
         self.canvas_scrollbar_x.pack(side=tk.BOTTOM, fill=tk.X)
         self.canvas.pack(side=tk.TOP, fill=BOTH, expand=True) # Frame内で伸縮
 
-        self.canvas.bind("<Button-1>", self.on_canvas_click) # クリックイベント
+        # 見えている範囲だけをタイルで描画 (大きな画像でもすぐ開け、Ctrl+ホイールで拡大・縮小できる)
+        self.image_view = TiledImageView(self.canvas, self.canvas_scrollbar_x, self.canvas_scrollbar_y, on_zoom=self.on_zoom_changed)
+
+        self.canvas.bind("<Button-1>", self.on_canvas_press) # クリック・ドラッグ開始
+        self.canvas.bind("<B1-Motion>", self.on_canvas_drag) # ドラッグ中 (問題領域の矩形を表示)
+        self.canvas.bind("<ButtonRelease-1>", self.on_canvas_click) # クリック (正解位置) またはドラッグ終了 (問題領域)
 
         # 2. 設定エリア (右側)
         self.config_frame = tk.Frame(self)
@@ -43,6 +53,18 @@ class PositionConfigTool(tk.Tk):
         Button(self.file_frame, text="画像を開く", command=self.load_image).pack(side=tk.LEFT, padx=5)
         Button(self.file_frame, text="JSON保存", command=self.save_json).pack(side=tk.LEFT, padx=5)
         Button(self.file_frame, text="JSON読込", command=self.load_json).pack(side=tk.LEFT, padx=5)
+        Button(self.file_frame, text="自動検出", command=self.auto_detect_layout).pack(side=tk.LEFT, padx=5) # 解答欄を検出して位置情報の候補にする
+
+        # 2-1-2. 表示倍率 (Ctrl+マウスホイールでも変更可能)
+        self.zoom_frame = tk.Frame(self.config_frame)
+        self.zoom_frame.pack(fill=tk.X, pady=5)
+        Label(self.zoom_frame, text="表示:").pack(side=tk.LEFT)
+        Button(self.zoom_frame, text="拡大", command=lambda: self.image_view.zoom_by(ZOOM_STEP)).pack(side=tk.LEFT, padx=2)
+        Button(self.zoom_frame, text="縮小", command=lambda: self.image_view.zoom_by(1 / ZOOM_STEP)).pack(side=tk.LEFT, padx=2)
+        Button(self.zoom_frame, text="全体", command=lambda: self.image_view.set_zoom(self.image_view.fit_zoom())).pack(side=tk.LEFT, padx=2)
+        Button(self.zoom_frame, text="等倍", command=lambda: self.image_view.set_zoom(1.0)).pack(side=tk.LEFT, padx=2)
+        self.zoom_label = Label(self.zoom_frame, text="100%")
+        self.zoom_label.pack(side=tk.LEFT, padx=5)
 
         # 2-2. 問題番号設定
         self.problem_frame = tk.Frame(self.config_frame)
@@ -61,6 +83,14 @@ class PositionConfigTool(tk.Tk):
         self.y_pos_label = Label(self.position_frame, text="-")
         self.y_pos_label.pack(side=tk.LEFT)
 
+        # 2-3-2. 問題領域 (ドラッグで指定, 任意。問題ごとに切り出して採点する場合に使用)
+        self.region_frame = tk.Frame(self.config_frame)
+        self.region_frame.pack(fill=tk.X, pady=5)
+        Label(self.region_frame, text="問題領域:").pack(side=tk.LEFT)
+        self.region_label = Label(self.region_frame, text="- (ドラッグで指定)")
+        self.region_label.pack(side=tk.LEFT)
+        Button(self.region_frame, text="クリア", command=self.clear_region).pack(side=tk.LEFT, padx=5)
+
         # 2-4. 位置情報登録ボタン
         Button(self.config_frame, text="位置情報を登録", command=self.register_position).pack(pady=10)
 
@@ -80,12 +110,10 @@ class PositionConfigTool(tk.Tk):
             return
 
         try:
+            pyramid = ImagePyramid.open(file_path) # 一度だけデコードし、縮小した段は表示時に作る
             self.image_path = file_path
-            pil_image = Image.open(file_path)
-            self.grid_image_tk = ImageTk.PhotoImage(pil_image) # PhotoImageに変換
-
-            self.canvas.config(scrollregion=(0, 0, pil_image.width, pil_image.height)) # Scroll領域設定
-            self.canvas.create_image(0, 0, image=self.grid_image_tk, anchor="nw") # 画像をCanvasに配置
+            self.clear_region()
+            self.image_view.set_image(pyramid) # ウィンドウに収まる倍率で表示
 
             messagebox.showinfo("画像読み込み", "画像を読み込みました")
             self.update_problem_list_display() # 画像読み込み時にリスト更新
@@ -107,6 +135,12 @@ class PositionConfigTool(tk.Tk):
         if not file_path:
             return
 
+        if self.image_path: # 採点時の位置合わせの基準にするため、開いている画像を JSON からの相対パスで記録
+            try:
+                self.positions["テンプレート画像"] = os.path.relpath(self.image_path, os.path.dirname(os.path.abspath(file_path)))
+            except ValueError: # Windows で別ドライブの場合
+                self.positions["テンプレート画像"] = os.path.abspath(self.image_path)
+
         try:
             with open(file_path, 'w', encoding='utf-8') as f:
                 json.dump(self.positions, f, indent=4, ensure_ascii=False) # JSONを書き込み、インデントと日本語対応
@@ -133,12 +167,93 @@ class PositionConfigTool(tk.Tk):
             messagebox.showerror("エラー", f"JSONファイル読み込み中にエラーが発生しました: {e}")
 
 
+    def auto_detect_layout(self):
+        """開いている画像から解答位置を自動で検出し、位置情報として読み込む (画像上に表示して確認・修正する)"""
+        if self.image_view.pyramid is None:
+            messagebox.showerror("入力エラー", "先に画像を開いてください")
+            return
+        if self.positions["問題位置情報"] and not messagebox.askyesno("自動検出", "登録済みの位置情報を検出結果で置き換えますか?"):
+            return
+
+        try:
+            detected, method = detect_layout(self.image_view.pyramid.level(0)) # 開いている画像をそのまま使う (再デコードしない)
+        except Exception as e:
+            messagebox.showerror("エラー", f"自動検出中にエラーが発生しました: {e}")
+            return
+        if not detected["問題位置情報"]:
+            messagebox.showinfo("自動検出", "解答欄を検出できませんでした")
+            return
+
+        self.positions = detected
+        self.update_problem_list_display() # リストと画像上の表示を更新
+        method_name = {"boxes": "解答欄の枠", "equals": "「=」の位置"}.get(method, method)
+        messagebox.showinfo("自動検出", f"{len(detected['問題位置情報'])} 問を検出しました ({method_name}から検出)\n"
+                                      "画像上の番号と位置を確認し、違う問題は問題番号を入力してクリックし直し、"
+                                      "「位置情報を登録」で修正してください")
+
+
+    def on_canvas_press(self, event):
+        """Canvasでマウスボタンを押した時の処理 (ドラッグ開始位置を記録)"""
+        self.drag_start = (self.canvas.canvasx(event.x), self.canvas.canvasy(event.y))
+
+
+    def on_canvas_drag(self, event):
+        """ドラッグ中の処理 (問題領域の矩形を表示)"""
+        if self.drag_start is None:
+            return
+        x = self.canvas.canvasx(event.x)
+        y = self.canvas.canvasy(event.y)
+        self.canvas.delete("drag_region")
+        self.canvas.create_rectangle(self.drag_start[0], self.drag_start[1], x, y, outline="blue", width=2, tags="drag_region")
+
+
     def on_canvas_click(self, event):
-        """Canvasクリック時のイベント処理"""
+        """Canvasクリック時のイベント処理 (ドラッグした場合は問題領域を指定。座標は元画像のピクセルに変換して記録)"""
         x = self.canvas.canvasx(event.x) # Canvas座標に変換
         y = self.canvas.canvasy(event.y)
-        self.x_pos_label.config(text=str(int(x))) # 整数で表示
-        self.y_pos_label.config(text=str(int(y)))
+        if self.drag_start is not None and (abs(x - self.drag_start[0]) > 5 or abs(y - self.drag_start[1]) > 5):
+            x1, y1 = self.image_view.to_image(*self.drag_start)
+            x2, y2 = self.image_view.to_image(x, y)
+            self.region = (int(min(x1, x2)), int(min(y1, y2)), int(max(x1, x2)), int(max(y1, y2)))
+            self.region_label.config(text=f"({self.region[0]}, {self.region[1]}) - ({self.region[2]}, {self.region[3]})")
+            self.drag_start = None
+            return
+        self.drag_start = None
+        image_x, image_y = self.image_view.to_image(x, y)
+        self.x_pos_label.config(text=str(int(image_x))) # 整数で表示
+        self.y_pos_label.config(text=str(int(image_y)))
+
+
+    def on_zoom_changed(self):
+        """表示倍率が変わった時の処理 (倍率の表示と問題領域の矩形を更新)"""
+        self.zoom_label.config(text=f"{self.image_view.zoom * 100:.0f}%")
+        self.draw_positions()
+        if self.region is not None:
+            x1, y1 = self.image_view.to_canvas(self.region[0], self.region[1])
+            x2, y2 = self.image_view.to_canvas(self.region[2], self.region[3])
+            self.canvas.delete("drag_region")
+            self.canvas.create_rectangle(x1, y1, x2, y2, outline="blue", width=2, tags="drag_region")
+
+
+    def draw_positions(self):
+        """登録済みの位置 (赤丸と問題番号) と問題領域 (緑の点線) を画像上に表示する"""
+        self.canvas.delete("positions")
+        for problem_info in self.positions["問題位置情報"]:
+            region = problem_info.get("問題領域")
+            if region:
+                x1, y1 = self.image_view.to_canvas(region["x1"], region["y1"])
+                x2, y2 = self.image_view.to_canvas(region["x2"], region["y2"])
+                self.canvas.create_rectangle(x1, y1, x2, y2, outline="green", dash=(4, 2), tags="positions")
+            x, y = self.image_view.to_canvas(problem_info["正解位置"]["x"], problem_info["正解位置"]["y"])
+            self.canvas.create_oval(x - 6, y - 6, x + 6, y + 6, outline="red", width=2, tags="positions")
+            self.canvas.create_text(x + 8, y - 8, text=str(problem_info["問題番号"]), fill="red", anchor="sw", tags="positions")
+
+
+    def clear_region(self):
+        """ドラッグで指定した問題領域を解除"""
+        self.region = None
+        self.canvas.delete("drag_region")
+        self.region_label.config(text="- (ドラッグで指定)")
 
 
     def register_position(self):
@@ -166,6 +281,9 @@ class PositionConfigTool(tk.Tk):
         for problem_info in self.positions["問題位置情報"]:
             if problem_info["問題番号"] == problem_number:
                 problem_info["正解位置"] = {"x": x_pos, "y": y_pos} # 上書き
+                if self.region is not None:
+                    problem_info["問題領域"] = self.region_to_json()
+                    self.clear_region() # 次の問題に引き継がないよう解除
                 messagebox.showinfo("情報更新", f"問題番号 {problem_number} の位置情報を更新しました")
                 self.update_problem_list_display() # リスト表示更新
                 return # 更新したら処理を終える
@@ -175,11 +293,20 @@ class PositionConfigTool(tk.Tk):
             "問題番号": problem_number,
             "正解位置": {"x": x_pos, "y": y_pos}
         }
+        if self.region is not None:
+            new_problem_info["問題領域"] = self.region_to_json()
+            self.clear_region()
         self.positions["問題位置情報"].append(new_problem_info)
         messagebox.showinfo("情報登録", f"問題番号 {problem_number} の位置情報を登録しました")
         self.update_problem_list_display() # リスト表示更新
 
 
+    def region_to_json(self):
+        """ドラッグで指定した問題領域を JSON 保存用の辞書にする"""
+        x1, y1, x2, y2 = self.region
+        return {"x1": x1, "y1": y1, "x2": x2, "y2": y2}
+
+
     def update_problem_list_display(self):
         """登録済み問題リストをLabelに表示更新"""
         problem_list_text = ""
@@ -189,11 +316,16 @@ class PositionConfigTool(tk.Tk):
         if self.positions["問題位置情報"]:
             problem_list_text += "--- 登録済み問題 ---\n"
             for problem_info in sorted(self.positions["問題位置情報"], key=lambda x: x["問題番号"]): # 問題番号順にソート
-                problem_list_text += f"問題{problem_info['問題番号']}: X={problem_info['正解位置']['x']}, Y={problem_info['正解位置']['y']}\n"
+                problem_list_text += f"問題{problem_info['問題番号']}: X={problem_info['正解位置']['x']}, Y={problem_info['正解位置']['y']}"
+                region = problem_info.get("問題領域")
+                if region:
+                    problem_list_text += f" 領域=({region['x1']},{region['y1']})-({region['x2']},{region['y2']})"
+                problem_list_text += "\n"
         else:
             problem_list_text += "位置情報はまだ登録されていません\n"
 
         self.problem_list_label.config(text=problem_list_text) # Labelを更新
+        self.draw_positions()
 
 
 if __name__ == "__main__":
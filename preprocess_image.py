@@ -0,0 +1,226 @@
+import io
+import os
+from PIL import Image, ImageOps
+
+DEFAULT_CROP_MARGIN = 16 # 問題の範囲の周囲に残す余白 (ピクセル)
+EXIF_ORIENTATION_TAG = 0x0112 # EXIF の Orientation (1: そのまま, 2-8: 反転・回転して表示する)
+
+
+class PreprocessResult:
+    """
+    前処理後の画像と、元画像との座標対応を保持するクラス
+
+    前処理後の座標 (x', y') と元画像の座標 (x, y) の関係:
+        x = x' / scale_x + offset_x
+        y = y' / scale_y + offset_y
+    """
+
+    def __init__(self, image, payload, mime_type, original_size, scale_x, scale_y, offset_x=0, offset_y=0):
+        self.image = image # 前処理後の PIL Image
+        self.payload = payload # API に送るエンコード済みバイト列
+        self.mime_type = mime_type # payload の MIME タイプ
+        self.original_size = original_size # 元画像のサイズ (幅, 高さ)
+        self.scale_x = scale_x # 横方向の縮小率 (前処理後 / 元画像)
+        self.scale_y = scale_y # 縦方向の縮小率 (前処理後 / 元画像)
+        self.offset_x = offset_x # 切り抜き位置 (元画像の座標)
+        self.offset_y = offset_y
+
+    def to_original(self, x, y):
+        """前処理後の画像上の座標を元画像の座標に変換"""
+        return (x / self.scale_x + self.offset_x, y / self.scale_y + self.offset_y)
+
+    def to_processed(self, x, y):
+        """元画像の座標を前処理後の画像上の座標に変換"""
+        return ((x - self.offset_x) * self.scale_x, (y - self.offset_y) * self.scale_y)
+
+    def as_blob(self):
+        """Gemini API にそのまま渡せる形式 ({"mime_type", "data"}) で返す"""
+        return {"mime_type": self.mime_type, "data": self.payload}
+
+
+def layout_bounding_box(sheet_layout, image_size, margin=DEFAULT_CROP_MARGIN):
+    """
+    全問題の領域 (問題文と解答) を囲む矩形を求める関数
+
+    位置情報JSONに「問題領域」があればそれを使い、ない問題は layout.Layout.problem_region と同じく
+    正解位置から推定する (隣の問題との中間まで。左右に問題がなければ画像の端まで含め、問題文を切らない)。
+
+    Args:
+        sheet_layout: layout.Layout
+        image_size:   位置情報を作った画像の大きさ (幅, 高さ)
+        margin:       矩形の周囲に付ける余白 (ピクセル)
+    Returns:
+        tuple: (左, 上, 右, 下) の矩形 (問題が登録されていない場合は None)
+    """
+    if len(sheet_layout) == 0:
+        return None
+    regions = [sheet_layout.problem_region(index, image_size) for index in range(len(sheet_layout))]
+    width, height = image_size
+    return (max(0, min(region[0] for region in regions) - margin), max(0, min(region[1] for region in regions) - margin),
+            min(width, max(region[2] for region in regions) + margin),
+            min(height, max(region[3] for region in regions) + margin))
+
+
+def layout_crop_options(sheet_layout, reference_image_path=None, margin=DEFAULT_CROP_MARGIN):
+    """
+    問題の範囲だけを送るための前処理の設定 (preprocess_for_upload の crop_box, crop_reference_size) を作る関数
+
+    矩形は位置情報を作ったテンプレート画像の座標で求め、解像度の違うシートでは
+    normalize_image がシートの大きさに合わせて拡大・縮小する。
+
+    Args:
+        sheet_layout:         layout.Layout
+        reference_image_path: テンプレート画像がない場合に大きさの基準にする画像 (通常は 1 枚目のシート)
+        margin:               矩形の周囲に付ける余白 (ピクセル)
+    Returns:
+        dict: {"crop_box": [左, 上, 右, 下], "crop_reference_size": [幅, 高さ]} (基準の画像がない場合は None)
+    """
+    image_path = sheet_layout.template_path
+    if not image_path or not os.path.exists(image_path):
+        image_path = reference_image_path
+    if not image_path:
+        return None
+    with Image.open(image_path) as image:
+        image_size = image.size # 位置情報は回転情報を反映しない画素の並びの座標 (位置設定ツール・マーク合成と同じ)
+    crop_box = layout_bounding_box(sheet_layout, image_size, margin)
+    if crop_box is None:
+        return None
+    return {"crop_box": list(crop_box), "crop_reference_size": list(image_size)}
+
+
+def exif_transpose_box(box, image_size, orientation):
+    """
+    回転情報を反映する前の画像の矩形を、ImageOps.exif_transpose() した後の画像の座標に変換する関数
+
+    Args:
+        box:         矩形 (左, 上, 右, 下) (回転情報を反映する前の座標)
+        image_size:  回転情報を反映する前の画像の大きさ (幅, 高さ)
+        orientation: EXIF の Orientation (1-8)
+    Returns:
+        tuple: 変換後の矩形 (左, 上, 右, 下)
+    """
+    width, height = image_size
+    transform = {
+        2: lambda x, y: (width - x, y), # 左右反転
+        3: lambda x, y: (width - x, height - y), # 180 度回転
+        4: lambda x, y: (x, height - y), # 上下反転
+        5: lambda x, y: (y, x), # 転置
+        6: lambda x, y: (height - y, x), # 時計回りに 90 度回転
+        7: lambda x, y: (height - y, width - x), # 反転して転置
+        8: lambda x, y: (y, width - x), # 反時計回りに 90 度回転
+    }.get(orientation)
+    if transform is None:
+        return tuple(box)
+    left, top, right, bottom = box
+    (x1, y1), (x2, y2) = transform(left, top), transform(right, bottom)
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+
+def normalize_image(image, max_long_edge=1600, grayscale=True, crop_box=None, crop_reference_size=None):
+    """
+    採点前の画像の正規化 (回転情報の反映・切り抜き・グレースケール化・縮小) を行う関数
+
+    preprocess_for_upload() はこの結果をエンコードして API に送る。
+    重複シートの検出 (sheet_dedup) も同じ正規化をした画像で比べる。
+
+    Args:
+        image:         PIL Image オブジェクト
+        max_long_edge: 長辺の最大ピクセル数 (これより大きい場合のみ縮小, None で縮小しない)
+        grayscale:     グレースケールに変換するか
+        crop_box:      切り抜く矩形 (左, 上, 右, 下) (None で切り抜かない)。位置情報と同じく、
+                       回転情報を反映する前の画素の並びの座標で指定する
+        crop_reference_size: crop_box を求めた画像の大きさ (幅, 高さ)。画像の大きさが違えば矩形を合わせて拡大・縮小する
+    Returns:
+        tuple: (正規化後の画像, 元画像のサイズ, 切り抜き後のサイズ, 切り抜きの左上 (x, y))
+               (元画像のサイズと切り抜きの左上は、回転情報を反映した後の座標)
+    """
+    raw_size = image.size
+    orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    image = ImageOps.exif_transpose(image) # スマートフォン撮影画像の回転情報を反映
+    original_size = image.size
+    offset = (0, 0)
+
+    # 1. 切り抜き (問題が並ぶ範囲のみ残す)
+    if crop_box is not None:
+        left, top, right, bottom = crop_box
+        if crop_reference_size and tuple(crop_reference_size) != raw_size: # テンプレートと解像度が違うシート
+            ratio_x, ratio_y = raw_size[0] / crop_reference_size[0], raw_size[1] / crop_reference_size[1]
+            left, right, top, bottom = left * ratio_x, right * ratio_x, top * ratio_y, bottom * ratio_y
+        left, top, right, bottom = exif_transpose_box((left, top, right, bottom), raw_size, orientation) # 回転後の座標へ
+        left, top = max(0, int(left)), max(0, int(top))
+        right, bottom = min(image.width, int(right)), min(image.height, int(bottom))
+        image = image.crop((left, top, right, bottom))
+        offset = (left, top)
+    cropped_size = image.size
+
+    # 2. グレースケール化 (縮小前に行うと縮小処理のデータ量も減る)
+    if grayscale:
+        image = image.convert("L")
+    elif image.mode not in ("RGB", "L"):
+        image = image.convert("RGB") # JPEG は透明度を扱えないため
+
+    # 3. 縮小 (長辺を max_long_edge に合わせる)
+    if max_long_edge and max(image.size) > max_long_edge:
+        ratio = max_long_edge / max(image.size)
+        new_size = (max(1, round(image.width * ratio)), max(1, round(image.height * ratio)))
+        image = image.resize(new_size, Image.LANCZOS)
+    return image, original_size, cropped_size, offset
+
+
+def preprocess_for_upload(image, max_long_edge=1600, grayscale=True, binarize=False, threshold=160,
+                          jpeg_quality=85, crop_box=None, crop_reference_size=None):
+    """
+    API に送る前に画像を縮小・グレースケール化・二値化・圧縮する関数
+
+    Args:
+        image:         PIL Image オブジェクト
+        max_long_edge: 長辺の最大ピクセル数 (これより大きい場合のみ縮小, None で縮小しない)
+        grayscale:     グレースケールに変換するか
+        binarize:      白黒二値化するか (True の場合は PNG で保存)
+        threshold:     二値化のしきい値 (0-255)
+        jpeg_quality:  JPEG の品質 (二値化しない場合に使用)
+        crop_box:      切り抜く矩形 (左, 上, 右, 下) (回転情報を反映する前の座標, None で切り抜かない)
+        crop_reference_size: crop_box を求めた画像の大きさ (layout_crop_options を参照)
+    Returns:
+        PreprocessResult: 前処理後の画像とエンコード済みデータ、元画像との座標対応
+    """
+    # 1.-3. 回転情報の反映・切り抜き・グレースケール化・縮小
+    image, original_size, cropped_size, (offset_x, offset_y) = normalize_image(
+        image, max_long_edge, grayscale or binarize, crop_box, crop_reference_size)
+
+    # 4. 二値化または JPEG 圧縮
+    buffer = io.BytesIO()
+    if binarize:
+        image = image.point(lambda value: 255 if value >= threshold else 0, mode="1")
+        image.save(buffer, format="PNG", optimize=True)
+        mime_type = "image/png"
+    else:
+        image.save(buffer, format="JPEG", quality=jpeg_quality, optimize=True)
+        mime_type = "image/jpeg"
+
+    return PreprocessResult(
+        image,
+        buffer.getvalue(),
+        mime_type,
+        original_size,
+        scale_x=image.width / cropped_size[0],
+        scale_y=image.height / cropped_size[1],
+        offset_x=offset_x,
+        offset_y=offset_y,
+    )
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    image_file = "keisan_problem.png" # 計算問題画像
+
+    result = preprocess_for_upload(Image.open(image_file), max_long_edge=800)
+    print(f"元画像サイズ: {result.original_size}, 前処理後: {result.image.size}, {len(result.payload)} バイト ({result.mime_type})")
+    print(f"前処理後の (100, 100) は元画像の {result.to_original(100, 100)}")
+
+    import layout # 問題の範囲だけを送る場合 (grade_cli.py --crop-to-layout)
+    crop_options = layout_crop_options(layout.Layout.load("problem_positions.json"), image_file)
+    if crop_options is not None:
+        cropped = preprocess_for_upload(Image.open(image_file), max_long_edge=800, **crop_options)
+        print(f"問題の範囲 {crop_options['crop_box']}: 前処理後 {cropped.image.size}, {len(cropped.payload)} バイト, "
+              f"前処理後の (0, 0) は元画像の {cropped.to_original(0, 0)}")
@@ -0,0 +1,107 @@
+from PIL import Image, ImageDraw, ImageFont
+
+LABEL_HEIGHT = 30 # 各タイルの上に付けるラベル欄の高さ (ピクセル)
+TILE_PADDING = 8 # タイル同士の間隔 (ピクセル)
+DEFAULT_MAX_MOSAIC_WIDTH = 1600 # モザイク画像の最大幅 (これより広い領域は縮小する)
+
+
+def mosaic_label(problem_number):
+    """モザイク画像に描くラベル (プロンプトでも同じ表記を使う)"""
+    return f"[{problem_number}]"
+
+
+def crop_problem_regions(image, layout, problem_numbers=None):
+    """
+    シート画像から問題ごとの領域を切り出す
+
+    Args:
+        image:           シート画像 (PIL Image)
+        layout:          layout.Layout
+        problem_numbers: 切り出す問題番号のリスト (None で全問題, 位置情報JSONの順)
+    Returns:
+        list: (問題番号, 切り出した画像) のリスト
+    """
+    wanted = None if problem_numbers is None else {str(problem_number) for problem_number in problem_numbers}
+    crops = []
+    for index, problem_number in enumerate(layout.problem_numbers):
+        if wanted is not None and problem_number not in wanted:
+            continue
+        x1, y1, x2, y2 = layout.problem_region(index, image.size)
+        if x2 <= x1 or y2 <= y1:
+            continue
+        crops.append((problem_number, image.crop((x1, y1, x2, y2))))
+    return crops
+
+
+def build_mosaic(image, layout, problem_numbers=None, max_width=DEFAULT_MAX_MOSAIC_WIDTH):
+    """
+    問題ごとの領域を切り出し、ラベル付きのタイルとして 1 枚の画像に並べる
+
+    タイルは位置情報JSONの順に左から右へ並べ、全体が正方形に近くなる幅 (最大 max_width) を超えたら次の行に移る (棚詰め)。
+    問題文のない余白を送らずに済むため、ページ全体を送るより画像が小さくなり、
+    ラベルの問題番号をそのまま結果のキーにできる。
+
+    Args:
+        image:           シート画像 (PIL Image)
+        layout:          layout.Layout
+        problem_numbers: 含める問題番号のリスト (None で全問題。一部の問題だけ再採点する場合に指定)
+        max_width:       モザイク画像の最大幅
+    Returns:
+        tuple: (モザイク画像 (PIL Image, RGB), 含めた問題番号のリスト)。含める問題がない場合は (None, [])
+    """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    crops = crop_problem_regions(image, layout, problem_numbers)
+    if not crops:
+        return None, []
+
+    # --- タイルの配置を決める (棚詰め) ---
+    tiles = []
+    total_area = sum((crop.width + TILE_PADDING) * (crop.height + LABEL_HEIGHT + TILE_PADDING) for _, crop in crops)
+    content_width = max(max(crop.width for _, crop in crops), int(total_area ** 0.5)) # 正方形に近い形を目安にする
+    content_width = min(max_width, content_width + 2 * TILE_PADDING)
+    x = y = TILE_PADDING
+    row_height = 0
+    mosaic_width = 0
+    for problem_number, crop in crops:
+        if crop.width > content_width - 2 * TILE_PADDING: # 広すぎる領域は縮小
+            ratio = (content_width - 2 * TILE_PADDING) / crop.width
+            crop = crop.resize((max(1, round(crop.width * ratio)), max(1, round(crop.height * ratio))), Image.LANCZOS)
+        if x > TILE_PADDING and x + crop.width + TILE_PADDING > content_width:
+            x = TILE_PADDING
+            y += row_height + TILE_PADDING
+            row_height = 0
+        tiles.append((problem_number, crop, x, y))
+        x += crop.width + TILE_PADDING
+        row_height = max(row_height, LABEL_HEIGHT + crop.height)
+        mosaic_width = max(mosaic_width, x)
+    mosaic_height = y + row_height + TILE_PADDING
+
+    # --- 描画 ---
+    mosaic = Image.new("RGB", (mosaic_width, mosaic_height), (255, 255, 255))
+    draw = ImageDraw.Draw(mosaic)
+    font = ImageFont.load_default(LABEL_HEIGHT - 6)
+    for problem_number, crop, x, y in tiles:
+        draw.rectangle((x - 1, y, x + crop.width, y + LABEL_HEIGHT - 1), fill=(0, 0, 0))
+        draw.text((x + 4, y + 2), mosaic_label(problem_number), fill=(255, 255, 255), font=font)
+        mosaic.paste(crop, (x, y + LABEL_HEIGHT))
+        draw.rectangle((x - 1, y, x + crop.width, y + LABEL_HEIGHT + crop.height), outline=(0, 0, 0), width=1)
+    return mosaic, [problem_number for problem_number, _, _, _ in tiles]
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    import sys
+    from layout import Layout
+
+    if len(sys.argv) < 3:
+        print("使い方: python region_mosaic.py 画像ファイル 位置情報JSON [問題番号 ...]")
+        sys.exit(1)
+    sheet_layout = Layout.load(sys.argv[2])
+    with Image.open(sys.argv[1]) as sheet_image:
+        mosaic_image, labels = build_mosaic(sheet_image, sheet_layout, sys.argv[3:] or None)
+    if mosaic_image is None:
+        print("切り出す問題がありません")
+        sys.exit(1)
+    mosaic_image.save("region_mosaic.png")
+    print(f"問題 {', '.join(labels)} のモザイク画像 ({mosaic_image.width}x{mosaic_image.height}) を region_mosaic.png に保存しました")
@@ -0,0 +1,229 @@
+import math
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+METHODS = ("affine", "homography") # affine: 平行移動・回転・拡大縮小, homography: 射影変換 (スマートフォンで斜めから撮影した場合など)
+DEFAULT_MAX_SIDE = 1000 # 特徴点はこの長辺まで縮小した画像で探す (1 枚数十ミリ秒に収めるため)
+DEFAULT_FEATURES = 1000 # 探す特徴点 (ORB) の最大数
+MIN_INLIERS = 30 # 位置合わせに使えた対応点がこれより少なければ「確信度が低い」とする
+MIN_INLIER_RATIO = 0.25 # 対応点のうち変換に合う割合がこれより低ければ「確信度が低い」とする
+MAX_ROTATION = 15.0 # これより大きく回転している推定結果は誤りとみなす (度)
+SCALE_RANGE = (0.5, 2.0) # この範囲外の拡大率の推定結果は誤りとみなす
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                  (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)) # JPEG は縮小しながらデコードできる
+
+
+def load_reduced_gray(image, max_side=DEFAULT_MAX_SIDE):
+    """
+    画像を長辺 max_side 程度のグレースケール配列として読み込む
+
+    ファイルパスの場合は、画像の大きさをヘッダーだけ読んで調べ、OpenCV の縮小デコード
+    (JPEG では元の大きさに展開せずに済む) を使う。
+
+    Args:
+        image:    画像ファイルのパス、PIL Image、またはグレースケールの配列
+        max_side: 縮小後の長辺の目安 (これ以上にはなる)
+    Returns:
+        tuple: (グレースケール配列, 元画像に対する縮小率) (読めない場合は (None, 1.0))
+    """
+    if isinstance(image, str):
+        try:
+            with Image.open(image) as header: # ヘッダーだけ読んで大きさを調べる
+                original_size = header.size
+        except OSError:
+            return None, 1.0
+        flags = cv2.IMREAD_GRAYSCALE
+        for reduction, reduced_flag in _REDUCED_FLAGS:
+            if max(original_size) / reduction >= max_side:
+                flags = reduced_flag
+                break
+        gray = cv2.imdecode(np.fromfile(image, dtype=np.uint8), flags | cv2.IMREAD_IGNORE_ORIENTATION)
+        if gray is None:
+            return None, 1.0
+    else:
+        if isinstance(image, Image.Image):
+            image = np.asarray(image.convert("L"))
+        gray = image
+        original_size = (gray.shape[1], gray.shape[0])
+    scale = gray.shape[1] / original_size[0]
+    if max(gray.shape) > max_side * 1.5: # 縮小デコードできない形式 (PNG など) や配列で渡された場合
+        ratio = max_side / max(gray.shape)
+        gray = cv2.resize(gray, (max(1, round(gray.shape[1] * ratio)), max(1, round(gray.shape[0] * ratio))),
+                          interpolation=cv2.INTER_AREA)
+        scale *= ratio
+    return gray, scale
+
+
+class Registration:
+    """
+    1 枚のシートの位置合わせの結果 (テンプレート画像の座標 → シート画像の座標 の変換)
+
+    確信度が低い場合は matrix を None にし (補正しない = 位置情報JSONの座標をそのまま使う)、
+    low_confidence を True にする。要確認のシートとして結果ファイルに記録される。
+    """
+
+    def __init__(self, matrix=None, matches=0, inliers=0, low_confidence=True, reason="", elapsed=0.0):
+        self.matrix = matrix # 2x3 (affine) または 3x3 (homography) の変換行列。補正しない場合は None
+        self.matches = matches # 特徴点の対応の数
+        self.inliers = inliers # そのうち変換に合う対応の数
+        self.low_confidence = low_confidence
+        self.reason = reason # 確信度が低い理由
+        self.elapsed = elapsed # 位置合わせにかかった時間 (秒)
+
+    @property
+    def confidence(self):
+        """確信度 (0.0〜1.0): 変換に合う対応点の割合と数から求める"""
+        if not self.matches:
+            return 0.0
+        return round(self.inliers / self.matches * min(1.0, self.inliers / (2 * MIN_INLIERS)), 3)
+
+    def transform_point(self, x, y):
+        """テンプレート画像上の点 (x, y) をシート画像上の点に変換する (補正しない場合はそのまま返す)"""
+        if self.matrix is None:
+            return x, y
+        m = self.matrix
+        if m.shape[0] == 3: # 射影変換
+            w = m[2, 0] * x + m[2, 1] * y + m[2, 2]
+            return (m[0, 0] * x + m[0, 1] * y + m[0, 2]) / w, (m[1, 0] * x + m[1, 1] * y + m[1, 2]) / w
+        return m[0, 0] * x + m[0, 1] * y + m[0, 2], m[1, 0] * x + m[1, 1] * y + m[1, 2]
+
+    def summary(self):
+        """
+        結果ファイル・イベントに含める要約
+
+        Returns:
+            dict: {"confidence", "low_confidence", "inliers", "matches", "dx", "dy", "angle", "scale", ("reason")}
+        """
+        summary = {"confidence": self.confidence, "low_confidence": self.low_confidence,
+                   "inliers": self.inliers, "matches": self.matches}
+        if self.matrix is not None:
+            angle, scale = _rotation_and_scale(self.matrix)
+            summary.update(dx=round(float(self.matrix[0, 2]), 1), dy=round(float(self.matrix[1, 2]), 1),
+                           angle=round(angle, 2), scale=round(scale, 4))
+        if self.reason:
+            summary["reason"] = self.reason
+        return summary
+
+
+def _rotation_and_scale(matrix):
+    """変換行列の回転角 (度) と拡大率"""
+    a, b, c, d = matrix[0, 0], matrix[0, 1], matrix[1, 0], matrix[1, 1]
+    return math.degrees(math.atan2(c, a)), math.sqrt(abs(a * d - b * c))
+
+
+class SheetRegistrar:
+    """
+    スキャンしたシートをテンプレート画像 (位置情報JSONを作った画像) に位置合わせする
+
+    テンプレートの特徴点 (ORB) は作成時に 1 回だけ求めて保持し、シートごとには
+    シート側の特徴点を求めて照合 (比率テスト) し、RANSAC で変換を推定する。
+    推定した変換で〇×マークの位置をずらすことで、スキャナーごとのずれ・傾き・拡大率の違いを補正する。
+    テンプレートの特徴点は読むだけで、ORB と照合器はスレッドごとに作るため、合成段の複数のワーカーで共有できる。
+
+    Args:
+        template:         テンプレート画像 (ファイルパス、PIL Image、またはグレースケールの配列)
+        method:           推定する変換 (METHODS)
+        max_side:         特徴点を探す画像の長辺
+        n_features:       探す特徴点の最大数
+        min_inliers:      これより対応点が少なければ確信度が低いとする
+        min_inlier_ratio: 対応点のうち変換に合う割合がこれより低ければ確信度が低いとする
+    Raises:
+        ValueError: テンプレート画像が読めない、または特徴点が見つからない場合
+    """
+
+    def __init__(self, template, method="affine", max_side=DEFAULT_MAX_SIDE, n_features=DEFAULT_FEATURES,
+                 min_inliers=MIN_INLIERS, min_inlier_ratio=MIN_INLIER_RATIO):
+        if method not in METHODS:
+            raise ValueError(f"不明な変換です: {method}")
+        self.method = method
+        self.max_side = max_side
+        self.min_inliers = min_inliers
+        self.min_inlier_ratio = min_inlier_ratio
+        self.n_features = n_features
+        self._local = threading.local() # スレッドごとの ORB と照合器
+
+        gray, scale = load_reduced_gray(template, max_side)
+        if gray is None:
+            raise ValueError(f"テンプレート画像を読み込めません: {template}")
+        self.template_points, self.template_descriptors = self._features(gray, scale)
+        if self.template_descriptors is None or len(self.template_points) < min_inliers:
+            raise ValueError("テンプレート画像から特徴点が十分に見つかりません (位置合わせに使えません)")
+
+    def _tools(self):
+        """このスレッドの (ORB, 照合器) を返す"""
+        if not hasattr(self._local, "orb"):
+            self._local.orb = cv2.ORB_create(nfeatures=self.n_features)
+            self._local.matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+        return self._local.orb, self._local.matcher
+
+    def _features(self, gray, scale):
+        """特徴点 (元画像の座標に戻したもの) と特徴量を求める"""
+        keypoints, descriptors = self._tools()[0].detectAndCompute(gray, None)
+        points = np.float32([keypoint.pt for keypoint in keypoints]).reshape(-1, 2) / scale
+        return points, descriptors
+
+    def register(self, sheet):
+        """
+        シートをテンプレートに位置合わせする
+
+        Args:
+            sheet: シート画像 (ファイルパス、PIL Image、またはグレースケールの配列)
+        Returns:
+            Registration
+        """
+        start = time.perf_counter()
+        gray, scale = load_reduced_gray(sheet, self.max_side)
+        if gray is None:
+            return Registration(reason="画像を読み込めません", elapsed=time.perf_counter() - start)
+        sheet_points, sheet_descriptors = self._features(gray, scale)
+        if sheet_descriptors is None or len(sheet_points) < self.min_inliers:
+            return Registration(reason="特徴点が見つかりません", elapsed=time.perf_counter() - start)
+
+        good = []
+        for pair in self._tools()[1].knnMatch(self.template_descriptors, sheet_descriptors, k=2):
+            if len(pair) == 2 and pair[0].distance < 0.75 * pair[1].distance: # 比率テスト (紛らわしい対応を捨てる)
+                good.append(pair[0])
+        if len(good) < self.min_inliers:
+            return Registration(matches=len(good), reason="対応する特徴点が足りません", elapsed=time.perf_counter() - start)
+
+        source = self.template_points[[match.queryIdx for match in good]]
+        destination = sheet_points[[match.trainIdx for match in good]]
+        threshold = 3.0 / scale # RANSAC の許容誤差 (縮小画像で 3 ピクセル)
+        if self.method == "homography":
+            matrix, mask = cv2.findHomography(source, destination, cv2.RANSAC, threshold)
+        else:
+            matrix, mask = cv2.estimateAffinePartial2D(source, destination, method=cv2.RANSAC,
+                                                       ransacReprojThreshold=threshold)
+        inliers = int(mask.sum()) if mask is not None else 0
+        elapsed = time.perf_counter() - start
+        if matrix is None:
+            return Registration(matches=len(good), reason="変換を推定できません", elapsed=elapsed)
+
+        angle, sheet_scale = _rotation_and_scale(matrix)
+        reason = ""
+        if abs(angle) > MAX_ROTATION or not SCALE_RANGE[0] <= sheet_scale <= SCALE_RANGE[1]:
+            reason = f"推定した変換が不自然です (回転 {angle:.1f} 度, 拡大率 {sheet_scale:.2f})"
+        elif inliers < self.min_inliers or inliers < self.min_inlier_ratio * len(good):
+            reason = f"変換に合う対応点が少なすぎます ({inliers}/{len(good)})"
+        return Registration(None if reason else matrix, matches=len(good), inliers=inliers,
+                            low_confidence=bool(reason), reason=reason, elapsed=elapsed)
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 3:
+        print("使い方: python registration.py テンプレート画像 シート画像 [シート画像 ...]")
+        sys.exit(1)
+    start_time = time.perf_counter()
+    registrar = SheetRegistrar(sys.argv[1])
+    print(f"テンプレートの特徴点: {len(registrar.template_points)} 個 ({(time.perf_counter() - start_time) * 1000:.0f} ms)")
+    for sheet_path in sys.argv[2:]:
+        result = registrar.register(sheet_path)
+        status = "要確認" if result.low_confidence else "OK"
+        print(f"{sheet_path}: {status} {result.summary()} ({result.elapsed * 1000:.0f} ms)")
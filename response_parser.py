@@ -0,0 +1,362 @@
+import collections
+import json
+import re
+import threading
+import unicodedata
+
+# 正解・不正解として受け付ける表記 (NFKC 正規化・小文字化した後で比較)
+TRUE_WORDS = {"true", "correct", "yes", "ok", "o", "正解", "正", "〇", "○", "◯", "まる", "✓", "✔"}
+FALSE_WORDS = {"false", "incorrect", "wrong", "no", "ng", "x", "不正解", "誤", "誤り", "×", "✕", "✗", "✘", "ばつ"}
+# 値がオブジェクトの場合に正誤・確信度として読むキー
+VERDICT_FIELDS = ("correct", "is_correct", "result", "verdict", "judgement", "value", "正誤", "結果")
+CONFIDENCE_FIELDS = ("confidence", "score", "probability", "確信度", "信頼度")
+
+_KEY_NUMBER = re.compile(r"[\[(]?\s*(?:問題|問|no\.?|q|problem)?\s*(\d+)\s*(?:番)?\s*[\])]?", re.IGNORECASE)
+_CODE_FENCE = re.compile(r"```[a-zA-Z]*")
+# JSON として読めない回答から「キー: 値」の組を拾うための正規表現
+_PAIR = re.compile(r"""["']?([^"'\s:,{}]+?)["']?\s*[:：=]\s*(true|false|"[^"]*"|'[^']*'|[^\s,}]+)""", re.IGNORECASE)
+
+_stats_lock = threading.Lock()
+_stats = collections.Counter()
+_failed_samples = collections.deque(maxlen=20) # 解析に失敗した回答 (先頭部分, 調査用)
+
+
+class ProblemResults(dict):
+    """
+    正誤結果の辞書 ({問題番号: True/False}) に、問題ごとの確信度を添えたもの
+
+    通常の辞書と同じように使え、採点関数を包む処理 (ハイブリッド採点・重複シートの省略など) を
+    そのまま通り抜けて、パイプラインのイベントと結果ファイルに確信度を届ける。
+
+    Args:
+        results:    正誤結果の辞書
+        confidence: 問題番号 -> 確信度 (0.0-1.0)。回答に含まれていた問題のみ
+    """
+
+    def __init__(self, results=(), confidence=None):
+        super().__init__(results)
+        self.confidence = dict(confidence or {})
+
+    def merge(self, other):
+        """other の正誤結果で上書きする (上書きした問題の確信度は other のものに置き換える)"""
+        other_confidence = getattr(other, "confidence", {})
+        for problem_number, verdict in other.items():
+            self[problem_number] = verdict
+            self.confidence.pop(problem_number, None)
+            if problem_number in other_confidence:
+                self.confidence[problem_number] = other_confidence[problem_number]
+
+
+def confidence_of(problem_results):
+    """正誤結果に添えられた確信度の辞書 (確信度がない場合は空の辞書)"""
+    return dict(getattr(problem_results, "confidence", None) or {})
+
+
+def normalize_problem_key(key):
+    """
+    問題番号のキーを位置情報JSONの問題番号の表記にそろえる ("1", 1, "問題1", "[1]", "（１）" → "1")
+
+    数字を含まない・複数の数字を含むキーはそのまま (前後の空白だけ除いて) 返す。
+    """
+    text = unicodedata.normalize("NFKC", str(key)).strip()
+    match = _KEY_NUMBER.fullmatch(text)
+    if match:
+        return str(int(match.group(1)))
+    return text
+
+
+def normalize_verdict(value):
+    """
+    正誤結果の値を bool にそろえる (true / "正解" / "○" / {"correct": true, "confidence": 0.9} など)
+
+    Returns:
+        tuple: (正誤結果 (True/False, 解釈できない場合は None), 確信度 (0.0〜1.0, 含まれない場合は None))
+    """
+    if isinstance(value, bool):
+        return value, None
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value), None
+    if isinstance(value, str):
+        word = unicodedata.normalize("NFKC", value).strip().strip("\"'").lower()
+        if word in TRUE_WORDS:
+            return True, None
+        if word in FALSE_WORDS:
+            return False, None
+        return None, None
+    if isinstance(value, dict):
+        fields = {str(k).lower(): v for k, v in value.items()}
+        verdict = None
+        for name in VERDICT_FIELDS:
+            if name in fields:
+                verdict, _ = normalize_verdict(fields[name])
+                break
+        confidence = None
+        for name in CONFIDENCE_FIELDS:
+            raw = fields.get(name)
+            if isinstance(raw, (int, float)) and not isinstance(raw, bool):
+                confidence = raw / 100 if 1 < raw <= 100 else raw # パーセント表記にも対応
+                confidence = min(1.0, max(0.0, float(confidence)))
+                break
+        return verdict, confidence
+    return None, None
+
+
+def normalize_results(raw_results):
+    """
+    {キー: 値} の辞書のキーと値を正規化する
+
+    Returns:
+        tuple: (正誤結果の辞書, 確信度の辞書 (含まれる問題のみ), 解釈できなかったキーのリスト)
+    """
+    results = {}
+    confidence = {}
+    dropped = []
+    for key, value in raw_results.items():
+        verdict, verdict_confidence = normalize_verdict(value)
+        if verdict is None:
+            dropped.append(str(key))
+            continue
+        problem_number = normalize_problem_key(key)
+        results[problem_number] = verdict
+        if verdict_confidence is not None:
+            confidence[problem_number] = verdict_confidence
+    return results, confidence, dropped
+
+
+def strip_code_fences(text):
+    """```json ... ``` のようなコードブロックの記号を取り除く"""
+    return _CODE_FENCE.sub("", text).strip()
+
+
+def extract_json_object(text):
+    """
+    前置きやコードブロックを含む回答から、最初の JSON オブジェクトを取り出す
+
+    Returns:
+        dict: 取り出したオブジェクト (見つからない・壊れている場合は None)
+    """
+    if not text:
+        return None
+    stripped = strip_code_fences(text)
+    try:
+        value = json.loads(stripped)
+        if isinstance(value, dict):
+            return value
+    except json.JSONDecodeError:
+        pass
+    decoder = json.JSONDecoder()
+    start = stripped.find("{")
+    while start != -1: # 前置きの後の { から順に、JSON として読める位置を探す
+        try:
+            value, _ = decoder.raw_decode(stripped, start)
+            if isinstance(value, dict):
+                return value
+        except json.JSONDecodeError:
+            pass
+        start = stripped.find("{", start + 1)
+    return None
+
+
+def _pairs_from_text(text):
+    """JSON として読めない回答から「キー: 値」の組を拾う (最後の手段。文章を拾わないよう問題番号らしいキーのみ)"""
+    return {key: value for key, value in _PAIR.findall(text) if normalize_problem_key(key).isdigit()}
+
+
+def parse_response(text):
+    """
+    Gemini の回答テキストを正誤結果に変換する (コードブロック・前置き・表記ゆれに対応)
+
+    そのまま JSON として読めれば "clean"、コードブロックの除去やオブジェクトの切り出し、
+    「キー: 値」の拾い出しで読めた場合は "recovered" として集計する (parse_stats で確認できる)。
+
+    Returns:
+        dict: {"results": 正誤結果の辞書, "confidence": 確信度の辞書, "status": "clean" / "recovered",
+               "dropped": 解釈できなかったキーのリスト} (正誤結果が 1 つも得られない場合は None)
+    """
+    status = "recovered"
+    raw_results = None
+    if text:
+        try:
+            raw_results = json.loads(text)
+            status = "clean"
+        except json.JSONDecodeError:
+            raw_results = extract_json_object(text)
+        if not isinstance(raw_results, dict):
+            raw_results = None
+            status = "recovered"
+
+    results, confidence, dropped = normalize_results(raw_results) if raw_results is not None else ({}, {}, [])
+    if raw_results is None and text: # オブジェクトとして読めなかった (途中で切れた場合など)
+        results, confidence, dropped = normalize_results(_pairs_from_text(strip_code_fences(text)))
+        status = "recovered"
+    return _finish(text, results, confidence, dropped, status)
+
+
+def _finish(text, results, confidence, dropped, status):
+    """解析結果を集計に加えて返す"""
+    with _stats_lock:
+        _stats["responses"] += 1
+        _stats["dropped_entries"] += len(dropped)
+        if not results:
+            _stats["failed"] += 1
+            _failed_samples.append((text or "")[:500])
+        else:
+            _stats[status] += 1
+    if not results:
+        return None
+    return {"results": results, "confidence": confidence, "status": status, "dropped": dropped}
+
+
+def parse_batch_response(text):
+    """
+    複数シートをまとめて送った場合の回答 ({"シート番号": {問題番号: 正誤結果}}) を解析する
+
+    Returns:
+        dict: シート番号 (文字列) をキー、正誤結果 (ProblemResults) を値とする辞書 (1 シートも読めない場合は None)
+    """
+    try:
+        raw_batch = json.loads(text or "")
+        status = "clean"
+    except json.JSONDecodeError:
+        raw_batch = extract_json_object(text)
+        status = "recovered"
+    batch_results = {}
+    dropped = []
+    for sheet_key, raw_results in (raw_batch if isinstance(raw_batch, dict) else {}).items():
+        if not isinstance(raw_results, dict):
+            dropped.append(str(sheet_key))
+            continue
+        results, confidence, sheet_dropped = normalize_results(raw_results)
+        dropped.extend(f"{sheet_key}/{key}" for key in sheet_dropped)
+        if results:
+            batch_results[normalize_problem_key(sheet_key)] = ProblemResults(results, confidence)
+    if _finish(text, batch_results, {}, dropped, status) is None:
+        return None
+    return batch_results
+
+
+def parse_stats():
+    """
+    回答の解析の集計を返す
+
+    Returns:
+        dict: {"responses", "clean", "recovered", "failed", "dropped_entries", "failed_samples"}
+    """
+    with _stats_lock:
+        stats = {name: _stats[name] for name in ("responses", "clean", "recovered", "failed", "dropped_entries")}
+        stats["failed_samples"] = list(_failed_samples)
+    return stats
+
+
+def reset_parse_stats():
+    """回答の解析の集計をリセット (採点開始時に呼ぶ)"""
+    with _stats_lock:
+        _stats.clear()
+        _failed_samples.clear()
+
+
+class StreamingVerdictParser:
+    """
+    ストリーミングで届く回答を少しずつ読み、問題ごとの正誤結果が確定した時点で取り出すパーサー
+
+    最上位の JSON オブジェクトのメンバー ("1": true など) を区切りの , や } が届いた時点で解釈するため、
+    回答の生成が終わる前に先頭の問題の結果を使える。前置きやコードブロックの記号は読み飛ばす。
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._member_start = None
+        self._closed = False
+        self.results = {}
+        self.confidence = {}
+        self.dropped = []
+
+    @property
+    def text(self):
+        """これまでに届いた回答テキスト全体"""
+        return self._buffer
+
+    def feed(self, chunk):
+        """
+        回答の続きを渡す
+
+        Returns:
+            list: 新たに確定した (問題番号, 正誤結果) のリスト
+        """
+        self._buffer += chunk or ""
+        found = []
+        buffer = self._buffer
+        while self._pos < len(buffer) and not self._closed:
+            c = buffer[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"' and self._depth > 0: # オブジェクトの外 (前置き) の引用符は無視
+                self._in_string = True
+            elif c in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._member_start = self._pos + 1 if c == "{" else None
+            elif c in "}]" and self._depth > 0:
+                if self._depth == 1:
+                    found.extend(self._take_member(buffer[self._member_start:self._pos]))
+                    self._closed = self._member_start is not None # 最上位のオブジェクトが閉じたら以降は読まない
+                    self._member_start = None
+                self._depth -= 1
+            elif c == "," and self._depth == 1 and self._member_start is not None:
+                found.extend(self._take_member(buffer[self._member_start:self._pos]))
+                self._member_start = self._pos + 1
+            self._pos += 1
+        return found
+
+    def _take_member(self, member_text):
+        """メンバー 1 つ分 ("1": true) を解釈する"""
+        if self._member_start is None or not member_text.strip():
+            return []
+        try:
+            raw = json.loads("{" + member_text + "}")
+        except json.JSONDecodeError:
+            raw = _pairs_from_text(member_text)
+        results, confidence, dropped = normalize_results(raw)
+        self.results.update(results)
+        self.confidence.update(confidence)
+        self.dropped.extend(dropped)
+        return list(results.items())
+
+    def finish(self):
+        """
+        回答が全て届いた後に呼び、parse_response と同じ形の結果を返す (回答全体を解析し直さずに済む)
+
+        ストリーミング中に何も取り出せなかった場合だけ、回答全体を parse_response で解析し直す。
+        """
+        if not self.results:
+            return parse_response(self._buffer)
+        return _finish(self._buffer, dict(self.results), dict(self.confidence), list(self.dropped),
+                       "clean" if self._closed else "recovered")
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    samples = [
+        '{"1": true, "2": false, "3": true}',
+        '採点結果です。\n```json\n{"問題1": "正解", "問題2": "×", "問題3": {"correct": true, "confidence": 0.72}}\n```',
+        '{"(１)": "○", "(２)": "不正解", "(3)": "読めません"}',
+        '1: true, 2: false, 3: true',
+    ]
+    for sample in samples:
+        print(repr(sample[:40]), "->", parse_response(sample))
+
+    stream_parser = StreamingVerdictParser()
+    for piece in ['以下が結果です {"1": tr', 'ue, "2": fal', 'se, "3"', ': true}']:
+        print(f"受信 {piece!r:<20} 確定: {stream_parser.feed(piece)}")
+    print("最終結果:", stream_parser.finish())
+    print("集計:", parse_stats())
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import response_parser
+
+
+def make_cache_key(image_bytes, model_name, prompt_text):
+    """
+    キャッシュキーを作成する関数
+
+    画像のバイト列・モデル名・プロンプトのいずれかが変われば別のキーになる。
+
+    Args:
+        image_bytes: 画像ファイルのバイト列
+        model_name:  Gemini のモデル名
+        prompt_text: API に送るプロンプト
+    Returns:
+        str: SHA-256 の16進文字列
+    """
+    image_hash = hashlib.sha256(image_bytes).hexdigest()
+    prompt_hash = hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{image_hash}:{model_name}:{prompt_hash}".encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Gemini API の正誤結果 ({問題番号: True/False}) をディスクに保存するキャッシュ
+
+    1 エントリ = 1 JSON ファイル (<キー>.json)。
+    有効期限 (ttl_seconds) を過ぎたエントリは読み込み時に削除し、
+    エントリ数が max_entries を、合計サイズが max_bytes を超えたら
+    最後に使われた時刻 (ファイルの更新時刻) が古いものから削除する (LRU)。
+    エントリ数と合計サイズはメモリ上で数えておき、フォルダを走査するのは
+    上限を超えたときだけ (上限の EVICT_RATIO 倍まで減らすので、毎回は走査しない)。
+
+    Args:
+        cache_dir:   キャッシュを保存するフォルダ
+        ttl_seconds: エントリの有効期限 (秒, None で無期限)
+        max_entries: 保持する最大エントリ数
+        max_bytes:   保持する最大の合計サイズ (バイト, None で無制限)
+    """
+
+    EVICT_RATIO = 0.9 # 上限を超えたら、上限のこの割合まで減らす
+
+    def __init__(self, cache_dir=".markai_cache", ttl_seconds=30 * 24 * 60 * 60, max_entries=10000,
+                 max_bytes=64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0 # キャッシュヒット数
+        self.misses = 0 # キャッシュミス数
+        self.evictions = 0 # 上限超過で削除したエントリ数
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._entry_count, self._total_bytes = self._scan_usage() # 起動時に 1 回だけ数える
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _entry_paths(self):
+        return [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.endswith(".json")]
+
+    def _scan_usage(self):
+        """フォルダ内のエントリ数と合計サイズ"""
+        entry_count = total_bytes = 0
+        for entry_path in self._entry_paths():
+            try:
+                total_bytes += os.path.getsize(entry_path)
+            except FileNotFoundError:
+                continue
+            entry_count += 1
+        return entry_count, total_bytes
+
+    @property
+    def entry_count(self):
+        """保存されているエントリ数"""
+        return self._entry_count
+
+    @property
+    def total_bytes(self):
+        """保存されているエントリの合計サイズ (バイト)"""
+        return self._total_bytes
+
+    def get(self, key):
+        """キャッシュされた正誤結果を返す (存在しない・期限切れの場合は None)"""
+        entry_path = self._entry_path(key)
+        with self._lock:
+            try:
+                with open(entry_path, 'r', encoding='utf-8') as f:
+                    entry = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self.misses += 1
+                return None
+
+            if self.ttl_seconds is not None and time.time() - entry.get("created_at", 0) > self.ttl_seconds:
+                self._discard(entry_path) # 期限切れ
+                self.misses += 1
+                return None
+
+            os.utime(entry_path) # 最終使用時刻を更新 (LRU 用)
+            self.hits += 1
+            return response_parser.ProblemResults(entry["results"], entry.get("confidence"))
+
+    def put(self, key, results, model_name=""):
+        """正誤結果をキャッシュに保存 (確信度が添えられていれば一緒に保存する)"""
+        entry = {"created_at": time.time(), "model": model_name, "results": results}
+        confidence = response_parser.confidence_of(results)
+        if confidence:
+            entry["confidence"] = confidence
+        entry_path = self._entry_path(key)
+        temp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            new_size = os.path.getsize(temp_path)
+            old_size = self._file_size(entry_path) # 同じキーの上書きなら数は増えない
+            os.replace(temp_path, entry_path) # 書き込み途中のファイルを読まないように置き換え
+            if old_size is None:
+                self._entry_count += 1
+                self._total_bytes += new_size
+            else:
+                self._total_bytes += new_size - old_size
+            if self._over_limit():
+                self._evict()
+
+    def invalidate(self, key):
+        """指定したキーのエントリを削除"""
+        with self._lock:
+            self._discard(self._entry_path(key))
+
+    def clear(self):
+        """全エントリを削除"""
+        with self._lock:
+            for entry_path in self._entry_paths():
+                self._remove(entry_path)
+            self._entry_count = self._total_bytes = 0
+
+    def _over_limit(self):
+        if self._entry_count > self.max_entries:
+            return True
+        return self.max_bytes is not None and self._total_bytes > self.max_bytes
+
+    def _evict(self):
+        """
+        上限を超えたエントリを、最終使用時刻が古い順に削除
+
+        他のプロセスも同じフォルダを使うことがあるため、ここで数え直してメモリ上の値を合わせる。
+        上限の EVICT_RATIO 倍まで減らしておき、次に上限を超えるまでは走査しない。
+        """
+        entries = []
+        for entry_path in self._entry_paths():
+            try:
+                stat = os.stat(entry_path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        entries.sort()
+
+        entry_count = len(entries)
+        total_bytes = sum(size for _, size, _ in entries)
+        target_entries = int(self.max_entries * self.EVICT_RATIO)
+        target_bytes = None if self.max_bytes is None else int(self.max_bytes * self.EVICT_RATIO)
+        for _, size, entry_path in entries:
+            if entry_count <= target_entries and (target_bytes is None or total_bytes <= target_bytes):
+                break
+            self._remove(entry_path)
+            entry_count -= 1
+            total_bytes -= size
+            self.evictions += 1
+        self._entry_count, self._total_bytes = entry_count, total_bytes
+
+    def _discard(self, entry_path):
+        """エントリを 1 つ削除し、エントリ数と合計サイズから差し引く"""
+        size = self._file_size(entry_path)
+        if size is None:
+            return
+        self._remove(entry_path)
+        self._entry_count = max(self._entry_count - 1, 0)
+        self._total_bytes = max(self._total_bytes - size, 0)
+
+    @staticmethod
+    def _file_size(entry_path):
+        try:
+            return os.path.getsize(entry_path)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _remove(entry_path):
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass
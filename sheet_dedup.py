@@ -0,0 +1,471 @@
+import collections
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from get_gemini_results_json import DEFAULT_PREPROCESS_OPTIONS
+from preprocess_image import normalize_image
+
+INDEX_FILE_NAME = "sheet_index.jsonl" # 過去の実行で採点したシートのハッシュと正誤結果 (キャッシュフォルダ内)
+REPORT_FILE_NAME = "dedup_report.json" # まとめたシートの一覧 (出力フォルダ内)
+DEFAULT_THRESHOLD = 6 # 知覚ハッシュ (64 ビット) のハミング距離がこれ以下のシートを重複の候補とする (大きいほど索引の探索が全件比較に近づく)
+DEFAULT_MAX_CHANGED_PIXELS = 40 # 位置合わせ後、1 タイルで一致しないインクの画素がこれ以下なら同じシートとみなす
+INK_THRESHOLD = 128 # これより暗い画素をインク (文字) とみなす
+VERIFY_TILE = 64 # 照合で差分を数えるタイルの大きさ (正規化後の画像の画素)
+VERIFY_TOLERANCE = 2 # 照合でずれとして許す距離 (画素)
+HASH_SIZE = 8 # 知覚ハッシュは DCT の低周波 8x8 成分から作る (64 ビット)
+_DCT_SIZE = 32
+_DCT_MATRIX = np.cos(np.pi * (2 * np.arange(_DCT_SIZE)[None, :] + 1) * np.arange(_DCT_SIZE)[:, None] / (2 * _DCT_SIZE))
+
+
+def perceptual_hash(image):
+    """
+    画像の知覚ハッシュ (pHash) を求める
+
+    32x32 に縮小した画像の DCT の低周波成分が中央値より大きいかを 1 ビットずつ並べる。
+    再スキャン・圧縮・わずかなずれでは数ビットしか変わらない。
+
+    Args:
+        image: PIL Image (normalize_image() で正規化したもの)
+    Returns:
+        int: 64 ビットのハッシュ
+    """
+    pixels = np.asarray(image.convert("L").resize((_DCT_SIZE, _DCT_SIZE), Image.BOX), dtype=np.float64)
+    low = (_DCT_MATRIX @ pixels @ _DCT_MATRIX.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    bits = low > np.median(low[1:]) # 直流成分 (全体の明るさ) は中央値の計算から除く
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hamming_distance(a, b):
+    """2 つのハッシュの異なるビット数"""
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """
+    ハミング距離で近いハッシュを探す BK 木
+
+    各節点の子を「親との距離」ごとに持ち、三角不等式で調べる枝を絞るため、
+    全件と比べずに (登録数に対して劣線形で) 距離 max_distance 以内の要素を見つけられる。
+    """
+
+    def __init__(self):
+        self._root = None # [ハッシュ, 要素のリスト, {距離: 子の節点}]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key, item):
+        """ハッシュ key の要素 item を追加する"""
+        self._size += 1
+        if self._root is None:
+            self._root = [key, [item], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(key, node[0])
+            if distance == 0:
+                node[1].append(item) # 同じハッシュは同じ節点にまとめる
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [item], {}]
+                return
+            node = child
+
+    def search(self, key, max_distance):
+        """
+        ハッシュ key から距離 max_distance 以内の要素を探す
+
+        Returns:
+            list: (距離, 要素) のリスト (距離の近い順)
+        """
+        found = []
+        pending = [self._root] if self._root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = hamming_distance(key, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    pending.append(child)
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+def load_normalized(image_path, preprocess_options=DEFAULT_PREPROCESS_OPTIONS, page_number=None):
+    """
+    画像ファイルを採点時と同じ正規化 (回転情報の反映・縮小) をしたグレースケール画像として読み込む
+
+    page_number を指定した場合は、複数ページのファイル (PDF / TIFF) のそのページを読み込む。
+    """
+    max_long_edge = (preprocess_options or {}).get("max_long_edge")
+    if page_number is not None:
+        import page_source # 複数ページのファイルのシートを照合する場合だけ使う
+        return normalize_image(page_source.load_page(image_path, page_number), max_long_edge=max_long_edge,
+                               grayscale=True)[0]
+    with Image.open(image_path) as image:
+        return normalize_image(image, max_long_edge=max_long_edge, grayscale=True)[0]
+
+
+def count_changed_pixels(original, duplicate, registrar=None):
+    """
+    2 枚のシートを位置合わせして重ね、一致しないインクの画素数を数える
+
+    知覚ハッシュはページ全体の見た目なので、同じ用紙で答えが 1 つだけ違うシートとも近くなる。
+    重複とみなす前に、この関数で答えの書き込みまで同じかを確かめる。
+
+    Args:
+        original:  元のシート (正規化後のグレースケール配列)
+        duplicate: 重複の候補 (正規化後のグレースケール配列)
+        registrar: original をテンプレートにした registration.SheetRegistrar (省略時は作成する)
+    Returns:
+        int: タイル (VERIFY_TILE 四方) ごとの不一致画素数の最大値 (位置合わせできない場合は None)
+    """
+    import cv2 # 重複の候補が見つかった場合だけ使う
+    import registration
+
+    if registrar is None:
+        try:
+            registrar = registration.SheetRegistrar(original, max_side=max(original.shape))
+        except ValueError: # 白紙など特徴点のない用紙は照合できない
+            return None
+    alignment = registrar.register(duplicate)
+    if alignment.matrix is None:
+        return None
+    height, width = original.shape
+    warped = cv2.warpAffine(duplicate, alignment.matrix, (width, height), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                            borderValue=255) # 候補を元のシートの座標に合わせる
+
+    kernel = np.ones((2 * VERIFY_TOLERANCE + 1, 2 * VERIFY_TOLERANCE + 1), np.uint8)
+    ink_a = (original < INK_THRESHOLD).astype(np.uint8)
+    ink_b = (warped < INK_THRESHOLD).astype(np.uint8)
+    changed = (ink_a & (1 - cv2.dilate(ink_b, kernel))) | (ink_b & (1 - cv2.dilate(ink_a, kernel)))
+    rows, cols = -(-height // VERIFY_TILE), -(-width // VERIFY_TILE)
+    padded = np.zeros((rows * VERIFY_TILE, cols * VERIFY_TILE), np.uint32)
+    padded[:height, :width] = changed
+    return int(padded.reshape(rows, VERIFY_TILE, cols, VERIFY_TILE).sum(axis=(1, 3)).max())
+
+
+class _SheetEntry:
+    """
+    索引に登録したシート 1 枚 (正誤結果が出るまで、同じシートの重複は event で待つ)
+
+    シートは シートID で表し、照合ではあとから読める元のファイル (source_path, 複数ページのファイルは
+    page_number のページ) を読む。採点に使った一時ファイル (PDF / TIFF のページ) は採点後に消えるため記録しない。
+    """
+
+    def __init__(self, sheet_id, source_path, page_number, sheet_hash, results=None, file_stamp=None,
+                 previous_run=False):
+        self.sheet_id = sheet_id
+        self.source_path = source_path
+        self.page_number = page_number
+        self.sheet_hash = sheet_hash
+        self.results = results
+        self.file_stamp = file_stamp # 登録時の (サイズ, 更新時刻)。画像が差し替えられたら照合に使わない
+        self.previous_run = previous_run
+        self.failed = False # 採点に失敗した (重複の元にしない)
+        self.event = threading.Event()
+        if results is not None:
+            self.event.set()
+
+    @property
+    def source_key(self):
+        """元のファイルとページ (同じなら同じシート)"""
+        return (self.source_path, self.page_number)
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class SheetDeduplicator:
+    """
+    重複したシート (二重送り・同じ用紙の再スキャン) を見つけ、1 枚目の正誤結果を使い回して API 呼び出しを省く
+
+    各シートを採点時と同じ正規化をしてから知覚ハッシュを求め、BK 木の索引で距離 threshold 以内の
+    シートを探す。候補は位置合わせして重ね、答えの書き込みまで同じ (不一致の画素が max_changed_pixels 以下)
+    場合だけ重複とする (verify=False ならハッシュだけで判定)。索引は index_path に追記するため、
+    過去の実行で採点したシートの再スキャンも見つかる (元の画像が残っている場合)。
+
+    同じ実行内で 1 枚目の採点中に重複が届いた場合は、1 枚目の結果を待ってから使い回す。
+
+    Args:
+        layout_fingerprint: layout.Layout.fingerprint (レイアウトが違うシートの結果は使わない)
+        index_path:         過去の実行の索引 (INDEX_FILE_NAME, None なら今回の実行内だけ)
+        threshold:          重複の候補とするハッシュの距離 (0-64)
+        max_changed_pixels: 照合で同じシートとみなす不一致画素数の上限 (タイルごと)
+        verify:             候補を画素で照合するか
+        preprocess_options: 採点時の前処理の設定 (正規化に合わせる)
+    """
+
+    def __init__(self, layout_fingerprint, index_path=None, threshold=DEFAULT_THRESHOLD,
+                 max_changed_pixels=DEFAULT_MAX_CHANGED_PIXELS, verify=True, preprocess_options=DEFAULT_PREPROCESS_OPTIONS):
+        self.layout_fingerprint = layout_fingerprint
+        self.index_path = index_path
+        self.threshold = threshold
+        self.max_changed_pixels = max_changed_pixels
+        self.verify = verify
+        self.preprocess_options = preprocess_options
+        self.groups = collections.OrderedDict() # 元のシートのシートID -> まとめたシートのリスト
+        self.stats = {"sheets": 0, "duplicates": 0, "rejected": 0} # rejected: ハッシュは近いが照合で別のシートと判定
+        self._tree = BKTree()
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._originals = collections.OrderedDict() # 元のシートの source_key -> (正規化後の配列, SheetRegistrar)
+        self._sheets = {} # 画像パス -> (シートID, 元のファイルの絶対パス, ページ番号) (track() で登録)
+        if index_path is not None and os.path.exists(index_path):
+            self._load_index()
+
+    def track(self, jobs):
+        """
+        採点するシート (grading_pipeline.SheetJob) のシートIDと元のファイルを登録する (パイプラインに渡す前に呼ぶ)
+
+        採点関数には画像パスしか渡らないため、索引と一覧をシートIDで記録し、
+        PDF / TIFF のページは一時ファイルではなく元のファイルのページで照合できるようにする。
+        登録していない画像パスは、画像パスをシートIDとして扱う。
+        """
+        with self._lock:
+            for job in jobs:
+                self._sheets[job.image_path] = (job.sheet_id, os.path.abspath(job.source_path), job.page_number)
+
+    def _sheet_for(self, image_path):
+        """画像パス -> (シートID, 元のファイルの絶対パス, ページ番号)"""
+        with self._lock:
+            sheet = self._sheets.get(image_path)
+        return sheet or (image_path, os.path.abspath(image_path), None) # 次回の実行でも読めるよう絶対パスで記録
+
+    def _load_index(self):
+        """過去の実行の索引を読み込む (同じレイアウトで、元のファイルとページごとに最新のもの)"""
+        latest = {}
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # 書き込み途中で終了した最終行などは無視
+                if entry.get("layout") == self.layout_fingerprint:
+                    source_path = entry.get("source") or entry.get("image_path") # image_path は以前の形式
+                    latest[(source_path, entry.get("page"))] = dict(entry, source=source_path)
+        for entry in latest.values():
+            sheet_hash = int(entry["hash"], 16)
+            self._tree.add(sheet_hash, _SheetEntry(entry.get("sheet") or entry["source"], entry["source"], entry.get("page"),
+                                                   sheet_hash, entry["results"], entry.get("file_stamp"),
+                                                   previous_run=True))
+
+    def _record_index(self, entry):
+        """採点したシートを索引ファイルに追記する"""
+        if self.index_path is None:
+            return
+        record = {"hash": f"{entry.sheet_hash:016x}", "layout": self.layout_fingerprint, "sheet": entry.sheet_id,
+                  "source": entry.source_path, "page": entry.page_number, "file_stamp": entry.file_stamp,
+                  "results": entry.results, "time": time.time()}
+        with self._index_lock:
+            os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _original(self, entry):
+        """元のシートの正規化後の配列と位置合わせ器 (直近のものは使い回す)"""
+        import registration
+
+        with self._lock:
+            cached = self._originals.get(entry.source_key)
+            if cached is not None:
+                self._originals.move_to_end(entry.source_key)
+                return cached
+        pixels = np.asarray(load_normalized(entry.source_path, self.preprocess_options, entry.page_number))
+        try:
+            registrar = registration.SheetRegistrar(pixels, max_side=max(pixels.shape))
+        except ValueError:
+            registrar = None
+        with self._lock:
+            self._originals[entry.source_key] = (pixels, registrar)
+            while len(self._originals) > 16:
+                self._originals.popitem(last=False)
+        return pixels, registrar
+
+    def _verify(self, entry, pixels):
+        """候補 entry が今のシート (正規化後の配列 pixels) と同じシートか画素で確かめる"""
+        if not self.verify:
+            return True, None
+        try:
+            if entry.file_stamp is not None and _file_stamp(entry.source_path) != list(entry.file_stamp):
+                return False, None # 元の画像が差し替えられている
+            original, registrar = self._original(entry)
+        except (OSError, ValueError, RuntimeError): # 元の画像・ページが残っていない (pypdf がない場合も)
+            return False, None
+        if registrar is None: # 白紙など特徴点のない用紙は照合できない
+            return False, None
+        changed_pixels = count_changed_pixels(original, pixels, registrar)
+        return changed_pixels is not None and changed_pixels <= self.max_changed_pixels, changed_pixels
+
+    def _claim(self, image_path):
+        """
+        シートの重複を探し、なければ索引に (採点待ちとして) 登録する
+
+        Returns:
+            tuple: ("duplicate", 元のシートの _SheetEntry, 照合の情報) / ("new", 登録した _SheetEntry, None) /
+                   (None, None, None) (画像が読めずハッシュを求められない場合)
+        """
+        sheet_id, source_path, page_number = self._sheet_for(image_path)
+        try:
+            normalized = load_normalized(image_path, self.preprocess_options) # 採点に使う画像 (ページは一時ファイル)
+            file_stamp = _file_stamp(source_path)
+        except OSError:
+            return None, None, None
+        sheet_hash = perceptual_hash(normalized)
+        pixels = np.asarray(normalized)
+        own = _SheetEntry(sheet_id, source_path, page_number, sheet_hash, file_stamp=file_stamp)
+        with self._lock:
+            self.stats["sheets"] += 1
+            candidates = [(distance, entry) for distance, entry in self._tree.search(sheet_hash, self.threshold)
+                          if not entry.failed and entry.source_key != own.source_key] # 同じシートの再採点は結果キャッシュに任せる
+            if not candidates: # 候補がなければ照合せずにすぐ登録する (続けて届いた重複がこのシートを待てるように)
+                self._tree.add(sheet_hash, own)
+                return "new", own, None
+        for distance, entry in candidates:
+            same, changed_pixels = self._verify(entry, pixels)
+            if same:
+                return "duplicate", entry, {"sheet": sheet_id, "distance": distance, "changed_pixels": changed_pixels}
+            with self._lock:
+                self.stats["rejected"] += 1
+        with self._lock:
+            self._tree.add(sheet_hash, own)
+        return "new", own, None
+
+    def _resolve(self, entry, results):
+        """登録したシートの採点結果を記録し、待っている重複に知らせる"""
+        entry.results = results
+        entry.failed = results is None
+        entry.event.set()
+        if results is not None:
+            self._record_index(entry)
+
+    def _reuse(self, entry, match):
+        """元のシートの結果を待って使い回す (元のシートが失敗した場合は None)"""
+        entry.event.wait()
+        if entry.results is None:
+            return None
+        with self._lock:
+            self.stats["duplicates"] += 1
+            group = self.groups.setdefault(entry.sheet_id, {"source": entry.source_path, "page": entry.page_number,
+                                                            "previous_run": entry.previous_run, "duplicates": []})
+            group["duplicates"].append(match)
+        return dict(entry.results)
+
+    def grade(self, image_path, grader):
+        """
+        重複でなければ grader で採点し、重複なら元のシートの正誤結果を返す
+
+        Args:
+            image_path: 画像パス
+            grader:     画像パスを受け取り正誤結果の辞書 (失敗時 None) を返す関数
+        """
+        kind, entry, match = self._claim(image_path)
+        if kind == "duplicate":
+            results = self._reuse(entry, match)
+            if results is not None:
+                return results
+            return grader(image_path) # 元のシートの採点に失敗した場合は自分で採点する
+        try:
+            results = grader(image_path)
+        except BaseException:
+            if entry is not None:
+                self._resolve(entry, None)
+            raise
+        if entry is not None:
+            self._resolve(entry, results)
+        return results
+
+    def grade_batch(self, image_paths, batch_grader):
+        """
+        grade() の複数シート版 (重複でないシートだけを batch_grader にまとめて渡す)
+
+        Returns:
+            dict: {画像パス: 正誤結果}
+        """
+        results_by_path = {}
+        own_entries = {} # 画像パス -> 登録した _SheetEntry (ハッシュを求められなかったシートは None)
+        duplicates = [] # (画像パス, 元のシートの _SheetEntry, 照合の情報)
+        for image_path in image_paths:
+            kind, entry, match = self._claim(image_path)
+            if kind == "duplicate":
+                duplicates.append((image_path, entry, match))
+            else:
+                own_entries[image_path] = entry
+        if own_entries:
+            try:
+                results_by_path.update(batch_grader(list(own_entries)) or {})
+            finally:
+                for image_path, entry in own_entries.items():
+                    if entry is not None:
+                        self._resolve(entry, results_by_path.get(image_path))
+        for image_path, entry, match in duplicates: # 同じバッチ内の元のシートは上で結果が出ている
+            results = self._reuse(entry, match)
+            if results is None:
+                results = (batch_grader([image_path]) or {}).get(image_path)
+            results_by_path[image_path] = results
+        return results_by_path
+
+    def wrap(self, grader):
+        """grader を重複を飛ばす採点関数で包む (grading_pipeline.GradingPipeline の grader に渡す)"""
+        return lambda image_path: self.grade(image_path, grader)
+
+    def wrap_batch(self, batch_grader):
+        """batch_grader を重複を飛ばす採点関数で包む (grading_pipeline.GradingPipeline の batch_grader に渡す)"""
+        return lambda image_paths: self.grade_batch(image_paths, batch_grader)
+
+    def report(self):
+        """
+        まとめたシートの一覧
+
+        Returns:
+            dict: {"sheets", "duplicates", "rejected", "threshold",
+                   "groups": [{"original", "source", "page", "previous_run", "duplicates": [{"sheet", "distance", "changed_pixels"}]}]}
+                  (original・sheet はシートID、source・page は元のシートを読める元のファイルとページ番号)
+        """
+        with self._lock:
+            groups = [{"original": sheet_id, "source": group["source"], "page": group["page"],
+                       "previous_run": group["previous_run"], "duplicates": list(group["duplicates"])}
+                      for sheet_id, group in self.groups.items()]
+            return dict(self.stats, threshold=self.threshold, verify=self.verify, groups=groups)
+
+    def write_report(self, path):
+        """まとめたシートの一覧を JSON ファイルに保存する"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+
+    def format_summary(self):
+        """結果の要約 (1 行目) と、まとめたグループ (2 行目以降)"""
+        report = self.report()
+        lines = [f"重複シート: {report['duplicates']} 枚をまとめました (API 呼び出しを省略, "
+                 f"{report['sheets']} 枚中, 照合で別のシートと判定 {report['rejected']} 件)"]
+        for group in report["groups"]:
+            duplicate_sheets = ", ".join(match["sheet"] for match in group["duplicates"])
+            origin = f" (前回の実行: {group['source']})" if group["previous_run"] else ""
+            lines.append(f"  {group['original']}{origin} ← {duplicate_sheets}")
+        return "\n".join(lines)
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("使い方: python sheet_dedup.py 画像 [画像 ...] (知覚ハッシュと、重複とみなされる組を表示)")
+        sys.exit(1)
+    deduplicator = SheetDeduplicator(layout_fingerprint=None)
+    for path in sys.argv[1:]:
+        start_time = time.perf_counter()
+        sheet_results = deduplicator.grade(path, lambda image_path: {"path": image_path})
+        print(f"{path}: {'重複 (' + sheet_results['path'] + ')' if sheet_results['path'] != path else '新規'} "
+              f"({(time.perf_counter() - start_time) * 1000:.0f} ms)")
+    print(deduplicator.format_summary())
@@ -0,0 +1,37 @@
+import json
+import os
+
+from PIL import Image
+
+import grade_report
+
+
+def write_results(results_path, records):
+    with open(results_path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def test_output_paths_are_resolved_against_the_results_file(tmp_path, monkeypatch):
+    output_dir = tmp_path / "run" / "marked_images"
+    (output_dir / "sub").mkdir(parents=True)
+    Image.new("RGB", (40, 30), "white").save(output_dir / "sub" / "marked_a.png")
+    results_path = output_dir / "grading_results.jsonl"
+    write_results(results_path, [ # 採点したときのカレントフォルダ (run/) 基準の相対パス
+        {"sheet": "sub/a.png", "status": "saved", "output_path": os.path.join("marked_images", "sub", "marked_a.png"),
+         "results": {"1": True}},
+        {"sheet": "b.png", "status": "saved", "output_path": os.path.join("marked_images", "marked_b.png"),
+         "results": {"1": False}},
+        {"sheet": "c.png", "status": "failed"},
+    ])
+    monkeypatch.chdir(tmp_path) # 別のフォルダから作成する
+
+    records = grade_report.load_results(str(results_path))
+    output_paths = {record["sheet"]: record.get("output_path") for record in records}
+    assert output_paths["sub/a.png"] == str(output_dir / "sub" / "marked_a.png")
+
+    missing = []
+    page_count = grade_report.build_report(records, str(tmp_path / "report.pdf"), contact_sheet=False,
+                                           on_missing=lambda sheet_id, output_path: missing.append(sheet_id))
+    assert missing == ["b.png"] # 失敗したシート (画像なし) は知らせない
+    assert page_count == 2 # 集計表 + 採点済み画像 1 枚
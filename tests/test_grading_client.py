@@ -0,0 +1,230 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import fake_gemini
+import get_gemini_results_json
+import response_parser
+import result_cache
+from grading_client import AsyncGradingClient, CircuitBreaker, TokenBucket, make_partial_regrader
+
+
+@pytest.fixture
+def sheets(tmp_path):
+    """採点用の小さな画像を 12 枚作る (内容が違うのでキャッシュキーも別)"""
+    paths = []
+    for i in range(12):
+        path = tmp_path / f"sheet_{i:02d}.png"
+        Image.new("RGB", (64, 48), (i * 20, 255 - i * 20, 128)).save(path)
+        paths.append(str(path))
+    return paths
+
+
+def make_client(model, **options):
+    options.setdefault("requests_per_minute", None)
+    options.setdefault("tokens_per_minute", None)
+    options.setdefault("base_delay", 0.001)
+    options.setdefault("max_delay", 0.01)
+    return AsyncGradingClient(model=model, **options)
+
+
+def test_grades_with_the_fake_model(sheets):
+    model = fake_gemini.FakeGenerativeModel(latency=0.0, jitter=0.0)
+    client = make_client(model)
+    results = asyncio.run(client.grade_many(sheets[:3]))
+    assert results == {path: {"1": True, "2": False, "3": True} for path in sheets[:3]}
+    assert client.stats["requests"] == model.request_count == 3
+    assert client.stats["retries"] == 0
+
+
+def test_preprocessing_and_cache_run_off_the_event_loop(sheets, tmp_path, monkeypatch):
+    threads = {}
+    build_contents = get_gemini_results_json.build_contents
+
+    def recording_build_contents(image_bytes, options):
+        threads["preprocess"] = threading.get_ident()
+        return build_contents(image_bytes, options)
+
+    class RecordingCache(result_cache.ResultCache):
+        def get(self, key):
+            threads["cache_get"] = threading.get_ident()
+            return super().get(key)
+
+        def put(self, key, results, model_name=""):
+            threads["cache_put"] = threading.get_ident()
+            super().put(key, results, model_name)
+
+    monkeypatch.setattr(get_gemini_results_json, "build_contents", recording_build_contents)
+    client = make_client(fake_gemini.FakeGenerativeModel(latency=0.0, jitter=0.0),
+                         cache=RecordingCache(str(tmp_path / "cache")))
+
+    async def grade():
+        threads["loop"] = threading.get_ident()
+        return await client.grade(sheets[0])
+
+    assert asyncio.run(grade()) is not None
+    assert set(threads) == {"loop", "preprocess", "cache_get", "cache_put"}
+    assert all(ident != threads["loop"] for name, ident in threads.items() if name != "loop") # 1 枚の縮小で他のシートを待たせない
+
+
+def test_retries_429_until_success(sheets):
+    model = fake_gemini.FakeGenerativeModel(latency=0.0, jitter=0.0, rate_limit_rate=0.5, seed=1)
+    client = make_client(model, max_retries=20, circuit_breaker=CircuitBreaker(error_threshold=1.1))
+    results = asyncio.run(client.grade_many(sheets))
+
+    assert all(sheet_results is not None for sheet_results in results.values())
+    assert client.stats["retries"] > 0
+    assert client.stats["retries"] == model.request_count - len(sheets) # 成功した 1 回以外は全て再試行
+    assert client.stats["requests"] == model.request_count
+    assert client.stats["failures"] == 0
+
+
+def test_gives_up_after_max_retries(sheets):
+    model = fake_gemini.FakeGenerativeModel(latency=0.0, jitter=0.0, rate_limit_rate=1.0)
+    client = make_client(model, max_retries=3, circuit_breaker=CircuitBreaker(error_threshold=1.1))
+    assert asyncio.run(client.grade(sheets[0])) is None
+    assert model.request_count == 4 # 最初の 1 回 + 再試行 3 回
+    assert client.stats["retries"] == 3
+    assert client.stats["failures"] == 1
+
+
+def test_does_not_retry_permanent_errors(sheets):
+    class BadRequestModel(fake_gemini.FakeGenerativeModel):
+        async def generate_content_async(self, contents, stream=False, **kwargs):
+            self.request_count += 1
+            raise fake_gemini.FakeAPIError(400, "Bad Request (fake)")
+
+    model = BadRequestModel(latency=0.0)
+    client = make_client(model, max_retries=5)
+    assert asyncio.run(client.grade(sheets[0])) is None
+    assert model.request_count == 1
+    assert client.stats["retries"] == 0
+
+
+def test_respects_in_flight_cap(sheets):
+    model = fake_gemini.FakeGenerativeModel(latency=0.05, jitter=0.0)
+    client = make_client(model, max_in_flight=3)
+    asyncio.run(client.grade_many(sheets))
+    assert model.max_in_flight == 3
+
+
+def test_circuit_breaker_opens_on_errors(sheets):
+    model = fake_gemini.FakeGenerativeModel(latency=0.0, jitter=0.0, error_rate=1.0)
+    breaker = CircuitBreaker(window=4, error_threshold=0.5, min_requests=4, cooldown=0.1)
+    client = make_client(model, max_retries=0, circuit_breaker=breaker)
+
+    async def grade_in_order():
+        return [await client.grade(path) for path in sheets[:8]] # 1 件ずつ送る
+
+    started = time.perf_counter()
+    results = asyncio.run(grade_in_order())
+    elapsed = time.perf_counter() - started
+
+    assert results == [None] * 8
+    assert breaker.state == "open"
+    assert breaker.trip_count == 1 + 4 # 4 件目で停止し、試しの 1 件が失敗するたびにもう一度停止する
+    assert elapsed >= 4 * 0.1 # 停止中は cooldown 秒待ってから 1 件だけ試す
+
+
+def test_circuit_breaker_recovers_after_probe():
+    breaker = CircuitBreaker(window=4, error_threshold=0.5, min_requests=2, cooldown=0.05)
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == "open"
+
+    async def probe():
+        await breaker.wait_until_ready()
+        return breaker.state
+
+    assert asyncio.run(probe()) == "half_open"
+    breaker.record(True)
+    assert breaker.state == "closed"
+
+
+def test_rpm_pacing(sheets):
+    model = fake_gemini.FakeGenerativeModel(latency=0.0, jitter=0.0)
+    client = make_client(model)
+    client.request_bucket = TokenBucket(600, burst=1) # 10 件/秒, まとめて送れるのは 1 件
+
+    started = time.perf_counter()
+    asyncio.run(client.grade_many(sheets[:6]))
+    elapsed = time.perf_counter() - started
+
+    assert model.request_count == 6
+    assert elapsed >= 0.45 # 1 件目はすぐ、残り 5 件は 0.1 秒間隔
+
+
+def test_batch_requests_go_through_the_client(sheets):
+    batch_text = json.dumps({"0": {"1": True}, "1": {"1": False}})
+    model = fake_gemini.FakeGenerativeModel(response_text=batch_text, latency=0.0, jitter=0.0,
+                                            rate_limit_rate=0.4, seed=3)
+    client = make_client(model, max_retries=20, circuit_breaker=CircuitBreaker(error_threshold=1.1))
+    results = asyncio.run(client.grade_batch(sheets[:4], batch_size=2))
+
+    assert results == {sheets[0]: {"1": True}, sheets[1]: {"1": False},
+                       sheets[2]: {"1": True}, sheets[3]: {"1": False}}
+    assert model.request_count - client.stats["retries"] == 2 # 2 枚ずつ 2 リクエスト (429 は再試行)
+    assert client.stats["requests"] == model.request_count
+
+
+def test_batch_falls_back_for_missing_sheets(sheets):
+    model = fake_gemini.FakeGenerativeModel(latency=0.0, jitter=0.0) # 1 枚分の形式で答えるため、まとめた回答は読めない
+    client = make_client(model)
+    results = asyncio.run(client.grade_batch(sheets[:3], batch_size=3))
+
+    assert results == {path: {"1": True, "2": False, "3": True} for path in sheets[:3]}
+    assert model.request_count == 4 # まとめた 1 件 + 1 枚ずつ 3 件
+
+
+def test_sync_batch_grader_shares_the_limits(sheets):
+    batch_text = json.dumps({"0": {"1": True}, "1": {"1": True}})
+    model = fake_gemini.FakeGenerativeModel(response_text=batch_text, latency=0.05, jitter=0.0)
+    client = make_client(model, max_in_flight=1)
+    try:
+        batch_grader = client.as_sync_batch_grader(batch_size=2)
+        results = batch_grader(sheets[:6])
+    finally:
+        client.close()
+    assert len(results) == 6
+    assert model.max_in_flight == 1 # バッチ同士も同時実行数の上限を守る
+
+
+CONFIDENT_TEXT = json.dumps({"1": {"correct": True, "confidence": 0.9}, "2": {"correct": False, "confidence": 55}})
+
+
+def test_confidence_reaches_the_results(sheets, tmp_path):
+    model = fake_gemini.FakeGenerativeModel(response_text=CONFIDENT_TEXT, latency=0.0, jitter=0.0)
+    cache = result_cache.ResultCache(str(tmp_path / "cache"))
+    client = make_client(model, cache=cache)
+    problem_results = asyncio.run(client.grade(sheets[0]))
+    assert problem_results == {"1": True, "2": False}
+    assert problem_results.confidence == {"1": 0.9, "2": 0.55}
+
+    cached_results = asyncio.run(client.grade(sheets[0])) # キャッシュにも確信度を保存する
+    assert client.stats["cache_hits"] == 1
+    assert cached_results.confidence == {"1": 0.9, "2": 0.55}
+
+
+def test_streaming_parses_the_reply_once(sheets):
+    model = fake_gemini.FakeGenerativeModel(response_text=CONFIDENT_TEXT, latency=0.0, jitter=0.0, stream_chunks=3)
+    verdicts = []
+    client = make_client(model, stream=True, on_verdict=lambda path, number, verdict: verdicts.append((number, verdict)))
+    response_parser.reset_parse_stats()
+    problem_results = asyncio.run(client.grade(sheets[0]))
+
+    assert verdicts == [("1", True), ("2", False)]
+    assert problem_results.confidence == {"1": 0.9, "2": 0.55}
+    assert response_parser.parse_stats()["responses"] == 1 # 受信しながら解析した結果をそのまま使う
+
+
+def test_partial_regrade_replaces_confidence():
+    previous = response_parser.ProblemResults({"1": True, "2": True}, {"1": 0.6, "2": 0.7})
+    regrade = make_partial_regrader(lambda path, numbers=None: response_parser.ProblemResults({"2": False}),
+                                    ["2"], {"a.png": previous})
+    problem_results = regrade("a.png")
+    assert problem_results == {"1": True, "2": False}
+    assert problem_results.confidence == {"1": 0.6} # 採点し直した問題の古い確信度は残さない
@@ -0,0 +1,242 @@
+import threading
+import time
+
+import pytest
+
+import response_parser
+from grading_pipeline import GradingPipeline, SheetJob
+
+RESULTS = {"1": True, "2": False}
+
+
+class StubGrader:
+    """API の代わりに待つだけの採点関数 (同時に呼ばれた数の最大を記録)"""
+
+    def __init__(self, latency=0.05, results=RESULTS, fail_paths=(), error_paths=(), gate=None):
+        self.latency = latency
+        self.results = results
+        self.fail_paths = set(fail_paths) # None を返す (API エラー扱い)
+        self.error_paths = set(error_paths) # 例外を投げる
+        self.gate = gate # 指定した場合はこの Event がセットされるまで応答しない
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, image_path):
+        with self._lock:
+            self.calls.append(image_path)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.gate is not None:
+                self.gate.wait(5)
+            time.sleep(self.latency)
+            if image_path in self.error_paths:
+                raise RuntimeError("stub error")
+            if image_path in self.fail_paths:
+                return None
+            return dict(self.results)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def stub_compositor(image_path, problem_results):
+    return None if image_path.startswith("bad_composite") else object()
+
+
+def make_jobs(names):
+    return [SheetJob(name, name, f"marked_{name}") for name in names]
+
+
+def run_pipeline(pipeline, jobs, timeout=10):
+    pipeline.start(jobs)
+    assert pipeline.wait(timeout), "パイプラインが終了しない"
+    return pipeline.poll_events(max_events=10_000)
+
+
+def final_events(events):
+    """シートID -> 最後のイベント ("finished" は除く)"""
+    return {event["sheet_id"]: event for event in events if event["event"] != "finished"
+            and event["event"] in ("saved", "failed", "cancelled")}
+
+
+def test_runs_api_calls_concurrently():
+    grader = StubGrader(latency=0.2)
+    pipeline = GradingPipeline(grader, stub_compositor, saver=lambda image, path: None, api_workers=4, cpu_workers=2)
+    started = time.perf_counter()
+    events = run_pipeline(pipeline, make_jobs([f"s{i}.png" for i in range(8)]))
+    elapsed = time.perf_counter() - started
+
+    assert grader.max_in_flight == 4 # api_workers まで同時に呼ぶ (それ以上は呼ばない)
+    assert elapsed < 8 * 0.2 * 0.75 # 順番に呼ぶより明らかに速い
+    finals = final_events(events)
+    assert len(finals) == 8
+    assert all(event["event"] == "saved" and event["problem_results"] == RESULTS for event in finals.values())
+    assert events[-1]["event"] == "finished"
+
+
+def test_event_order_per_sheet():
+    pipeline = GradingPipeline(StubGrader(latency=0.0), stub_compositor, saver=lambda image, path: None)
+    events = run_pipeline(pipeline, make_jobs(["a.png"]))
+    assert [event["event"] for event in events] == ["started", "graded", "composited", "saved", "finished"]
+
+
+def test_failed_stage_events():
+    grader = StubGrader(latency=0.0, fail_paths={"api_none.png"}, error_paths={"api_error.png"})
+    pipeline = GradingPipeline(grader, stub_compositor, saver=lambda image, path: None)
+    events = run_pipeline(pipeline, make_jobs(["ok.png", "api_none.png", "api_error.png", "bad_composite.png"]))
+    finals = final_events(events)
+
+    assert finals["ok.png"]["event"] == "saved"
+    assert finals["api_none.png"]["event"] == "failed"
+    assert finals["api_none.png"]["stage"] == "api"
+    assert finals["api_error.png"]["event"] == "failed"
+    assert finals["api_error.png"]["stage"] == "api"
+    assert isinstance(finals["api_error.png"]["error"], RuntimeError)
+    assert finals["bad_composite.png"]["event"] == "failed"
+    assert finals["bad_composite.png"]["stage"] == "composite"
+
+
+def test_saver_error_is_a_composite_failure():
+    def broken_saver(image, path):
+        raise OSError("disk full")
+
+    pipeline = GradingPipeline(StubGrader(latency=0.0), stub_compositor, saver=broken_saver)
+    finals = final_events(run_pipeline(pipeline, make_jobs(["a.png"])))
+    assert finals["a.png"]["event"] == "failed"
+    assert finals["a.png"]["stage"] == "composite"
+
+
+def test_cancel_one_sheet_before_it_starts():
+    gate = threading.Event()
+    grader = StubGrader(latency=0.0, gate=gate)
+    pipeline = GradingPipeline(grader, stub_compositor, saver=lambda image, path: None, api_workers=1)
+    pipeline.start(make_jobs(["first.png", "second.png", "third.png"]))
+    time.sleep(0.1) # first.png の API 呼び出し中
+    pipeline.cancel("second.png")
+    gate.set()
+    assert pipeline.wait(10)
+    finals = final_events(pipeline.poll_events(max_events=1000))
+
+    assert finals["first.png"]["event"] == "saved"
+    assert finals["second.png"]["event"] == "cancelled"
+    assert finals["third.png"]["event"] == "saved"
+    assert "second.png" not in grader.calls # キャンセルしたシートは API を呼ばない
+
+
+def test_cancel_discards_result_of_call_in_flight():
+    gate = threading.Event()
+    grader = StubGrader(latency=0.0, gate=gate)
+    pipeline = GradingPipeline(grader, stub_compositor, saver=lambda image, path: None, api_workers=1)
+    pipeline.start(make_jobs(["busy.png"]))
+    time.sleep(0.1)
+    pipeline.cancel("busy.png") # API 呼び出し中にキャンセル → 応答後に破棄
+    gate.set()
+    assert pipeline.wait(10)
+    events = pipeline.poll_events(max_events=1000)
+
+    assert final_events(events)["busy.png"]["event"] == "cancelled"
+    assert "graded" not in [event["event"] for event in events]
+
+
+def test_cancel_all():
+    gate = threading.Event()
+    grader = StubGrader(latency=0.0, gate=gate)
+    pipeline = GradingPipeline(grader, stub_compositor, saver=lambda image, path: None, api_workers=2)
+    pipeline.start(make_jobs([f"s{i}.png" for i in range(6)]))
+    time.sleep(0.1)
+    pipeline.cancel_all()
+    gate.set()
+    assert pipeline.wait(10)
+    finals = final_events(pipeline.poll_events(max_events=1000))
+
+    assert len(finals) == 6
+    assert all(event["event"] == "cancelled" for event in finals.values())
+    assert len(grader.calls) <= 2 # 呼び出し中だった分だけ
+
+
+def test_keep_open_submit_and_close():
+    pipeline = GradingPipeline(StubGrader(latency=0.0), stub_compositor, saver=lambda image, path: None)
+    pipeline.start(make_jobs(["a.png"]), keep_open=True)
+    time.sleep(0.3)
+    assert not pipeline.finished # 全シートが終わっても keep_open の間は終了しない
+
+    pipeline.submit(make_jobs(["b.png", "c.png"]))
+    time.sleep(0.3)
+    assert not pipeline.finished
+    pipeline.close()
+    assert pipeline.wait(10)
+
+    events = pipeline.poll_events(max_events=1000)
+    assert {sheet_id for sheet_id, event in final_events(events).items() if event["event"] == "saved"} == \
+        {"a.png", "b.png", "c.png"}
+    assert [event["event"] for event in events].count("finished") == 1
+    with pytest.raises(RuntimeError):
+        pipeline.submit(make_jobs(["d.png"])) # close() 後は追加できない
+
+
+def test_close_waits_for_submitted_jobs():
+    gate = threading.Event()
+    pipeline = GradingPipeline(StubGrader(latency=0.0, gate=gate), stub_compositor, saver=lambda image, path: None)
+    pipeline.start([], keep_open=True)
+    pipeline.submit(make_jobs(["late.png"]))
+    pipeline.close()
+    time.sleep(0.1)
+    assert not pipeline.finished # 投入済みのシートが終わるまでは終了しない
+    gate.set()
+    assert pipeline.wait(10)
+    assert final_events(pipeline.poll_events())["late.png"]["event"] == "saved"
+
+
+def test_submit_requires_keep_open():
+    pipeline = GradingPipeline(StubGrader(latency=0.0), stub_compositor, saver=lambda image, path: None)
+    run_pipeline(pipeline, make_jobs(["a.png"]))
+    with pytest.raises(RuntimeError):
+        pipeline.submit(make_jobs(["b.png"]))
+
+
+def test_preset_results_skip_the_api():
+    grader = StubGrader(latency=0.0)
+    pipeline = GradingPipeline(grader, stub_compositor, saver=lambda image, path: None)
+    job = make_jobs(["resumed.png"])[0]
+    job.problem_results = {"1": False}
+    events = run_pipeline(pipeline, [job])
+
+    assert grader.calls == []
+    graded = [event for event in events if event["event"] == "graded"][0]
+    assert graded["reused"] is True
+    assert final_events(events)["resumed.png"]["problem_results"] == {"1": False}
+
+
+def test_batch_grader_groups_waiting_sheets():
+    batches = []
+
+    def batch_grader(image_paths):
+        batches.append(list(image_paths))
+        return {path: dict(RESULTS) for path in image_paths}
+
+    gate = threading.Event()
+    pipeline = GradingPipeline(StubGrader(latency=0.0, gate=gate), stub_compositor, saver=lambda image, path: None,
+                               api_workers=1, batch_grader=batch_grader, batch_size=3)
+    pipeline.start(make_jobs([f"s{i}.png" for i in range(7)]))
+    time.sleep(0.1) # 1 枚目は単独で呼ばれ、その間に残りがキューに溜まる
+    gate.set()
+    assert pipeline.wait(10)
+    finals = final_events(pipeline.poll_events(max_events=1000))
+
+    assert all(event["event"] == "saved" for event in finals.values())
+    assert len(finals) == 7
+    assert all(len(batch) <= 3 for batch in batches)
+    assert sum(len(batch) for batch in batches) >= 5
+
+
+def test_confidence_is_part_of_the_events():
+    grader = lambda image_path: response_parser.ProblemResults(RESULTS, {"1": 0.9})
+    pipeline = GradingPipeline(grader, stub_compositor, saver=lambda image, path: None)
+    events = run_pipeline(pipeline, make_jobs(["a.png"]))
+
+    graded = [event for event in events if event["event"] == "graded"][0]
+    assert graded["confidence"] == {"1": 0.9}
+    assert final_events(events)["a.png"]["confidence"] == {"1": 0.9}
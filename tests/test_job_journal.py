@@ -0,0 +1,63 @@
+import job_journal
+from grading_pipeline import GradingPipeline, SheetJob
+
+RESULTS = {"1": True, "2": False}
+
+
+def make_job(tmp_path, name, content=b"sheet"):
+    image_path = tmp_path / name
+    image_path.write_bytes(content)
+    return SheetJob(name, str(image_path), str(tmp_path / f"marked_{name}"))
+
+
+def saved_event(job, input_hash=None):
+    open(job.output_path, "wb").close()
+    event = {"event": "saved", "sheet_id": job.sheet_id, "image_path": job.image_path,
+             "output_path": job.output_path, "problem_results": RESULTS}
+    if input_hash is not None:
+        event["input_hash"] = input_hash
+    return event
+
+
+def test_plan_without_resume_does_not_hash(tmp_path, monkeypatch):
+    journal = job_journal.JobJournal(str(tmp_path / "out"), "layout")
+    jobs = [make_job(tmp_path, f"s{i}.png") for i in range(3)]
+    hashed = []
+    monkeypatch.setattr(job_journal, "hash_file", lambda path: hashed.append(path) or "hash")
+
+    jobs_to_run, skipped_jobs = journal.plan(jobs, resume=False)
+    assert (jobs_to_run, skipped_jobs) == (jobs, [])
+    assert hashed == []
+
+    journal.record(saved_event(jobs[0], input_hash="from-pipeline")) # 記録する時も計算しない (GUI スレッド)
+    journal.record(saved_event(jobs[1]))
+    assert hashed == []
+    assert journal.input_hashes == {"s0.png": "from-pipeline"}
+
+
+def test_pipeline_hashes_inputs_and_carries_them_in_events(tmp_path):
+    jobs = [make_job(tmp_path, "a.png", b"a")]
+    pipeline = GradingPipeline(lambda image_path: dict(RESULTS), lambda image_path, problem_results: object(),
+                               saver=lambda image, path: None, input_hasher=job_journal.hash_file)
+    pipeline.start(jobs)
+    assert pipeline.wait(10)
+    events = [event for event in pipeline.poll_events(max_events=100) if event["event"] != "finished"]
+
+    assert [event["event"] for event in events] == ["started", "graded", "composited", "saved"]
+    assert all(event["input_hash"] == job_journal.hash_file(jobs[0].image_path) for event in events)
+
+
+def test_resume_skips_sheets_recorded_without_planning(tmp_path):
+    output_folder = str(tmp_path / "out")
+    jobs = [make_job(tmp_path, "a.png", b"a"), make_job(tmp_path, "b.png", b"b")]
+    first_run = job_journal.JobJournal(output_folder, "layout")
+    first_run.plan(jobs, resume=False)
+    first_run.record(saved_event(jobs[0], input_hash=job_journal.hash_file(jobs[0].image_path)))
+    first_run.close()
+
+    second_run = job_journal.JobJournal(output_folder, "layout")
+    jobs_to_run, skipped_jobs = second_run.plan(jobs, resume=True)
+    second_run.close()
+    assert [job.sheet_id for job in skipped_jobs] == ["a.png"]
+    assert [job.sheet_id for job in jobs_to_run] == ["b.png"]
+    assert skipped_jobs[0].problem_results == RESULTS
@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+from local_grader import HybridGrader
+
+
+class StubLocalGrader:
+    """画像パスごとに決めた (正誤結果, 不確かな問題) を返すローカル採点器"""
+
+    def __init__(self, graded):
+        self.graded = graded
+        self.layout = SimpleNamespace(problem_numbers=["1", "2", "3"])
+
+    def grade(self, image_path):
+        return self.graded[image_path]
+
+
+GRADED = {
+    "local.png": ({"1": True, "2": True, "3": False}, []),
+    "mixed.png": ({"1": True, "2": False}, ["3"]),
+    "unreadable.png": (None, None), # ローカルで読めない画像
+}
+
+
+def api_grader(image_path):
+    return {"1": False, "2": False, "3": True}
+
+
+def test_unreadable_sheets_are_counted_as_api_graded():
+    grader = HybridGrader(StubLocalGrader(GRADED), api_grader)
+    assert grader("unreadable.png") == {"1": False, "2": False, "3": True}
+    assert grader.stats == {"sheets": 1, "api_sheets": 1, "local_problems": 0, "api_problems": 3}
+    assert grader.api_calls_avoided() == 0.0
+
+
+def test_batch_counts_every_sheet():
+    batches = []
+
+    def batch_api_grader(image_paths):
+        batches.append(image_paths)
+        return {image_path: api_grader(image_path) for image_path in image_paths}
+
+    grader = HybridGrader(StubLocalGrader(GRADED), api_grader, batch_api_grader=batch_api_grader)
+    results = grader.grade_batch(list(GRADED))
+
+    assert batches == [["mixed.png", "unreadable.png"]] # 全問題をローカルで採点できたシートは送らない
+    assert results["local.png"] == {"1": True, "2": True, "3": False}
+    assert results["mixed.png"] == {"1": True, "2": False, "3": True}
+    assert results["unreadable.png"] == {"1": False, "2": False, "3": True}
+    assert grader.stats == {"sheets": 3, "api_sheets": 2, "local_problems": 5, "api_problems": 4}
+    assert abs(grader.api_calls_avoided() - 1 / 3) < 1e-9
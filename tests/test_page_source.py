@@ -0,0 +1,95 @@
+import os
+import time
+
+from PIL import Image
+
+import grade_report
+import page_source
+
+
+def _write_pdf(path, colors):
+    """1 ページに 1 色の画像を埋め込んだ PDF を作る"""
+    writer = grade_report.StreamingPdfWriter(str(path))
+    writer.close([writer.add_image_page(Image.new("RGB", (80, 60), color), dpi=72) for color in colors])
+
+
+def _write_tiff(path, colors):
+    """1 ページ 1 色の複数ページ TIFF を作る"""
+    frames = [Image.new("RGB", (80, 60), color) for color in colors]
+    frames[0].save(path, save_all=True, append_images=frames[1:])
+
+
+def _take_all(spooler, timeout=10.0):
+    """全ページを受け取る (release() はしない)"""
+    jobs, errors = [], []
+    deadline = time.monotonic() + timeout
+    while not spooler.exhausted and time.monotonic() < deadline:
+        taken_jobs, taken_errors = spooler.take()
+        jobs += taken_jobs
+        errors += taken_errors
+        time.sleep(0.01)
+    assert spooler.exhausted
+    return jobs, errors
+
+
+def test_page_sheet_id():
+    assert page_source.page_sheet_id("1組.pdf", 12) == "1組.pdf#12"
+
+
+def test_same_stem_sources_do_not_share_files(tmp_path):
+    input_dir = tmp_path / "in"
+    output_dir = tmp_path / "out"
+    input_dir.mkdir()
+    _write_pdf(input_dir / "cls.pdf", [(255, 0, 0), (0, 255, 0)])
+    _write_tiff(str(input_dir / "cls.tif"), [(0, 0, 255), (255, 255, 0)])
+    expected_colors = {"cls.pdf#1": (255, 0, 0), "cls.pdf#2": (0, 255, 0),
+                       "cls.tif#1": (0, 0, 255), "cls.tif#2": (255, 255, 0)}
+
+    source_files = page_source.find_multipage_files(str(input_dir))
+    assert source_files == ["cls.pdf", "cls.tif"]
+    spooler = page_source.PageSpooler(str(input_dir), str(output_dir), source_files, dpi=None, max_ahead=10)
+    spooler.start()
+    jobs, errors = _take_all(spooler)
+
+    assert errors == []
+    assert sorted(job.sheet_id for job in jobs) == sorted(expected_colors)
+    assert len({job.image_path for job in jobs}) == 4 # 一時ファイルが上書きされていない
+    assert len({job.output_path for job in jobs}) == 4
+    for job in jobs:
+        with Image.open(job.image_path) as page:
+            red, green, blue = page.convert("RGB").getpixel((40, 30))
+        expected = expected_colors[job.sheet_id]
+        assert all(abs(a - b) <= 8 for a, b in zip((red, green, blue), expected)), job.sheet_id # PDF は JPEG のため誤差を許す
+
+    for job in jobs: # 採点済み画像の代わりに一時ファイルをそのまま出力として置く
+        os.makedirs(os.path.dirname(job.output_path), exist_ok=True)
+        Image.open(job.image_path).save(job.output_path)
+        spooler.release(job.sheet_id)
+        assert not os.path.exists(job.image_path)
+    assembled = {os.path.basename(path): count for path, count, missing in spooler.assemble()}
+    assert assembled == {"marked_cls.pdf": 2, "marked_cls.tif": 2}
+    with Image.open(output_dir / "marked_cls.tif") as tiff:
+        tiff.seek(1)
+        assert tiff.convert("RGB").getpixel((40, 30)) == (255, 255, 0) # TIFF の 2 ページ目 (PDF のページではない)
+
+
+def test_spooler_waits_for_release(tmp_path):
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    _write_tiff(str(input_dir / "many.tif"), [(i * 20, 0, 0) for i in range(6)])
+    spooler = page_source.PageSpooler(str(input_dir), str(tmp_path / "out"), ["many.tif"], dpi=None, max_ahead=2)
+    spooler.start()
+    time.sleep(0.3)
+    jobs, _ = spooler.take()
+    assert len(jobs) == 2 # release() されるまで 3 ページ目を読まない
+    for job in jobs:
+        spooler.release(job.sheet_id)
+    taken = list(jobs)
+    deadline = time.monotonic() + 10
+    while not spooler.exhausted and time.monotonic() < deadline:
+        new_jobs, _ = spooler.take()
+        for job in new_jobs:
+            spooler.release(job.sheet_id)
+        taken += new_jobs
+        time.sleep(0.01)
+    assert [job.sheet_id for job in taken] == [f"many.tif#{i}" for i in range(1, 7)]
@@ -0,0 +1,71 @@
+from PIL import Image, ImageOps
+
+from layout import Layout
+from preprocess_image import EXIF_ORIENTATION_TAG, layout_bounding_box, layout_crop_options, preprocess_for_upload
+
+MARK = Image.new("RGBA", (10, 10), (255, 0, 0, 255))
+
+
+def make_layout(problems, template_path=None):
+    position_data = {"問題位置情報": problems}
+    if template_path:
+        position_data["テンプレート画像"] = template_path
+    return Layout(position_data, MARK, MARK)
+
+
+def test_box_uses_problem_regions():
+    sheet_layout = make_layout([
+        {"問題番号": 1, "正解位置": {"x": 300, "y": 100}, "問題領域": {"x1": 40, "y1": 60, "x2": 360, "y2": 140}},
+        {"問題番号": 2, "正解位置": {"x": 300, "y": 200}, "問題領域": {"x1": 40, "y1": 160, "x2": 380, "y2": 240}},
+    ])
+    assert layout_bounding_box(sheet_layout, (800, 600), margin=10) == (30, 50, 390, 250)
+
+
+def test_box_keeps_question_text_without_regions():
+    # 正解位置は右側にあり、問題文はその左 (位置情報JSONに問題領域がない)
+    sheet_layout = make_layout([{"問題番号": 1, "正解位置": {"x": 222, "y": 38}},
+                                {"問題番号": 2, "正解位置": {"x": 242, "y": 110}},
+                                {"問題番号": 3, "正解位置": {"x": 234, "y": 180}}])
+    left, top, right, bottom = layout_bounding_box(sheet_layout, (279, 198))
+    assert left == 0 and right == 279 # 左右に問題がなければ端まで含める
+
+
+def test_crop_box_follows_sheet_resolution(tmp_path):
+    template_path = tmp_path / "template.png"
+    Image.new("RGB", (400, 300), "white").save(template_path)
+    sheet_layout = make_layout([
+        {"問題番号": 1, "正解位置": {"x": 300, "y": 100}, "問題領域": {"x1": 100, "y1": 50, "x2": 350, "y2": 150}},
+    ], template_path=str(template_path))
+    crop_options = layout_crop_options(sheet_layout, margin=0)
+    assert crop_options == {"crop_box": [100, 50, 350, 150], "crop_reference_size": [400, 300]}
+
+    sheet = Image.new("RGB", (800, 600), "white") # テンプレートの 2 倍の解像度でスキャンしたシート
+    result = preprocess_for_upload(sheet, max_long_edge=None, **crop_options)
+    assert result.image.size == (500, 200)
+    assert (result.offset_x, result.offset_y) == (200, 100)
+    assert result.to_original(0, 0) == (200, 100)
+    processed_x, processed_y = result.to_processed(600, 200) # 正解位置 (シートの座標) は切り抜いた範囲に入る
+    assert 0 <= processed_x < result.image.width and 0 <= processed_y < result.image.height
+
+
+def test_crop_box_follows_exif_rotation(tmp_path):
+    # スマートフォンで横向きに撮った写真: 画素は 400x300 のまま保存され、Orientation=6 (時計回りに 90 度) で表示する
+    photo = Image.new("RGB", (400, 300), "white")
+    photo.paste((0, 0, 0), (100, 50, 350, 150)) # 問題の範囲 (位置情報と同じ、回転前の座標)
+    exif = photo.getexif()
+    exif[EXIF_ORIENTATION_TAG] = 6
+    photo_path = tmp_path / "photo.jpg"
+    photo.save(photo_path, exif=exif.tobytes(), quality=95)
+
+    sheet_layout = make_layout([
+        {"問題番号": 1, "正解位置": {"x": 300, "y": 100}, "問題領域": {"x1": 100, "y1": 50, "x2": 350, "y2": 150}},
+    ])
+    crop_options = layout_crop_options(sheet_layout, reference_image_path=str(photo_path), margin=0)
+    assert crop_options["crop_reference_size"] == [400, 300] # 回転前の大きさ
+
+    with Image.open(photo_path) as sheet:
+        result = preprocess_for_upload(sheet, max_long_edge=None, **crop_options)
+    assert result.image.size == (100, 250) # 回転後の向きで、問題の範囲だけが残る
+    assert result.image.getextrema()[1] < 64 # 白い部分 (範囲の外) を含まない
+    with Image.open(photo_path) as sheet:
+        assert ImageOps.exif_transpose(sheet).size == (300, 400)
@@ -0,0 +1,46 @@
+import os
+
+from result_cache import ResultCache
+
+RESULTS = {"1": True, "2": False}
+
+
+def test_put_does_not_scan_below_the_limit(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path), max_entries=100)
+    scans = []
+    monkeypatch.setattr(cache, "_evict", lambda: scans.append(1))
+    for i in range(50):
+        cache.put(f"key{i}", RESULTS)
+    cache.put("key0", RESULTS) # 同じキーの上書きは数えない
+    assert scans == []
+    assert cache.entry_count == 50
+    assert cache.total_bytes == sum(os.path.getsize(tmp_path / f"key{i}.json") for i in range(50))
+
+
+def test_evicts_least_recently_used_down_to_the_low_water_mark(tmp_path):
+    cache = ResultCache(str(tmp_path), max_entries=10)
+    for i in range(10):
+        cache.put(f"key{i}", RESULTS)
+        os.utime(tmp_path / f"key{i}.json", (1000 + i, 1000 + i))
+    assert cache.get("key0") == RESULTS # 使ったエントリは新しくなる
+
+    cache.put("key10", RESULTS)
+    assert cache.entry_count == len(os.listdir(tmp_path)) == 9 # 上限の 9 割まで減らす
+    assert cache.evictions == 2
+    assert cache.get("key1") is None and cache.get("key2") is None
+    assert cache.get("key0") == RESULTS
+
+
+def test_size_limit_counts_bytes(tmp_path):
+    cache = ResultCache(str(tmp_path), max_entries=1000, max_bytes=2000)
+    big_results = {str(number): True for number in range(40)} # 1 エントリ数百バイト
+    for i in range(20):
+        cache.put(f"key{i}", big_results)
+        assert cache.total_bytes <= 2000
+    assert cache.total_bytes == sum(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path))
+
+    reopened = ResultCache(str(tmp_path), max_entries=1000, max_bytes=2000) # 既存のフォルダは起動時に数える
+    assert (reopened.entry_count, reopened.total_bytes) == (cache.entry_count, cache.total_bytes)
+    reopened.invalidate("key19")
+    reopened.clear()
+    assert (reopened.entry_count, reopened.total_bytes) == (0, 0)
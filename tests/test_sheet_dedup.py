@@ -0,0 +1,83 @@
+import json
+import os
+import random
+
+from PIL import Image, ImageDraw
+
+from grading_pipeline import SheetJob
+from sheet_dedup import SheetDeduplicator
+
+RESULTS = {"1": True, "2": False}
+
+
+def make_sheet(seed, size=(600, 800)):
+    """特徴点が取れるよう、線と四角をばらまいたシート画像"""
+    rng = random.Random(seed)
+    image = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(image)
+    for _ in range(120):
+        x, y = rng.randrange(size[0] - 40), rng.randrange(size[1] - 40)
+        if rng.random() < 0.5:
+            draw.rectangle((x, y, x + rng.randrange(5, 40), y + rng.randrange(5, 40)), outline=0, width=2)
+        else:
+            draw.line((x, y, x + rng.randrange(-40, 40), y + rng.randrange(-40, 40)), fill=0, width=3)
+    return image
+
+
+def page_job(tmp_path, tiff_path, page_number, page):
+    """PageSpooler と同じく、ページを一時ファイルに書き出したシート"""
+    spool_path = tmp_path / f"spool_{page_number}.png"
+    page.save(spool_path)
+    job = SheetJob(f"{tiff_path.name}#{page_number}", str(spool_path), f"marked_{page_number}.png")
+    job.source_path, job.page_number = str(tiff_path), page_number
+    return job
+
+
+def test_spooled_pages_are_verified_from_the_source_across_runs(tmp_path):
+    sheet = make_sheet(1)
+    tiff_path = tmp_path / "scan.tif"
+    sheet.save(tiff_path, save_all=True, append_images=[make_sheet(2)], dpi=(200, 200))
+    index_path = str(tmp_path / "sheet_index.jsonl")
+
+    first_run = SheetDeduplicator("layout", index_path=index_path)
+    job = page_job(tmp_path, tiff_path, 1, sheet)
+    first_run.track([job])
+    assert first_run.grade(job.image_path, lambda image_path: dict(RESULTS)) == RESULTS
+    os.remove(job.image_path) # 採点後に一時ファイルは消える
+
+    with open(index_path, encoding="utf-8") as f:
+        entry = json.loads(f.readline())
+    assert entry["sheet"] == "scan.tif#1"
+    assert (entry["source"], entry["page"]) == (os.path.abspath(tiff_path), 1)
+
+    rescan_path = tmp_path / "rescan.png" # 同じシートを別の実行で再スキャン
+    sheet.save(rescan_path)
+    second_run = SheetDeduplicator("layout", index_path=index_path)
+    second_run.track([SheetJob("rescan.png", str(rescan_path), "marked_rescan.png")])
+    graded = []
+    assert second_run.grade(str(rescan_path), lambda image_path: graded.append(image_path)) == RESULTS
+    assert graded == [] # 元のページを PDF / TIFF から読んで照合し、API は呼ばない
+    assert second_run.stats["rejected"] == 0
+
+    report = second_run.report()
+    assert report["groups"] == [{"original": "scan.tif#1", "source": os.path.abspath(tiff_path), "page": 1,
+                                 "previous_run": True,
+                                 "duplicates": [dict(report["groups"][0]["duplicates"][0], sheet="rescan.png")]}]
+    assert "scan.tif#1" in second_run.format_summary()
+
+
+def test_duplicate_pages_in_one_run_are_reported_by_sheet_id(tmp_path):
+    sheet = make_sheet(3)
+    tiff_path = tmp_path / "double_fed.tif"
+    sheet.save(tiff_path, save_all=True, append_images=[sheet], dpi=(200, 200))
+    deduplicator = SheetDeduplicator("layout")
+    jobs = [page_job(tmp_path, tiff_path, page_number, sheet) for page_number in (1, 2)]
+    deduplicator.track(jobs)
+
+    calls = []
+    for job in jobs:
+        assert deduplicator.grade(job.image_path, lambda image_path: calls.append(image_path) or dict(RESULTS)) == RESULTS
+    assert len(calls) == 1
+    group = deduplicator.report()["groups"][0]
+    assert group["original"] == "double_fed.tif#1"
+    assert [match["sheet"] for match in group["duplicates"]] == ["double_fed.tif#2"]
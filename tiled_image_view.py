@@ -0,0 +1,280 @@
+import collections
+import math
+
+from PIL import Image, ImageTk
+
+TILE_SIZE = 256 # 表示タイルの一辺 (画面上のピクセル)
+DEFAULT_CACHE_TILES = 128 # 保持するタイル (PhotoImage) の最大数
+MIN_ZOOM = 1 / 32
+MAX_ZOOM = 8.0
+ZOOM_STEP = 1.25 # 拡大・縮小 1 回分の倍率
+
+
+class ImagePyramid:
+    """
+    画像を一度だけデコードし、縦横 1/2 ずつ縮小した段 (ピラミッド) から任意の倍率の表示範囲を切り出す
+
+    縮小した段は必要になった時点で 1 つ上の段から作るため、全体表示だけなら最も粗い段までの
+    縮小 (Image.reduce) だけで済む。全段を合わせても元画像の約 4/3 倍のメモリに収まる。
+
+    Args:
+        image:    元画像 (PIL Image)
+        min_size: 最も粗い段の長辺 (これ以下になるまで縮小する)
+    """
+
+    def __init__(self, image, min_size=TILE_SIZE):
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+        self.width, self.height = image.size
+        self._levels = [image]
+        self.level_count = 1
+        while max(self.width, self.height) / 2 ** (self.level_count - 1) > min_size:
+            self.level_count += 1
+
+    @classmethod
+    def open(cls, path):
+        """
+        画像ファイルを開いてピラミッドを作る
+
+        Raises:
+            FileNotFoundError, PIL.UnidentifiedImageError: Image.open と同じ
+        """
+        image = Image.open(path)
+        image.load() # ここで一度だけデコードする
+        return cls(image)
+
+    def level(self, index):
+        """index 段目の画像 (0 が元画像, 1 段ごとに縦横 1/2) を返す"""
+        index = min(max(0, index), self.level_count - 1)
+        while len(self._levels) <= index:
+            self._levels.append(self._levels[-1].reduce(2))
+        return self._levels[index]
+
+    def level_for_zoom(self, zoom):
+        """表示倍率 zoom で使う段 (zoom 以上の解像度を持つ最も粗い段) を返す"""
+        if zoom >= 1:
+            return 0
+        return min(self.level_count - 1, int(math.floor(math.log2(1 / zoom) + 1e-9)))
+
+    def render(self, zoom, box):
+        """
+        表示倍率 zoom で、表示座標の範囲 box を画像にする
+
+        Args:
+            zoom: 表示倍率 (1.0 で元画像の等倍)
+            box:  表示座標の範囲 (x1, y1, x2, y2)
+
+        Returns:
+            PIL.Image: box の大きさの画像
+        """
+        index = self.level_for_zoom(zoom)
+        level_image = self.level(index)
+        factor = zoom * 2 ** index # 段の画像から表示への倍率
+        x1, y1, x2, y2 = box
+        source_box = (x1 / factor, y1 / factor, min(x2 / factor, level_image.width), min(y2 / factor, level_image.height))
+        size = (max(1, round((source_box[2] - source_box[0]) * factor)), max(1, round((source_box[3] - source_box[1]) * factor)))
+        resample = Image.NEAREST if factor >= 2 else Image.BILINEAR # 大きく拡大した場合は画素が見えるように
+        return level_image.resize(size, resample, box=source_box)
+
+
+class TiledImageView:
+    """
+    Canvas に ImagePyramid を表示する (見えている範囲のタイルだけを PhotoImage にする)
+
+    スクロール・拡大縮小・ウィンドウサイズの変更のたびに、見えている範囲のタイルを作って配置し、
+    範囲外に出たタイルは Canvas から取り除く。作ったタイルは最近使った順に DEFAULT_CACHE_TILES 枚まで
+    保持するため、大きな画像でもメモリ使用量は画面の大きさ程度に収まる。
+    Canvas 座標は表示倍率をかけた座標なので、元画像の座標との変換には to_image / to_canvas を使う。
+
+    Args:
+        canvas:      表示先の Canvas
+        xscrollbar:  横スクロールバー (省略可)
+        yscrollbar:  縦スクロールバー (省略可)
+        on_zoom:     表示倍率が変わった時に呼ぶ関数 (引数なし。Canvas 上の図形を描き直す場合に使う)
+        cache_tiles: 保持するタイルの最大数
+    """
+
+    def __init__(self, canvas, xscrollbar=None, yscrollbar=None, on_zoom=None, cache_tiles=DEFAULT_CACHE_TILES):
+        self.canvas = canvas
+        self.xscrollbar = xscrollbar
+        self.yscrollbar = yscrollbar
+        self.on_zoom = on_zoom
+        self.cache_tiles = cache_tiles
+        self.pyramid = None
+        self.zoom = 1.0
+        self._tiles = collections.OrderedDict() # (倍率, 列, 行) -> PhotoImage (最近使った順)
+        self._items = {} # (列, 行) -> Canvas 上の画像 ID (現在の倍率で配置中のもの)
+        self._render_pending = False
+
+        canvas.config(xscrollcommand=self._on_xscroll, yscrollcommand=self._on_yscroll)
+        canvas.bind("<Configure>", lambda event: self.schedule_render(), add="+")
+        canvas.bind("<MouseWheel>", self._on_mouse_wheel, add="+") # Windows / macOS
+        canvas.bind("<Button-4>", self._on_mouse_wheel, add="+") # Linux (上)
+        canvas.bind("<Button-5>", self._on_mouse_wheel, add="+") # Linux (下)
+
+    def set_image(self, pyramid, zoom=None):
+        """
+        表示する画像を切り替える
+
+        Args:
+            pyramid: ImagePyramid
+            zoom:    表示倍率 (省略時はウィンドウに収まる倍率, ただし等倍以下)
+        """
+        self.pyramid = pyramid
+        self._clear_tiles()
+        self._tiles.clear()
+        self.set_zoom(zoom if zoom is not None else self.fit_zoom())
+        self.canvas.xview_moveto(0)
+        self.canvas.yview_moveto(0)
+
+    def fit_zoom(self):
+        """画像全体がウィンドウに収まる表示倍率 (等倍以下)"""
+        if self.pyramid is None:
+            return 1.0
+        width = max(1, self.canvas.winfo_width())
+        height = max(1, self.canvas.winfo_height())
+        if width <= 1 or height <= 1: # まだウィンドウが表示されていない
+            return 1.0
+        return min(1.0, width / self.pyramid.width, height / self.pyramid.height)
+
+    def set_zoom(self, zoom, anchor=None):
+        """
+        表示倍率を変える
+
+        Args:
+            zoom:   新しい表示倍率 (MIN_ZOOM〜MAX_ZOOM に収める)
+            anchor: 倍率を変えても動かさない点 (Canvas ウィジェット上の座標 (x, y), 省略時は中央)
+        """
+        zoom = min(MAX_ZOOM, max(MIN_ZOOM, zoom))
+        if self.pyramid is None:
+            self.zoom = zoom
+            return
+        if anchor is None:
+            anchor = (self.canvas.winfo_width() / 2, self.canvas.winfo_height() / 2)
+        image_x, image_y = self.to_image(self.canvas.canvasx(anchor[0]), self.canvas.canvasy(anchor[1]), clamp=False)
+
+        if zoom != self.zoom:
+            self._clear_tiles()
+        self.zoom = zoom
+        scroll_width = self.pyramid.width * zoom
+        scroll_height = self.pyramid.height * zoom
+        self.canvas.config(scrollregion=(0, 0, scroll_width, scroll_height))
+        self.canvas.xview_moveto(max(0.0, (image_x * zoom - anchor[0]) / scroll_width))
+        self.canvas.yview_moveto(max(0.0, (image_y * zoom - anchor[1]) / scroll_height))
+        if self.on_zoom is not None:
+            self.on_zoom()
+        self.schedule_render()
+
+    def zoom_by(self, factor, anchor=None):
+        """表示倍率を factor 倍にする"""
+        self.set_zoom(self.zoom * factor, anchor)
+
+    def to_image(self, canvas_x, canvas_y, clamp=True):
+        """Canvas 座標を元画像の座標 (ピクセル) に変換する"""
+        x = canvas_x / self.zoom
+        y = canvas_y / self.zoom
+        if clamp and self.pyramid is not None:
+            x = min(max(0, x), self.pyramid.width - 1)
+            y = min(max(0, y), self.pyramid.height - 1)
+        return x, y
+
+    def to_canvas(self, image_x, image_y):
+        """元画像の座標を Canvas 座標に変換する"""
+        return image_x * self.zoom, image_y * self.zoom
+
+    def schedule_render(self):
+        """タイルの配置を予約する (連続したスクロールでも 1 回にまとめる)"""
+        if not self._render_pending:
+            self._render_pending = True
+            self.canvas.after_idle(self.render)
+
+    def render(self):
+        """見えている範囲のタイルを配置し、範囲外のタイルを取り除く"""
+        self._render_pending = False
+        if self.pyramid is None:
+            return
+        scroll_width = self.pyramid.width * self.zoom
+        scroll_height = self.pyramid.height * self.zoom
+        left = max(0.0, self.canvas.canvasx(0))
+        top = max(0.0, self.canvas.canvasy(0))
+        right = min(scroll_width, self.canvas.canvasx(self.canvas.winfo_width()))
+        bottom = min(scroll_height, self.canvas.canvasy(self.canvas.winfo_height()))
+
+        visible = set()
+        for row in range(int(top // TILE_SIZE), int(math.ceil(bottom / TILE_SIZE))):
+            for col in range(int(left // TILE_SIZE), int(math.ceil(right / TILE_SIZE))):
+                visible.add((col, row))
+
+        for position in list(self._items):
+            if position not in visible:
+                self.canvas.delete(self._items.pop(position))
+        for col, row in sorted(visible):
+            tile = self._tile(col, row, scroll_width, scroll_height)
+            if (col, row) not in self._items:
+                self._items[(col, row)] = self.canvas.create_image(col * TILE_SIZE, row * TILE_SIZE, image=tile,
+                                                                   anchor="nw", tags="tile")
+        self.canvas.tag_lower("tile") # ドラッグ中の矩形などを画像より手前に表示
+
+        limit = max(self.cache_tiles, len(visible) * 2) # 表示中のタイルは捨てない
+        while len(self._tiles) > limit:
+            self._tiles.popitem(last=False)
+
+    def _tile(self, col, row, scroll_width, scroll_height):
+        """現在の倍率のタイル (PhotoImage) を返す (キャッシュになければ作る)"""
+        key = (self.zoom, col, row)
+        tile = self._tiles.get(key)
+        if tile is None:
+            box = (col * TILE_SIZE, row * TILE_SIZE,
+                   min((col + 1) * TILE_SIZE, scroll_width), min((row + 1) * TILE_SIZE, scroll_height))
+            tile = ImageTk.PhotoImage(self.pyramid.render(self.zoom, box), master=self.canvas)
+            self._tiles[key] = tile
+        else:
+            self._tiles.move_to_end(key)
+        return tile
+
+    def _clear_tiles(self):
+        """配置中のタイルを Canvas から取り除く"""
+        self.canvas.delete("tile")
+        self._items.clear()
+
+    def _on_xscroll(self, first, last):
+        """横スクロール時 (スクロールバーを更新してタイルを配置し直す)"""
+        if self.xscrollbar is not None:
+            self.xscrollbar.set(first, last)
+        self.schedule_render()
+
+    def _on_yscroll(self, first, last):
+        """縦スクロール時 (スクロールバーを更新してタイルを配置し直す)"""
+        if self.yscrollbar is not None:
+            self.yscrollbar.set(first, last)
+        self.schedule_render()
+
+    def _on_mouse_wheel(self, event):
+        """マウスホイール: 縦スクロール (Shift で横スクロール, Ctrl で拡大・縮小)"""
+        up = event.num == 4 or getattr(event, "delta", 0) > 0
+        if event.state & 0x0004: # Ctrl
+            self.zoom_by(ZOOM_STEP if up else 1 / ZOOM_STEP, anchor=(event.x, event.y))
+        elif event.state & 0x0001: # Shift
+            self.canvas.xview_scroll(-1 if up else 1, "units")
+        else:
+            self.canvas.yview_scroll(-1 if up else 1, "units")
+        return "break"
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    import sys
+    import time
+
+    if len(sys.argv) < 2:
+        print("使い方: python tiled_image_view.py 画像ファイル")
+        sys.exit(1)
+    start = time.perf_counter()
+    example_pyramid = ImagePyramid.open(sys.argv[1])
+    print(f"デコード: {(time.perf_counter() - start) * 1000:.0f} ms ({example_pyramid.width}x{example_pyramid.height}, "
+          f"{example_pyramid.level_count} 段)")
+    for example_zoom in (0.1, 0.5, 1.0, 2.0):
+        start = time.perf_counter()
+        example_tile = example_pyramid.render(example_zoom, (0, 0, TILE_SIZE, TILE_SIZE))
+        print(f"倍率 {example_zoom}: 段 {example_pyramid.level_for_zoom(example_zoom)}, タイル {example_tile.size}, "
+              f"{(time.perf_counter() - start) * 1000:.1f} ms")
@@ -0,0 +1,217 @@
+import collections
+import json
+import os
+import threading
+import time
+
+# 処理段の表示順 (集計表示・エクスポートで使う)
+STAGES = ["load", "preprocess", "local_ocr", "api", "parse", "register", "composite", "encode", "write", "sheet"]
+
+
+class _Span:
+    """with 文で使う計測区間 (終了時に Tracer に記録する)"""
+
+    __slots__ = ("tracer", "name", "sheet", "fields", "start")
+
+    def __init__(self, tracer, name, sheet, fields):
+        self.tracer = tracer
+        self.name = name
+        self.sheet = sheet
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.fields # with 文の中でバイト数やトークン数を追加できる
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None:
+            self.fields["error"] = exc_type.__name__
+        self.tracer.record(self.name, self.start, time.perf_counter(), self.sheet, **self.fields)
+        return False
+
+
+class _NullSpan:
+    """計測無効時の何もしない計測区間"""
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """
+    シートごと・処理段ごとの所要時間 (スパン) を記録する軽量なトレーサー
+
+    各段の処理を with tracer.span("api", sheet=画像パス) as fields: で囲むと、開始・終了時刻と
+    スレッド、fields に追加した値 (バイト数・トークン数など) が 1 件のスパンとして記録される。
+    スパンは最新の max_spans 件だけを保持し、JSONL または Chrome のトレース形式
+    (chrome://tracing, Perfetto で表示可能) で書き出せる。
+
+    Args:
+        enabled:   False の場合は何も記録しない (計測のオーバーヘッドをなくす)
+        max_spans: 保持する最大スパン数 (古いものから捨てる)
+    """
+
+    def __init__(self, enabled=True, max_spans=100_000):
+        self.enabled = enabled
+        self.origin = time.perf_counter() # スパンの時刻はこの時点からの経過秒で記録
+        self._spans = collections.deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def span(self, name, sheet=None, **fields):
+        """計測区間を返す (with 文で使う)"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, sheet, fields)
+
+    def record(self, name, start, end, sheet=None, **fields):
+        """
+        計測済みの区間を記録する (別スレッドで計測した時間をまとめて記録する場合など)
+
+        Args:
+            name:   処理段の名前 (STAGES のいずれか)
+            start:  開始時刻 (time.perf_counter)
+            end:    終了時刻 (time.perf_counter)
+            sheet:  シート (画像パス)
+            fields: 追加情報 (bytes, tokens など)
+        """
+        if not self.enabled:
+            return
+        span = {"name": name, "sheet": sheet, "start": start - self.origin, "duration": end - start,
+                "thread": threading.current_thread().name}
+        span.update(fields)
+        with self._lock:
+            self._spans.append(span)
+
+    def spans(self):
+        """記録済みのスパンのリスト (コピー)"""
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        """記録済みのスパンを全て捨て、時刻の基準をリセット"""
+        with self._lock:
+            self._spans.clear()
+            self.origin = time.perf_counter()
+
+    def summary(self):
+        """
+        処理段ごとの集計を返す
+
+        Returns:
+            dict: {"sheets", "sheets_per_minute", "stages": {段の名前: {"count", "p50", "p95", "total", "bytes", "tokens"}}}
+        """
+        spans = self.spans()
+        durations = collections.defaultdict(list)
+        totals = collections.defaultdict(lambda: {"bytes": 0, "tokens": 0})
+        for span in spans:
+            durations[span["name"]].append(span["duration"])
+            totals[span["name"]]["bytes"] += span.get("bytes", 0) or 0
+            totals[span["name"]]["tokens"] += span.get("tokens", 0) or 0
+
+        stages = {}
+        for name in sorted(durations, key=lambda n: STAGES.index(n) if n in STAGES else len(STAGES)):
+            values = sorted(durations[name])
+            stages[name] = {
+                "count": len(values),
+                "p50": _percentile(values, 0.50),
+                "p95": _percentile(values, 0.95),
+                "total": sum(values),
+                "bytes": totals[name]["bytes"],
+                "tokens": totals[name]["tokens"],
+            }
+
+        sheet_spans = [span for span in spans if span["name"] == "sheet"]
+        sheets_per_minute = 0.0
+        if sheet_spans:
+            first_start = min(span["start"] for span in sheet_spans)
+            last_end = max(span["start"] + span["duration"] for span in sheet_spans)
+            if last_end > first_start:
+                sheets_per_minute = len(sheet_spans) / (last_end - first_start) * 60
+        return {"sheets": len(sheet_spans), "sheets_per_minute": sheets_per_minute, "stages": stages}
+
+    def format_summary(self):
+        """summary() を表示用の文字列 (1 行 1 段) にする"""
+        summary = self.summary()
+        lines = [f"完了 {summary['sheets']} 枚  スループット {summary['sheets_per_minute']:.1f} 枚/分"]
+        for name, stage in summary["stages"].items():
+            line = (f"{name:<10} {stage['count']:>6} 回  p50 {stage['p50'] * 1000:8.1f} ms  "
+                    f"p95 {stage['p95'] * 1000:8.1f} ms")
+            if stage["bytes"]:
+                line += f"  {stage['bytes'] / 1024:10,.0f} KB"
+            if stage["tokens"]:
+                line += f"  {stage['tokens']:,} トークン"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def export_jsonl(self, path):
+        """スパンを JSONL (1 行 1 スパン) で書き出す"""
+        with open(path, 'w', encoding='utf-8') as f:
+            for span in self.spans():
+                f.write(json.dumps(span, ensure_ascii=False) + "\n")
+
+    def export_chrome_trace(self, path):
+        """スパンを Chrome のトレース形式 (JSON) で書き出す (chrome://tracing や Perfetto で表示)"""
+        thread_ids = {}
+        events = []
+        for span in self.spans():
+            tid = thread_ids.setdefault(span["thread"], len(thread_ids) + 1)
+            args = {key: value for key, value in span.items() if key not in ("name", "start", "duration", "thread")}
+            events.append({"name": span["name"], "cat": "grading", "ph": "X", "pid": os.getpid(), "tid": tid,
+                           "ts": round(span["start"] * 1_000_000), "dur": round(span["duration"] * 1_000_000),
+                           "args": args})
+        for thread_name, tid in thread_ids.items(): # スレッド名を表示するためのメタデータ
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                           "args": {"name": thread_name}})
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+    def export(self, path):
+        """拡張子に応じて書き出す (.jsonl は JSONL, それ以外は Chrome のトレース形式)"""
+        if path.endswith(".jsonl"):
+            self.export_jsonl(path)
+        else:
+            self.export_chrome_trace(path)
+
+
+def _percentile(sorted_values, fraction):
+    """ソート済みの値の百分位数 (最近傍法)"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+_tracer = Tracer(enabled=False) # 既定では計測しない
+
+
+def get_tracer():
+    """現在のトレーサーを返す (各処理段はこれを使ってスパンを記録する)"""
+    return _tracer
+
+
+def set_tracer(tracer):
+    """トレーサーを切り替える (GUI やコマンドラインで計測を有効にする場合に呼ぶ)"""
+    global _tracer
+    _tracer = tracer
+    return tracer
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    example_tracer = set_tracer(Tracer())
+    for i in range(5):
+        with get_tracer().span("sheet", sheet=f"sheet_{i}.png"):
+            with get_tracer().span("api", sheet=f"sheet_{i}.png") as span_fields:
+                time.sleep(0.01 * (i + 1))
+                span_fields["tokens"] = 258
+            with get_tracer().span("composite", sheet=f"sheet_{i}.png"):
+                time.sleep(0.005)
+    print(example_tracer.format_summary())
+    example_tracer.export("trace_example.json")
+    print("Chrome のトレース形式で trace_example.json に保存しました")
@@ -0,0 +1,440 @@
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from PIL import Image
+
+from grading_pipeline import SheetJob
+
+DEFAULT_LEASE_SECONDS = 300.0 # リースの期限 (秒)。ワーカーが止まった場合、この時間が過ぎるとジョブは待ち行列に戻る
+DEFAULT_MAX_ATTEMPTS = 5 # 1 枚あたりの最大試行回数 (これを超えて失敗・期限切れになったジョブは failed)
+DEFAULT_RETRY_DELAY = 10.0 # 失敗したジョブを再び取り出せるようにするまでの待ち時間 (秒, 試行ごとに倍)
+REQUEST_BUDGET = "requests" # API リクエスト数の共有レート制限の名前
+JOB_STATES = ("queued", "leased", "done", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS layouts (
+    id INTEGER PRIMARY KEY,
+    fingerprint TEXT UNIQUE NOT NULL,
+    position_json TEXT NOT NULL,
+    correct_mark BLOB NOT NULL,
+    incorrect_mark BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    sheet_id TEXT NOT NULL,
+    image_path TEXT UNIQUE NOT NULL,
+    output_path TEXT NOT NULL,
+    layout_id INTEGER NOT NULL REFERENCES layouts(id),
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_expires REAL,
+    results TEXT,
+    message TEXT,
+    elapsed REAL,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (state, available_at);
+CREATE TABLE IF NOT EXISTS budgets (
+    name TEXT PRIMARY KEY,
+    per_minute REAL NOT NULL,
+    capacity REAL NOT NULL,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class QueuedJob(SheetJob):
+    """待ち行列から取り出したジョブ (grading_pipeline.GradingPipeline にそのまま投入できる)"""
+
+    def __init__(self, job_id, sheet_id, image_path, output_path, layout_id, attempts):
+        super().__init__(sheet_id, image_path, output_path)
+        self.job_id = job_id # 待ち行列での ID
+        self.layout_id = layout_id # WorkQueue.load_layout() に渡す ID
+        self.attempts = attempts # 今回を含む試行回数
+
+
+class WorkQueue:
+    """
+    SQLite のファイル 1 つで作るジョブの待ち行列 (外部のサービスを使わずに、複数のプロセス・マシンで採点を分担する)
+
+    コーディネーターが位置情報JSONとマーク画像 (add_layout) とシート (enqueue) を登録し、
+    ワーカーは claim() でジョブにリース (期限付きの担当) を付けて取り出し、complete() / fail() で結果を書き戻す。
+    処理中は extend_leases() でリースを延長し、ワーカーが止まって期限が切れたジョブは、
+    次の claim() (または requeue_expired()) で自動的に待ち行列に戻る。
+
+    API のレート制限 (budgets) とワーカー共通の設定 (settings) も同じファイルに保存するため、
+    何台のワーカーで処理しても 1 分あたりのリクエスト数の上限を全体で守れる (SharedRateLimiter)。
+
+    接続はスレッドごとに作る。複数のマシンから使う場合は、ファイルロックが使える共有フォルダに置き、
+    wal=False (WAL は同じマシン内でしか使えない) にする。画像のパスも全マシンで同じパスで読める必要がある。
+
+    Args:
+        db_path: 待ち行列のファイルパス (なければ作成)
+        wal:     WAL モードを使うか (同じマシンのワーカーだけなら True の方が速い)
+        timeout: 他のプロセスが書き込み中の場合に待つ最大時間 (秒)
+    """
+
+    def __init__(self, db_path, wal=True, timeout=30.0):
+        self.db_path = db_path
+        self.wal = wal
+        self.timeout = timeout
+        self._local = threading.local() # スレッドごとの接続
+        self._layouts = {} # レイアウトID -> layout.Layout (読み込み済みのもの)
+        self._layouts_lock = threading.Lock()
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+
+    def _connection(self):
+        """このスレッドの接続を返す (なければ作成)"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None) # トランザクションは明示的に開始
+            connection.execute(f"PRAGMA journal_mode={'WAL' if self.wal else 'DELETE'}")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """書き込み用のトランザクション (開始時に書き込みロックを取り、他のワーカーと同じジョブを取り合わない)"""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def close(self):
+        """このスレッドの接続を閉じる"""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    # --- 設定 (全ワーカー共通) ---
+
+    def set_setting(self, name, value):
+        """ワーカー共通の設定を保存する (値は JSON で保存)"""
+        with self._transaction() as connection:
+            connection.execute("INSERT INTO settings (name, value) VALUES (?, ?) "
+                               "ON CONFLICT(name) DO UPDATE SET value = excluded.value", (name, json.dumps(value)))
+
+    def get_setting(self, name, default=None):
+        """ワーカー共通の設定を読み込む (未設定なら default)"""
+        row = self._connection().execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    # --- レイアウト ---
+
+    def add_layout(self, sheet_layout, json_path, correct_mark_path, incorrect_mark_path):
+        """
+        位置情報JSONとマーク画像を待ち行列に登録する (ワーカーは元のファイルがなくても同じレイアウトで合成できる)
+
+        Args:
+            sheet_layout: layout.Layout.load() で読み込んだ Layout (fingerprint で同じレイアウトの登録をまとめる)
+            json_path, correct_mark_path, incorrect_mark_path: 読み込んだファイルのパス
+        Returns:
+            int: レイアウトID
+        """
+        with open(json_path, 'r', encoding='utf-8') as f:
+            position_json = f.read()
+        with open(correct_mark_path, 'rb') as f:
+            correct_mark = f.read()
+        with open(incorrect_mark_path, 'rb') as f:
+            incorrect_mark = f.read()
+        with self._transaction() as connection:
+            connection.execute("INSERT OR IGNORE INTO layouts (fingerprint, position_json, correct_mark, incorrect_mark) "
+                               "VALUES (?, ?, ?, ?)", (sheet_layout.fingerprint, position_json, correct_mark, incorrect_mark))
+            return connection.execute("SELECT id FROM layouts WHERE fingerprint = ?",
+                                      (sheet_layout.fingerprint,)).fetchone()[0]
+
+    def load_layout(self, layout_id):
+        """
+        登録されたレイアウトを layout.Layout として返す (ワーカー内では 1 回だけ読み込んで使い回す)
+
+        Returns:
+            layout.Layout
+        """
+        import layout # NumPy を使うため、ワーカーでだけ読み込む
+
+        with self._layouts_lock:
+            sheet_layout = self._layouts.get(layout_id)
+        if sheet_layout is not None:
+            return sheet_layout
+        row = self._connection().execute("SELECT fingerprint, position_json, correct_mark, incorrect_mark FROM layouts "
+                                         "WHERE id = ?", (layout_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"レイアウトが登録されていません: {layout_id}")
+        fingerprint, position_json, correct_mark, incorrect_mark = row
+        marks = []
+        for mark_bytes in (correct_mark, incorrect_mark):
+            with Image.open(io.BytesIO(mark_bytes)) as mark_image:
+                marks.append(mark_image.convert("RGBA"))
+        sheet_layout = layout.Layout(json.loads(position_json), marks[0], marks[1], fingerprint)
+        with self._layouts_lock:
+            self._layouts[layout_id] = sheet_layout
+        return sheet_layout
+
+    # --- ジョブ ---
+
+    def enqueue(self, jobs, layout_id, requeue_done=False):
+        """
+        シートを待ち行列に追加する
+
+        同じ画像 (image_path) がすでにある場合、失敗したもの・レイアウトが変わったものは待ち行列に戻し、
+        完了済みのものは requeue_done=True の場合だけ採点し直す。処理中のものはそのままにする。
+
+        Args:
+            jobs:         grading_pipeline.SheetJob のリスト (grading_pipeline.build_jobs で作成)
+            layout_id:    add_layout() の戻り値
+            requeue_done: 完了済みのシートも採点し直すか
+        Returns:
+            int: 待ち行列に入った (戻った) シートの数
+        """
+        now = time.time()
+        added = 0
+        with self._transaction() as connection:
+            for job in jobs:
+                cursor = connection.execute(
+                    "INSERT INTO jobs (sheet_id, image_path, output_path, layout_id, updated_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(image_path) DO UPDATE SET sheet_id = excluded.sheet_id, "
+                    "output_path = excluded.output_path, layout_id = excluded.layout_id, state = 'queued', attempts = 0, "
+                    "available_at = 0, lease_owner = NULL, lease_expires = NULL, message = NULL, updated_at = excluded.updated_at "
+                    "WHERE jobs.state = 'failed' OR (jobs.state != 'leased' AND jobs.layout_id != excluded.layout_id) "
+                    "OR (jobs.state = 'done' AND ?)",
+                    (job.sheet_id, os.path.abspath(job.image_path), os.path.abspath(job.output_path), layout_id, now,
+                     requeue_done))
+                added += cursor.rowcount
+        return added
+
+    def _requeue_expired(self, connection, now):
+        """期限切れのリースを待ち行列に戻す (試行回数を使い切ったジョブは failed)"""
+        max_attempts = self.get_setting("max_attempts", DEFAULT_MAX_ATTEMPTS)
+        cursor = connection.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+            "message = 'リースの期限切れ (ワーカーが停止した可能性があります)', "
+            "lease_owner = NULL, lease_expires = NULL, available_at = 0, updated_at = ? "
+            "WHERE state = 'leased' AND lease_expires < ?", (max_attempts, now, now))
+        return cursor.rowcount
+
+    def requeue_expired(self):
+        """
+        期限切れのリースを待ち行列に戻す (claim() でも毎回行う)
+
+        Returns:
+            int: 戻した (または試行回数を使い切って failed にした) ジョブの数
+        """
+        with self._transaction() as connection:
+            return self._requeue_expired(connection, time.time())
+
+    def claim(self, worker_id, limit=1):
+        """
+        待ち行列の先頭からジョブを取り出し、リースを付ける
+
+        Args:
+            worker_id: ワーカーの名前 (ホスト名:プロセスID など。リースの延長・完了の確認に使う)
+            limit:     取り出す最大数
+        Returns:
+            list: QueuedJob のリスト (取り出せるジョブがなければ空)
+        """
+        now = time.time()
+        lease_seconds = self.get_setting("lease_seconds", DEFAULT_LEASE_SECONDS)
+        with self._transaction() as connection:
+            self._requeue_expired(connection, now)
+            rows = connection.execute(
+                "SELECT id, sheet_id, image_path, output_path, layout_id, attempts FROM jobs "
+                "WHERE state = 'queued' AND available_at <= ? ORDER BY id LIMIT ?", (now, limit)).fetchall()
+            connection.executemany(
+                "UPDATE jobs SET state = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE id = ?", [(worker_id, now + lease_seconds, now, row[0]) for row in rows])
+        return [QueuedJob(job_id, sheet_id, image_path, output_path, layout_id, attempts + 1)
+                for job_id, sheet_id, image_path, output_path, layout_id, attempts in rows]
+
+    def extend_leases(self, worker_id, job_ids):
+        """
+        処理中のジョブのリースを延長する (ワーカーが生きていることを知らせる)
+
+        Returns:
+            int: 延長できたジョブの数 (期限切れで他のワーカーに渡ったものは含まない)
+        """
+        if not job_ids:
+            return 0
+        lease_expires = time.time() + self.get_setting("lease_seconds", DEFAULT_LEASE_SECONDS)
+        with self._transaction() as connection:
+            return sum(connection.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND state = 'leased' AND lease_owner = ?",
+                (lease_expires, job_id, worker_id)).rowcount for job_id in job_ids)
+
+    def complete(self, job_id, worker_id, problem_results, elapsed=0.0, message=None):
+        """
+        ジョブを完了にして正誤結果を書き戻す
+
+        リースが期限切れで待ち行列に戻っていても、まだ他のワーカーが取り出していなければ完了にする。
+
+        Returns:
+            bool: 書き戻せたか (他のワーカーが処理中・完了済みの場合は False)
+        """
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET state = 'done', results = ?, elapsed = ?, message = ?, lease_owner = NULL, "
+                "lease_expires = NULL, updated_at = ? WHERE id = ? AND "
+                "((state = 'leased' AND lease_owner = ?) OR state = 'queued')",
+                (json.dumps(problem_results, ensure_ascii=False), elapsed, message, time.time(), job_id,
+                 worker_id)).rowcount == 1
+
+    def fail(self, job_id, worker_id, message, elapsed=0.0):
+        """
+        ジョブの失敗を記録する (試行回数が残っていれば、待ち時間を置いて待ち行列に戻す)
+
+        Returns:
+            str: ジョブの新しい状態 ("queued" / "failed", 他のワーカーが処理中なら None)
+        """
+        now = time.time()
+        max_attempts = self.get_setting("max_attempts", DEFAULT_MAX_ATTEMPTS)
+        retry_delay = self.get_setting("retry_delay", DEFAULT_RETRY_DELAY)
+        with self._transaction() as connection:
+            row = connection.execute("SELECT attempts FROM jobs WHERE id = ? AND state = 'leased' AND lease_owner = ?",
+                                     (job_id, worker_id)).fetchone()
+            if row is None:
+                return None
+            state = "failed" if row[0] >= max_attempts else "queued"
+            connection.execute(
+                "UPDATE jobs SET state = ?, message = ?, elapsed = ?, available_at = ?, lease_owner = NULL, "
+                "lease_expires = NULL, updated_at = ? WHERE id = ?",
+                (state, message, elapsed, now + retry_delay * 2 ** (row[0] - 1), now, job_id))
+        return state
+
+    def release(self, worker_id):
+        """
+        ワーカーの終了時に、処理中のジョブを待ち行列に戻す (試行回数は増やさない)
+
+        Returns:
+            int: 戻したジョブの数
+        """
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET state = 'queued', attempts = MAX(attempts - 1, 0), lease_owner = NULL, "
+                "lease_expires = NULL, updated_at = ? WHERE state = 'leased' AND lease_owner = ?",
+                (time.time(), worker_id)).rowcount
+
+    def counts(self):
+        """
+        状態ごとのジョブ数
+
+        Returns:
+            dict: {"queued", "leased", "done", "failed", "expired" (期限切れのリース), "workers" (処理中のワーカー数)}
+        """
+        connection = self._connection()
+        counts = dict.fromkeys(JOB_STATES, 0)
+        counts.update(connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        counts["expired"], counts["workers"] = connection.execute(
+            "SELECT SUM(lease_expires < ?), COUNT(DISTINCT lease_owner) FROM jobs WHERE state = 'leased'",
+            (time.time(),)).fetchone()
+        counts["expired"] = counts["expired"] or 0
+        return counts
+
+    def finished_jobs(self):
+        """
+        完了・失敗したジョブを 1 件ずつ返す (結果ファイルの作成用)
+
+        Yields:
+            dict: {"sheet", "image_path", "output_path", "state", "results", "message", "elapsed", "attempts"}
+        """
+        cursor = self._connection().execute(
+            "SELECT sheet_id, image_path, output_path, state, results, message, elapsed, attempts FROM jobs "
+            "WHERE state IN ('done', 'failed') ORDER BY id")
+        for sheet_id, image_path, output_path, state, results, message, elapsed, attempts in cursor:
+            yield {"sheet": sheet_id, "image_path": image_path, "output_path": output_path, "state": state,
+                   "results": json.loads(results) if results else None, "message": message,
+                   "elapsed": elapsed or 0.0, "attempts": attempts}
+
+    # --- レート制限 ---
+
+    def set_budget(self, name, per_minute, burst=None):
+        """共有レート制限の上限を設定する (None で制限なし)"""
+        with self._transaction() as connection:
+            if per_minute is None:
+                connection.execute("DELETE FROM budgets WHERE name = ?", (name,))
+                return
+            capacity = burst or per_minute
+            connection.execute(
+                "INSERT INTO budgets (name, per_minute, capacity, tokens, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET per_minute = excluded.per_minute, capacity = excluded.capacity, "
+                "tokens = MIN(budgets.tokens, excluded.capacity)", (name, per_minute, capacity, capacity, time.time()))
+
+    def take_budget(self, name, amount=1):
+        """
+        共有レート制限から amount 分を消費する (足りなければ消費しない)
+
+        Returns:
+            float: 待つべき秒数 (0.0 なら消費済み。上限が設定されていなければ常に 0.0)
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute("SELECT per_minute, capacity, tokens, updated_at FROM budgets WHERE name = ?",
+                                     (name,)).fetchone()
+            if row is None:
+                return 0.0
+            per_minute, capacity, tokens, updated_at = row
+            amount = min(amount, capacity) # 上限を超える要求は満タンになるまで待てば通す
+            tokens = min(capacity, tokens + max(0.0, now - updated_at) * per_minute / 60.0)
+            wait = 0.0
+            if tokens >= amount:
+                tokens -= amount
+            else:
+                wait = (amount - tokens) * 60.0 / per_minute
+            connection.execute("UPDATE budgets SET tokens = ?, updated_at = ? WHERE name = ?", (tokens, now, name))
+        return wait
+
+
+class SharedRateLimiter:
+    """
+    WorkQueue に保存したトークンバケットで、全ワーカー (全プロセス・全マシン) のリクエスト数を制限する
+
+    grading_client.TokenBucket と同じ方式で、残量と補充時刻を待ち行列のファイルに保存する。
+    マシンの時計がずれていると補充量がずれるため、複数のマシンで使う場合は時刻を同期しておく。
+
+    Args:
+        work_queue: WorkQueue
+        name:       レート制限の名前 (WorkQueue.set_budget で上限を設定したもの)
+    """
+
+    def __init__(self, work_queue, name=REQUEST_BUDGET):
+        self.work_queue = work_queue
+        self.name = name
+        self.waited = 0.0 # 枠が空くのを待った合計時間 (秒)
+
+    def acquire(self, amount=1):
+        """amount 分の枠が空くまで待ってから消費する"""
+        while True:
+            wait = self.work_queue.take_budget(self.name, amount)
+            if wait <= 0.0:
+                return
+            self.waited += wait
+            time.sleep(wait) # 他のワーカーが先に使った場合はもう一度待つ
+
+
+# --- 実行例 ---
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        print("使い方: python work_queue.py 待ち行列ファイル (状態ごとのジョブ数を表示)")
+        sys.exit(1)
+    work_queue = WorkQueue(sys.argv[1])
+    print(f"期限切れで戻したジョブ: {work_queue.requeue_expired()} 件")
+    print(work_queue.counts())